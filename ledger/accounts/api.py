@@ -7,6 +7,7 @@ from ledger.accounts.reports import user_report
 from django.views.decorators.csrf import csrf_exempt
 from rest_framework.authentication import SessionAuthentication, BasicAuthentication 
 from ledger.accounts import models as accounts_models
+from ledger.accounts.search import search_filter
 from django.db.models import Q
 import json
 
@@ -183,21 +184,9 @@ class UserAccountsList(views.APIView):
                 if search_value:
                     if len(search_value) > 0:
                         if search_value.isnumeric() is True:
-                            query &= Q(            
-                                Q(id=search_value)
-                                | Q(phone_number__icontains=search_value)
-                                | Q(mobile_number__icontains=search_value)
-                            )
+                            query &= Q(id=search_value) | search_filter(search_value, ('phone_number', 'mobile_number'))
                         else:
-                            query &= Q(
-                                Q(first_name__icontains=search_value) 
-                                | Q(last_name__icontains=search_value)
-                                | Q(legal_first_name__icontains=search_value)
-                                | Q(legal_last_name__icontains=search_value)
-                                | Q(email__icontains=search_value)
-                          
-
-                            )
+                            query &= search_filter(search_value)
 
                 accounts_array= []
                 accounts_total = accounts_models.EmailUser.objects.all().count()                
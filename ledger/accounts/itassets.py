@@ -0,0 +1,145 @@
+'''
+    Sync of the staff accounts published by IT Assets.
+
+    Existing users are loaded by email in one query and compared with the
+    feed, only the rows that changed are written, one UPDATE per batch. New
+    users are created in bulk together with the email identity and social
+    auth rows the EmailUser post_save listener would have added.
+'''
+
+import time
+
+from django.db import transaction
+from django.db.models import Case, When, Value
+from social_django.models import UserSocialAuth
+
+from ledger.accounts.models import EmailUser, EmailIdentity
+from ledger.api import versions
+from ledger.accounts.signals import name_changed
+
+# Fields kept in step with IT Assets
+SYNC_FIELDS = ('first_name', 'last_name', 'is_staff', 'staff_phone_number', 'staff_mobile_number', 'position_title', 'manager_name', 'manager_email')
+SYNC_BATCH_SIZE = 500
+
+
+def batches(values, size=SYNC_BATCH_SIZE):
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def itassets_user_fields(user, domains):
+    ''' (email, {field: value}) for a user in the IT Assets json, None when
+        the email is not in one of the department domains.
+    '''
+    ed = str(user['email']).split('@')
+    if len(ed) < 2 or ed[1] not in domains:
+        return None
+    email = user['email'].lower().replace(' ', '')
+    manager_email = ''
+    manager_name = ''
+    if user['manager']:
+        manager_email = user['manager']['email']
+        manager_name = user['manager']['name']
+    return email, {
+        'first_name': user['given_name'] or 'No First Name',
+        'last_name': user['surname'] or 'No Last Name',
+        'is_staff': True,
+        'staff_phone_number': user['telephone'],
+        'staff_mobile_number': user['mobile_phone'],
+        'position_title': user['title'],
+        'manager_name': manager_name,
+        'manager_email': manager_email,
+    }
+
+
+def bulk_update_users(users, fields, batch_size=SYNC_BATCH_SIZE):
+    ''' Write fields of users with one UPDATE per batch.
+    '''
+    for batch in batches(users, batch_size):
+        updates = {}
+        for field in fields:
+            output_field = EmailUser._meta.get_field(field)
+            updates[field] = Case(
+                *[When(pk=u.pk, then=Value(getattr(u, field), output_field=output_field)) for u in batch],
+                output_field=output_field
+            )
+        EmailUser.objects.filter(pk__in=[u.pk for u in batch]).update(**updates)
+        versions.invalidate_rows('EmailUser', *[u.pk for u in batch])
+
+
+def bulk_create_users(users, batch_size=SYNC_BATCH_SIZE):
+    ''' bulk_create skips the post_save listener, add the email identity and
+        social auth rows it would have created.
+    '''
+    created = []
+    for batch in batches(users, batch_size):
+        created.extend(EmailUser.objects.bulk_create(batch))
+    emails = [u.email for u in created]
+    identities = set()
+    social = set()
+    for batch in batches(emails, batch_size):
+        identities.update(EmailIdentity.objects.filter(email__in=batch).values_list('email', flat=True))
+        social.update(UserSocialAuth.objects.filter(provider='email', uid__in=batch).values_list('uid', flat=True))
+    EmailIdentity.objects.bulk_create(
+        [EmailIdentity(user=u, email=u.email) for u in created if u.email not in identities],
+        batch_size=batch_size
+    )
+    UserSocialAuth.objects.bulk_create(
+        [UserSocialAuth(user=u, provider='email', uid=u.email, extra_data={'email': [u.email]}) for u in created if u.email not in social],
+        batch_size=batch_size
+    )
+    return created
+
+
+def sync_users(data, domains, batch_size=SYNC_BATCH_SIZE):
+    ''' Create or update the staff accounts in the IT Assets json.
+        Returns the created, updated and unchanged counts and the elapsed seconds.
+    '''
+    started = time.time()
+    wanted = {}
+    for user in data:
+        row = itassets_user_fields(user, domains)
+        if row:
+            # The last entry for an email wins, as it did when each was saved in turn
+            wanted[row[0]] = row[1]
+
+    existing = {}
+    for batch in batches(wanted.keys(), batch_size):
+        existing.update((u.email, u) for u in EmailUser.objects.filter(email__in=batch))
+
+    changed = []
+    changed_fields = set()
+    renamed = []
+    new = []
+    unchanged = 0
+    for email, fields in wanted.items():
+        u = existing.get(email)
+        if u is None:
+            new.append(EmailUser(email=email, **fields))
+            continue
+        diff = [f for f in SYNC_FIELDS if getattr(u, f) != fields[f]]
+        if not diff:
+            unchanged += 1
+            continue
+        if 'first_name' in diff or 'last_name' in diff:
+            renamed.append(u)
+        for f in diff:
+            setattr(u, f, fields[f])
+        changed.append(u)
+        changed_fields.update(diff)
+
+    with transaction.atomic():
+        if changed:
+            bulk_update_users(changed, sorted(changed_fields), batch_size)
+        created = bulk_create_users(new, batch_size)
+
+    for u in renamed:
+        name_changed.send(sender=EmailUser, user=u)
+
+    return {
+        'created': [u.email for u in created],
+        'updated': len(changed),
+        'unchanged': unchanged,
+        'elapsed': time.time() - started,
+    }
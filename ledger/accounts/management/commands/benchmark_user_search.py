@@ -0,0 +1,93 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+from ledger.accounts.models import EmailUser
+from ledger.accounts.search import search_emailusers, search_filter
+import random
+import string
+import time
+
+BENCHMARK_DOMAIN = 'user-search-benchmark.invalid'
+FIRST_NAMES = ['james','mary','robert','patricia','john','jennifer','michael','linda','david','elizabeth','william','barbara','richard','susan','joseph','jessica','thomas','sarah','charles','karen']
+LAST_NAMES = ['smith','johnson','williams','brown','jones','garcia','miller','davis','rodriguez','martinez','hernandez','lopez','gonzalez','wilson','anderson','thomas','taylor','moore','jackson','martin']
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    index = int(round((pct / 100.0) * (len(values) - 1)))
+    return values[index]
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the indexed EmailUser search, reporting p50/p95 latency.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=500000, help='Make sure at least this many accounts exist, generating benchmark accounts if needed')
+        parser.add_argument('--runs', type=int, default=200, help='Searches per benchmark')
+        parser.add_argument('--cleanup', action='store_true', help='Delete the generated benchmark accounts and exit')
+
+    def handle(self, *args, **options):
+        generated = EmailUser.objects.filter(email__endswith='@'+BENCHMARK_DOMAIN)
+        if options['cleanup']:
+            deleted = generated._raw_delete(generated.db)
+            self.stdout.write(self.style.SUCCESS('Deleted {} benchmark accounts'.format(deleted)))
+            return
+
+        missing = options['users'] - EmailUser.objects.count()
+        if missing > 0:
+            self.generate(missing, generated.count())
+
+        keywords = self.keywords(options['runs'])
+        cases = [
+            ('user_info_search', lambda k: list(search_emailusers(k)[:20])),
+            ('UserAccountsList', lambda k: (EmailUser.objects.filter(search_filter(k)).count(), list(EmailUser.objects.filter(search_filter(k)).order_by('id')[:10]))),
+            ('query_emailuser_by_args', lambda k: (EmailUser.objects.filter(search_filter(k, ('first_name', 'last_name', 'email', 'phone_number', 'mobile_number', 'fax_number'))).count(),)),
+        ]
+        self.stdout.write('Accounts: {}'.format(EmailUser.objects.count()))
+        for name, search in cases:
+            timings = []
+            for keyword in keywords:
+                started = time.time()
+                search(keyword)
+                timings.append((time.time() - started) * 1000)
+            self.stdout.write('{:<25} p50 {:>8.1f}ms  p95 {:>8.1f}ms  max {:>8.1f}ms'.format(
+                name, percentile(timings, 50), percentile(timings, 95), max(timings)))
+
+        with connection.cursor() as cursor:
+            sql, params = search_emailusers(keywords[0])[:20].query.sql_with_params()
+            cursor.execute('EXPLAIN ' + sql, params)
+            self.stdout.write('\n'.join(row[0] for row in cursor.fetchall()))
+
+    def keywords(self, runs):
+        keywords = []
+        for n in range(runs):
+            choice = n % 4
+            if choice == 0:
+                keywords.append(random.choice(FIRST_NAMES)[:4])
+            elif choice == 1:
+                keywords.append('{} {}'.format(random.choice(FIRST_NAMES), random.choice(LAST_NAMES)[:3]))
+            elif choice == 2:
+                keywords.append(random.choice(LAST_NAMES))
+            else:
+                keywords.append('{}.{}'.format(random.choice(FIRST_NAMES), random.choice(LAST_NAMES)))
+        return keywords
+
+    def generate(self, count, offset):
+        self.stdout.write('Generating {} benchmark accounts'.format(count))
+        batch = []
+        for n in range(offset, offset + count):
+            first_name = random.choice(FIRST_NAMES)
+            last_name = random.choice(LAST_NAMES)
+            suffix = ''.join(random.choice(string.ascii_lowercase) for i in range(4))
+            batch.append(EmailUser(
+                email='{}.{}.{}{}@{}'.format(first_name, last_name, suffix, n, BENCHMARK_DOMAIN),
+                first_name=first_name.title(),
+                last_name=last_name.title(),
+                mobile_number='04{:08d}'.format(n % 100000000),
+            ))
+            if len(batch) == 5000:
+                EmailUser.objects.bulk_create(batch)
+                batch = []
+        if batch:
+            EmailUser.objects.bulk_create(batch)
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE accounts_emailuser')
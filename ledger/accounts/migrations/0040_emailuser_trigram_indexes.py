@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 10:00
+from __future__ import unicode_literals
+
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+# Trigram indexes on the expression icontains compiles to, so user searches
+# no longer scan the whole accounts_emailuser table. They are built
+# concurrently, outside a transaction, so the table stays writable while the
+# migration runs.
+TRIGRAM_FIELDS = ['email', 'first_name', 'last_name', 'legal_first_name', 'legal_last_name', 'phone_number', 'mobile_number', 'fax_number']
+
+
+def create_indexes():
+    return [
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS accounts_emailuser_{0}_trgm ON accounts_emailuser USING gin (UPPER("{0}"::text) gin_trgm_ops);'.format(field)
+        for field in TRIGRAM_FIELDS
+    ]
+
+
+def drop_indexes():
+    return [
+        'DROP INDEX CONCURRENTLY IF EXISTS accounts_emailuser_{0}_trgm;'.format(field)
+        for field in TRIGRAM_FIELDS
+    ]
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('accounts', '0039_auto_20241021_1023'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.RunSQL(create_indexes(), drop_indexes()),
+    ]
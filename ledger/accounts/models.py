@@ -9,7 +9,6 @@ from django.db import models, IntegrityError, transaction
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils import timezone
 from django.dispatch import receiver
-from django.db.models import Q
 from django.db.models.signals import post_delete, pre_save, post_save
 from django.core.exceptions import ValidationError
 
@@ -542,12 +541,8 @@ def query_emailuser_by_args(**kwargs):
     total = queryset.count()
 
     if search_value:
-        queryset = queryset.filter(Q(first_name__icontains=search_value) |
-                                        Q(last_name__icontains=search_value) |
-                                        Q(email__icontains=search_value) |
-                                        Q(phone_number__icontains=search_value) |
-                                        Q(mobile_number__icontains=search_value) |
-                                        Q(fax_number__icontains=search_value))
+        from ledger.accounts.search import search_filter
+        queryset = queryset.filter(search_filter(search_value, ('first_name', 'last_name', 'email', 'phone_number', 'mobile_number', 'fax_number')))
 
     count = queryset.count()
     queryset = queryset.order_by(order_column)[start:start + length]
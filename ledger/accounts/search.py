@@ -0,0 +1,45 @@
+from django.contrib.postgres.search import TrigramSimilarity
+from django.db.models import Q
+from django.db.models.functions import Greatest
+
+from ledger.accounts.models import EmailUser
+
+# Fields covered by the trigram indexes created in migration 0040.
+# icontains compiles to UPPER("field"::text) LIKE UPPER(%s) on postgres,
+# which is the expression those indexes are built on.
+NAME_FIELDS = ('first_name', 'last_name', 'legal_first_name', 'legal_last_name', 'email')
+NUMBER_FIELDS = ('phone_number', 'mobile_number', 'fax_number')
+RANK_FIELDS = ('email', 'first_name', 'last_name')
+
+
+def search_filter(value, fields=NAME_FIELDS):
+    ''' Q matching value anywhere in any of the fields.
+    '''
+    query = Q()
+    for field in fields:
+        query |= Q(**{'{}__icontains'.format(field): value})
+    return query
+
+
+def rank_users(queryset, keyword):
+    ''' Annotate search_rank (best trigram similarity of the keyword to the
+        email and names) and order by it, closest matches first.
+    '''
+    keyword = keyword.lower()
+    similarity = [TrigramSimilarity(field, keyword) for field in RANK_FIELDS]
+    return queryset.annotate(search_rank=Greatest(*similarity)).order_by('-search_rank', 'id')
+
+
+def search_emailusers(keyword, queryset=None):
+    ''' Typeahead search, keyword matches the email, the given name or with
+        two or more words the given name then the last name. Ranked.
+    '''
+    if queryset is None:
+        queryset = EmailUser.objects.all()
+    words = keyword.split(" ")
+    query = Q(email__icontains=keyword.lower())
+    if len(words) == 1:
+        query |= Q(first_name__icontains=words[0].lower())
+    if len(words) > 1:
+        query |= Q(first_name__icontains=words[0].lower()) & Q(last_name__icontains=words[1].lower())
+    return rank_users(queryset.filter(query), keyword)
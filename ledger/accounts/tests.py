@@ -7,7 +7,9 @@ from django.test import TestCase
 from django.test import Client
 from social_django.models import UserSocialAuth
 
-from ledger.accounts.models import EmailUser
+from ledger.accounts.models import EmailUser, EmailIdentity
+from ledger.accounts.itassets import sync_users
+from ledger.accounts.search import search_emailusers
 
 REGISTERED_USER_EMAIL = 'registered_user@test.net'
 NEW_USER_EMAIL = 'new_user@test.net'
@@ -115,3 +117,46 @@ class AccountsTestCase(TestCase):
 
         # check that the another user wasn't created
         #self.assertEqual(EmailUser.objects.count(), original_user_count + 1)
+
+
+class EmailUserSearchTestCase(TestCase):
+
+    def setUp(self):
+        EmailUser.objects.create(email='jo.bloggs@test.net', first_name='Jo', last_name='Bloggs')
+        EmailUser.objects.create(email='joanne.smith@test.net', first_name='Joanne', last_name='Smith')
+        EmailUser.objects.create(email='someone@test.net', first_name='Someone', last_name='Else')
+
+    def test_search_name(self):
+        """Testing that first name and last name searches only match those users"""
+        self.assertEqual([u.email for u in search_emailusers('joanne smi')], ['joanne.smith@test.net'])
+        self.assertNotIn('someone@test.net', [u.email for u in search_emailusers('jo')])
+
+    def test_search_ranked(self):
+        """Testing that the closest match is returned first"""
+        results = list(search_emailusers('jo.bloggs'))
+        self.assertEqual(results[0].email, 'jo.bloggs@test.net')
+
+
+class ITAssetsSyncTestCase(TestCase):
+
+    def itassets_user(self, email, given_name, title='Officer'):
+        return {'email': email, 'given_name': given_name, 'surname': 'Staff', 'title': title,
+                'telephone': '9219 9000', 'mobile_phone': None, 'manager': {'email': 'boss@dbca.wa.gov.au', 'name': 'Boss'}}
+
+    def test_sync_users(self):
+        """Testing that only new and changed staff accounts are written"""
+        data = [self.itassets_user('Old@dbca.wa.gov.au', 'Old'), self.itassets_user('outside@test.net', 'Out')]
+        result = sync_users(data, ['dbca.wa.gov.au'])
+        self.assertEqual(result['created'], ['old@dbca.wa.gov.au'])
+        self.assertTrue(EmailIdentity.objects.filter(email='old@dbca.wa.gov.au').exists())
+        self.assertTrue(UserSocialAuth.objects.filter(provider='email', uid='old@dbca.wa.gov.au').exists())
+        self.assertFalse(EmailUser.objects.filter(email='outside@test.net').exists())
+
+        data = [self.itassets_user('old@dbca.wa.gov.au', 'Old', title='Manager'), self.itassets_user('new@dbca.wa.gov.au', 'New')]
+        with self.assertNumQueries(9):
+            result = sync_users(data, ['dbca.wa.gov.au'])
+        self.assertEqual((result['created'], result['updated'], result['unchanged']), (['new@dbca.wa.gov.au'], 1, 0))
+        self.assertEqual(EmailUser.objects.get(email='old@dbca.wa.gov.au').position_title, 'Manager')
+
+        result = sync_users(data, ['dbca.wa.gov.au'])
+        self.assertEqual((result['created'], result['updated'], result['unchanged']), ([], 0, 2))
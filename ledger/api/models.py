@@ -4,7 +4,7 @@ from django.db import models, IntegrityError, transaction
 from django.utils import timezone
 from django.dispatch import receiver
 from django.db.models import Q
-from django.db.models.signals import post_delete, pre_save, post_save
+from django.db.models.signals import post_delete, pre_save, post_save, m2m_changed
 from django.core.exceptions import ValidationError
 from django.utils.crypto import get_random_string
 from django_countries.fields import CountryField
@@ -12,6 +12,8 @@ from django.utils.crypto import get_random_string
 
 from datetime import datetime, date
 
+from ledger.api import versions
+
 class API(models.Model):
     STATUS = (
        (0, 'Inactive'),
@@ -40,3 +42,65 @@ class API(models.Model):
     def get_random_key(self,key_length=100):
         return get_random_string(length=key_length, allowed_chars=u'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789')
 
+
+@receiver(post_save, sender=API)
+@receiver(post_delete, sender=API)
+def invalidate_api_registry(sender, instance, **kwargs):
+    from ledger.api.utils import api_registry
+    versions.now_and_on_commit(api_registry.invalidate)
+
+
+# Versions of the rows behind the cached gateway lookups, see ledger.api.versions
+# =============================================
+@receiver(post_save, sender='accounts.EmailUser')
+@receiver(post_delete, sender='accounts.EmailUser')
+def invalidate_emailuser_version(sender, instance, **kwargs):
+    versions.invalidate_rows('EmailUser', instance.pk)
+
+@receiver(post_save, sender='accounts.Address')
+@receiver(post_delete, sender='accounts.Address')
+def invalidate_address_version(sender, instance, **kwargs):
+    versions.invalidate_rows('EmailUser', instance.user_id)
+
+@receiver(m2m_changed)
+def invalidate_emailuser_groups_version(sender, instance, action, reverse, pk_set, **kwargs):
+    if sender._meta.label_lower != 'accounts.emailuser_groups' or not action.startswith('post_'):
+        return
+    if not reverse:
+        versions.invalidate_rows('EmailUser', instance.pk)
+    elif pk_set:
+        versions.invalidate_rows('EmailUser', *pk_set)
+    else:
+        # Group cleared from the user side of the relation
+        versions.invalidate_all_rows('EmailUser')
+
+@receiver(post_save, sender='auth.Group')
+def invalidate_group_version(sender, instance, **kwargs):
+    # Group names are part of every user
+    versions.invalidate_all_rows('EmailUser')
+
+@receiver(post_save, sender='invoice.Invoice')
+@receiver(post_delete, sender='invoice.Invoice')
+def invalidate_invoice_version(sender, instance, **kwargs):
+    versions.invalidate_rows('Invoice', instance.pk)
+
+@receiver(post_save, sender='invoice.InvoicePaymentSummary')
+@receiver(post_delete, sender='invoice.InvoicePaymentSummary')
+def invalidate_invoice_summary_version(sender, instance, **kwargs):
+    versions.invalidate_rows('Invoice', instance.invoice_id)
+
+@receiver(post_save, sender='order.Order')
+@receiver(post_delete, sender='order.Order')
+def invalidate_order_version(sender, instance, **kwargs):
+    versions.invalidate_rows('OrderId', instance.pk)
+    versions.invalidate_rows('Order', instance.number)
+
+@receiver(post_save, sender='payments.OracleInterfaceSystem')
+@receiver(post_delete, sender='payments.OracleInterfaceSystem')
+def invalidate_oracle_interface_system_version(sender, instance, **kwargs):
+    versions.invalidate_rows('OracleInterfaceSystem', instance.system_id)
+
+@receiver(post_save, sender='address.Country')
+@receiver(post_delete, sender='address.Country')
+def invalidate_country_version(sender, instance, **kwargs):
+    versions.invalidate_all_rows('Country')
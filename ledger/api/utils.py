@@ -1,5 +1,64 @@
 from ledger.api import models as ledgerapi_models
+from django.core.cache import cache
+from collections import namedtuple
 import ipaddress
+import threading
+import time
+import uuid
+
+API_REGISTRY_VERSION_KEY = 'ledger_api_registry_version'
+# Reload at least this often in case the version key was evicted or an API was changed with queryset.update()
+API_REGISTRY_MAX_AGE = 300
+
+APIKey = namedtuple('APIKey', ['id', 'system_id', 'system_name', 'networks'])
+
+
+class APIKeyRegistry(object):
+    ''' In process map of active api keys to their allowed networks, parsed once.
+        Reloaded when the version in the shared cache changes, which happens
+        whenever an API is saved or deleted.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.keys = None
+        self.version = None
+        self.loaded = 0
+
+    def load(self, version):
+        keys = {}
+        for api in ledgerapi_models.API.objects.filter(active=1):
+            networks = []
+            for line in (api.allowed_ips or '').splitlines():
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    networks.append(ipaddress.ip_network(line))
+                except ValueError as e:
+                    print ("Invalid allowed ip for API {}: {}".format(api.id, e))
+            keys[api.api_key] = APIKey(api.id, api.system_id, api.system_name, tuple(networks))
+        self.keys = keys
+        self.version = version
+        self.loaded = time.time()
+        return keys
+
+    def get(self, apikey):
+        version = cache.get(API_REGISTRY_VERSION_KEY)
+        # Take the map under the lock, another thread may replace or drop it
+        # once the lock is released
+        with self.lock:
+            keys = self.keys
+            if keys is None or version != self.version or time.time() - self.loaded > API_REGISTRY_MAX_AGE:
+                keys = self.load(version)
+        return keys.get(apikey)
+
+    def invalidate(self):
+        cache.set(API_REGISTRY_VERSION_KEY, uuid.uuid4().hex, None)
+        with self.lock:
+            self.keys = None
+
+
+api_registry = APIKeyRegistry()
 
 
 def get_client_ip(request):
@@ -15,15 +74,33 @@ def get_client_ip(request):
     return ip
 
 
-def api_allow(clientip,apikey):
-    allow = False
-    if ledgerapi_models.API.objects.filter(api_key=apikey,active=1).count() > 0:
-        api = ledgerapi_models.API.objects.filter(api_key=apikey)[0]
-        allowed_ips = api.allowed_ips.splitlines()
-        for line in allowed_ips:
-            if ipaddress.ip_address(clientip) in ipaddress.ip_network(line):
-                allow = True
+def get_api(apikey):
+    ''' The active API for this key or None.
+    '''
+    return api_registry.get(apikey)
 
 
+def api_allow(clientip,api):
+    ''' True when clientip is in one of the allowed networks of api, an
+        APIKey from get_api or the key itself.
+    '''
+    allow = False
+    if not isinstance(api, APIKey):
+        api = api_registry.get(api)
+    if api is not None:
+        try:
+            address = ipaddress.ip_address(clientip.strip())
+        except (ValueError, AttributeError):
+            return False
+        for network in api.networks:
+            if address in network:
+                allow = True
+                break
     return allow
 
+
+def authorize(request, api):
+    ''' True when the key is active and the request comes from one of its allowed networks.
+        Pass the APIKey already returned by get_api to skip a second lookup.
+    '''
+    return api_allow(get_client_ip(request), api)
@@ -0,0 +1,82 @@
+from django.core.cache import cache
+from django.db import transaction
+import uuid
+
+# Versions of the rows behind the gateway lookups (users, invoices, orders,
+# oracle systems, countries), replaced whenever one of the rows is saved.
+# Responses built from those rows are cached and tagged with an ETag made
+# from the versions, see ledgergw.response_cache.
+#
+# Versions are replaced when the row is saved and again when the transaction
+# commits. A response built from the old rows by another request before the
+# commit would otherwise be cached under the new version.
+CACHE_TIMEOUT = 86400
+
+
+def _new_version():
+    return uuid.uuid4().hex
+
+def _generation(model_name):
+    ''' Generation shared by all the rows of a model, replaced to invalidate them all at once.
+    '''
+    key = 'rowversion:{}:generation'.format(model_name)
+    generation = cache.get(key)
+    if generation is None:
+        generation = _new_version()
+        cache.set(key, generation, CACHE_TIMEOUT)
+    return generation
+
+def now_and_on_commit(func, *args):
+    ''' Run func(*args) now and again once the current transaction commits.
+    '''
+    func(*args)
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(lambda: func(*args))
+
+def _version_key(model_name, generation, key):
+    return 'rowversion:{}:{}:{}'.format(model_name, generation, key)
+
+def row_versions(rows):
+    ''' Current versions of [(model_name, key), ...], in the same order.
+        One cache round trip for the generations and one for the versions.
+    '''
+    generations = dict((m, _generation(m)) for m in set(m for m, k in rows))
+    keys = [_version_key(m, generations[m], k) for m, k in rows]
+    found = cache.get_many(keys)
+    missing = dict((k, _new_version()) for k in keys if k not in found)
+    if missing:
+        cache.set_many(missing, CACHE_TIMEOUT)
+        found.update(missing)
+    return [found[k] for k in keys]
+
+def row_version(model_name, key):
+    return row_versions([(model_name, key)])[0]
+
+def invalidate_rows(model_name, *keys):
+    ''' New versions for the rows of model_name with the given keys.
+    '''
+    keys = set(str(k) for k in keys if k is not None and k != '')
+    if keys:
+        now_and_on_commit(_delete_versions, model_name, keys)
+
+def _delete_versions(model_name, keys):
+    generation = _generation(model_name)
+    cache.delete_many([_version_key(model_name, generation, k) for k in keys])
+
+def invalidate_all_rows(model_name):
+    now_and_on_commit(_replace_generation, model_name)
+
+def _replace_generation(model_name):
+    cache.set('rowversion:{}:generation'.format(model_name), _new_version(), CACHE_TIMEOUT)
+
+def invalidate_orders(order_ids=(), numbers=()):
+    ''' Orders are looked up by number or by id, both versions are replaced.
+        The invoices of the orders change too (owner, item count).
+    '''
+    from ledger.order.models import Order
+    order_ids = set(order_ids)
+    numbers = set(numbers)
+    if order_ids:
+        numbers.update(Order.objects.filter(id__in=order_ids).values_list('number', flat=True))
+    invalidate_rows('OrderId', *order_ids)
+    invalidate_rows('Order', *numbers)
@@ -24,7 +24,6 @@ from ledger.payments.models import Invoice, BpointToken, OracleInterfaceSystem,
 from ledger.accounts.models import EmailUser
 from ledger.payments.facade import invoice_facade, bpoint_facade, bpay_facade
 from ledger.payments.utils import isLedgerURL, systemid_check, LinkedInvoiceCreate
-from ledger.api import models as ledgerapi_models
 from ledger.api import utils as ledgerapi_utils
 from ledger.payments.bpoint.gateway import Gateway
 from ledger.basket.models import Basket
@@ -169,8 +168,9 @@ class PaymentDetailsView(CorePaymentDetailsView):
         elif self.checkout_session.get_user_logged_in():
             if 'LEDGER_API_KEY' in self.request.COOKIES:
                 apikey = self.request.COOKIES['LEDGER_API_KEY']
-                if ledgerapi_models.API.objects.filter(api_key=apikey,active=1).count():
-                       if ledgerapi_utils.api_allow(ledgerapi_utils.get_client_ip(self.request),apikey) is True:
+                api_key_obj = ledgerapi_utils.get_api(apikey)
+                if api_key_obj:
+                       if ledgerapi_utils.authorize(self.request, api_key_obj) is True:
                            user = EmailUser.objects.get(id=int(self.checkout_session.get_user_logged_in()))
 
         if user:
@@ -267,8 +267,9 @@ class PaymentDetailsView(CorePaymentDetailsView):
         if request.COOKIES.get('payment_api_wrapper') == 'true':
             if 'LEDGER_API_KEY' in request.COOKIES:
                 apikey = request.COOKIES['LEDGER_API_KEY']
-                if ledgerapi_models.API.objects.filter(api_key=apikey,active=1).count():
-                       if ledgerapi_utils.api_allow(ledgerapi_utils.get_client_ip(request),apikey) is True:
+                api_key_obj = ledgerapi_utils.get_api(apikey)
+                if api_key_obj:
+                       if ledgerapi_utils.authorize(request, api_key_obj) is True:
                              PAYMENT_INTERFACE_SYSTEM_PROJECT_CODE = request.POST.get('PAYMENT_INTERFACE_SYSTEM_PROJECT_CODE','')
                              PAYMENT_INTERFACE_SYSTEM_ID = request.POST.get('PAYMENT_INTERFACE_SYSTEM_ID','')
                              ois = OracleInterfaceSystem.objects.get(id=int(PAYMENT_INTERFACE_SYSTEM_ID), system_id=PAYMENT_INTERFACE_SYSTEM_PROJECT_CODE)
@@ -436,8 +437,9 @@ class PaymentDetailsView(CorePaymentDetailsView):
                         # Swap user if in session
                         if 'LEDGER_API_KEY' in self.request.COOKIES:
                             apikey = self.request.COOKIES['LEDGER_API_KEY']
-                            if ledgerapi_models.API.objects.filter(api_key=apikey,active=1).count():
-                                   if ledgerapi_utils.api_allow(ledgerapi_utils.get_client_ip(self.request),apikey) is True:
+                            api_key_obj = ledgerapi_utils.get_api(apikey)
+                            if api_key_obj:
+                                   if ledgerapi_utils.authorize(self.request, api_key_obj) is True:
                                        if self.checkout_session.get_user_logged_in(): 
                                             user_logged_in = EmailUser.objects.get(id=int(self.checkout_session.get_user_logged_in()))
                             else:
@@ -13,6 +13,7 @@ from django.core.urlresolvers import reverse
 from django.template import loader, Template, Context
 from django.utils.html import strip_tags
 from ledger.accounts.models import Document
+from ledger.emails import outbox
 from confy import env
 
 logger = logging.getLogger('log')
@@ -93,7 +94,7 @@ class EmailBase(object):
                 attachments=_attachments, cc=cc, bcc=bcc, reply_to=reply_to, headers={'System-Environment': email_instance})
         msg.attach_alternative(html_body, 'text/html')
         try:
-            msg.send(fail_silently=False)
+            outbox.send_message(msg)
             return msg
         except Exception as e:
             logger.exception("Error while sending email to {}: {}".format(to_addresses, e))
@@ -162,7 +163,7 @@ class EmailBase2(object):
                 attachments=_attachments, cc=cc, bcc=bcc, reply_to=reply_to, headers={'System-Environment': email_instance})
         msg.attach_alternative(html_body, 'text/html')
         try:
-            msg.send(fail_silently=False)
+            outbox.send_message(msg)
             return msg
         except Exception as e:
             logger.exception("Error while sending email to {}: {}".format(to_addresses, e))
@@ -177,7 +178,9 @@ def sendHtmlEmail(to,subject,context,template,cc,bcc,from_email,template_group,a
     context['default_url'] = env('DEFAULT_HOST', '')
     context['default_url_internal'] = env('DEFAULT_URL_INTERNAL', '')
     log_hash = int(hashlib.sha1(str(datetime.datetime.now()).encode('utf-8')).hexdigest(), 16) % (10 ** 8)
-    email_log(str(log_hash)+' '+subject+":"+str(to)+":"+template_group)
+    # The outbox worker logs queued messages when it sends them
+    if email_delivery != 'on' or not outbox.outbox_enabled():
+        email_log(str(log_hash)+' '+subject+":"+str(to)+":"+template_group)
     if email_delivery != 'on':
         print ("EMAIL DELIVERY IS OFF NO EMAIL SENT -- email.py ")
         return False
@@ -243,6 +246,9 @@ def sendHtmlEmail(to,subject,context,template,cc,bcc,from_email,template_group,a
         #if attachment1:
         #    for a in attachment1:
         #        msg.attach(a)
+        if outbox.outbox_enabled():
+             outbox.queue_message(msg, template_group, log_hash)
+             return True
         try:
              email_log(str(log_hash)+' '+subject)
              msg.send()
@@ -258,6 +264,9 @@ def sendHtmlEmail(to,subject,context,template,cc,bcc,from_email,template_group,a
           #if attachment1:
           #    for a in attachment1:
           #        msg.attach(a)
+          if outbox.outbox_enabled():
+               outbox.queue_message(msg, template_group, log_hash)
+               return True
           try:
                email_log(str(log_hash)+' '+subject)
                msg.send()
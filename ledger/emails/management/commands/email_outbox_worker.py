@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from ledger.emails import outbox
+import time
+
+class Command(BaseCommand):
+    help = 'Send the queued emails in the outbox'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--poll', type=float, default=2, help='Seconds between checks for new messages')
+        parser.add_argument('--once', action='store_true', help='Exit once no messages are due')
+        parser.add_argument('--max-seconds', type=float, default=None, help='Exit after this many seconds')
+
+    def handle(self, *args, **options):
+        worker = outbox.worker_name()
+        started = time.time()
+        self.stdout.write('Email outbox worker {} started'.format(worker))
+        while True:
+            remaining = None
+            if options['max_seconds'] is not None:
+                remaining = options['max_seconds'] - (time.time() - started)
+                if remaining <= 0:
+                    break
+            totals = outbox.run_outbox(max_seconds=remaining, worker=worker)
+            if totals['sent'] or totals['failed']:
+                self.stdout.write('Sent: {sent} Failed: {failed}'.format(**totals))
+            if options['once']:
+                break
+            time.sleep(options['poll'])
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmailOutbox',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subject', models.CharField(blank=True, default='', max_length=1000)),
+                ('to', models.TextField(blank=True, default='', help_text='Comma separated recipients')),
+                ('template_group', models.CharField(blank=True, max_length=100, null=True)),
+                ('log_hash', models.CharField(blank=True, max_length=20, null=True)),
+                ('message', models.BinaryField()),
+                ('status', models.SmallIntegerField(choices=[(0, 'Pending'), (1, 'Sending'), (2, 'Sent'), (3, 'Failed')], default=0)),
+                ('attempts', models.SmallIntegerField(default=0)),
+                ('max_attempts', models.SmallIntegerField(default=5)),
+                ('run_after_dt', models.DateTimeField(blank=True, default=None, help_text='Retry is held back until this time', null=True)),
+                ('worker', models.CharField(blank=True, max_length=255, null=True)),
+                ('lease_expiry_dt', models.DateTimeField(blank=True, default=None, null=True)),
+                ('sent_dt', models.DateTimeField(blank=True, default=None, null=True)),
+                ('error', models.TextField(blank=True, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='emailoutbox',
+            index_together=set([('status', 'run_after_dt')]),
+        ),
+    ]
@@ -0,0 +1,36 @@
+from __future__ import unicode_literals
+
+from django.db import models
+
+
+class EmailOutbox(models.Model):
+    ''' A message waiting for, or done with, delivery by the outbox worker.
+        The message is kept pickled so attachments and alternatives survive.
+    '''
+    STATUS = (
+       (0, 'Pending'),
+       (1, 'Sending'),
+       (2, 'Sent'),
+       (3, 'Failed'),
+    )
+
+    subject = models.CharField(max_length=1000, blank=True, default='')
+    to = models.TextField(blank=True, default='', help_text="Comma separated recipients")
+    template_group = models.CharField(max_length=100, null=True, blank=True)
+    log_hash = models.CharField(max_length=20, null=True, blank=True)
+    message = models.BinaryField()
+    status = models.SmallIntegerField(choices=STATUS, default=0)
+    attempts = models.SmallIntegerField(default=0)
+    max_attempts = models.SmallIntegerField(default=5)
+    run_after_dt = models.DateTimeField(default=None, null=True, blank=True, help_text="Retry is held back until this time")
+    worker = models.CharField(max_length=255, null=True, blank=True)
+    lease_expiry_dt = models.DateTimeField(default=None, null=True, blank=True)
+    sent_dt = models.DateTimeField(default=None, null=True, blank=True)
+    error = models.TextField(null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        index_together = (('status', 'run_after_dt'),)
+
+    def __str__(self):
+        return '{} {}'.format(self.subject, self.to)
@@ -0,0 +1,194 @@
+'''
+    Persistent outbox for outgoing email.
+
+    With EMAIL_OUTBOX on, sendHtmlEmail and EmailBase.send store the built
+    message and return straight away. The outbox worker
+    (manage.py email_outbox_worker) claims queued messages in batches,
+    sends them over one SMTP connection, retries failures with backoff and
+    appends one structured line per message to logs/email.log, a batch at
+    a time.
+'''
+
+import datetime
+import json
+import os
+import pickle
+import smtplib
+import socket
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import get_connection
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+# Models are imported inside the functions, emails.py is imported by
+# modules loaded before the app registry is ready.
+
+def outbox_enabled():
+    return getattr(settings, 'EMAIL_OUTBOX', False)
+
+def batch_size():
+    return getattr(settings, 'EMAIL_OUTBOX_BATCH_SIZE', 100)
+
+def lease_seconds():
+    return getattr(settings, 'EMAIL_OUTBOX_LEASE_SECONDS', 300)
+
+def retry_delay(attempts):
+    ''' Exponential backoff before a failed message is sent again.
+    '''
+    backoff = getattr(settings, 'EMAIL_OUTBOX_RETRY_BACKOFF_SECONDS', 60)
+    return timedelta(seconds=backoff * (2 ** max(attempts - 1, 0)))
+
+def worker_name():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+def queue_message(msg, template_group=None, log_hash=None):
+    ''' Store a built EmailMessage for the worker to send, returns the outbox row.
+    '''
+    from ledger.emails.models import EmailOutbox
+    # A connection can't be pickled and the worker brings its own
+    msg.connection = None
+    return EmailOutbox.objects.create(
+        subject=str(msg.subject)[:1000],
+        to=','.join(msg.recipients()),
+        template_group=template_group,
+        log_hash=str(log_hash) if log_hash is not None else None,
+        message=pickle.dumps(msg, pickle.HIGHEST_PROTOCOL),
+    )
+
+def send_message(msg, template_group=None, log_hash=None):
+    ''' Queue msg when the outbox is on, otherwise send it now.
+    '''
+    if outbox_enabled():
+        queue_message(msg, template_group, log_hash)
+        return 1
+    return msg.send(fail_silently=False)
+
+def email_log_many(lines):
+    ''' Append lines to logs/email.log with one write.
+    '''
+    if not lines:
+        return
+    dt = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    with open(os.path.join(settings.BASE_DIR, 'logs', 'email.log'), 'a+') as f:
+        f.write(''.join('{}: {}\r\n'.format(dt, line) for line in lines))
+
+def claim_messages(worker, limit):
+    ''' Lock and lease up to limit messages for this worker, oldest first.
+
+        Pending messages past their retry time and sending messages whose
+        lease has expired (the worker died) are claimed. Rows locked by
+        another worker are skipped.
+    '''
+    from ledger.emails.models import EmailOutbox
+    now = timezone.now()
+    with transaction.atomic():
+        ids = list(EmailOutbox.objects.select_for_update(skip_locked=True).filter(
+            Q(status=0, run_after_dt__isnull=True) | Q(status=0, run_after_dt__lte=now) |
+            Q(status=1, lease_expiry_dt__lt=now)
+        ).order_by('id').values_list('id', flat=True)[:limit])
+        EmailOutbox.objects.filter(id__in=ids).update(
+            status=1, worker=worker, lease_expiry_dt=now + timedelta(seconds=lease_seconds())
+        )
+    return list(EmailOutbox.objects.filter(id__in=ids).order_by('id'))
+
+def deliver(rows, connection):
+    ''' Send the claimed rows over connection, reconnecting if the server drops it.
+        Returns {row id: error or None}.
+    '''
+    results = {}
+    for row in rows:
+        started = time.time()
+        try:
+            msg = pickle.loads(bytes(row.message))
+            msg.connection = connection
+            try:
+                sent = connection.send_messages([msg])
+            except smtplib.SMTPServerDisconnected:
+                connection.close()
+                connection.open()
+                sent = connection.send_messages([msg])
+            results[row.id] = None if sent else 'Not accepted by the mail gateway'
+        except Exception as e:
+            results[row.id] = '{}: {}'.format(e.__class__.__name__, e)
+        row.elapsed = time.time() - started
+    return results
+
+def save_results(rows, results, worker):
+    ''' Record the outcome of a batch, sent rows with one update. Returns
+        the delivery log lines.
+    '''
+    from ledger.emails.models import EmailOutbox
+    now = timezone.now()
+    sent = [row.id for row in rows if results[row.id] is None]
+    lines = []
+    with transaction.atomic():
+        if sent:
+            EmailOutbox.objects.filter(id__in=sent, worker=worker).update(
+                status=2, sent_dt=now, attempts=F('attempts') + 1, lease_expiry_dt=None, error=None
+            )
+        for row in rows:
+            error = results[row.id]
+            attempts = row.attempts + 1
+            if error is None:
+                status = 'sent'
+            elif attempts < row.max_attempts:
+                status = 'retry'
+                EmailOutbox.objects.filter(id=row.id, worker=worker).update(
+                    status=0, attempts=attempts, run_after_dt=now + retry_delay(attempts), lease_expiry_dt=None, error=error
+                )
+            else:
+                status = 'failed'
+                EmailOutbox.objects.filter(id=row.id, worker=worker).update(
+                    status=3, attempts=attempts, lease_expiry_dt=None, error=error
+                )
+            lines.append(json.dumps({
+                'outbox': row.id, 'hash': row.log_hash, 'status': status, 'attempt': attempts,
+                'subject': row.subject, 'to': row.to, 'group': row.template_group,
+                'queued': row.created.isoformat() if row.created else None,
+                'ms': int(row.elapsed * 1000), 'error': error,
+            }))
+    return lines
+
+def run_outbox(connection=None, max_seconds=None, limit=None, worker=None):
+    ''' Send queued messages until none are due or max_seconds has passed,
+        over a single SMTP connection. Returns the number sent and failed.
+    '''
+    if worker is None:
+        worker = worker_name()
+    if limit is None:
+        limit = batch_size()
+    if connection is None:
+        connection = get_connection(fail_silently=False)
+    started = time.time()
+    totals = {'sent': 0, 'failed': 0}
+    opened = False
+    try:
+        while max_seconds is None or time.time() - started < max_seconds:
+            rows = claim_messages(worker, limit)
+            if not rows:
+                break
+            try:
+                if not opened:
+                    connection.open()
+                    opened = True
+            except Exception as e:
+                # Gateway unreachable, the batch goes back with an attempt counted
+                error = '{}: {}'.format(e.__class__.__name__, e)
+                results = dict((row.id, error) for row in rows)
+                for row in rows:
+                    row.elapsed = 0
+                email_log_many(save_results(rows, results, worker))
+                totals['failed'] += len(rows)
+                break
+            results = deliver(rows, connection)
+            email_log_many(save_results(rows, results, worker))
+            for error in results.values():
+                totals['failed' if error else 'sent'] += 1
+    finally:
+        if opened:
+            connection.close()
+    return totals
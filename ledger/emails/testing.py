@@ -0,0 +1,97 @@
+'''
+    A local SMTP server standing in for the mail gateway in tests.
+
+        with LocalSMTPServer(reject=['nobody@test.net']) as server:
+            connection = server.connection()
+            ...
+            server.messages  # [(from, [recipients], data)]
+'''
+
+import socketserver
+import threading
+
+from django.core.mail import get_connection
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode('utf-8'))
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        self.reply('220 localhost SMTP stand-in')
+        mail_from, recipients = None, []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            line = line.decode('utf-8', 'replace').rstrip('\r\n')
+            command = line[:4].upper()
+            if command in ('HELO', 'EHLO'):
+                self.reply('250 localhost')
+            elif command == 'MAIL':
+                mail_from, recipients = line.split(':', 1)[1].strip(' <>'), []
+                self.reply('250 OK')
+            elif command == 'RCPT':
+                recipient = line.split(':', 1)[1].strip(' <>')
+                if recipient in server.reject:
+                    self.reply('550 No such user')
+                else:
+                    recipients.append(recipient)
+                    self.reply('250 OK')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                while True:
+                    line = self.rfile.readline()
+                    if not line or line in (b'.\r\n', b'.\n'):
+                        break
+                    if line.startswith(b'..'):
+                        line = line[1:]
+                    data.append(line)
+                with server.lock:
+                    server.messages.append((mail_from, recipients, b''.join(data)))
+                self.reply('250 OK')
+            elif command == 'RSET':
+                mail_from, recipients = None, []
+                self.reply('250 OK')
+            elif command == 'NOOP':
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+
+class LocalSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, reject=()):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), SMTPHandler)
+        self.reject = set(reject)
+        self.messages = []
+        self.connections = 0
+        self.lock = threading.Lock()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def connection(self, **kwargs):
+        ''' An email backend connection to this server.
+        '''
+        kwargs.update(host='127.0.0.1', port=self.port, username='', password='', use_tls=False, use_ssl=False)
+        return get_connection(fail_silently=False, **kwargs)
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
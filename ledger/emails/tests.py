@@ -0,0 +1,34 @@
+import os
+import tempfile
+
+from django.core.mail import EmailMessage
+from django.test import TestCase, override_settings
+
+from ledger.emails import outbox
+from ledger.emails.models import EmailOutbox
+from ledger.emails.testing import LocalSMTPServer
+
+
+@override_settings(EMAIL_OUTBOX=True, PRODUCTION_EMAIL=True, BASE_DIR=tempfile.gettempdir(), EMAIL_BACKEND='ledger.ledger_email.LedgerEmailBackend')
+class EmailOutboxTestCase(TestCase):
+
+    def setUp(self):
+        os.makedirs(os.path.join(tempfile.gettempdir(), 'logs'), exist_ok=True)
+
+    def test_outbox(self):
+        """Testing that queued messages share one connection and failures are retried"""
+        for to in ['one@test.net', 'two@test.net', 'nobody@test.net']:
+            outbox.send_message(EmailMessage('Receipt', 'Body', 'no-reply@test.net', [to]), 'system-oim', 1234)
+        self.assertEqual(EmailOutbox.objects.filter(status=0).count(), 3)
+
+        with LocalSMTPServer(reject=['nobody@test.net']) as server:
+            totals = outbox.run_outbox(connection=server.connection())
+        self.assertEqual(totals, {'sent': 2, 'failed': 1})
+        self.assertEqual(server.connections, 1)
+        self.assertEqual([m[1] for m in server.messages], [['one@test.net'], ['two@test.net']])
+
+        failed = EmailOutbox.objects.get(to='nobody@test.net')
+        self.assertEqual((failed.status, failed.attempts), (0, 1))
+        self.assertIsNotNone(failed.run_after_dt)
+        # Held back until the retry time
+        self.assertEqual(outbox.claim_messages('test', 10), [])
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 11:02
+from __future__ import unicode_literals
+
+from decimal import Decimal as D
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+DETAIL_FIELDS = (
+    ('payment', 'payment_details'),
+    ('refund', 'refund_details'),
+    ('deduction', 'deduction_details'),
+)
+
+
+def backfill_allocations(apps, schema_editor):
+    Line = apps.get_model('order', 'Line')
+    LineAllocation = apps.get_model('order', 'LineAllocation')
+    batch = []
+    for line in Line.objects.only('id', 'payment_details', 'refund_details', 'deduction_details').order_by('id').iterator():
+        for kind, field in DETAIL_FIELDS:
+            for method, txns in (getattr(line, field) or {}).items():
+                for txn_id, amount in (txns or {}).items():
+                    try:
+                        txn_id = int(txn_id)
+                    except (TypeError, ValueError):
+                        continue
+                    batch.append(LineAllocation(line_id=line.id, kind=kind, method=method, transaction_id=txn_id, amount=D(amount)))
+        if len(batch) >= 2000:
+            LineAllocation.objects.bulk_create(batch)
+            batch = []
+    if batch:
+        LineAllocation.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('order', '0014_auto_20230105_1730'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LineAllocation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('payment', 'Payment'), ('refund', 'Refund'), ('deduction', 'Deduction')], max_length=10)),
+                ('method', models.CharField(choices=[('card', 'Card'), ('bpay', 'BPAY'), ('cash', 'Cash'), ('order', 'Order')], max_length=10)),
+                ('transaction_id', models.IntegerField()),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('line', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='allocations', to='order.Line')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='lineallocation',
+            index_together=set([('method', 'transaction_id', 'kind')]),
+        ),
+        migrations.RunPython(backfill_allocations, migrations.RunPython.noop),
+    ]
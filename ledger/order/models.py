@@ -1,7 +1,9 @@
 import json
 from decimal import Decimal as D
 from django.db import models
+from django.db.models import Sum
 from ledger.accounts.models import Organisation
+from ledger.api import versions
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.postgres.fields import JSONField
 from oscar.apps.order.abstract_models import AbstractLine as CoreAbstractLine, AbstractOrder as CoreAbstractOrder
@@ -59,6 +61,10 @@ class Line(CoreAbstractLine):
                 amount += D(a)
         return amount
 
+    def save(self, *args, **kwargs):
+        super(Line, self).save(*args, **kwargs)
+        LineAllocation.sync([self])
+
     # A line reference is the ID that a partner uses to represent this
     # particular line (it's not the same as a SKU).
     partner_line_reference = models.CharField(
@@ -68,4 +74,100 @@ class Line(CoreAbstractLine):
     partner_line_notes = models.TextField(
         _("Partner Notes"), blank=True, null=True)
 
+
+class LineAllocationQuerySet(models.QuerySet):
+
+    def allocated(self, method, transaction_id, kind='payment'):
+        ''' Total allocated from a single transaction.
+        '''
+        total = self.filter(method=method, transaction_id=transaction_id, kind=kind).aggregate(total=Sum('amount'))['total']
+        return total or D('0.00')
+
+    def totals_by_transaction(self, method, transaction_ids=None, kind='payment'):
+        ''' {transaction_id: total} for one payment method.
+        '''
+        qs = self.filter(method=method, kind=kind)
+        if transaction_ids is not None:
+            qs = qs.filter(transaction_id__in=list(transaction_ids))
+        return dict(qs.order_by().values_list('transaction_id').annotate(total=Sum('amount')))
+
+    def totals_by_oracle_code(self, kind='payment', method=None):
+        ''' {oracle_code: total} across the lines in this queryset.
+        '''
+        qs = self.filter(kind=kind)
+        if method:
+            qs = qs.filter(method=method)
+        return dict(qs.order_by().values_list('line__oracle_code').annotate(total=Sum('amount')))
+
+
+class LineAllocation(models.Model):
+    ''' Normalised copy of Line payment_details, refund_details and
+        deduction_details, one row per transaction amount on a line.
+        Rows are rebuilt from the json whenever a line is saved.
+    '''
+
+    KIND_FIELDS = (
+        ('payment', 'payment_details'),
+        ('refund', 'refund_details'),
+        ('deduction', 'deduction_details'),
+    )
+
+    KIND_CHOICES = (
+        ('payment', 'Payment'),
+        ('refund', 'Refund'),
+        ('deduction', 'Deduction'),
+    )
+
+    METHOD_CHOICES = (
+        ('card', 'Card'),
+        ('bpay', 'BPAY'),
+        ('cash', 'Cash'),
+        ('order', 'Order'),
+    )
+
+    line = models.ForeignKey(Line, related_name='allocations', on_delete=models.CASCADE)
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    method = models.CharField(max_length=10, choices=METHOD_CHOICES)
+    transaction_id = models.IntegerField()
+    amount = models.DecimalField(max_digits=12, decimal_places=2)
+
+    objects = LineAllocationQuerySet.as_manager()
+
+    class Meta:
+        index_together = (('method', 'transaction_id', 'kind'),)
+
+    def __str__(self):
+        return '{} {} {} {}'.format(self.kind, self.method, self.transaction_id, self.amount)
+
+    @classmethod
+    def from_line(cls, line):
+        allocations = []
+        for kind, field in cls.KIND_FIELDS:
+            details = getattr(line, field) or {}
+            for method, txns in details.items():
+                for txn_id, amount in (txns or {}).items():
+                    try:
+                        txn_id = int(txn_id)
+                    except (TypeError, ValueError):
+                        continue
+                    allocations.append(cls(line_id=line.pk, kind=kind, method=method, transaction_id=txn_id, amount=D(amount)))
+        return allocations
+
+    @classmethod
+    def sync(cls, lines):
+        ''' Replace the allocation rows of the given lines with the
+            contents of their json detail fields.
+        '''
+        lines = [l for l in lines if l.pk]
+        if not lines:
+            return
+        cls.objects.filter(line_id__in=[l.pk for l in lines]).delete()
+        allocations = []
+        for line in lines:
+            allocations.extend(cls.from_line(line))
+        cls.objects.bulk_create(allocations)
+        # The paid totals of the order lines changed
+        versions.invalidate_orders(order_ids=set(l.order_id for l in lines))
+
+
 from oscar.apps.order.models import *  # noqa
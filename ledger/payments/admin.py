@@ -47,6 +47,14 @@ class UnpaidInvoiceAdmin(admin.ModelAdmin):
     def invoice_number(self, obj):
         return '%s'%(obj.invoice.reference)            
 
+@admin.register(models.InvoicePaymentSummary)
+class InvoicePaymentSummaryAdmin(admin.ModelAdmin):
+    list_display = ('invoice','bpoint_paid','bpay_paid','cash_paid','refunded','deducted','balance','payment_status','updated')
+    search_fields = ('invoice__reference',)
+    list_filter = ('payment_status',)
+    raw_id_fields = ('invoice',)
+    list_per_page = 30
+
 @admin.register(models.BpayTransaction)
 class BpayTransactionAdmin(admin.ModelAdmin):
     list_display = (
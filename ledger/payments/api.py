@@ -1,7 +1,7 @@
 import json
 from django.db import transaction
 from django.conf import settings
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import HttpResponse, HttpResponseRedirect, StreamingHttpResponse
 from django.template.loader import get_template
 from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse
@@ -24,7 +24,7 @@ from ledger.payments import utils as payments_utils
 from ledger.payments.invoice import utils as invoice_utils
 from ledger.payments import models as payments_models
 from ledger.payments.facade import bpoint_facade
-from ledger.payments.reports import generate_items_csv, generate_trans_csv, generate_items_csv_allocated
+from ledger.payments.reports import generate_items_csv_stream, generate_trans_csv
 from ledger.payments.emails import send_refund_email
 from ledger.checkout.utils import calculate_excl_gst
 from ledger.payments import helpers
@@ -795,7 +795,7 @@ class ReportCreateView(views.APIView):
                     filename = 'report-{}-{}'.format(str(serializer.validated_data['start']),str(serializer.validated_data['end']))
                     # Generate Report
                     if serializer.validated_data['items']:
-                        report = generate_items_csv(systemid_check(serializer.validated_data['system']),
+                        report = generate_items_csv_stream(systemid_check(serializer.validated_data['system']),
                                                     serializer.validated_data['start'],
                                                     serializer.validated_data['end'],
                                                     serializer.validated_data['banked_start'],
@@ -807,7 +807,10 @@ class ReportCreateView(views.APIView):
                                                     serializer.validated_data['end'],
                                                     district = serializer.validated_data['district'])
                     if report:                        
-                        response = HttpResponse(FileWrapper(report), content_type='text/csv')
+                        if serializer.validated_data['items']:
+                            response = StreamingHttpResponse(report, content_type='text/csv')
+                        else:
+                            response = HttpResponse(FileWrapper(report), content_type='text/csv')
                         response['Content-Disposition'] = 'attachment; filename="{}.csv"'.format(filename)
                         return response
                     else:
@@ -851,19 +854,23 @@ class ReportCreateAllocatedView(views.APIView):
                     filename = 'report-{}-{}'.format(str(serializer.validated_data['start']),str(serializer.validated_data['end']))
                     # Generate Report
                     if serializer.validated_data['items']:
-                        report = generate_items_csv_allocated(systemid_check(serializer.validated_data['system']),
+                        report = generate_items_csv_stream(systemid_check(serializer.validated_data['system']),
                                                     serializer.validated_data['start'],
                                                     serializer.validated_data['end'],
                                                     serializer.validated_data['banked_start'],
                                                     serializer.validated_data['banked_end'],
-                                                    district = serializer.validated_data['district'])
+                                                    district = serializer.validated_data['district'],
+                                                    allocated=True)
                     else:
                         report = generate_trans_csv(systemid_check(serializer.validated_data['system'])
                                                     ,serializer.validated_data['start'],
                                                     serializer.validated_data['end'],
                                                     district = serializer.validated_data['district'])
                     if report:
-                        response = HttpResponse(FileWrapper(report), content_type='text/csv')
+                        if serializer.validated_data['items']:
+                            response = StreamingHttpResponse(report, content_type='text/csv')
+                        else:
+                            response = HttpResponse(FileWrapper(report), content_type='text/csv')
                         response['Content-Disposition'] = 'attachment; filename="{}.csv"'.format(filename)
                         return response
                     else:
@@ -1105,7 +1112,12 @@ def CancelInvoice(request, *args, **kwargs):
                 isp = payments_utils.get_oracle_interface_system_permissions(system_id,request.user.email)  
                 if isp["manage_ledger_tool"] is True or isp["all_access"] is True:
                     if Invoice.objects.filter(reference=invoice_reference, voided=False).count() > 0:                                    
-                        inv = Invoice.objects.filter(reference=invoice_reference).update(voided=True)
+                        # Saved one by one so the stored payment summary and the
+                        # cached gateway responses see the invoice cancelled
+                        inv = Invoice.objects.filter(reference=invoice_reference)
+                        for i in inv:
+                            i.voided=True
+                            i.save()
                         inv = UnpaidInvoice.objects.filter(invoice_reference=invoice_reference).update(voided=True)
                         return HttpResponse(json.dumps({'status': 200, 'message': 'success'}), content_type='application/json')
                     else:
@@ -7,12 +7,15 @@ from six.moves import StringIO
 from os import listdir
 from os.path import isfile, join
 from decimal import Decimal
-from django.db import IntegrityError, transaction
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from django.db import IntegrityError, connection, connections, transaction
 from django.core.mail import EmailMessage, get_connection
 from django.conf import settings
 from ledger.payments.bpay.models import *
 from ledger.payments.bpay.crn import getCRN
 from ledger.payments.utils import update_payments
+from ledger.payments import trans_hash
 
 logging.info('Starting logger for BPAY.')
 logger = logging.getLogger(__name__)
@@ -208,93 +211,182 @@ def validate_file(f):
     except:
         raise
 
-def parseFile(file_path):
+# Records held in memory before they are written with one bulk_create
+BPAY_CHUNK_SIZE = 1000
+
+# Record type: (model, builder)
+RECORD_TYPES = {
+    '02': (BpayGroupRecord, record_grouprec),
+    '03': (BpayAccountRecord, record_accountrec),
+    '30': (BpayTransaction, record_txn),
+    '49': (BpayAccountTrailer, record_accounttrailer),
+    '98': (BpayGroupTrailer, record_grouptrailer),
+}
+
+def ingest_file(f):
+    '''Stream the records of a validated file into the database,
+        BPAY_CHUNK_SIZE records of a type at a time.
+        Returns the new BpayFile and the crns of its transactions.
+    '''
+    bpay_file = BpayFile()
+    pending = dict((k, []) for k in RECORD_TYPES)
+    crns = set()
+    biller_code = None
+    filetrailer_row = None
+
+    def flush(step):
+        if pending[step]:
+            RECORD_TYPES[step][0].objects.bulk_create(pending[step])
+            pending[step] = []
+
+    for row in csv.reader(f):
+        if not row:
+            continue
+        step = checkStepValue(row[0])
+        if step == '01':
+            # Format the time to 24h
+            bpay_file.created = validate_datetime(row[3],row[4])
+            bpay_file.file_id = row[5]
+            bpay_file.save()
+            continue
+        if bpay_file.pk is None:
+            raise Exception('The file header record must come before the other records.')
+        if step == '99':
+            filetrailer_row = row
+            continue
+        if step == '02':
+            biller_code = row[1]
+        elif step == '30':
+            if row[11] in ['APF','LBX']:
+                continue
+            row.append(biller_code)
+            crns.add(row[4])
+        pending[step].append(RECORD_TYPES[step][1](row,bpay_file))
+        if len(pending[step]) >= BPAY_CHUNK_SIZE:
+            flush(step)
+
+    for step in RECORD_TYPES:
+        flush(step)
+    # Create File Trailer Record
+    record_filetrailer(filetrailer_row,bpay_file).save()
+    return bpay_file, crns
+
+def allocate_payments(crns):
+    '''Update the payments of the invoices referenced by the crns, each invoice
+        in its own short transaction. Returns [(reference, error)] for the
+        invoices that failed.
+    '''
+    from ledger.payments.models import Invoice
+    from ledger.payments.invoice.models import InvoicePaymentSummary
+    crns = list(set(crns))
+    references = set()
+    for i in range(0, len(crns), BPAY_CHUNK_SIZE):
+        references.update(Invoice.objects.filter(reference__in=crns[i:i + BPAY_CHUNK_SIZE]).values_list('reference', flat=True))
+    # bulk_create skips BpayTransaction.save so refresh the totals here
+    trans_hash.invalidate_invoice_transactions('BpayTransaction', *references)
+    failed = []
+    for reference in sorted(references):
+        try:
+            with transaction.atomic():
+                InvoicePaymentSummary.refresh(reference)
+                update_payments(reference)
+        except Exception as e:
+            logger.exception('BPAY payment allocation failed for invoice {}'.format(reference))
+            failed.append((reference, str(e)))
+    return failed
+
+# pg_advisory_lock key held while the payments of the bpay files are allocated
+BPAY_ALLOCATION_LOCK_ID = 7310002
+
+@contextmanager
+def allocation_lock():
+    '''Only one process allocates the payments of the files at a time.
+    '''
+    if connection.vendor != 'postgresql':
+        yield
+        return
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_lock(%s)', [BPAY_ALLOCATION_LOCK_ID])
+    try:
+        yield
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_unlock(%s)', [BPAY_ALLOCATION_LOCK_ID])
+
+def allocate_files():
+    '''Allocate the payments of every file not allocated yet, the files just
+        parsed and those an earlier run failed to allocate. A file is marked
+        allocated once all the invoices it pays are updated.
+        Returns [(reference, error)] for the invoices that failed.
+    '''
+    with allocation_lock():
+        file_ids = list(BpayFile.objects.filter(payments_allocated=False).values_list('id', flat=True))
+        if not file_ids:
+            return []
+        crns = {}
+        for file_id, crn in BpayTransaction.objects.filter(file_id__in=file_ids).values_list('file_id', 'crn'):
+            crns.setdefault(file_id, set()).add(crn)
+        failed = allocate_payments(set(c for file_crns in crns.values() for c in file_crns))
+        failed_references = set(r for r, e in failed)
+        allocated = [f for f in file_ids if not (crns.get(f, set()) & failed_references)]
+        BpayFile.objects.filter(id__in=allocated).update(payments_allocated=True)
+    return failed
+
+def parseFile(file_path, allocate=True):
     '''Parse the file in order to create the relevant
         objects.
+        The records are stored in one transaction, the invoice payments are
+        updated after it commits unless allocate is False.
     '''
-    from ledger.payments.models import Invoice
     f = get_file(file_path)
-    transaction_list, group_list, account_list = [], [], []
-    transaction_rows, group_rows, account_rows  = [], [], []
-    accountttrailer_rows, grouptrailer_rows, filetrailer_row = [], [], None
-    accountttrailer_list, grouptrailer_list = [], []
-    bpay_file = None
-    success = True
-    biller_code = None
     try:
         # Validate the file first
         validate_file(f)
         f.seek(0)
-        reader = csv.reader(f)
-        # Instanciate a new Bpay File
-        bpay_file = BpayFile()
-        for row in reader:
-            if row:
-                if checkStepValue(row[0]) == '01':
-                    # Format the time to 24h
-                    bpay_file.created = validate_datetime(row[3],row[4])
-                    bpay_file.file_id = row[5]
-                elif checkStepValue(row[0]) == '02':
-                    biller_code = row[1]
-                    group_rows.append(row)
-                elif checkStepValue(row[0]) == '03':
-                    account_rows.append(row)
-                elif checkStepValue(row[0]) == '30':
-                    if row[11] not in ['APF','LBX']:
-                        #transaction_list.append(record_txn(row,bpay_file))
-                        row.append(biller_code)
-                        transaction_rows.append(row)
-                elif checkStepValue(row[0]) == '49':
-                    accountttrailer_rows.append(row)
-                elif checkStepValue(row[0]) == '98':
-                    grouptrailer_rows.append(row)
-                elif checkStepValue(row[0]) == '99':
-                    filetrailer_row = row
-
         with transaction.atomic():
-            bpay_file.save()
-            # Create Group Records
-            for row in group_rows:
-                group_list.append(record_grouprec(row,bpay_file))
-            # Create Account Records
-            for row in account_rows:
-                account_list.append(record_accountrec(row,bpay_file))
-            # Create transactions
-            for row in transaction_rows:
-                transaction_list.append(record_txn(row,bpay_file))
-            # Create Account Trailer Records
-            for row in accountttrailer_rows:
-                accountttrailer_list.append(record_accounttrailer(row,bpay_file))
-            # Create Group Trailer Records
-            for row in grouptrailer_rows:
-                grouptrailer_list.append(record_grouptrailer(row,bpay_file))
-            # Store Records
-            BpayGroupRecord.objects.bulk_create(group_list)
-            BpayAccountRecord.objects.bulk_create(account_list)
-            BpayTransaction.objects.bulk_create(transaction_list)
-            BpayAccountTrailer.objects.bulk_create(accountttrailer_list)
-            BpayGroupTrailer.objects.bulk_create(grouptrailer_list)
-            # Create File Trailer Record
-            record_filetrailer(filetrailer_row,bpay_file).save()
-
-            # Update payments in the new transaction invoices
-            for t in bpay_file.transactions.all():
-                try:
-                    inv = Invoice.objects.get(reference=t.crn)
-                    update_payments(inv.reference)
-                except Invoice.DoesNotExist:
-                    pass
-        return success,bpay_file,''
+            bpay_file, crns = ingest_file(f)
     except IntegrityError as e:
-        success = False
-        return success,None,str(e)
+        return False,None,str(e)
     except Exception as e:
         traceback.print_exc()
-        success = False
-        return success,None,str(e)
+        return False,None,str(e)
     finally:
         f.close()
 
+    if allocate:
+        failed = allocate_files()
+        if failed:
+            return True,bpay_file,'Payments not allocated for invoices: {}'.format(', '.join(r for r, e in failed))
+    return True,bpay_file,''
+
+def bpay_parser_workers():
+    return getattr(settings, 'BPAY_PARSER_WORKERS', 1)
+
+def _parse_file_thread(file_path):
+    try:
+        return parseFile(file_path, allocate=False)
+    finally:
+        # Connections are per thread, don't leave this one open
+        connections.close_all()
+
+def parseFiles(files, workers=None):
+    '''parseFile for every [path, name], up to workers files at a time each in
+        its own thread and transaction. The payments of the new files and of
+        any file not allocated by an earlier run are then allocated once.
+        Returns the results in the order of files and [(reference, error)]
+        for the invoices whose payments could not be allocated.
+    '''
+    if workers is None:
+        workers = bpay_parser_workers()
+    paths = [p for p,n in files]
+    if workers <= 1 or len(paths) <= 1:
+        results = [parseFile(p, allocate=False) for p in paths]
+    else:
+        with ThreadPoolExecutor(max_workers=min(workers, len(paths))) as executor:
+            results = list(executor.map(_parse_file_thread, paths))
+    # Invoices paid in more than one file are only updated once, after every file is in
+    return results, allocate_files()
+
 def getfiles(path):
     files = []
     try:
@@ -330,6 +422,13 @@ def generateParserSummary(files):
     output.write('\nFiles previously processed:\n')
     for n,t in processed:
         output.write('  File Name: {}\n'.format(n))
+    # Invoices whose payments could not be updated
+    allocation_failed = files.get('allocation_failed')
+    if allocation_failed:
+        output.write('\nInvoices with payments not allocated:\n')
+        for r,e in allocation_failed:
+            output.write('  Invoice: {}\n'.format(r))
+            output.write('    Reason: {}\n'.format(e))
 
     contents = output.getvalue()
     output.close()
@@ -435,7 +534,7 @@ def monthlyReport():
     files =  BpayFile.objects.all()
     sendBillerCodeEmail(generateTransactionsSummary(files,unmatched_only=True),monthly=True)
 
-def bpayParser(path):
+def bpayParser(path, workers=None):
     files = getfiles(path)
     valid_files = []
     failed_files = []
@@ -443,10 +542,10 @@ def bpayParser(path):
     processed_files = []
     try:
         if settings.NOTIFICATION_EMAIL:
-            for p,n in files:
-                status,bfile,reason = parseFile(p)
+            results, allocation_failed = parseFiles(files, workers)
+            for (p,n),(status,bfile,reason) in zip(files, results):
                 if bfile is not None:
-                    if bfile.transactions.all():
+                    if bfile.transactions.exists():
                         valid_files.append([n,bfile])
                     else:
                         other_files.append([n,bfile])
@@ -460,7 +559,8 @@ def bpayParser(path):
                 'valid': valid_files,
                 'failed': failed_files,
                 'other': other_files,
-                'processed': processed_files
+                'processed': processed_files,
+                'allocation_failed': allocation_failed
             })
             sendSummaryEmail(summary)
             sendBillerCodeEmail(generateTransactionsSummary(valid_files))
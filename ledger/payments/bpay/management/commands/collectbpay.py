@@ -6,10 +6,11 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('path')
+        parser.add_argument('--workers', type=int, default=None, help='Files ingested at once, defaults to BPAY_PARSER_WORKERS')
     
     def handle(self, *args, **options):
         try:
-            bpayParser(options['path'])
+            bpayParser(options['path'], options['workers'])
         except Exception as e:
             raise CommandError(e)
         
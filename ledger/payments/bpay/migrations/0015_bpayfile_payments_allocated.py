@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bpay', '0014_auto_20180118_1505'),
+    ]
+
+    operations = [
+        # Files already in the table were allocated when they were parsed
+        migrations.AddField(
+            model_name='bpayfile',
+            name='payments_allocated',
+            field=models.BooleanField(default=True, help_text='The payments of the file were allocated to their invoices.'),
+        ),
+        migrations.AlterField(
+            model_name='bpayfile',
+            name='payments_allocated',
+            field=models.BooleanField(default=False, help_text='The payments of the file were allocated to their invoices.'),
+        ),
+    ]
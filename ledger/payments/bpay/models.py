@@ -1,20 +1,15 @@
-from django.db import models, connection
+from django.db import models, connection, transaction
 from django.conf import settings
 from decimal import Decimal as D
 from django.dispatch import receiver
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.utils.encoding import python_2_unicode_compatible
 from django.core.validators import MinLengthValidator
 from django.core.exceptions import ValidationError
 #from oscar.apps.order.models import Order
-from ledger.order.models import Order
-from django.core.cache import cache
-from datetime import datetime 
-import hashlib
+from ledger.order.models import Order, LineAllocation
 from ledger.payments import trans_hash
 
-change_hash = trans_hash.bpay_transaction_hash()
-
 class BpayJobRecipient(models.Model):
     email = models.EmailField(unique=True)
 
@@ -28,6 +23,7 @@ class BpayFile(models.Model):
     inserted = models.DateTimeField(auto_now_add=True)
     created = models.DateTimeField(help_text='File Creation Date Time.')
     file_id = models.BigIntegerField(help_text='File Identification Number.')
+    payments_allocated = models.BooleanField(default=False, help_text='The payments of the file were allocated to their invoices.')
 
     class Meta:
         unique_together = ('created','file_id')
@@ -132,17 +128,34 @@ class BpayTransaction(models.Model):
         unique_together = ('crn', 'txn_ref', 'p_date')
         db_table = 'payments_bpaytransaction'
 
+    def payment_totals(self, values=None):
+        ''' {invoice reference: change to the payment summary} of this
+            transaction, or of values read from the table before a save. It
+            counts for the invoice of its crn and the invoices it is linked to.
+        '''
+        from ledger.payments.invoice.models import InvoiceBPAY, payment_totals
+        values = values or {'crn': self.crn, 'p_instruction_code': self.p_instruction_code, 'type': self.type, 'amount': self.amount}
+        totals = payment_totals({}, {(values['p_instruction_code'], str(values['type'])): D(values['amount'])}, {})
+        references = set([values['crn']])
+        if self.pk:
+            references.update(InvoiceBPAY.objects.filter(bpay_id=self.pk).values_list('invoice__reference', flat=True))
+        return dict((reference, totals) for reference in references)
+
     def save(self, *args, **kwargs):
-        super(BpayTransaction, self).save(*args, **kwargs)
+        from ledger.payments.invoice.models import InvoicePaymentSummary
+        with transaction.atomic():
+            previous = None
+            if self.pk:
+                previous = BpayTransaction.objects.filter(pk=self.pk).values('crn', 'p_instruction_code', 'type', 'amount').first()
+            super(BpayTransaction, self).save(*args, **kwargs)
+            removed = self.payment_totals(previous) if previous else {}
+            added = self.payment_totals()
 
-        cache.delete('BpayTransaction')
-        bt = BpayTransaction.objects.all().order_by('-id')[:1]
-        if bt.count() > 0:
-            bt[0].id
-            lastest_row_string = str(bt[0].id)
-            #change_hash = hashlib.md5(lastest_row_string.encode('utf-8')).hexdigest()
-            change_hash = hashlib.md5(datetime.now().strftime("%m/%d/%Y, %H:%M:%S").encode('utf-8')).hexdigest()
-            cache.set('BpayTransaction', change_hash,  86400)
+            # Only evict the cached transactions of the invoices this transaction belongs to
+            trans_hash.invalidate_invoice_transactions('BpayTransaction', *(set(removed) | set(added)))
+
+            # Move this transaction's amount between the payment totals of the affected invoices
+            InvoicePaymentSummary.move_totals(removed, added)
 
     @property
     def approved(self):
@@ -171,29 +184,17 @@ class BpayTransaction(models.Model):
 
     @property
     def payment_allocated(self):
-        allocated = D('0.0')
-        if self.order:
-            lines = self.order.lines.all()
-            for line in lines:
-                for k,v in line.payment_details.items():
-                    if k == 'bpay':
-                        for i,a in v.items():
-                            if i == str(self.id):
-                                allocated += D(a)
-        return allocated
+        order = self.order
+        if order:
+            return LineAllocation.objects.filter(line__order=order).allocated('bpay', self.id, kind='payment')
+        return D('0.0')
 
     @property
     def refund_allocated(self):
-        allocated = D('0.0')
-        if self.order:
-            lines = self.order.lines.all()
-            for line in lines:
-                for k,v in line.refund_details.items():
-                    if k == 'bpay':
-                        for i,a in v.items():
-                            if i == str(self.id):
-                                allocated += D(a)
-        return allocated
+        order = self.order
+        if order:
+            return LineAllocation.objects.filter(line__order=order).allocated('bpay', self.id, kind='refund')
+        return D('0.0')
 
     @property
     def system(self):
@@ -237,6 +238,13 @@ class BpayTransaction(models.Model):
     def __unicode__(self):
         return str(self.crn)
 
+@receiver(post_delete, sender=BpayTransaction)
+def _bpay_transaction_post_delete(sender, instance, **kwargs):
+    from ledger.payments.invoice.models import InvoicePaymentSummary
+    # Its links to other invoices are deleted (and refresh those invoices) first
+    trans_hash.invalidate_invoice_transactions('BpayTransaction', instance.crn)
+    InvoicePaymentSummary.move_totals(removed=instance.payment_totals())
+
 class BpayGroupRecord(models.Model):
     DATE_MODIFIERS = (
         (1,'interim/previous day'),
@@ -8,17 +8,23 @@ from ledger.payments.bpoint.BPOINT.Utils import RequestSender
 from ledger.payments.bpoint.BPOINT.Responses import TransactionResponse,\
     TransactionSearchResponse, AuthKeyResponse, DVTokenResponse,\
     DVTokenSearchResponse, APIResponse, FraudScreeningResponse
+from confy import env
 import logging
 logger = logging.getLogger('ledger_bpoint')
 
+BPOINT_BASE_URL = env('BPOINT_BASE_URL', "https://www.bpoint.com.au/webapi/v2")
+
 class Request(object):
     def __init__(self, credentials):
         self.url = None
         self.credentials = credentials
         self.method = None
-        self.base_url = "https://www.bpoint.com.au/webapi/v2"
+        self.base_url = BPOINT_BASE_URL
         self.user_agent = "BPOINT:1037:1|PYTHON"
-        self.timeout = 100000
+        # Read timeout in ms, None uses the RequestSender default
+        self.timeout = None
+        # Safe to send again if the gateway did not answer
+        self.idempotent = False
         
     @abstractmethod
     def get_payload(self):
@@ -128,6 +134,7 @@ class TransactionSearchRequest(Request, CrnBlock):
         
         self.url = "/txns/search"
         self.method = "POST"
+        self.idempotent = True
         
         self.action = None
         self.amount = 0
@@ -362,6 +369,7 @@ class DVTokenSearchRequest(Request, CrnBlock):
         
         self.method = "POST"
         self.url = "/dvtokens/search"
+        self.idempotent = True
         
         self.card_type = None
         self.expired_cards_only = False
@@ -4,19 +4,75 @@ Created on 15 Jan 2015
 @author: ChrisR
 '''
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from confy import env
+import threading
+import logging
+import time
 import json
 import base64
+logger = logging.getLogger('ledger_bpoint')
+
+# Timeouts are in seconds, Request.timeout (ms) overrides the read timeout
+BPOINT_CONNECT_TIMEOUT = env('BPOINT_CONNECT_TIMEOUT', 5)
+BPOINT_READ_TIMEOUT = env('BPOINT_READ_TIMEOUT', 45)
+# Extra attempts for requests that are safe to repeat (GET and searches)
+BPOINT_RETRIES = env('BPOINT_RETRIES', 2)
+BPOINT_RETRY_BACKOFF = env('BPOINT_RETRY_BACKOFF', 0.5)
+BPOINT_POOL_SIZE = env('BPOINT_POOL_SIZE', 10)
+RETRY_STATUS_CODES = (502, 503, 504)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def auth_header(credentials):
+    return base64.b64encode((credentials.username + "|" +
+                             credentials.merchant_number + ":" +
+                             credentials.password).encode()).decode()
+
+def get_session(base_url, credentials):
+    ''' Keep-alive session per gateway and credentials, the auth header is
+        built once and the TLS connection is reused between calls.
+    '''
+    authorization = auth_header(credentials)
+    key = (base_url, authorization)
+    session = _sessions.get(key)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                session.headers.update({"Authorization" : authorization, "Content-Type" : "application/json; charset=utf-8"})
+                # Connection failures never reached the gateway so any method can be retried
+                adapter = HTTPAdapter(pool_connections=BPOINT_POOL_SIZE, pool_maxsize=BPOINT_POOL_SIZE,
+                                      max_retries=Retry(total=BPOINT_RETRIES, connect=BPOINT_RETRIES, read=0, status=0, redirect=0,
+                                                        backoff_factor=BPOINT_RETRY_BACKOFF))
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _sessions[key] = session
+    return session
+
+def close_sessions():
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
 
 class RequestSender(object):
-    def __init__(self, base_url):
+    def __init__(self, base_url, retries=None):
         self.base_url = base_url
         self.user_agent = "Premier.Billpay.API.BPOINT.Python-V1.0";
-        
+        self.retries = BPOINT_RETRIES if retries is None else retries
+
+    def timeout(self, request):
+        read_timeout = BPOINT_READ_TIMEOUT
+        if request.timeout:
+            read_timeout = request.timeout / 1000
+        return (BPOINT_CONNECT_TIMEOUT, read_timeout)
+
     def send(self, request):
-        credentials = request.credentials
-        auth_header_value = base64.b64encode((credentials.username + "|" +
-                                          credentials.merchant_number + ":" +
-                                          credentials.password).encode())
+        session = get_session(self.base_url, request.credentials)
         url = self.base_url + request.build_url()
         
         built_payload = request.get_payload()
@@ -26,23 +82,33 @@ class RequestSender(object):
             payload = json.dumps(built_payload)
         
         method = request.method
-        header_dict = {"Authorization" : auth_header_value.decode(), "Content-Type" : "application/json; charset=utf-8"}
+        header_dict = {}
         
         if request.user_agent is not None:
             header_dict["User-Agent"] = request.user_agent
         else:
             header_dict["User-Agent"] = self.user_agent
-            
-        if method == "POST":
-            endpoint = requests.post(url, data = payload, headers = header_dict, timeout = request.timeout / 1000)
-        elif method == "GET":
-            endpoint = requests.get(url, headers = header_dict, timeout = request.timeout / 1000)
-        elif method == "PUT":
-            endpoint = requests.put(url, data = payload, headers = header_dict, timeout = request.timeout / 1000)
-        elif method == "DELETE":
-            endpoint = requests.delete(url, headers = header_dict, timeout = request.timeout / 1000)
-        
-        return json.loads(endpoint.text)
+
+        # Payments must not be sent twice, only repeat reads and searches
+        attempts = 1
+        if method == "GET" or getattr(request, 'idempotent', False):
+            attempts = 1 + self.retries
+
+        for attempt in range(1, attempts + 1):
+            start = time.time()
+            try:
+                endpoint = session.request(method, url, data = payload, headers = header_dict, timeout = self.timeout(request))
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                request.latency = time.time() - start
+                logger.warning('bpoint %s %s failed after %.0fms (attempt %s/%s): %s', method, request.build_url(), request.latency * 1000, attempt, attempts, e)
+                if attempt == attempts:
+                    raise
+            else:
+                request.latency = time.time() - start
+                logger.info('bpoint %s %s %s in %.0fms (attempt %s/%s)', method, request.build_url(), endpoint.status_code, request.latency * 1000, attempt, attempts)
+                if endpoint.status_code not in RETRY_STATUS_CODES or attempt == attempts:
+                    return json.loads(endpoint.text)
+            time.sleep(BPOINT_RETRY_BACKOFF * (2 ** (attempt - 1)))
 
 class WebHookConsumer:
     @staticmethod
@@ -1,18 +1,18 @@
 from django.core.management.base import BaseCommand
 from django.utils import timezone
-from ledger.payments.bpoint.models import BpointTransaction, BpointToken
 from ledger.payments.models import Invoice,OracleInterface,CashTransaction
-from ledger.order.models import Order, Line as OrderLine
 #from oscar.apps.order.models import Order
 #from ledger.basket.models import Basket
 from django.conf import settings
 from datetime import timedelta, datetime
 from ledger.payments.bpoint.facade import Facade
 from ledger.payments.bpoint.gateway import Gateway
+from ledger.payments.bpoint import reconcile
 from ledger.payments.models import OracleInterfaceSystem, OracleInterface, OracleParser, OracleParserInvoice 
 from ledger.emails.emails import sendHtmlEmail
 from ledger.payments import models as payment_models
-from ledger.payments.models import TrackRefund, LinkedInvoice, OracleAccountCode, RefundFailed, OracleInterfaceSystem
+from ledger.payments import parallel
+from ledger.payments.models import TrackRefund, LinkedInvoice, OracleAccountCode, RefundFailed
 from decimal import Decimal as D
 import json
 import os
@@ -25,8 +25,11 @@ class Command(BaseCommand):
          settlement_date_search = yesterday.strftime("%Y%m%d")
          parser.add_argument('settlement_date', nargs='?', default=settlement_date_search)
          parser.add_argument('system_id', nargs='?', default=None)
+         parser.add_argument('--processes', type=int, default=None, help='Systems audited at once, defaults to ORACLE_SYSTEM_PROCESSES')
 
     def handle(self, *args, **options):
+           if parallel.run_command_per_system(__name__.rsplit('.', 1)[-1], options['settlement_date'], options['system_id'], options['processes']):
+               return
 
            SYSTEM_ID = ''
            ois = None
@@ -49,32 +52,26 @@ class Command(BaseCommand):
                start_li = settlement_date_search_obj.strftime("%Y-%m-%d")+' 00:00'
                end_li = settlement_date_search_obj.strftime("%Y-%m-%d")+' 23:59'
                print (start_li+" to "+end_li)
-               linked_invoices = LinkedInvoice.objects.filter(created__gte=start_li,created__lte=end_li, system_identifier=oracle_system).values('invoice_group_id').distinct()
+               group_ids = list(LinkedInvoice.objects.filter(created__gte=start_li,created__lte=end_li, system_identifier=oracle_system).values_list('invoice_group_id', flat=True).distinct())
+               linked_invoice_groups = {}
+               for lig in LinkedInvoice.objects.filter(invoice_group_id__in=group_ids):
+                   linked_invoice_groups.setdefault(lig.invoice_group_id_id, []).append(lig.invoice_reference)
 
-               #linked_invoices = LinkedInvoice.objects.filter(invoice_group_id=68682).values('invoice_group_id').distinct()
-               for li in linked_invoices:
-                   #print (li.invoice_reference)
-                   linked_invoice_groups = LinkedInvoice.objects.filter(invoice_group_id=li['invoice_group_id'])
-                   linked_invoice_group_totals[li['invoice_group_id']] = {"bpoint_total" : D('0.00'), "oracle_order_total": D('0.00'), "invoices": []}
-                   for lig in linked_invoice_groups:
-                       if lig.invoice_reference not in linked_invoice_group_totals[li['invoice_group_id']]["invoices"]:
-                           bpoint_trans = BpointTransaction.objects.filter(crn1=lig.invoice_reference)
-                           for bt in bpoint_trans:
-                                if bt.action == 'payment':
-                                    linked_invoice_group_totals[li['invoice_group_id']]["bpoint_total"] = linked_invoice_group_totals[li['invoice_group_id']]["bpoint_total"] + bt.amount
-                                if bt.action == 'refund':
-                                    linked_invoice_group_totals[li['invoice_group_id']]["bpoint_total"] = linked_invoice_group_totals[li['invoice_group_id']]["bpoint_total"] - bt.amount
-                           linked_invoice_group_totals[li['invoice_group_id']]["invoices"].append(lig.invoice_reference)
+               references = set(ref for refs in linked_invoice_groups.values() for ref in refs)
+               bpoint_by_crn1 = reconcile.index(reconcile.ledger_transactions(crn1__in=references), 'crn1')
+               invoice_orders = {}
+               for reference, order_number in Invoice.objects.filter(reference__in=list(references)).values_list('reference', 'order_number'):
+                   invoice_orders.setdefault(reference, []).append(order_number)
+               order_totals = reconcile.order_totals(n for numbers in invoice_orders.values() for n in numbers)
 
-                           invoices = Invoice.objects.filter(reference=lig.invoice_reference)
-                           for inv in invoices:
-                                orders = Order.objects.filter(number=inv.order_number)
-                                for o in orders:
-                                    order_lines = OrderLine.objects.filter(order=o)
-                                    for ol in order_lines:
-                                        if 'order' in ol.payment_details:
-                                           for pd_key,pd_val in ol.payment_details['order'].items():
-                                               linked_invoice_group_totals[li['invoice_group_id']]["oracle_order_total"] = linked_invoice_group_totals[li['invoice_group_id']]["oracle_order_total"] + D(pd_val)
+               for group_id in group_ids:
+                   linked_invoice_group_totals[group_id] = {"bpoint_total" : D('0.00'), "oracle_order_total": D('0.00'), "invoices": []}
+                   for invoice_reference in linked_invoice_groups.get(group_id, []):
+                       if invoice_reference not in linked_invoice_group_totals[group_id]["invoices"]:
+                           linked_invoice_group_totals[group_id]["bpoint_total"] += reconcile.bpoint_total(bpoint_by_crn1.get(invoice_reference, []))
+                           linked_invoice_group_totals[group_id]["invoices"].append(invoice_reference)
+                           for order_number in invoice_orders.get(invoice_reference, []):
+                               linked_invoice_group_totals[group_id]["oracle_order_total"] += order_totals.get(order_number, D('0.00'))
 
                rows = []
                for ligt in linked_invoice_group_totals:
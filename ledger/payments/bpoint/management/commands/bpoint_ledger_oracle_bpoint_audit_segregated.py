@@ -1,18 +1,18 @@
 from django.core.management.base import BaseCommand
 from django.utils import timezone
-from ledger.payments.bpoint.models import BpointTransaction, BpointToken
 from ledger.payments.models import Invoice,OracleInterface,CashTransaction
-from ledger.order.models import Order, Line as OrderLine
 #from oscar.apps.order.models import Order
 from ledger.basket.models import Basket
 from django.conf import settings
 from datetime import timedelta, datetime
 from ledger.payments.bpoint.facade import Facade
 from ledger.payments.bpoint.gateway import Gateway
+from ledger.payments.bpoint import reconcile
 from ledger.payments.models import OracleInterfaceSystem, OracleInterface, OracleParser, OracleParserInvoice 
 from ledger.emails.emails import sendHtmlEmail
 from ledger.payments import models as payment_models
-from ledger.payments.models import TrackRefund, LinkedInvoice, OracleAccountCode, RefundFailed, OracleInterfaceSystem
+from ledger.payments import parallel
+from ledger.payments.models import TrackRefund, LinkedInvoice, OracleAccountCode, RefundFailed
 from decimal import Decimal as D
 import json
 import os
@@ -25,8 +25,11 @@ class Command(BaseCommand):
          settlement_date_search = yesterday.strftime("%Y%m%d")
          parser.add_argument('settlement_date', nargs='?', default=settlement_date_search)
          parser.add_argument('system_id', nargs='?', default=None)
+         parser.add_argument('--processes', type=int, default=None, help='Systems audited at once, defaults to ORACLE_SYSTEM_PROCESSES')
 
     def handle(self, *args, **options):
+           if parallel.run_command_per_system(__name__.rsplit('.', 1)[-1], options['settlement_date'], options['system_id'], options['processes']):
+               return
 
            SYSTEM_ID = ''
 
@@ -56,34 +59,25 @@ class Command(BaseCommand):
                end_li = settlement_date_search_obj.strftime("%Y-%m-%d")+' 23:59'
                print (start_li+" to "+end_li)
 
-               invoices = Invoice.objects.filter(settlement_date=settlement_date_search_obj)
+               invoices = list(Invoice.objects.filter(settlement_date=settlement_date_search_obj))
+               bpoint_by_crn1 = reconcile.index(reconcile.ledger_transactions(crn1__in=[inv.reference for inv in invoices], settlement_date=settlement_date_search_obj), 'crn1')
+               order_totals = reconcile.order_totals(inv.order_number for inv in invoices if inv.order_number)
+               used_receipts = set()
                for inv in invoices:
-                   #print (inv.order_number)
                    bpoint_trans = True
-                   bp_trans = BpointTransaction.objects.filter(crn1=inv.reference, settlement_date=settlement_date_search_obj)
-                   if bp_trans.count() > 0:
+                   bp_trans = bpoint_by_crn1.get(inv.reference, [])
+                   if bp_trans:
                        for bp in bp_trans:
-                           if bp.receipt_number in used_bp_trans:
+                           if bp.receipt_number in used_receipts:
                               dupe_bp_trans.append(bp.receipt_number)
                            else:
                               used_bp_trans.append(bp.receipt_number)
+                              used_receipts.add(bp.receipt_number)
                    else:
                        if inv.amount > 0:
-                           #no_bpoint_trans.append(inv.reference)
                            bpoint_trans = False
 
-                           #print (bp.amount)
-
-                   order_total = D('0.00')
-                   orders = Order.objects.filter(number=inv.order_number)
-                   for o in orders:
-                       order_lines = OrderLine.objects.filter(order=o)
-                       for ol in order_lines:
-                           if 'order' in ol.payment_details:
-                              for pd_key,pd_val in ol.payment_details['order'].items():
-                                  order_total = order_total + D(pd_val)
-                
-                                  #print (pd_val)
+                   order_total = order_totals.get(inv.order_number, D('0.00'))
                    if order_total > 0 and bpoint_trans is False:
                           no_bpoint_trans.append(inv.reference)
                print (settlement_date_search_obj)
@@ -1,6 +1,5 @@
 from django.core.management.base import BaseCommand
 from django.utils import timezone
-from ledger.payments.bpoint.models import BpointTransaction, BpointToken
 #from ledger.payments.models import Invoice,OracleInterface,CashTransaction
 #from oscar.apps.order.models import Order
 #from ledger.basket.models import Basket
@@ -8,9 +7,11 @@ from django.conf import settings
 from datetime import timedelta, datetime
 from ledger.payments.bpoint.facade import Facade
 from ledger.payments.bpoint.gateway import Gateway
+from ledger.payments.bpoint import reconcile
 from ledger.payments.models import OracleInterfaceSystem, OracleInterface, OracleParser, OracleParserInvoice, PaymentTotal
 from ledger.emails.emails import sendHtmlEmail
 from ledger.payments import models as payment_models
+from ledger.payments import parallel
 from decimal import Decimal as D
 import json
 import os
@@ -23,8 +24,11 @@ class Command(BaseCommand):
          settlement_date_search = yesterday.strftime("%Y%m%d")
          parser.add_argument('settlement_date', nargs='?', default=settlement_date_search)
          parser.add_argument('system_id', nargs='?', default=None)
+         parser.add_argument('--processes', type=int, default=None, help='Systems audited at once, defaults to ORACLE_SYSTEM_PROCESSES')
 
     def handle(self, *args, **options):
+           if parallel.run_command_per_system(__name__.rsplit('.', 1)[-1], options['settlement_date'], options['system_id'], options['processes']):
+               return
            
            #system = settings.PS_PAYMENT_SYSTEM_ID
            #system = system.replace('S','0')
@@ -79,86 +83,60 @@ class Command(BaseCommand):
 
 
                b = bpoint_facade.fetch_transaction_by_settlement_date(settlement_date_search)
+               ledger_bpoint = reconcile.ledger_transactions(settlement_date=settlement_date_search_obj, crn1__istartswith=SYSTEM_ID)
+               recon = reconcile.Reconciliation(b, ledger_bpoint)
+               # Latest ledger transaction for each crn1 and action, whatever the settlement date
+               ledger_by_crn1_action = reconcile.index(reconcile.ledger_transactions(crn1__in=[c.crn1 for c in recon.approved]), 'crn1_action')
+               duplicates = set(id(c) for c in recon.duplicates('crn1'))
                ledger_payment_amount = 0
                bpoint_amount = 0
                bpoint_amount_nice = 0
                oracle_parser_amount = float('0.00')
                recordcount = 0
-               duplicate_check_array =[]
-               for c in b:
-                    if c.bank_response_code == '00' and c.response_code == '0':
-                        amount = str(c.amount)[:-2]+'.'+str(c.amount)[-2:]
-                        # Skip reversal as these do not impact bpoint settlement totals
-                        if c.action == 'reversal':
-                            continue
-
-                        if c.action == 'refund':
-                            bpoint_amount = bpoint_amount - c.amount
-                        elif c.action == 'reversal':
-                             pass
-                        #    bpoint_amount = bpoint_amount - c.amount
+               for c in recon.approved:
+                    amount = reconcile.gateway_amount(c.amount)
+                    # Skip reversal as these do not impact bpoint settlement totals
+                    if c.action == 'reversal':
+                        continue
+
+                    if c.action == 'refund':
+                        bpoint_amount = bpoint_amount - c.amount
+                    else:
+                        bpoint_amount = bpoint_amount + c.amount
+
+                    bpoint_amount_nice = reconcile.gateway_amount(bpoint_amount)
+                    bp = ledger_by_crn1_action.get((c.crn1, c.action), [])
+                    ledger_payment_settlement_date = ''
+                    if bp:
+                        ledger_payment_settlement_date = bp[0].settlement_date
+                        if bp[0].action == 'refund':
+                            ledger_payment_amount = ledger_payment_amount - bp[0].amount
                         else:
-                            bpoint_amount = bpoint_amount + c.amount
-                        
-                        bpoint_amount_nice = str(bpoint_amount)[:-2]+'.'+str(bpoint_amount)[-2:]
-                        bp_lpb_diff = bpoint_amount_nice
-                        bp = BpointTransaction.objects.filter(crn1=c.crn1, action=c.action)
-                        ledger_payment_settlement_date = ''
-                        if bp.count() > 0:
-                            ledger_payment_settlement_date = bp[0].settlement_date 
-                            if bp[0].action == 'refund':
-                                ledger_payment_amount = ledger_payment_amount - bp[0].amount
-                            elif bp[0].action == 'reversal':
-                                pass
-                            else:
-                                ledger_payment_amount = ledger_payment_amount + bp[0].amount
-                        bp_lpb_diff = float(bpoint_amount_nice) - float(ledger_payment_amount)
-                        is_dupe = False
-                        if c.crn1 in duplicate_check_array:
-                            is_dupe = True
-
-                        if c.crn1 in parser_invoice_totals:
-                            oracle_parser_amount = float(oracle_parser_amount) + float(parser_invoice_totals[c.crn1])
-
-                        rows.append({'txn_number': c.txn_number,'crn1': c.crn1,'processed_date_time': c.processed_date_time, 'settlement_date': c.settlement_date, 'action': c.action, 'amount': amount, 'bpoint_amount': bpoint_amount_nice, 'ledger_payment_amount': ledger_payment_amount, 'bp_lpb_diff': bp_lpb_diff ,'ledger_payment_settlement_date': ledger_payment_settlement_date, 'is_dupe': is_dupe, 'oracle_parser_amount': oracle_parser_amount})
-                        duplicate_check_array.append(c.crn1)
-                        recordcount=recordcount + 1
+                            ledger_payment_amount = ledger_payment_amount + bp[0].amount
+                    bp_lpb_diff = float(bpoint_amount_nice) - float(ledger_payment_amount)
+                    is_dupe = id(c) in duplicates
+
+                    if c.crn1 in parser_invoice_totals:
+                        oracle_parser_amount = float(oracle_parser_amount) + float(parser_invoice_totals[c.crn1])
+
+                    rows.append({'txn_number': c.txn_number,'crn1': c.crn1,'processed_date_time': c.processed_date_time, 'settlement_date': c.settlement_date, 'action': c.action, 'amount': amount, 'bpoint_amount': bpoint_amount_nice, 'ledger_payment_amount': ledger_payment_amount, 'bp_lpb_diff': bp_lpb_diff ,'ledger_payment_settlement_date': ledger_payment_settlement_date, 'is_dupe': is_dupe, 'oracle_parser_amount': oracle_parser_amount})
+                    recordcount=recordcount + 1
 
-               
                print ("Transaction count in Bpoint: "+str(recordcount))
                missing_records = []
-               ledger_bpoint_count = 0
-               bp1 = BpointTransaction.objects.filter(settlement_date=settlement_date_search_obj, crn1__istartswith=SYSTEM_ID)
-               for rec in bp1:
-                      exists = False
-                      for c in b:
-                          if rec.crn1 == c.crn1:
-                              exists = True
-                      if exists is False:
-                             missing_records.append({'crn1': rec.crn1, 'created':rec.created, 'settlement_date': rec.settlement_date, 'amount': rec.amount,'action': rec.action})
-                      ledger_bpoint_count = ledger_bpoint_count + 1
-               print ("Ledger Bpoint Transaction count:" +str(ledger_bpoint_count))
+               for rec in recon.missing_in_gateway('crn1'):
+                      missing_records.append({'crn1': rec.crn1, 'created':rec.created, 'settlement_date': rec.settlement_date, 'amount': rec.amount,'action': rec.action})
+               print ("Ledger Bpoint Transaction count:" +str(len(recon.ledger)))
 
                missing_records_in_ledger = []
-               ledger_bpoint_count = 0
-               bp1 = BpointTransaction.objects.filter(settlement_date=settlement_date_search_obj, crn1__istartswith=SYSTEM_ID).order_by('processed')
-               for c in b:
-                      if c.bank_response_code == '00' and c.response_code == '0':
-                         exists = False
-                         for rec in bp1:
-                             if rec.crn1 == c.crn1:
-                                 exists = True
-                         if exists is False:
-                                bpoint_amount_nice1 = str(c.amount)[:-2]+'.'+str(c.amount)[-2:]
-                                missing_records_in_ledger.append({'crn1': c.crn1, 'created':c.processed_date_time, 'settlement_date': c.settlement_date, 'amount':bpoint_amount_nice1,'action': c.action})
-                         ledger_bpoint_count = ledger_bpoint_count + 1
-               print ("Ledger Bpoint Transaction count:" +str(ledger_bpoint_count))
+               for c in recon.missing_in_ledger('crn1'):
+                      missing_records_in_ledger.append({'crn1': c.crn1, 'created':c.processed_date_time, 'settlement_date': c.settlement_date, 'amount':reconcile.gateway_amount(c.amount),'action': c.action})
+               print ("Ledger Bpoint Transaction count:" +str(len(recon.approved)))
 
                # Totals
                ledger_payment_amount_total = 0
                ledger_payment_amount_total_rolling_totals = []
-               bp_ledger_payment_refund = BpointTransaction.objects.filter(settlement_date=settlement_date_search_obj, crn1__istartswith=SYSTEM_ID)
-               for bpl in bp_ledger_payment_refund:
+               for bpl in recon.ledger:
                     if bpl.action == 'refund':
                         ledger_payment_amount_total = ledger_payment_amount_total - bpl.amount
                     else:
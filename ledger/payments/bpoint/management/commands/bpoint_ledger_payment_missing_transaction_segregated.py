@@ -2,6 +2,7 @@ from django.core.management.base import BaseCommand
 from django.utils import timezone
 from ledger.payments.bpoint.models import BpointTransaction, BpointToken
 from ledger.payments.bpoint.gateway import Gateway
+from ledger.payments.bpoint import reconcile
 
 #from ledger.payments.models import Invoice,OracleInterface,CashTransaction
 #from oscar.apps.order.models import Order
@@ -12,6 +13,7 @@ from ledger.payments.bpoint.facade import Facade
 from ledger.payments.models import OracleInterfaceSystem, OracleInterface, OracleParser, OracleParserInvoice 
 from ledger.emails.emails import sendHtmlEmail
 from ledger.payments import models as payment_models
+from ledger.payments import parallel
 import json
 import os
 
@@ -23,8 +25,11 @@ class Command(BaseCommand):
          settlement_date_search = yesterday.strftime("%Y%m%d")
          parser.add_argument('settlement_date', nargs='?', default=settlement_date_search)
          parser.add_argument('system_id', nargs='?', default=None)
+         parser.add_argument('--processes', type=int, default=None, help='Systems audited at once, defaults to ORACLE_SYSTEM_PROCESSES')
 
     def handle(self, *args, **options):
+           if parallel.run_command_per_system(__name__.rsplit('.', 1)[-1], options['settlement_date'], options['system_id'], options['processes']):
+               return
           
            SYSTEM_ID = ''
 
@@ -61,50 +66,37 @@ class Command(BaseCommand):
                     )
                
                b = bpoint_facade.fetch_transaction_by_settlement_date(settlement_date_search)
-               ledger_payment_amount = 0
-               bpoint_amount = 0
-               bpoint_amount_nice = 0
-               oracle_parser_amount = float('0.00')
-               recordcount = 0
-               duplicate_check_array =[]
-               
+               recon = reconcile.Reconciliation(b, reconcile.ledger_transactions(settlement_date=settlement_date_search_obj))
+               missing = [c for c in recon.missing_in_ledger('txn_number') if c.action != 'reversal']
+               originals = reconcile.index(reconcile.ledger_transactions(txn_number__in=[c.original_txn_number for c in missing]), 'txn_number')
+
                missing_records_in_ledger = []
-               ledger_bpoint_count = 0
-               bp1 = BpointTransaction.objects.filter(settlement_date=settlement_date_search_obj)
-               for c in b:
-                      if c.bank_response_code == '00' and c.response_code == '0':
-                         exists = False
-                         for rec in bp1:
-                             if rec.txn_number == c.txn_number:
-                                 exists = True
-                         #exists = False
-                         if c.action != 'reversal':
-                            if exists is False:
-                                    bpoint_amount_nice1 = str(c.amount)[:-2]+'.'+str(c.amount)[-2:]
-                                    missing_records_in_ledger.append({'crn1': c.crn1, 'created':c.processed_date_time, 'settlement_date': c.settlement_date, 'amount':bpoint_amount_nice1,'action': c.action, 'txn_number': c.txn_number, 'card_details' : c.card_details.masked_card_number, 'rrn': c.rrn , 'original_txn_number' : c.original_txn_number , 'card_type' : c.card_type, 'receipt_number' : c.receipt_number, 'dvtoken': c.dvtoken })
-                                    orignal_crn1 = ''
-                                    if c.original_txn_number:
-                                        bpoint_orginal = BpointTransaction.objects.filter(txn_number=c.original_txn_number)
-                                        if bpoint_orginal.count() > 0:
-                                            orignal_crn1 = bpoint_orginal[0].crn1
-                                    BpointTransaction.objects.create(action=c.action,
-                                                                    amount=bpoint_amount_nice1,
-                                                                    amount_original=bpoint_amount_nice1,
-                                                                    cardtype=c.card_type,
-                                                                    crn1=c.crn1,
-                                                                    original_crn1=orignal_crn1, 
-                                                                    response_code=0, 
-                                                                    response_txt='Approved', 
-                                                                    receipt_number=c.receipt_number, 
-                                                                    processed=c.processed_date_time, 
-                                                                    settlement_date=datetime.strptime(c.settlement_date, "%Y%m%d").date(),
-                                                                    type=c.type, 
-                                                                    txn_number=c.txn_number,
-                                                                    original_txn=c.original_txn_number,
-                                                                    dvtoken=c.dvtoken,
-                                                                    is_test=c.is_test_txn)
+               for c in missing:
+                    bpoint_amount_nice1 = reconcile.gateway_amount(c.amount)
+                    missing_records_in_ledger.append({'crn1': c.crn1, 'created':c.processed_date_time, 'settlement_date': c.settlement_date, 'amount':bpoint_amount_nice1,'action': c.action, 'txn_number': c.txn_number, 'card_details' : c.card_details.masked_card_number, 'rrn': c.rrn , 'original_txn_number' : c.original_txn_number , 'card_type' : c.card_type, 'receipt_number' : c.receipt_number, 'dvtoken': c.dvtoken })
+                    orignal_crn1 = ''
+                    if c.original_txn_number and c.original_txn_number in originals:
+                        orignal_crn1 = originals[c.original_txn_number][0].crn1
+                    txn = BpointTransaction.objects.create(action=c.action,
+                                                    amount=bpoint_amount_nice1,
+                                                    amount_original=bpoint_amount_nice1,
+                                                    cardtype=c.card_type,
+                                                    crn1=c.crn1,
+                                                    original_crn1=orignal_crn1, 
+                                                    response_code=0, 
+                                                    response_txt='Approved', 
+                                                    receipt_number=c.receipt_number, 
+                                                    processed=c.processed_date_time, 
+                                                    settlement_date=datetime.strptime(c.settlement_date, "%Y%m%d").date(),
+                                                    type=c.type, 
+                                                    txn_number=c.txn_number,
+                                                    original_txn=c.original_txn_number,
+                                                    dvtoken=c.dvtoken,
+                                                    is_test=c.is_test_txn)
+                    # A refund can be missing along with the payment it refunds
+                    originals.setdefault(txn.txn_number, []).insert(0, txn)
 
-                            ledger_bpoint_count = ledger_bpoint_count + 1
+               ledger_bpoint_count = len([c for c in recon.approved if c.action != 'reversal'])
                print ("Ledger Bpoint Transaction count:" +str(ledger_bpoint_count))
 
                # Totals
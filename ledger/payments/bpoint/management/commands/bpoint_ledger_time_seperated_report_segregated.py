@@ -1,18 +1,18 @@
 from django.core.management.base import BaseCommand
 from django.utils import timezone
-from ledger.payments.bpoint.models import BpointTransaction, BpointToken
 from ledger.payments.models import Invoice,OracleInterface,CashTransaction
-from ledger.order.models import Order, Line as OrderLine
 #from oscar.apps.order.models import Order
 from ledger.basket.models import Basket
 from django.conf import settings
 from datetime import timedelta, datetime
 from ledger.payments.bpoint.facade import Facade
 from ledger.payments.bpoint.gateway import Gateway
+from ledger.payments.bpoint import reconcile
 from ledger.payments.models import OracleInterfaceSystem, OracleInterface, OracleParser, OracleParserInvoice 
 from ledger.emails.emails import sendHtmlEmail
 from ledger.payments import models as payment_models
-from ledger.payments.models import TrackRefund, LinkedInvoice, OracleAccountCode, RefundFailed, OracleInterfaceSystem
+from ledger.payments import parallel
+from ledger.payments.models import TrackRefund, LinkedInvoice, OracleAccountCode, RefundFailed
 from decimal import Decimal as D
 import json
 import os
@@ -25,8 +25,11 @@ class Command(BaseCommand):
          settlement_date_search = yesterday.strftime("%Y%m%d")
          parser.add_argument('settlement_date', nargs='?', default=settlement_date_search)
          parser.add_argument('system_id', nargs='?', default=None)
+         parser.add_argument('--processes', type=int, default=None, help='Systems audited at once, defaults to ORACLE_SYSTEM_PROCESSES')
 
     def handle(self, *args, **options):
+           if parallel.run_command_per_system(__name__.rsplit('.', 1)[-1], options['settlement_date'], options['system_id'], options['processes']):
+               return
 
            SYSTEM_ID = ''
            time_intervals = [
@@ -79,40 +82,32 @@ class Command(BaseCommand):
                    settlement_date_search = options['settlement_date']
                settlement_date_search_obj = datetime.strptime(settlement_date_search, '%Y%m%d')
 
+               ledger_bpoint = reconcile.ledger_transactions(settlement_date=settlement_date_search_obj, crn1__startswith=SYSTEM_ID)
+               invoices = list(Invoice.objects.filter(settlement_date=settlement_date_search_obj, system=SYSTEM_ID))
+               order_totals = reconcile.order_totals(inv.order_number for inv in invoices if inv.order_number)
+               tz = timezone.get_current_timezone()
+
                for ti in time_intervals:
                     print (ti)
                     settlement_date_search_obj_delta = settlement_date_search_obj + timedelta(days=ti['day'])
                     start_li = settlement_date_search_obj_delta.strftime("%Y-%m-%d")+' '+ti['hour']+':00:00'
                     end_li = settlement_date_search_obj_delta.strftime("%Y-%m-%d")+' '+ti['hour']+':59:59'
                     print (start_li+" to "+end_li)
+                    start_dt = timezone.make_aware(datetime.strptime(start_li, "%Y-%m-%d %H:%M:%S"), tz)
+                    end_dt = timezone.make_aware(datetime.strptime(end_li, "%Y-%m-%d %H:%M:%S"), tz)
 
-                    bpoint_total = D('0.00')
-                    bpoint_transactions = []
-                    bp_trans = BpointTransaction.objects.filter(settlement_date=settlement_date_search_obj, processed__gte=start_li, processed__lte=end_li,  crn1__startswith=SYSTEM_ID)
-                    for bp in bp_trans:
-                        if bp.action == 'payment':
-                            bpoint_total = bpoint_total + bp.amount
-
-                        if bp.action == 'refund':
-                            bpoint_total = bpoint_total - bp.amount
-                        bpoint_transactions.append(bp.crn1+' ('+str(bp.amount)+')')
-
+                    bp_trans = [bp for bp in ledger_bpoint if bp.processed and start_dt <= bp.processed <= end_dt]
+                    bpoint_total = reconcile.bpoint_total(bp_trans)
+                    bpoint_transactions = [bp.crn1+' ('+str(bp.amount)+')' for bp in bp_trans]
 
                     order_total = D('0.00')
                     order_invoices = []
-                    invoices = Invoice.objects.filter(settlement_date=settlement_date_search_obj, created__gte=start_li, created__lte=end_li, system=SYSTEM_ID)
                     for inv in invoices:
+                        if not (start_dt <= inv.created <= end_dt):
+                            continue
                         print (inv.order_number)
-                        orders = Order.objects.filter(number=inv.order_number)
-                        line_order_total = D('0.00')
-                        for o in orders:
-                            order_lines = OrderLine.objects.filter(order=o)
-                            for ol in order_lines:
-
-                                if 'order' in ol.payment_details:
-                                   for pd_key,pd_val in ol.payment_details['order'].items():
-                                       order_total = order_total + D(pd_val)
-                                       line_order_total = line_order_total + D(pd_val)
+                        line_order_total = order_totals.get(inv.order_number, D('0.00'))
+                        order_total = order_total + line_order_total
                         order_invoices.append(inv.reference+' ('+str(line_order_total)+')')
 
                     row = {}
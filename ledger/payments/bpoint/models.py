@@ -3,21 +3,19 @@ import datetime
 from decimal import Decimal as D
 from django.db import models,transaction
 from django.db.models import Q
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.core.exceptions import ValidationError
 from ledger.payments.bpoint import settings as bpoint_settings
 from django.utils.encoding import python_2_unicode_compatible
 #from oscar.apps.order.models import Order
-from ledger.order.models import Order
+from ledger.order.models import Order, LineAllocation
 from ledger.accounts.models import EmailUser
 from ledger.payments.emails import send_refund_email
-from django.core.cache import cache
 from confy import env
 import datetime
-import hashlib
 from ledger.payments import trans_hash
 
-change_hash = trans_hash.bpoint_transaction_hash()
-
 class BpointTransaction(models.Model):
     ACTION_TYPES = (
         ('payment','payment'),
@@ -78,17 +76,28 @@ class BpointTransaction(models.Model):
     def __unicode__(self):
         return self.txn_number
 
+    def payment_totals(self, values=None):
+        ''' {crn1: change to the payment summary} of this transaction, or of
+            values read from the table before a save.
+        '''
+        from ledger.payments.invoice.models import payment_totals
+        values = values or {'crn1': self.crn1, 'action': self.action, 'response_code': self.response_code, 'amount': self.amount}
+        if values['response_code'] != '0' or values['amount'] is None:
+            return {}
+        return {values['crn1']: payment_totals({values['action']: D(values['amount'])}, {}, {})}
+
     def save(self, *args, **kwargs):
-        super(BpointTransaction, self).save(*args, **kwargs)
-        cache.delete('BpointTransaction')
-        bt = BpointTransaction.objects.all().order_by('-id')[:1]
-        if bt.count() > 0:
-            bt[0].id
-            lastest_row_string = str(bt[0].id)
-            #change_hash = hashlib.md5(lastest_row_string.encode('utf-8')).hexdigest()
-            change_hash = hashlib.md5(datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S").encode('utf-8')).hexdigest()
-            cache.set('BpointTransaction', change_hash,  86400)
-        
+        from ledger.payments.invoice.models import InvoicePaymentSummary
+        with transaction.atomic():
+            previous = None
+            if self.pk:
+                previous = BpointTransaction.objects.filter(pk=self.pk).values('crn1', 'action', 'response_code', 'amount').first()
+            super(BpointTransaction, self).save(*args, **kwargs)
+            # Only evict the cached transactions of the invoices this transaction belongs to
+            trans_hash.invalidate_invoice_transactions('BpointTransaction', self.crn1, previous['crn1'] if previous else None)
+
+            # Move this transaction's amount between the payment totals of the affected invoices
+            InvoicePaymentSummary.move_totals(self.payment_totals(previous) if previous else None, self.payment_totals())
 
     @property
     def approved(self):
@@ -102,38 +111,24 @@ class BpointTransaction(models.Model):
     @property
     def payment_allocated(self):
         from ledger.payments.models import Invoice
-        allocated = D('0.0')
         try:
             invoice = Invoice.objects.get(reference=self.crn1)
         except Invoice.DoesNotExist:
             invoice = None
-        if invoice and invoice.order:
-            lines = invoice.order.lines.all()
-            for line in lines:
-                for k,v in line.payment_details.items():
-                    if k == 'card':
-                        for i,a in v.items():
-                            if i == str(self.id):
-                                allocated += D(a)
-        return allocated
+        if invoice and invoice.order_number:
+            return LineAllocation.objects.filter(line__order__number=invoice.order_number).allocated('card', self.id, kind='payment')
+        return D('0.0')
 
     @property
     def refund_allocated(self):
         from ledger.payments.models import Invoice
-        allocated = D('0.0')
         try:
             invoice = Invoice.objects.get(reference=self.crn1)
         except Invoice.DoesNotExist:
             invoice = None
-        if invoice and invoice.order:
-            lines = invoice.order.lines.all()
-            for line in lines:
-                for k,v in line.refund_details.items():
-                    if k == 'card':
-                        for i,a in v.items():
-                            if i == str(self.id):
-                                allocated += D(a)
-        return allocated
+        if invoice and invoice.order_number:
+            return LineAllocation.objects.filter(line__order__number=invoice.order_number).allocated('card', self.id, kind='refund')
+        return D('0.0')
 
     @property
     def refundable_amount(self):
@@ -250,6 +245,12 @@ class BpointTransaction(models.Model):
             except:
                 raise
 
+@receiver(post_delete, sender=BpointTransaction)
+def _bpoint_transaction_post_delete(sender, instance, **kwargs):
+    from ledger.payments.invoice.models import InvoicePaymentSummary
+    trans_hash.invalidate_invoice_transactions('BpointTransaction', instance.crn1)
+    InvoicePaymentSummary.move_totals(removed=instance.payment_totals())
+
 class TempBankCard(object):
     def __init__(self,card_number,expiry_date,ccv=None):
         self.number=card_number
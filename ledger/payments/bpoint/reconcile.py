@@ -0,0 +1,138 @@
+'''
+    Reconciliation of bpoint gateway settlements against the ledger.
+
+    Both sides are loaded once and indexed in dicts, every comparison is a
+    lookup instead of a loop over the other side.
+'''
+
+from decimal import Decimal as D
+from operator import attrgetter
+from django.db.models import Sum
+from ledger.payments.bpoint.models import BpointTransaction
+
+# Number of values sent in a single IN (...) lookup
+RECONCILE_CHUNK_SIZE = 1000
+
+# Ways two transactions can be matched
+KEYS = {
+    'transaction': attrgetter('crn1', 'action', 'txn_number'),
+    'crn1': attrgetter('crn1'),
+    'crn1_action': attrgetter('crn1', 'action'),
+    'txn_number': attrgetter('txn_number'),
+}
+
+def chunks(values, size=RECONCILE_CHUNK_SIZE):
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+def approved(txn):
+    ''' Gateway transaction that settled.
+    '''
+    return txn.bank_response_code == '00' and txn.response_code == '0'
+
+def gateway_amount(amount):
+    ''' Gateway amounts are in cents, formatted the way the audit emails show them.
+    '''
+    return str(amount)[:-2]+'.'+str(amount)[-2:]
+
+def index(rows, key='transaction'):
+    ''' {key: [rows]} keeping the order the rows came in.
+    '''
+    getkey = KEYS[key]
+    indexed = {}
+    for row in rows:
+        indexed.setdefault(getkey(row), []).append(row)
+    return indexed
+
+def ledger_transactions(**filters):
+    ''' BpointTransaction rows for a lookup like crn1__in or txn_number__in,
+        loaded in chunks of RECONCILE_CHUNK_SIZE.
+    '''
+    lookup = [k for k in filters if k.endswith('__in')]
+    if len(lookup) != 1:
+        return list(BpointTransaction.objects.filter(**filters))
+    field = lookup[0]
+    values = [v for v in set(filters.pop(field)) if v]
+    rows = []
+    for chunk in chunks(values):
+        filters[field] = chunk
+        rows.extend(BpointTransaction.objects.filter(**filters))
+    # Chunks break the model ordering, put it back
+    rows.sort(key=lambda t: t.created, reverse=True)
+    return rows
+
+def order_totals(order_numbers):
+    ''' {order number: total of payment_details['order']} for the given orders.
+    '''
+    from ledger.order.models import LineAllocation
+    totals = {}
+    for chunk in chunks(set(order_numbers)):
+        totals.update(
+            LineAllocation.objects.filter(line__order__number__in=chunk, kind='payment', method='order')
+            .order_by().values_list('line__order__number').annotate(total=Sum('amount'))
+        )
+    return totals
+
+def bpoint_total(transactions):
+    ''' Payments less refunds.
+    '''
+    total = D('0.00')
+    for t in transactions:
+        if t.action == 'payment':
+            total += t.amount
+        elif t.action == 'refund':
+            total -= t.amount
+    return total
+
+
+class Reconciliation(object):
+    ''' Matches gateway transactions against ledger BpointTransaction rows.
+
+        Only approved gateway transactions are reconciled, the ledger is
+        checked against everything the gateway returned.
+    '''
+
+    def __init__(self, gateway, ledger):
+        self.gateway = list(gateway)
+        self.approved = [c for c in self.gateway if approved(c)]
+        self.ledger = list(ledger)
+        self._indexes = {}
+
+    def _index(self, side, key):
+        if (side, key) not in self._indexes:
+            self._indexes[(side, key)] = index(getattr(self, side), key)
+        return self._indexes[(side, key)]
+
+    def matched(self, key='transaction'):
+        ''' [(gateway txn, [ledger rows])] for gateway transactions found in the ledger.
+        '''
+        ledger = self._index('ledger', key)
+        getkey = KEYS[key]
+        return [(c, ledger[getkey(c)]) for c in self.approved if getkey(c) in ledger]
+
+    def missing_in_ledger(self, key='transaction'):
+        ledger = self._index('ledger', key)
+        getkey = KEYS[key]
+        return [c for c in self.approved if getkey(c) not in ledger]
+
+    def missing_in_gateway(self, key='transaction'):
+        gateway = self._index('gateway', key)
+        getkey = KEYS[key]
+        return [t for t in self.ledger if getkey(t) not in gateway]
+
+    def duplicates(self, key='crn1'):
+        ''' Approved gateway transactions whose key was already seen earlier
+            in the settlement, reversals are left out.
+        '''
+        getkey = KEYS[key]
+        seen = set()
+        dupes = []
+        for c in self.approved:
+            if c.action == 'reversal':
+                continue
+            k = getkey(c)
+            if k in seen:
+                dupes.append(c)
+            seen.add(k)
+        return dupes
@@ -0,0 +1,177 @@
+'''
+    Renders the invoice pdfs of many invoices at once, for finance staff
+    pulling every invoice of a system or date range.
+
+    Invoices are rendered in chunks by a pool of spawned processes. Each
+    process keeps its decoded logos and the reportlab fonts and styles
+    between documents, and renders through create_invoice_pdf_bytes so the
+    invoice pdf cache is warmed as it goes. The parent writes each chunk into
+    a zip or a merged pdf as it arrives.
+
+    A zip is written one invoice at a time. A merged pdf is held in memory
+    until it is complete, so it is only for small batches, at most
+    INVOICE_PDF_MAX_MERGED invoices. Use a zip for anything bigger.
+'''
+
+import multiprocessing
+import os
+import re
+import time
+import traceback
+import zipfile
+from io import BytesIO
+
+from django.conf import settings
+from django.db import connections
+
+# Page objects of the pdf, /Type /Pages is the page tree
+PAGE_RE = re.compile(rb'/Type\s*/Page\b')
+
+def pdf_processes():
+    return getattr(settings, 'INVOICE_PDF_PROCESSES', 1)
+
+def max_merged_invoices():
+    return getattr(settings, 'INVOICE_PDF_MAX_MERGED', 500)
+
+def count_pages(value):
+    return len(PAGE_RE.findall(value))
+
+def _setup_process(databases):
+    import django
+    django.setup()
+    # Use the databases the parent process is connected to, the test
+    # databases when run under the test runner
+    for alias, name in databases.items():
+        connections[alias].settings_dict['NAME'] = name
+    from ledger.payments import pdf
+    # Decoded once here and used by every document the process renders
+    for path in (pdf.DPAW_HEADER_LOGO, pdf.DPAW_HEADER_LOGO_SM, pdf.ROTTNEST_ISLAND_LOGO, pdf.BPAY_LOGO):
+        if os.path.exists(path):
+            pdf._image(path)
+
+def render_chunk(references):
+    ''' Render the invoices of references, returns a (reference, pdf bytes, error) per reference.
+    '''
+    from ledger.payments import pdf
+    from ledger.payments.invoice.models import Invoice
+    invoices = dict((i.reference, i) for i in Invoice.objects.filter(reference__in=references))
+    results = []
+    for reference in references:
+        invoice = invoices.get(reference)
+        if invoice is None:
+            results.append((reference, None, 'Invoice not found'))
+            continue
+        try:
+            value = pdf.create_invoice_pdf_bytes('invoice.pdf', invoice)
+            results.append((reference, value, None if value else 'No pdf for this invoice'))
+        except Exception:
+            results.append((reference, None, traceback.format_exc()))
+    return results
+
+def render_chunks(references, processes, chunksize):
+    ''' Yield the results of render_chunk, in the order of references.
+    '''
+    chunks = [references[i:i + chunksize] for i in range(0, len(references), chunksize)]
+    processes = min(processes, len(chunks))
+    # Pool workers (job_queue_worker) are daemons and can't start processes of their own
+    if processes <= 1 or multiprocessing.current_process().daemon:
+        for chunk in chunks:
+            yield render_chunk(chunk)
+        return
+
+    # Children open their own connections, don't hand them ours
+    databases = dict((alias, connections[alias].settings_dict['NAME']) for alias in connections)
+    connections.close_all()
+    context = multiprocessing.get_context('spawn')
+    pool = context.Pool(processes, initializer=_setup_process, initargs=(databases,))
+    try:
+        for results in pool.imap(render_chunk, chunks):
+            yield results
+    except BaseException:
+        # A failed chunk or the caller giving up, the remaining chunks aren't wanted
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+class ZipOutput(object):
+
+    def __init__(self, path):
+        self.zip = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+
+    def add(self, reference, value):
+        self.zip.writestr('invoice-{}.pdf'.format(reference), value)
+
+    def close(self):
+        self.zip.close()
+
+class MergedPDFOutput(object):
+    ''' Every page is kept in the writer until close, small batches only.
+    '''
+
+    def __init__(self, path):
+        from pypdf import PdfWriter
+        self.path = path
+        self.writer = PdfWriter()
+
+    def add(self, reference, value):
+        self.writer.append(BytesIO(value), outline_item=reference)
+
+    def close(self):
+        with open(self.path, 'wb') as f:
+            self.writer.write(f)
+        self.writer.close()
+
+OUTPUTS = {'zip': ZipOutput, 'pdf': MergedPDFOutput}
+
+def render_invoices(invoices, output=None, output_format=None, processes=None, chunksize=20):
+    ''' Render the invoices (a queryset or a list of references) into output,
+        a zip of one pdf per invoice or one merged pdf. With no output the
+        invoices are only rendered, which warms the invoice pdf cache.
+
+        A merged pdf of more than INVOICE_PDF_MAX_MERGED invoices raises
+        ValueError before anything is rendered.
+
+        Returns the documents, pages, failures and pages per second.
+    '''
+    if processes is None:
+        processes = pdf_processes()
+    if hasattr(invoices, 'values_list'):
+        invoices = invoices.order_by('created', 'id').values_list('reference', flat=True)
+    references = list(invoices)
+    if output and output_format is None:
+        output_format = 'pdf' if output.lower().endswith('.pdf') else 'zip'
+    if output and output_format == 'pdf' and len(references) > max_merged_invoices():
+        raise ValueError('{} invoices are too many to merge into one pdf, the most is {}. Write a zip instead.'.format(len(references), max_merged_invoices()))
+
+    started = time.time()
+    stats = {'documents': 0, 'pages': 0, 'failed': {}}
+    writer = None
+    if output:
+        # Written beside the output and moved into place once complete
+        partial = output + '.part'
+        writer = OUTPUTS[output_format](partial)
+    try:
+        for results in render_chunks(references, processes, chunksize):
+            for reference, value, error in results:
+                if error:
+                    stats['failed'][reference] = error
+                    continue
+                stats['documents'] += 1
+                stats['pages'] += count_pages(value)
+                if writer:
+                    writer.add(reference, value)
+        if writer:
+            writer.close()
+            writer = None
+            os.replace(partial, output)
+    finally:
+        if writer:
+            writer.close()
+            os.remove(partial)
+
+    stats['elapsed'] = time.time() - started
+    stats['pages_per_second'] = stats['pages'] / stats['elapsed'] if stats['elapsed'] else 0
+    return stats
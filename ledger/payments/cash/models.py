@@ -1,14 +1,14 @@
 from __future__ import unicode_literals
 import decimal
-from django.db import models
+from django.db import models, transaction
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.core.exceptions import ValidationError
 from ledger.payments.bpoint import settings as bpoint_settings
 from django.utils.encoding import python_2_unicode_compatible
-from ledger.payments.invoice.models import Invoice
-from django.core.cache import cache
-from datetime import datetime
+from ledger.payments.invoice.models import Invoice, InvoicePaymentSummary, payment_totals
+from ledger.order.models import LineAllocation
 from ledger.payments import trans_hash
-import hashlib
 
 DISTRICT_PERTH_HILLS = 'PHS'
 DISTRICT_SWAN_COASTAL = 'SWC'
@@ -74,13 +74,6 @@ REGION_CHOICES = (
     (REGION_SOUTH_COAST,'South Coast')
 )
 
-change_hash = trans_hash.cash_transaction_hash()
-
-change_cash_hash = cache.get('CashTransaction')
-if change_cash_hash is None:
-   change_cash_hash = hashlib.md5(datetime.now().strftime("%m/%d/%Y, %H:%M:%S").encode('utf-8')).hexdigest()
-   cache.set('CashTransaction', change_cash_hash,  86400)
-
 class Region(models.Model):
     name = models.CharField(max_length=50, unique=True)
 
@@ -123,18 +116,26 @@ class CashTransaction(models.Model):
     class Meta:
         db_table = 'payments_cashtransaction'
 
+    def payment_totals(self, values=None):
+        ''' {invoice reference: change to the payment summary} of this
+            transaction, or of values read from the table before a save.
+        '''
+        values = values or {'invoice_id': self.invoice_id, 'type': self.type, 'amount': self.amount}
+        return {values['invoice_id']: payment_totals({}, {}, {values['type']: decimal.Decimal(values['amount'])})}
+
     def save(self, *args, **kwargs):
         # Validations
         self.full_clean()
-        cache.delete('CashTransaction')
-        super(CashTransaction, self).save(*args, **kwargs)
-        ct = CashTransaction.objects.all().order_by('-id')[:1]
-        if ct.count() > 0:
-            ct[0].id
-            lastest_cash_row_string = str(ct[0].id)
-            #change_cash_hash = hashlib.md5(lastest_cash_row_string.encode('utf-8')).hexdigest()
-            change_cash_hash = hashlib.md5(datetime.now().strftime("%m/%d/%Y, %H:%M:%S").encode('utf-8')).hexdigest()
-            cache.set('CashTransaction', change_cash_hash,  86400)
+        with transaction.atomic():
+            previous = None
+            if self.pk:
+                previous = CashTransaction.objects.filter(pk=self.pk).values('invoice_id', 'type', 'amount').first()
+            super(CashTransaction, self).save(*args, **kwargs)
+            # Only evict the cached transactions of the invoice this transaction belongs to
+            trans_hash.invalidate_invoice_transactions('CashTransaction', self.invoice_id, previous['invoice_id'] if previous else None)
+
+            # Move this transaction's amount between the payment totals of the affected invoices
+            InvoicePaymentSummary.move_totals(self.payment_totals(previous) if previous else None, self.payment_totals())
 
     def clean(self, *args, **kwargs):
         if not self.receipt and self.external:
@@ -176,42 +177,26 @@ class CashTransaction(models.Model):
 
     @property
     def payment_allocated(self):
-        allocated = decimal.Decimal('0.0')
         invoice = self.invoice
-        if invoice.order:
-            lines = invoice.order.lines.all()
-            for line in lines:
-                for k,v in line.payment_details.items():
-                    if k == 'cash':
-                        for i,a in v.items():
-                            if i == str(self.id):
-                                allocated += decimal.Decimal(a)
-        return allocated
+        if invoice.order_number:
+            return LineAllocation.objects.filter(line__order__number=invoice.order_number).allocated('cash', self.id, kind='payment')
+        return decimal.Decimal('0.0')
 
     @property
     def refund_allocated(self):
-        allocated = decimal.Decimal('0.0')
         invoice = self.invoice
-        if invoice.order:
-            lines = invoice.order.lines.all()
-            for line in lines:
-                for k,v in line.refund_details.items():
-                    if k == 'cash':
-                        for i,a in v.items():
-                            if i == str(self.id):
-                                allocated += decimal.Decimal(a)
-        return allocated
+        if invoice.order_number:
+            return LineAllocation.objects.filter(line__order__number=invoice.order_number).allocated('cash', self.id, kind='refund')
+        return decimal.Decimal('0.0')
 
     @property
     def deduction_allocated(self):
-        allocated = decimal.Decimal('0.0')
         invoice = self.invoice
-        if invoice.order:
-            lines = invoice.order.lines.all()
-            for line in lines:
-                for k,v in line.deduction_details.items():
-                    if k == 'cash':
-                        for i,a in v.items():
-                            if i == str(self.id):
-                                allocated += decimal.Decimal(a)
-        return allocated
+        if invoice.order_number:
+            return LineAllocation.objects.filter(line__order__number=invoice.order_number).allocated('cash', self.id, kind='deduction')
+        return decimal.Decimal('0.0')
+
+@receiver(post_delete, sender=CashTransaction)
+def _cash_transaction_post_delete(sender, instance, **kwargs):
+    trans_hash.invalidate_invoice_transactions('CashTransaction', instance.invoice_id)
+    InvoicePaymentSummary.move_totals(removed=instance.payment_totals())
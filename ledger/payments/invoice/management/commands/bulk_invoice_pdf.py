@@ -0,0 +1,53 @@
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from ledger.payments.bulk_pdf import render_invoices
+from ledger.payments.invoice.models import Invoice
+
+class Command(BaseCommand):
+    help = 'Renders the invoice pdfs of a system or date range into a zip or a merged pdf.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', nargs='?', default=None, help='.zip or .pdf file to write, leave out to only warm the invoice pdf cache')
+        parser.add_argument('--system', default=None, help='Oracle system id, e.g. 0369')
+        parser.add_argument('--start', default=None, help='First invoice date, YYYY-MM-DD')
+        parser.add_argument('--end', default=None, help='Last invoice date, YYYY-MM-DD')
+        parser.add_argument('--reference', action='append', default=[], help='Invoice reference, can be given more than once')
+        parser.add_argument('--format', choices=['zip', 'pdf'], default=None, help='Defaults to the output file extension, a merged pdf is for small batches only')
+        parser.add_argument('--processes', type=int, default=None, help='Defaults to INVOICE_PDF_PROCESSES')
+
+    def parse_date(self, value):
+        try:
+            return timezone.make_aware(datetime.strptime(value, '%Y-%m-%d'))
+        except ValueError:
+            raise CommandError('Dates are YYYY-MM-DD, got {}'.format(value))
+
+    def handle(self, *args, **options):
+        invoices = Invoice.objects.all()
+        if options['system']:
+            invoices = invoices.filter(system=options['system'])
+        if options['start']:
+            invoices = invoices.filter(created__gte=self.parse_date(options['start']))
+        if options['end']:
+            invoices = invoices.filter(created__lt=self.parse_date(options['end']) + timedelta(days=1))
+        if options['reference']:
+            invoices = invoices.filter(reference__in=options['reference'])
+        if not (options['system'] or options['start'] or options['end'] or options['reference']):
+            raise CommandError('Give a system, a date range or invoice references.')
+
+        try:
+            stats = render_invoices(invoices, options['output'], options['format'], options['processes'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        for reference, error in stats['failed'].items():
+            self.stderr.write('{} FAILED\n{}'.format(reference, error))
+        self.stdout.write('Documents: {}'.format(stats['documents']))
+        self.stdout.write('Pages: {}'.format(stats['pages']))
+        self.stdout.write('Failed: {}'.format(len(stats['failed'])))
+        self.stdout.write('Elapsed: {:.1f}s'.format(stats['elapsed']))
+        self.stdout.write('Pages per second: {:.1f}'.format(stats['pages_per_second']))
+        if options['output']:
+            self.stdout.write(self.style.SUCCESS('Written to {}'.format(options['output'])))
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+from ledger.payments.invoice.models import Invoice, InvoicePaymentSummary
+
+class Command(BaseCommand):
+    help = 'Rebuild the materialised payment totals for invoices.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('system_id', nargs='?', default=None)
+        parser.add_argument('--missing-only', action='store_true', dest='missing_only', default=False, help='Only build summaries for invoices that do not have one.')
+
+    def handle(self, *args, **options):
+        invoices = Invoice.objects.all()
+        if options['system_id']:
+            invoices = invoices.filter(system=options['system_id'])
+        if options['missing_only']:
+            invoices = invoices.filter(payment_summary__isnull=True)
+        count = 0
+        try:
+            for reference in invoices.values_list('reference', flat=True).iterator():
+                InvoicePaymentSummary.refresh(reference)
+                count += 1
+        except Exception as e:
+            raise CommandError(e)
+
+        self.stdout.write(self.style.SUCCESS('Rebuilt payment summaries for {} invoices.'.format(count)))
@@ -1,7 +1,8 @@
 from django.core.management.base import BaseCommand
 from django.utils import timezone
-from ledger.payments.models import Invoice, UnpaidInvoice
-from ledger.order.models import Order, Line as OrderLine
+from ledger.payments.models import UnpaidInvoice
+from ledger.payments.invoice.models import SETTLED_STATUSES
+from ledger.order.models import Line as OrderLine
 #from oscar.apps.order.models import Order
 # from ledger.basket.models import Basket
 from django.conf import settings
@@ -19,6 +20,32 @@ import xlsxwriter
 import json
 import os
 
+# Order numbers sent in a single IN (...) lookup
+LINE_CHUNK_SIZE = 1000
+
+def unpaid_invoices(system_id):
+    '''Rows of the unpaid invoice table for the system, oldest invoice first.
+    '''
+    return list(
+        UnpaidInvoice.objects.filter(invoice_reference__startswith=system_id, voided=False)
+        .exclude(invoice__payment_summary__payment_status__in=SETTLED_STATUSES)
+        .order_by('invoice__created', 'invoice_id')
+        .values('invoice_reference', 'amount', 'due_date', 'due_status', 'invoice__created', 'invoice__order_number', 'invoice__payment_summary__payment_status')
+    )
+
+def unpaid_invoice_lines(unpaid):
+    '''(invoice row, order line) for the order lines of the unpaid invoices,
+        loaded LINE_CHUNK_SIZE orders at a time.
+    '''
+    for n in range(0, len(unpaid), LINE_CHUNK_SIZE):
+        chunk = unpaid[n:n + LINE_CHUNK_SIZE]
+        lines = {}
+        for ol in OrderLine.objects.filter(order__number__in=[i['invoice__order_number'] for i in chunk]).select_related('order').order_by('order_id', 'id'):
+            lines.setdefault(ol.order.number, []).append(ol)
+        for i in chunk:
+            for ol in lines.get(i['invoice__order_number'], []):
+                yield i, ol
+
 class Command(BaseCommand):
     help = 'Will produce a report of unpaid invoices to be used as a debtor report.'
 
@@ -27,6 +54,7 @@ class Command(BaseCommand):
         #  settlement_date_search = yesterday.strftime("%Y%m%d")
         #  parser.add_argument('settlement_date', nargs='?', default=settlement_date_search)
         parser.add_argument('system_id', nargs='?', default=None)
+        parser.add_argument('--rebuild', action='store_true', help='Rescan every invoice of the system into the unpaid invoice table first')
 
     def handle(self, *args, **options):
 
@@ -39,6 +67,8 @@ class Command(BaseCommand):
                 # print ("No system id provided")
                 # return
                 ois = payment_models.OracleInterfaceSystem.objects.filter(integration_type='bpoint_api',enabled=True,send_debtor_report=True)
+            # The table is kept up to date as invoices are paid, only the due dates move on their own
+            UnpaidInvoice.refresh_due_status()
             for oracle_system in ois: 
                 print ("SYSTEM LOOP")        
                 print (oracle_system)
@@ -48,7 +78,8 @@ class Command(BaseCommand):
                     os.makedirs(str(settings.BASE_DIR)+'/tmp/')
                 excel_file = str(settings.BASE_DIR)+'/tmp/'+md5hash+'.xlsx'
                 print (excel_file)
-                workbook = xlsxwriter.Workbook(excel_file)                        
+                # Rows are flushed to disk as they are written, each sheet must be written top to bottom
+                workbook = xlsxwriter.Workbook(excel_file, {'constant_memory': True})
                 worksheet = workbook.add_worksheet("Unpaid Invoice Report")
                 format = workbook.add_format()
                 format.set_pattern(1)
@@ -57,74 +88,33 @@ class Command(BaseCommand):
                 format.set_bold()
                 col = 0 
                 row = 0
-                worksheet.write(row, col, "CREATED", format)
                 worksheet.set_column(0, 0, 12)
-                worksheet.write(row, col + 1, "INVOICE NO",format)
                 worksheet.set_column(1, 1, 30)
-                worksheet.write(row, col + 2, "AMOUNT",format)
                 worksheet.set_column(2, 2, 30)
-                worksheet.write(row, col + 3, "PAYMENT STATUS",format)
                 worksheet.set_column(3, 3, 20)
-                worksheet.write(row, col + 4, "DUE DATE",format)
                 worksheet.set_column(4, 4, 20)       
-                worksheet.write(row, col + 5, "DUE STATUS",format)
                 worksheet.set_column(5, 5, 20)               
+                worksheet.write_row(row, col, ["CREATED", "INVOICE NO", "AMOUNT", "PAYMENT STATUS", "DUE DATE", "DUE STATUS"], format)
                 row += 1
 
-            # for oracle_system in ois:
-                print (oracle_system)
                 SYSTEM_ID = oracle_system.system_id
                 print (SYSTEM_ID)
-                iv = Invoice.objects.filter(reference__startswith=SYSTEM_ID, due_date__isnull=False)                
+                if options['rebuild']:
+                    UnpaidInvoice.rebuild(SYSTEM_ID)
+                unpaid = unpaid_invoices(SYSTEM_ID)
                 print ("IV COUINT")
-                print (iv.count())
-                    
-                for i in iv:
-                    
-    
-                    payment_status = i.payment_status
-                     
-                    if payment_status == 'paid' or payment_status == 'over_paid' or payment_status == 'cancelled':  
-                         pass
-                    else:
-                        print ("Adding invoice: "+i.reference)      
-                        worksheet.write(row, col, i.created.astimezone().strftime('%d/%m/%Y'))
-                        worksheet.write(row, col + 1, i.reference)
-                        worksheet.write(row, col + 2, i.amount)
-                        worksheet.write(row, col + 3, payment_status)
-                        due_date = ""
-                        if i.due_date is not None:
-                            due_date = i.due_date.strftime('%d/%m/%Y')
-                        worksheet.write(row, col + 4, due_date)
-                        due_status  = "Not Due"
-                        if payment_status == 'paid' or payment_status == 'over_paid':                        
-                            due_status  = "Paid"
-                        else:
-                            if i.due_date:
-                                if datetime.now().date() > i.due_date:
-                                    due_status  = "Overdue"
-                                else:
-                                    due_status  = "Not Due"
-                            else:
-                                due_status = "Unknown"
-                        worksheet.write(row, col + 5, due_status)
-                        # Add line here to ammend to unpaid invoices
-                        ui_array = UnpaidInvoice.objects.filter(invoice=i)
-                        if ui_array.count() > 0:
-                            ui = UnpaidInvoice.objects.get(invoice=i)
-                            ui.due_date =i.due_date
-                            ui.due_status = due_status
-                            ui.amount = i.amount
-                            ui.save()
-                        else:
-                            if due_status != "Paid":
-                                UnpaidInvoice.objects.create(invoice=i,invoice_reference=i.reference,system=i.system,due_status=due_status,due_date=i.due_date, amount=i.amount)
-
-                        if due_status == 'Paid':
-                            UnpaidInvoice.objectsfilter(invoice=i).delete()
-                        
-                        row += 1
+                print (len(unpaid))
 
+                for i in unpaid:
+                    worksheet.write_row(row, col, [
+                        i['invoice__created'].astimezone().strftime('%d/%m/%Y'),
+                        i['invoice_reference'],
+                        i['amount'],
+                        i['invoice__payment_summary__payment_status'],
+                        i['due_date'].strftime('%d/%m/%Y') if i['due_date'] else "",
+                        i['due_status'],
+                    ])
+                    row += 1
 
                 # new work sheet Itemised Unpaid Invoice Report
                 worksheet2 = workbook.add_worksheet("Itemised Unpaid Invoice Report")
@@ -135,77 +125,35 @@ class Command(BaseCommand):
                 format.set_bold()
                 col = 0 
                 row = 0
-                worksheet2.write(row, col, "INVOICE NUMBER", format)
                 worksheet2.set_column(0, 0, 12)
-                worksheet2.write(row, col + 1, "INVOICE DATE",format)
                 worksheet2.set_column(1, 1, 30)
-                worksheet2.write(row, col + 2, "ORDER NUMBER",format)
                 worksheet2.set_column(2, 2, 30)
-                worksheet2.write(row, col + 3, "ORDER CODE",format)
                 worksheet2.set_column(3, 3, 20)
-                worksheet2.write(row, col + 4, "DESCRIPTION",format)
                 worksheet2.set_column(4, 4, 20)       
-                worksheet2.write(row, col + 5, "QUANTITY",format)
                 worksheet2.set_column(5, 5, 20)               
-                worksheet2.write(row, col + 6, "TAX INCL",format)
                 worksheet2.set_column(6, 6, 20)                  
-                worksheet2.write(row, col + 7, "TAX EXCL",format)
                 worksheet2.set_column(7, 7, 20)                  
-                worksheet2.write(row, col + 8, "GST",format)    
                 worksheet2.set_column(8, 8, 20)                                  
-                worksheet2.write(row, col + 9, "DUE DATE",format)                    
                 worksheet2.set_column(9, 9, 20)                      
-                worksheet2.write(row, col + 10, "DUE STATUS",format)    
                 worksheet2.set_column(10, 10, 20)                                                              
+                worksheet2.write_row(row, col, ["INVOICE NUMBER", "INVOICE DATE", "ORDER NUMBER", "ORDER CODE", "DESCRIPTION", "QUANTITY", "TAX INCL", "TAX EXCL", "GST", "DUE DATE", "DUE STATUS"], format)
                 row += 1
 
-                # for oracle_system in ois:
-                #     print (oracle_system)
-                #     SYSTEM_ID = oracle_system.system_id
-                #     print (SYSTEM_ID)
-                iv = Invoice.objects.filter(reference__startswith=SYSTEM_ID, due_date__isnull=False)                
-                    
-                for i in iv:
-                    
-    
-                    payment_status = i.payment_status
-                    
-                    if payment_status == 'paid' or payment_status == 'over_paid' or payment_status == 'cancelled':  
-                        pass
-                    else:  
-                        print ("Adding Order: "+i.order_number)                                                 
-                        orders = Order.objects.filter(number=i.order_number)
-                        for o in orders:
-                            order_lines = OrderLine.objects.filter(order=o)
-                            for ol in order_lines:                                                
-                                calculate_tax_portion = ol.unit_price_incl_tax - ol.unit_price_excl_tax    
-                                worksheet2.write(row, col, i.reference)              
-                                worksheet2.write(row, col + 1, i.created.astimezone().strftime('%d/%m/%Y'))
-                                worksheet2.write(row, col + 2, i.order_number)
-                                worksheet2.write(row, col + 3, ol.oracle_code)
-                                worksheet2.write(row, col + 4, ol.title)                                    
-                                worksheet2.write(row, col + 5, ol.quantity)
-                                worksheet2.write(row, col + 6, ol.unit_price_incl_tax)
-                                worksheet2.write(row, col + 7, ol.unit_price_excl_tax)
-                                worksheet2.write(row, col + 8, calculate_tax_portion)                                    
-
-                                due_date = ""
-                                if i.due_date is not None:
-                                    due_date = i.due_date.strftime('%d/%m/%Y')
-                                worksheet2.write(row, col + 9, due_date)
-                                due_status  = "Not Due"
-                                if payment_status == 'paid' or payment_status == 'over_paid':                        
-                                    due_status  = "Paid"
-                                else:
-                                    if i.due_date:
-                                        if datetime.now().date() > i.due_date:
-                                            due_status  = "Overdue"
-                                        else:
-                                            due_status  = "Not Due"
-                                    else:
-                                        due_status = "Unknown"
-                                worksheet2.write(row, col + 10, due_status)
-                                row += 1
+                for i, ol in unpaid_invoice_lines(unpaid):
+                    worksheet2.write_row(row, col, [
+                        i['invoice_reference'],
+                        i['invoice__created'].astimezone().strftime('%d/%m/%Y'),
+                        i['invoice__order_number'],
+                        ol.oracle_code,
+                        ol.title,
+                        ol.quantity,
+                        ol.unit_price_incl_tax,
+                        ol.unit_price_excl_tax,
+                        ol.unit_price_incl_tax - ol.unit_price_excl_tax,
+                        i['due_date'].strftime('%d/%m/%Y') if i['due_date'] else "",
+                        i['due_status'],
+                    ])
+                    row += 1
 
 
                 workbook.close()     
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 09:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoice', '0020_auto_20250730_2013'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InvoicePaymentSummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bpoint_paid', models.DecimalField(decimal_places=2, default='0.00', max_digits=12)),
+                ('bpay_paid', models.DecimalField(decimal_places=2, default='0.00', max_digits=12)),
+                ('cash_paid', models.DecimalField(decimal_places=2, default='0.00', max_digits=12)),
+                ('refunded', models.DecimalField(decimal_places=2, default='0.00', max_digits=12)),
+                ('deducted', models.DecimalField(decimal_places=2, default='0.00', max_digits=12)),
+                ('balance', models.DecimalField(decimal_places=2, default='0.00', max_digits=12)),
+                ('payment_status', models.CharField(db_index=True, default='unpaid', max_length=20)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('invoice', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='payment_summary', to='invoice.Invoice')),
+            ],
+            options={
+                'db_table': 'payments_invoicepaymentsummary',
+            },
+        ),
+    ]
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import Sum
+
+# Only the pure calculations are taken from the current models, the rows
+# are read and written through the migration snapshot.
+from ledger.payments.invoice.models import calculate_payment_status, payment_totals
+
+CHUNK_SIZE = 1000
+
+
+def build_payment_summaries(apps, schema_editor):
+    ''' Build the payment summary of every invoice that has none, a chunk of
+        invoices at a time with one aggregate query per transaction type.
+    '''
+    Invoice = apps.get_model('invoice', 'Invoice')
+    InvoiceBPAY = apps.get_model('invoice', 'InvoiceBPAY')
+    InvoicePaymentSummary = apps.get_model('invoice', 'InvoicePaymentSummary')
+    BpointTransaction = apps.get_model('bpoint', 'BpointTransaction')
+    BpayTransaction = apps.get_model('bpay', 'BpayTransaction')
+    CashTransaction = apps.get_model('cash', 'CashTransaction')
+
+    missing = Invoice.objects.filter(payment_summary__isnull=True).order_by('id')
+    last_id = 0
+    while True:
+        invoices = list(missing.filter(id__gt=last_id).values_list('id', 'reference', 'amount', 'voided')[:CHUNK_SIZE])
+        if not invoices:
+            break
+        last_id = invoices[-1][0]
+        references = [i[1] for i in invoices]
+
+        bpoint = {}
+        for crn1, action, total in BpointTransaction.objects.filter(crn1__in=references, response_code='0').values('crn1', 'action').annotate(total=Sum('amount')).values_list('crn1', 'action', 'total'):
+            bpoint.setdefault(crn1, {})[action] = total
+        cash = {}
+        for reference, cash_type, total in CashTransaction.objects.filter(invoice_id__in=references).values('invoice_id', 'type').annotate(total=Sum('amount')).values_list('invoice_id', 'type', 'total'):
+            cash.setdefault(reference, {})[cash_type] = total
+        # A bpay transaction counts once for the invoice of its crn and once
+        # for each invoice it is linked to
+        bpay_rows = {}
+        for bpay_id, crn, code, bpay_type, amount in BpayTransaction.objects.filter(crn__in=references).values_list('id', 'crn', 'p_instruction_code', 'type', 'amount'):
+            bpay_rows[(crn, bpay_id)] = (code, str(bpay_type), amount)
+        for bpay_id, reference, code, bpay_type, amount in InvoiceBPAY.objects.filter(invoice__reference__in=references).values_list('bpay_id', 'invoice__reference', 'bpay__p_instruction_code', 'bpay__type', 'bpay__amount'):
+            bpay_rows[(reference, bpay_id)] = (code, str(bpay_type), amount)
+        bpay = {}
+        for (reference, bpay_id), (code, bpay_type, amount) in bpay_rows.items():
+            totals = bpay.setdefault(reference, {})
+            totals[(code, bpay_type)] = totals.get((code, bpay_type), 0) + amount
+
+        summaries = []
+        for invoice_id, reference, amount, voided in invoices:
+            totals = payment_totals(bpoint.get(reference, {}), bpay.get(reference, {}), cash.get(reference, {}))
+            paid = totals['bpoint_paid'] + totals['bpay_paid'] + totals['cash_paid']
+            balance, payment_status = calculate_payment_status(amount, voided, paid - totals['refunded'])
+            summaries.append(InvoicePaymentSummary(invoice_id=invoice_id, balance=balance, payment_status=payment_status, **totals))
+        InvoicePaymentSummary.objects.bulk_create(summaries)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoice', '0021_invoicepaymentsummary'),
+        ('bpoint', '0021_auto_20221019_1602'),
+        ('bpay', '0014_auto_20180118_1505'),
+        ('cash', '0010_parkstay_rebase'),
+    ]
+
+    operations = [
+        migrations.RunPython(build_payment_summaries, migrations.RunPython.noop),
+    ]
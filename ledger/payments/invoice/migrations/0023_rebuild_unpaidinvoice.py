@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# Only the pure calculations are taken from the current models, the rows
+# are read and written through the migration snapshot.
+from ledger.payments.invoice.models import calculate_due_status
+
+CHUNK_SIZE = 1000
+
+
+def rebuild_unpaid_invoices(apps, schema_editor):
+    ''' Bring the unpaid invoice table in line with the payment summaries,
+        as UnpaidInvoice.track would have left it, a chunk of invoices at a time.
+        Rows of invoices that were paid or lost their due date are removed.
+    '''
+    Invoice = apps.get_model('invoice', 'Invoice')
+    UnpaidInvoice = apps.get_model('invoice', 'UnpaidInvoice')
+
+    UnpaidInvoice.objects.filter(invoice__due_date__isnull=True).delete()
+    UnpaidInvoice.objects.filter(invoice__payment_summary__payment_status__in=['paid', 'over_paid']).delete()
+    UnpaidInvoice.objects.filter(invoice__payment_summary__payment_status='cancelled').update(voided=True)
+
+    owed = Invoice.objects.filter(due_date__isnull=False, payment_summary__isnull=False).exclude(
+        payment_summary__payment_status__in=['paid', 'over_paid', 'cancelled']
+    ).order_by('id')
+    last_id = 0
+    while True:
+        invoices = list(owed.filter(id__gt=last_id).values_list('id', 'reference', 'system', 'amount', 'due_date', 'payment_summary__payment_status')[:CHUNK_SIZE])
+        if not invoices:
+            break
+        last_id = invoices[-1][0]
+        tracked = set(UnpaidInvoice.objects.filter(invoice_id__in=[i[0] for i in invoices]).values_list('invoice_id', flat=True))
+        new_rows = []
+        for invoice_id, reference, system, amount, due_date, payment_status in invoices:
+            fields = {
+                'invoice_reference': reference,
+                'system': system,
+                'amount': amount,
+                'due_date': due_date,
+                'due_status': calculate_due_status(due_date, payment_status),
+                'voided': False,
+            }
+            if invoice_id in tracked:
+                UnpaidInvoice.objects.filter(invoice_id=invoice_id).update(**fields)
+            else:
+                new_rows.append(UnpaidInvoice(invoice_id=invoice_id, **fields))
+        UnpaidInvoice.objects.bulk_create(new_rows)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('invoice', '0022_build_invoicepaymentsummary'),
+    ]
+
+    operations = [
+        migrations.RunPython(rebuild_unpaid_invoices, migrations.RunPython.noop),
+    ]
@@ -4,7 +4,6 @@ import decimal
 from django.db import models,transaction
 from django.db.models import Q
 from django.db.models import Sum
-from django.db.models.functions import Coalesce
 from django.conf import settings
 from django.dispatch import receiver
 from django.db.models.signals import post_delete, pre_save, post_save
@@ -15,13 +14,46 @@ from ledger.order.models import Order
 from ledger.payments.bpay.crn import getCRN
 from ledger.payments.bpay.models import BpayTransaction
 from ledger.payments.bpoint.models import BpointTransaction, TempBankCard, BpointToken, UsedBpointToken
-from django.core.cache import cache
-import json
 from ledger.payments import trans_hash
 from django.core.files.storage import FileSystemStorage
 from datetime import datetime
 
-#from ledger.payments import trans_hash
+def calculate_payment_status(amount, voided, amount_paid):
+    ''' Work out the outstanding balance and payment status of an invoice
+        from the invoice amount and the net amount paid.
+    '''
+    if voided is True:
+        return decimal.Decimal(0), 'cancelled'
+    balance = decimal.Decimal(amount - amount_paid)
+    if balance < 0:
+        balance = decimal.Decimal(0)
+    if amount_paid == decimal.Decimal('0') and amount > 0:
+        pay_status = 'unpaid'
+    elif amount_paid < amount:
+        pay_status = 'partially_paid'
+    elif amount_paid == amount:
+        pay_status = 'paid'
+    else:
+        pay_status = 'over_paid'
+    return balance, pay_status
+
+# Stored totals of InvoicePaymentSummary, see payment_totals
+PAYMENT_TOTAL_FIELDS = ('bpoint_paid', 'bpay_paid', 'cash_paid', 'refunded', 'deducted')
+
+def payment_totals(bpoint, bpay, cash):
+    ''' Summary totals from the transaction amounts of an invoice, bpoint by
+        action (approved only), bpay by (instruction code, type) and cash by
+        type. Given the amount of a single transaction it gives the change
+        that transaction makes to the summary.
+    '''
+    zero = decimal.Decimal('0.00')
+    return {
+        'bpoint_paid': bpoint.get('payment',zero) + bpoint.get('capture',zero) - bpoint.get('reversal',zero),
+        'bpay_paid': bpay.get(('05','399'),zero) - bpay.get(('25','699'),zero),
+        'cash_paid': (cash.get('payment',zero) + cash.get('move_in',zero)) - (cash.get('reversal',zero) + cash.get('move_out',zero)),
+        'refunded': cash.get('refund',zero) + bpoint.get('refund',zero) + bpay.get(('15','699'),zero),
+        'deducted': cash.get('move_out',zero),
+    }
 
 upload_storage = FileSystemStorage(location=settings.LEDGER_PRIVATE_MEDIA_ROOT, base_url=settings.LEDGER_PRIVATE_MEDIA_URL)
 
@@ -116,7 +148,8 @@ class Invoice(models.Model):
 
     @property
     def refundable_amount(self):
-        return self.total_payment_amount - self.__calculate_total_refunds()
+        summary = self._payment_summary()
+        return summary.paid - summary.refunded
 
     @property
     def refundable(self):
@@ -159,58 +192,37 @@ class Invoice(models.Model):
     def payment_amount(self):
         ''' Total amount paid from bpay,bpoint and cash.
         '''
-        return self.__calculate_bpay_payments() + self.__calculate_bpoint_payments() + self.__calculate_cash_payments() - self.__calculate_total_refunds()
+        summary = self._payment_summary()
+        return summary.paid - summary.refunded
 
     @property
     def total_payment_amount(self):
         ''' Total amount paid from bpay,bpoint and cash.
         '''
-        return self.__calculate_bpay_payments() + self.__calculate_bpoint_payments() + self.__calculate_cash_payments()
+        return self._payment_summary().paid
 
     @property
     def refund_amount(self):
-        return self.__calculate_total_refunds()
+        return self._payment_summary().refunded
 
     @property
     def deduction_amount(self):
-        return self.__calculate_deductions()
+        return self._payment_summary().deducted
 
     @property
     def transferable_amount(self):
-        return self.__calculate_cash_payments()
+        return self._payment_summary().cash_paid
 
     @property
     def balance(self):
-        if self.voided:
-            return decimal.Decimal(0)
-        amount = decimal.Decimal(self.amount - self.payment_amount)
-        if amount < 0:
-            amount =  decimal.Decimal(0)
-        return amount
+        balance, status = calculate_payment_status(self.amount, self.voided, self.payment_amount)
+        return balance
 
     @property
     def payment_status(self):
         ''' Payment status of the invoice.
         '''
-        amount_paid = self.__calculate_bpay_payments() + self.__calculate_bpoint_payments() + self.__calculate_cash_payments() - self.__calculate_total_refunds() 
-        pay_status = 'over_paid'
-
-        if self.voided is True: 
-            pay_status = 'cancelled'
-        else:
-            if amount_paid == decimal.Decimal('0') and self.amount > 0:
-                pay_status = 'unpaid'
-            elif amount_paid < self.amount:
-                pay_status = 'partially_paid'
-            elif amount_paid == self.amount:
-                pay_status = 'paid'
-            else:
-                pay_status ='over_paid'
-
-            #if payment_status_cached != pay_status:
-            #    self.payment_status_cached  = pay_status
-            #    self.save()
-             
+        balance, pay_status = calculate_payment_status(self.amount, self.voided, self.payment_amount)
         return pay_status
 
     @property
@@ -235,134 +247,20 @@ class Invoice(models.Model):
                 cards.append(r)
         return cards
 
-    def bpay_transactions_cache(self, p_instruction_code, bpay_type):
-        amount = float('0.00')
-        bpay_json = []
-        change_hash = trans_hash.bpay_transaction_hash() 
-        if change_hash is not None:
-            change_invoice_hash = 'BpayTransaction:'+change_hash+':'+self.reference
-            cih = cache.get(change_invoice_hash)
-            #cih = None
-            if cih is None:
-                bpay_trans = self.bpay_transactions.all()
-                for bp in bpay_trans:
-                     bpay_json.append({'p_instruction_code': str(bp.p_instruction_code),'amount': float(bp.amount) , 'type': str(bp.type)})
-                cache.set(change_invoice_hash,json.dumps(bpay_json), 86400)
-            else:
-                bpay_json = json.loads(cih)
-            for cj in bpay_json:
-                if cj['p_instruction_code'] == p_instruction_code and str(bpay_type) == cj['type']:
-                     amount = amount + cj['amount']
-        return decimal.Decimal('{0:.2f}'.format(amount))
-
-    def bpoint_transactions_cache(self, bpoint_action, response_code):
-        amount = float('0.00')
-        bpoint_json = []
-        change_hash = trans_hash.bpoint_transaction_hash() #cache.get('BpointTransaction')
-        if change_hash is not None:
-            change_invoice_hash = 'BpointTransaction:'+change_hash+':'+self.reference
-            cih = cache.get(change_invoice_hash)
-            #cih = None
-            if cih is None:
-                bpoint_trans = self.bpoint_transactions.all()
-                for bp in bpoint_trans:
-                     bpoint_json.append({'action': str(bp.action),'amount': float(bp.amount) , 'response_code': str(bp.response_code)})
-                cache.set(change_invoice_hash,json.dumps(bpoint_json), 86400)
-            else:
-                bpoint_json = json.loads(cih)
-            for cj in bpoint_json:
-                if cj['action'] in bpoint_action and response_code == cj['response_code']:
-                     amount = amount + cj['amount']
-        return decimal.Decimal('{0:.2f}'.format(amount))
-
-
-    def cash_transactions_cache(self, cash_type):
-        amount = float('0.00')
-        cash_json = [] 
-      
-        change_cash_hash =  trans_hash.cash_transaction_hash() 
-        if change_cash_hash is not None:
-            change_cash_invoice_hash = 'CashTransaction:'+change_cash_hash+':'+self.reference
-            ccih = cache.get(change_cash_invoice_hash)
-            #ccih = None
-            if ccih is None:
-                cash_trans = self.cash_transactions.all()
-                for ct in cash_trans:
-                     cash_json.append({'type': str(ct.type),'amount': float(ct.amount)})
-                cache.set(change_cash_invoice_hash,json.dumps(cash_json),  86400) 
-            else:
-                cash_json = json.loads(ccih)
-            for cj in cash_json:
-                if cash_type == cj['type']:
-                    amount = amount + cj['amount'] 
-        return decimal.Decimal('{0:.2f}'.format(amount))
-
     # Helper Functions
     # =============================================
-    def __calculate_cash_payments(self):
-        ''' Calcluate the amount of cash payments made
-            less the reversals for this invoice.
-        '''
-        payments = self.cash_transactions_cache('payment')
-        move_ins = self.cash_transactions_cache('move_in')
-        reversals = self.cash_transactions_cache('reversal')
-        move_outs = self.cash_transactions_cache('move_out')
-
-        #payments = dict(self.cash_transactions.filter(type='payment').aggregate(amount__sum=Coalesce(Sum('amount'), decimal.Decimal('0')))).get('amount__sum')
-        #move_ins = dict(self.cash_transactions.filter(type='move_in').aggregate(amount__sum=Coalesce(Sum('amount'), decimal.Decimal('0')))).get('amount__sum')
-        #reversals = dict(self.cash_transactions.filter(type='reversal').aggregate(amount__sum=Coalesce(Sum('amount'), decimal.Decimal('0')))).get('amount__sum')
-        #move_outs = dict(self.cash_transactions.filter(type='move_out').aggregate(amount__sum=Coalesce(Sum('amount'), decimal.Decimal('0')))).get('amount__sum')
-        return (payments + move_ins) - (reversals + move_outs)
-
-    def __calculate_deductions(self):
-        '''Calculate all the move out transactions for this invoice
+    def _payment_summary(self):
+        ''' Get the materialised payment totals for this invoice. Invoices
+            without a summary yet get unsaved totals worked out from their
+            transactions, so reading never writes.
         '''
-        return self.cash_transactions_cache('move_out')
-        #return dict(self.cash_transactions.filter(type='move_out').aggregate(amount__sum=Coalesce(Sum('amount'), decimal.Decimal('0')))).get('amount__sum')
-
-    def __calculate_bpoint_payments(self):
-        ''' Calcluate the total amount of bpoint payments and
-            captures made less the reversals for this invoice.
-        '''
-        payments = 0
-        reversals = 0
-        payments = payments + self.bpoint_transactions_cache(['payment'],'0')
-        payments = payments + self.bpoint_transactions_cache(['capture'],'0')
-        reversals = self.bpoint_transactions_cache(['reversal'],'0')
-        #payments = payments + dict(self.bpoint_transactions.filter(action='payment', response_code='0').aggregate(amount__sum=Coalesce(Sum('amount'), decimal.Decimal('0')))).get('amount__sum')
-        #payments = payments + dict(self.bpoint_transactions.filter(action='capture', response_code='0').aggregate(amount__sum=Coalesce(Sum('amount'), decimal.Decimal('0')))).get('amount__sum')
-        #reversals = dict(self.bpoint_transactions.filter(action='reversal', response_code='0').aggregate(amount__sum=Coalesce(Sum('amount'), decimal.Decimal('0')))).get('amount__sum')
-
-        return payments - reversals
-
-    def __calculate_bpay_payments(self):
-        ''' Calcluate the amount of bpay payments made
-            less the reversals for this invoice.
-        '''
-        payments = 0
-        reversals = 0
-        if self.bpay_transactions:
-            payments = payments + self.bpay_transactions_cache('05',399) 
-            #payments = payments + dict(self.bpay_transactions.filter(p_instruction_code='05', type=399).aggregate(amount__sum=Coalesce(Sum('amount'), decimal.Decimal('0')))).get('amount__sum')
-            #reversals = dict(self.bpay_transactions.filter(p_instruction_code='25', type=699).aggregate(amount__sum=Coalesce(Sum('amount'), decimal.Decimal('0')))).get('amount__sum')
-            reversals = self.bpay_transactions_cache('25',699)
-
-        return payments - reversals
-
-    def __calculate_total_refunds(self):
-        ''' Calcluate the total amount of refunds
-            for this invoice.
-        '''
-        refunds = 0
-        cash_refunds = self.cash_transactions_cache('refund')
-        #cash_refunds = dict(self.cash_transactions.filter(type='refund').aggregate(amount__sum=Coalesce(Sum('amount'), decimal.Decimal('0')))).get('amount__sum')
-        #card_refunds = dict(self.bpoint_transactions.filter(action='refund', response_code='0').aggregate(amount__sum=Coalesce(Sum('amount'), decimal.Decimal('0')))).get('amount__sum')
-        card_refunds = self.bpoint_transactions_cache(['refund'],'0')
-        #bpay_refunds = dict(self.bpay_transactions.filter(p_instruction_code='15', type=699).aggregate(amount__sum=Coalesce(Sum('amount'), decimal.Decimal('0')))).get('amount__sum')
-        bpay_refunds = self.bpay_transactions_cache('15',699)
-
-        refunds = cash_refunds + card_refunds + bpay_refunds
-        return refunds
+        summary = None
+        if self.pk:
+            summary = InvoicePaymentSummary.objects.filter(invoice=self).first()
+        if summary is None:
+            summary = InvoicePaymentSummary(invoice=self)
+            summary.calculate()
+        return summary
 
     # Functions
     # =============================================
@@ -378,6 +276,15 @@ class Invoice(models.Model):
 
 
         super(Invoice,self).save(*args,**kwargs)
+        # amount and voided feed into the stored balance and status
+        summary = InvoicePaymentSummary.objects.filter(invoice=self).first()
+        if summary:
+            summary.invoice = self
+            summary.update_status()
+            summary.save()
+        elif self.due_date:
+            # Builds the summary, which records the invoice as unpaid
+            InvoicePaymentSummary.refresh(self.reference)
 
     def make_payment(self):
         ''' Pay this invoice with the token attached to it.
@@ -437,7 +344,7 @@ class Invoice(models.Model):
                     txn.crn = invoice.reference
                     txn.save()
                 # Move the remainder of the amount to the a cash transaction
-                new_amount = self.__calculate_cash_payments()
+                new_amount = self.transferable_amount
                 if self.transferable_amount < new_amount:
                     raise ValidationError('The amount to be moved is more than the allowed transferable amount')
                 if new_amount > 0:
@@ -528,12 +435,20 @@ class InvoiceBPAYListener(object):
     def _post_save(sender, instance, **kwargs):
         from ledger.payments.utils import update_payments
         original_instance = getattr(instance, "_original_instance") if hasattr(instance, "_original_instance") else None
+        references = [instance.invoice.reference]
+        if original_instance and original_instance.invoice_id != instance.invoice_id:
+            references.append(original_instance.invoice.reference)
+        trans_hash.invalidate_invoice_transactions('BpayTransaction', *references)
+        for reference in references:
+            InvoicePaymentSummary.refresh(reference)
         if not original_instance:
             update_payments(instance.invoice.reference)
 
     @staticmethod
     @receiver(post_delete, sender=InvoiceBPAY)
     def _post_delete(sender, instance, **kwargs):
+        trans_hash.invalidate_invoice_transactions('BpayTransaction', instance.invoice.reference)
+        InvoicePaymentSummary.refresh(instance.invoice.reference)
         for item in instance.invoice.order.lines.all():
             removable = []
             payment_details = item.payment_details['bpay']
@@ -547,7 +462,135 @@ class InvoiceBPAYListener(object):
 
 
 
+class InvoicePaymentSummary(models.Model):
+    ''' Materialised payment totals for an invoice.
+        Each bpoint, bpay and cash transaction save or delete adds its change
+        to the totals (see apply) so the status of an invoice can be read
+        from one row.
+    '''
+    invoice = models.OneToOneField(Invoice, related_name='payment_summary')
+    bpoint_paid = models.DecimalField(decimal_places=2,max_digits=12, default='0.00')
+    bpay_paid = models.DecimalField(decimal_places=2,max_digits=12, default='0.00')
+    cash_paid = models.DecimalField(decimal_places=2,max_digits=12, default='0.00')
+    refunded = models.DecimalField(decimal_places=2,max_digits=12, default='0.00')
+    deducted = models.DecimalField(decimal_places=2,max_digits=12, default='0.00')
+    balance = models.DecimalField(decimal_places=2,max_digits=12, default='0.00')
+    payment_status = models.CharField(max_length=20, db_index=True, default='unpaid')
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'payments_invoicepaymentsummary'
+
+    def __str__(self):
+        return '{} - {}'.format(self.invoice.reference, self.payment_status)
+
+    @property
+    def paid(self):
+        return self.bpoint_paid + self.bpay_paid + self.cash_paid
+
+    def calculate(self):
+        ''' Recalculate the totals from the transactions of the invoice.
+        '''
+        # prevent circular import
+        from ledger.payments.cash.models import CashTransaction
+        invoice = self.invoice
+        bpoint = {}
+        for b in BpointTransaction.objects.filter(crn1=invoice.reference, response_code='0').values('action').annotate(total=Sum('amount')):
+            bpoint[b['action']] = b['total']
+        bpay = {}
+        for b in invoice.bpay_transactions.values('p_instruction_code','type').annotate(total=Sum('amount')):
+            bpay[(b['p_instruction_code'],str(b['type']))] = b['total']
+        cash = {}
+        for c in CashTransaction.objects.filter(invoice_id=invoice.reference).values('type').annotate(total=Sum('amount')):
+            cash[c['type']] = c['total']
+
+        for field, total in payment_totals(bpoint, bpay, cash).items():
+            setattr(self, field, total)
+        self.update_status()
+
+    def update_status(self):
+        self.balance, self.payment_status = calculate_payment_status(self.invoice.amount, self.invoice.voided, self.paid - self.refunded)
+
+    def save(self, *args, **kwargs):
+        super(InvoicePaymentSummary, self).save(*args, **kwargs)
+        UnpaidInvoice.track(self.invoice, self.payment_status)
+
+    @classmethod
+    def refresh(cls, reference):
+        ''' Rebuild the summary for the invoice with the given reference.
+            Called from within the transaction that changed the payments.
+        '''
+        try:
+            invoice = Invoice.objects.get(reference=reference)
+        except Invoice.DoesNotExist:
+            return None
+        with transaction.atomic():
+            summary, created = cls.objects.select_for_update().get_or_create(invoice=invoice)
+            summary.invoice = invoice
+            summary.calculate()
+            summary.save()
+        return summary
+
+    @classmethod
+    def apply(cls, reference, added=None, removed=None):
+        ''' Add the totals of a saved transaction to the summary of an invoice
+            and take away the totals it had before (see payment_totals).
+            Invoices without a summary get one built from their transactions,
+            which already include the change.
+        '''
+        added = added or {}
+        removed = removed or {}
+        deltas = dict((f, added.get(f, 0) - removed.get(f, 0)) for f in PAYMENT_TOTAL_FIELDS)
+        if not any(deltas.values()):
+            return None
+        try:
+            invoice = Invoice.objects.get(reference=reference)
+        except Invoice.DoesNotExist:
+            return None
+        with transaction.atomic():
+            summary = cls.objects.select_for_update().filter(invoice_id=invoice.id).first()
+            if summary is None:
+                return cls.refresh(reference)
+            summary.invoice = invoice
+            for field, delta in deltas.items():
+                setattr(summary, field, getattr(summary, field) + delta)
+            summary.update_status()
+            summary.save()
+        return summary
+
+    @classmethod
+    def move_totals(cls, removed=None, added=None):
+        ''' Take the totals of a transaction off the invoices it counted for
+            and add its current totals to the ones it counts for now, each
+            given as {reference: totals}.
+        '''
+        removed = removed or {}
+        added = added or {}
+        for reference in set(removed) | set(added):
+            if reference:
+                cls.apply(reference, added.get(reference), removed.get(reference))
+
+
+def calculate_due_status(due_date, payment_status, today=None):
+    ''' Due status shown on the debtor report.
+    '''
+    if payment_status in ('paid', 'over_paid'):
+        return 'Paid'
+    if not due_date:
+        return 'Unknown'
+    if today is None:
+        today = datetime.now().date()
+    return 'Overdue' if today > due_date else 'Not Due'
+
+# Payment statuses that take an invoice off the debtor report
+SETTLED_STATUSES = ('paid', 'over_paid', 'cancelled')
+
+
 class UnpaidInvoice(models.Model):
+    ''' Invoices with a due date that are still owed, kept up to date from
+        the payment summary of the invoice (see track) so the debtor report
+        reads this table instead of working out every invoice's status.
+    '''
     invoice = models.ForeignKey(Invoice)
     invoice_reference = models.CharField(max_length=80,null=True,blank=True)
     system = models.CharField(max_length=4,blank=True,null=True)
@@ -559,3 +602,55 @@ class UnpaidInvoice(models.Model):
 
     def __str__(self):
         return str(self.invoice.reference)
+
+    @classmethod
+    def track(cls, invoice, payment_status):
+        ''' Add, update or remove the row of an invoice after its payment
+            status was saved. Invoices without a due date are left alone.
+        '''
+        if invoice.due_date is None:
+            return
+        if payment_status == 'cancelled':
+            cls.objects.filter(invoice=invoice).update(voided=True)
+        elif payment_status in SETTLED_STATUSES:
+            cls.objects.filter(invoice=invoice).delete()
+        else:
+            fields = {
+                'invoice_reference': invoice.reference,
+                'system': invoice.system,
+                'amount': invoice.amount,
+                'due_date': invoice.due_date,
+                'due_status': calculate_due_status(invoice.due_date, payment_status),
+                # An invoice can be owed again after it was cancelled
+                'voided': False,
+            }
+            if not cls.objects.filter(invoice=invoice).update(**fields):
+                cls.objects.create(invoice=invoice, **fields)
+
+    @classmethod
+    def refresh_due_status(cls, today=None):
+        ''' Mark the rows that passed their due date since the last run as overdue.
+        '''
+        if today is None:
+            today = datetime.now().date()
+        return cls.objects.filter(due_status='Not Due', due_date__lt=today).update(due_status='Overdue')
+
+    @classmethod
+    def rebuild(cls, reference_prefix):
+        ''' Full rescan of the invoices with a due date whose reference starts
+            with reference_prefix, eg to fill the table for a new system.
+        '''
+        cls.objects.filter(invoice__reference__startswith=reference_prefix, invoice__due_date__isnull=True).delete()
+        invoices = Invoice.objects.filter(reference__startswith=reference_prefix, due_date__isnull=False)
+        for reference in invoices.filter(payment_summary__isnull=True).values_list('reference', flat=True):
+            # Building the summary tracks the invoice
+            InvoicePaymentSummary.refresh(reference)
+        for summary in InvoicePaymentSummary.objects.filter(invoice__in=invoices).select_related('invoice').iterator():
+            # The stored status is stale when the invoice was changed with update()
+            stored = (summary.balance, summary.payment_status)
+            summary.update_status()
+            if (summary.balance, summary.payment_status) != stored:
+                # Saving the summary tracks the invoice
+                summary.save()
+            else:
+                cls.track(summary.invoice, summary.payment_status)
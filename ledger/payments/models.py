@@ -1,6 +1,6 @@
 from __future__ import unicode_literals
 import traceback
-from django.db import models
+from django.db import connection, models
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.conf import settings
 from django.contrib.postgres.fields import JSONField, IntegerRangeField
@@ -26,6 +26,17 @@ class OracleParserInvoice(models.Model):
     reference = models.CharField(max_length=50)
     details = JSONField() 
 
+# pg_advisory_xact_lock key held while OracleInterface receipts are numbered
+RECEIPT_NUMBER_LOCK_ID = 7310001
+
+def lock_receipt_numbers():
+    ''' Hold the receipt numbering until the current transaction ends, so
+        systems interfaced at the same time don't number from the same last receipt.
+    '''
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_xact_lock(%s)', [RECEIPT_NUMBER_LOCK_ID])
+
 def increment_receipt_number():
     last_interface = OracleInterface.objects.values('id', 'receipt_number').order_by('-id').first()
     if not last_interface:
@@ -0,0 +1,128 @@
+'''
+    Runs a per system job (oracle receipts, bpoint audits) for several
+    OracleInterfaceSystems at once.
+
+    Each system runs in its own spawned process with its own database
+    connection. A failing system does not stop the others, the results and
+    errors of every system are collected and reported once all have finished.
+'''
+
+import multiprocessing
+import time
+import traceback
+
+from django.conf import settings
+from django.core import management
+from django.core.mail import EmailMessage
+from django.db import connections
+from confy import env
+
+def system_processes():
+    return getattr(settings, 'ORACLE_SYSTEM_PROCESSES', 1)
+
+def bpoint_system_ids(system_id=None):
+    from ledger.payments.models import OracleInterfaceSystem
+    ois = OracleInterfaceSystem.objects.filter(integration_type='bpoint_api', enabled=True)
+    if system_id:
+        ois = ois.filter(system_id=system_id)
+    return list(ois.values_list('system_id', flat=True))
+
+def _setup_process(databases):
+    import django
+    django.setup()
+    # Use the databases the parent process is connected to, the test
+    # databases when run under the test runner
+    for alias, name in databases.items():
+        connections[alias].settings_dict['NAME'] = name
+
+def run_system(func, system_id, args=(), kwargs=None):
+    ''' Run func(system_id, *args, **kwargs), returns a result dict instead of raising.
+    '''
+    started = time.time()
+    result = {'system_id': system_id, 'result': None, 'error': None}
+    try:
+        result['result'] = func(system_id, *args, **(kwargs or {}))
+    except Exception:
+        result['error'] = traceback.format_exc()
+    finally:
+        if multiprocessing.current_process().name != 'MainProcess':
+            connections.close_all()
+    result['runtime'] = time.time() - started
+    return result
+
+def call_command_for_system(system_id, command, *args):
+    ''' Runs a management command that takes the system id as its last argument.
+    '''
+    management.call_command(command, *(list(args) + [system_id]))
+
+def run_for_systems(func, system_ids, args=(), kwargs=None, processes=None):
+    ''' Run func for every system, up to processes at a time, results are
+        returned in the order of system_ids.
+    '''
+    if processes is None:
+        processes = system_processes()
+    processes = min(processes, len(system_ids))
+    # Pool workers (job_queue_worker) are daemons and can't start processes of their own
+    if processes <= 1 or multiprocessing.current_process().daemon:
+        return [run_system(func, s, args, kwargs) for s in system_ids]
+
+    # Children open their own connections, don't hand them ours
+    databases = dict((alias, connections[alias].settings_dict['NAME']) for alias in connections)
+    connections.close_all()
+    context = multiprocessing.get_context('spawn')
+    pool = context.Pool(processes, initializer=_setup_process, initargs=(databases,))
+    try:
+        pending = [pool.apply_async(run_system, (func, s, args, kwargs)) for s in system_ids]
+        results = []
+        for system_id, p in zip(system_ids, pending):
+            try:
+                results.append(p.get())
+            except Exception:
+                # The process itself died or the result could not be returned
+                results.append({'system_id': system_id, 'result': None, 'error': traceback.format_exc(), 'runtime': None})
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+def report_system_results(title, results):
+    ''' Print the wall time of each system and email one summary of the failures.
+    '''
+    for r in results:
+        runtime = '{:.1f}s'.format(r['runtime']) if r['runtime'] is not None else '-'
+        print ('{} {} {}'.format(r['system_id'], 'FAILED' if r['error'] else 'OK', runtime))
+
+    failed = [r for r in results if r['error']]
+    if not failed:
+        return failed
+    body = '{} of {} systems failed.\n\n'.format(len(failed), len(results))
+    for r in failed:
+        body += '{}\n{}\n\n'.format(r['system_id'], r['error'])
+    email = EmailMessage(
+        '{} failed for {}'.format(title, ', '.join(r['system_id'] for r in failed)),
+        body,
+        settings.EMAIL_FROM,
+        to=[settings.NOTIFICATION_EMAIL],
+        headers={'System-Environment': env('EMAIL_INSTANCE','DEV')}
+    )
+    try:
+        email.send()
+    except Exception:
+        print (traceback.format_exc())
+    return failed
+
+def run_command_per_system(command, settlement_date, system_id=None, processes=None):
+    ''' Fans an audit command out over the bpoint systems, one call per
+        system. Returns False when the command should run by itself instead:
+        a system was given or only one process is allowed.
+    '''
+    if system_id:
+        return False
+    if processes is None:
+        processes = system_processes()
+    system_ids = bpoint_system_ids()
+    if min(processes, len(system_ids)) <= 1 or multiprocessing.current_process().daemon:
+        return False
+    results = run_for_systems(call_command_for_system, system_ids, args=(command, settlement_date), processes=processes)
+    report_system_results('{} for {}'.format(command, settlement_date), results)
+    return True
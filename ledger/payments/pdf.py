@@ -1,4 +1,7 @@
+import hashlib
 import os
+import tempfile
+import time
 
 from decimal import Decimal as D
 from io import BytesIO
@@ -20,6 +23,8 @@ from django.conf import settings
 from ledger.accounts.models import Document
 from ledger.checkout.utils import calculate_excl_gst
 from ledger.payments import models as payments_models
+from ledger.payments import trans_hash
+from ledger.payments.invoice.models import calculate_payment_status
 
 #DPAW_HEADER_LOGO = os.path.join(settings.PROJECT_DIR, 'payments','static', 'payments', 'img','dbca_logo.jpg')
 #DPAW_HEADER_LOGO_SM = os.path.join(settings.PROJECT_DIR, 'payments','static', 'payments', 'img','dbca_logo_small.png')
@@ -30,6 +35,11 @@ DPAW_HEADER_LOGO_SM = os.path.join(settings.STATIC_ROOT, 'payments','img','dbca_
 ROTTNEST_ISLAND_LOGO = os.path.join(settings.STATIC_ROOT, 'payments','img', 'rottnest_island_70h.png')
 BPAY_LOGO = os.path.join(settings.STATIC_ROOT, 'payments','img', 'BPAY_2012_PORT_BLUE.png')
 
+# Rendered invoices, one file per invoice named after the hash of everything printed on it
+INVOICE_PDF_CACHE_DIR = os.path.join(settings.LEDGER_PRIVATE_MEDIA_ROOT, 'invoice_pdf_cache')
+# Bump when the layout changes so cached invoices are rendered again
+INVOICE_PDF_LAYOUT_VERSION = 1
+
 
 HEADER_MARGIN = 10
 HEADER_SMALL_BUFFER = 3
@@ -71,6 +81,51 @@ styles.add(ParagraphStyle(name='Left', alignment=enums.TA_LEFT))
 styles.add(ParagraphStyle(name='Right', alignment=enums.TA_RIGHT))
 styles.add(ParagraphStyle(name='LongString', alignment=enums.TA_LEFT,wordWrap='CJK'))
 
+_images = {}
+
+def _image(path):
+    ''' Decoded image, read once per process.
+    '''
+    if path not in _images:
+        _images[path] = ImageReader(path)
+    return _images[path]
+
+def _invoice_settings(invoice):
+    ''' Template and ABN of the system the invoice belongs to.
+    '''
+    invoice_template = 'dbca_template'
+    abn = "38 052 249 024"
+    ois = payments_models.OracleInterfaceSystem.objects.filter(system_id=invoice.system).values('invoice_template', 'abn').first()
+    if ois:
+        invoice_template = ois['invoice_template']
+        if ois['abn']:
+            if len(ois['abn']) > 2:
+               abn = ois['abn']
+    return invoice_template, abn
+
+class InvoiceDocument(object):
+    ''' Everything the header and remittance of an invoice print, worked
+        out once per document instead of on every page.
+    '''
+    def __init__(self, invoice):
+        self.invoice = invoice
+        self.order = invoice.order
+        self.invoice_template, self.abn = _invoice_settings(invoice)
+        self.total_gst_tax = self.order.total_incl_tax - self.order.total_excl_tax
+        summary = invoice._payment_summary()
+        self.payment_amount = summary.paid - summary.refunded
+        self.balance, self.payment_status = calculate_payment_status(invoice.amount, invoice.voided, self.payment_amount)
+        self.organisation = self.order.organisation
+        self.invoice_name = ''
+        self.invoice_username = ''
+        owner = self.order.user
+        if owner:
+            self.invoice_name = owner.get_full_name()
+            self.invoice_username = owner.username
+        if invoice.invoice_name:
+            if len(invoice.invoice_name) > 0:
+                self.invoice_name = invoice.invoice_name
+
 class BrokenLine(Flowable):
 
     def __init__(self, width,height=0):
@@ -86,11 +141,12 @@ class BrokenLine(Flowable):
         self.canv.line(0, self.height,self.width,self.height)
 
 class Remittance(Flowable):
-    def __init__(self,current_x,current_y,invoice):
+    def __init__(self,current_x,current_y,invoice,document=None):
         Flowable.__init__(self)
         self.current_x = current_x
         self.current_y = current_y
         self.invoice = invoice
+        self.document = document or InvoiceDocument(invoice)
 
     def __repr__(self):
         return 'remittance'
@@ -99,7 +155,7 @@ class Remittance(Flowable):
         canvas = self.canv
         current_y, current_x = self.current_y, self.current_x
         canvas.setFont(DEFAULT_FONTNAME, MEDIUM_FONTSIZE)
-        dpaw_header_logo = ImageReader(DPAW_HEADER_LOGO_SM)
+        dpaw_header_logo = _image(DPAW_HEADER_LOGO_SM)
 
         dpaw_header_logo_size = dpaw_header_logo.getSize()
         canvas.drawImage(dpaw_header_logo, HEADER_MARGIN, current_y - (dpaw_header_logo_size[1]/1.8),height=dpaw_header_logo_size[1]/1.8, mask='auto', width=dpaw_header_logo_size[0]/1.8)
@@ -120,7 +176,7 @@ class Remittance(Flowable):
     def __payment_line(self):
         canvas = self.canv
         current_y, current_x = self.current_y, self.current_x
-        bpay_logo = ImageReader(BPAY_LOGO)
+        bpay_logo = _image(BPAY_LOGO)
         #current_y -= 40
         # Pay By Cheque
         cheque_x = current_x + 4 * inch
@@ -176,7 +232,7 @@ class Remittance(Flowable):
         canvas = self.canv
         current_y, current_x = self.current_y, self.current_x
         current_y -= 2 * inch
-        total_gst_tax = self.invoice.order.total_incl_tax - self.invoice.order.total_excl_tax
+        total_gst_tax = self.document.total_gst_tax
         canvas.setFont(DEFAULT_FONTNAME, LARGE_FONTSIZE)
         canvas.setFillColor(colors.black)
         canvas.drawString(current_x, current_y, 'Invoice Number')
@@ -210,32 +266,26 @@ class Remittance(Flowable):
 
 
 def _create_header(canvas, doc, draw_page_number=True):
-    invoice_name = ''
-    invoice_username = ''
     invoice = doc.invoice
-    ois = payments_models.OracleInterfaceSystem.objects.filter(system_id=invoice.system)
-    invoice_template = 'dbca_template'
-    abn = "38 052 249 024"
-    if ois.count() > 0:
-        invoice_template = ois[0].invoice_template
-        if ois[0].abn:
-            if len(ois[0].abn) > 2:
-               abn = ois[0].abn
-    
-            
+    document = doc.document
+    invoice_template = document.invoice_template
+    abn = document.abn
+    invoice_name = document.invoice_name
+    invoice_username = document.invoice_username
+
     canvas.saveState()
     canvas.setTitle('Invoice')
     canvas.setFont(BOLD_FONTNAME, LARGE_FONTSIZE)
 
     current_y = PAGE_HEIGHT - HEADER_MARGIN
        
-    dpaw_header_logo = ImageReader(DPAW_HEADER_LOGO)
     if invoice_template == 'ria':
         current_y -= 10 
-        dpaw_header_logo = ImageReader(ROTTNEST_ISLAND_LOGO)
+        dpaw_header_logo = _image(ROTTNEST_ISLAND_LOGO)
         dpaw_header_logo_size = dpaw_header_logo.getSize()
         canvas.drawImage(dpaw_header_logo, PAGE_WIDTH / 4, current_y - (dpaw_header_logo_size[1]/2),width=dpaw_header_logo_size[0]/1.7, height=dpaw_header_logo_size[1]/1.7, mask='auto')
     else:
+        dpaw_header_logo = _image(DPAW_HEADER_LOGO)
         dpaw_header_logo_size = dpaw_header_logo.getSize()
         canvas.drawImage(dpaw_header_logo, PAGE_WIDTH / 3, current_y - (dpaw_header_logo_size[1]/2),width=dpaw_header_logo_size[0]/2, height=dpaw_header_logo_size[1]/2, mask='auto')
 
@@ -251,24 +301,16 @@ def _create_header(canvas, doc, draw_page_number=True):
     invoice_details_offset = 37
     current_y -= 20
     
-    total_gst_tax = invoice.order.total_incl_tax - invoice.order.total_excl_tax
+    total_gst_tax = document.total_gst_tax
 
     canvas.setFont(BOLD_FONTNAME, SMALL_FONTSIZE)
     current_x = PAGE_MARGIN + 5
 
 #    canvas.drawString(current_x, current_y - (SMALL_FONTSIZE + HEADER_SMALL_BUFFER),    "TESTING")
 #    current_y -= 20
-    if invoice.order.organisation:
-         canvas.drawString(current_x, current_y - (SMALL_FONTSIZE + HEADER_SMALL_BUFFER),    invoice.order.organisation.name)
-         canvas.drawString(current_x, current_y - (SMALL_FONTSIZE + HEADER_SMALL_BUFFER) *2,    invoice.order.organisation.abn)
-
-    if invoice.owner:
-        invoice_name = invoice.owner.get_full_name()
-        invoice_username = invoice.owner.username
-        
-    if invoice.invoice_name:
-        if len(invoice.invoice_name) > 0:
-            invoice_name = invoice.invoice_name
+    if document.organisation:
+         canvas.drawString(current_x, current_y - (SMALL_FONTSIZE + HEADER_SMALL_BUFFER),    document.organisation.name)
+         canvas.drawString(current_x, current_y - (SMALL_FONTSIZE + HEADER_SMALL_BUFFER) *2,    document.organisation.abn)
 
     canvas.drawString(current_x, current_y - (SMALL_FONTSIZE + HEADER_SMALL_BUFFER) * 3,invoice_name)
     canvas.drawString(current_x, current_y - (SMALL_FONTSIZE + HEADER_SMALL_BUFFER) * 4,invoice_username)
@@ -297,10 +339,10 @@ def _create_header(canvas, doc, draw_page_number=True):
     canvas.drawString(current_x + invoice_details_offset, current_y - (SMALL_FONTSIZE + HEADER_SMALL_BUFFER) * nextrowcount, currency(total_gst_tax))
     nextrowcount = nextrowcount + 1
     canvas.drawRightString(current_x + 20, current_y - (SMALL_FONTSIZE + HEADER_SMALL_BUFFER) * nextrowcount, 'Paid (AUD)')
-    canvas.drawString(current_x + invoice_details_offset, current_y - (SMALL_FONTSIZE + HEADER_SMALL_BUFFER) * nextrowcount, currency(invoice.payment_amount))
+    canvas.drawString(current_x + invoice_details_offset, current_y - (SMALL_FONTSIZE + HEADER_SMALL_BUFFER) * nextrowcount, currency(document.payment_amount))
     nextrowcount = nextrowcount + 1
     canvas.drawRightString(current_x + 20, current_y - (SMALL_FONTSIZE + HEADER_SMALL_BUFFER) * nextrowcount, 'Outstanding (AUD)')
-    canvas.drawString(current_x + invoice_details_offset, current_y - (SMALL_FONTSIZE + HEADER_SMALL_BUFFER) * nextrowcount, currency(invoice.balance))
+    canvas.drawString(current_x + invoice_details_offset, current_y - (SMALL_FONTSIZE + HEADER_SMALL_BUFFER) * nextrowcount, currency(document.balance))
     canvas.restoreState()
 
 def _create_invoice(invoice_buffer, invoice):
@@ -316,7 +358,7 @@ def _create_invoice(invoice_buffer, invoice):
 
     # this is the only way to get data into the onPage callback function
     doc.invoice = invoice
-    owner = invoice.owner
+    doc.document = document = InvoiceDocument(invoice)
 
     elements = []
     #elements.append(Spacer(1, SECTION_BUFFER_HEIGHT * 5))
@@ -327,8 +369,8 @@ def _create_invoice(invoice_buffer, invoice):
         ('GRID',(0, 0), (-1, -1),1, colors.black),
         ('ALIGN', (0, 0), (-1, -1), 'LEFT')
         ])
-    items = invoice.order.lines.all()
-    discounts = invoice.order.basket_discounts
+    items = document.order.lines.all()
+    discounts = document.order.basket_discounts
     if invoice.text:
         elements.append(Paragraph(invoice.text, styles['Left']))
         elements.append(Spacer(1, SECTION_BUFFER_HEIGHT * 2))
@@ -392,7 +434,7 @@ def _create_invoice(invoice_buffer, invoice):
     elements.append(t)
     elements.append(Spacer(1, SECTION_BUFFER_HEIGHT * 2))
     # /Products Table
-    if invoice.payment_status != 'paid' and invoice.payment_status != 'over_paid':
+    if document.payment_status != 'paid' and document.payment_status != 'over_paid':
         elements.append(Paragraph(settings.INVOICE_UNPAID_WARNING, styles['Left']))
 
     elements.append(Spacer(1, SECTION_BUFFER_HEIGHT * 6))
@@ -403,16 +445,101 @@ def _create_invoice(invoice_buffer, invoice):
     elements.append(boundary)
     elements.append(Spacer(1, SECTION_BUFFER_HEIGHT))
 
-    remittance = Remittance(HEADER_MARGIN,HEADER_MARGIN - 10,invoice)
+    remittance = Remittance(HEADER_MARGIN,HEADER_MARGIN - 10,invoice,document)
     elements.append(remittance)
     #_create_remittance(invoice_buffer,doc)
     doc.build(elements)
 
     return invoice_buffer
 
-def create_invoice_pdf_bytes(filename, invoice):
+def _invoice_order_parts(invoice):
+    ''' What the invoice prints from its order: the owner, the organisation,
+        the totals, the lines and the discounts.
+    '''
+    order = invoice.order
+    if order is None:
+        return None
+    owner = order.user
+    organisation = order.organisation
+    return [
+        order.total_incl_tax, order.total_excl_tax,
+        (owner.get_full_name(), owner.username) if owner else None,
+        (organisation.name, organisation.abn) if organisation else None,
+        [(line.id, line.description, line.quantity, line.unit_price_incl_tax,
+          line.line_price_before_discounts_incl_tax, line.line_price_before_discounts_excl_tax)
+         for line in order.lines.all()],
+        [(str(discount.offer), discount.amount) for discount in order.basket_discounts],
+    ]
+
+def invoice_pdf_cache_key(invoice):
+    ''' Hash of everything that ends up on the rendered invoice. Any payment
+        changes the transaction versions and the payment summary, any change
+        to the order, its owner or organisation changes the order parts.
+    '''
+    summary = invoice._payment_summary()
+    parts = [
+        INVOICE_PDF_LAYOUT_VERSION, invoice.reference, invoice.order_number, invoice.amount, invoice.voided,
+        invoice.due_date, invoice.created, invoice.text, invoice.invoice_name, invoice.system,
+        trans_hash.bpoint_transaction_hash(invoice.reference),
+        trans_hash.bpay_transaction_hash(invoice.reference),
+        trans_hash.cash_transaction_hash(invoice.reference),
+        summary.paid, summary.refunded, summary.deducted, summary.balance, summary.payment_status,
+        _invoice_settings(invoice), settings.BPAY_ALLOWED, settings.INVOICE_UNPAID_WARNING,
+        _invoice_order_parts(invoice),
+    ]
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+def invoice_pdf_cache_path(reference, key):
+    return os.path.join(INVOICE_PDF_CACHE_DIR, reference, '{}.pdf'.format(key))
+
+def _cache_invoice_pdf(path, value):
+    ''' Write the rendered invoice and drop the older renders of it.
+    '''
+    folder = os.path.dirname(path)
+    os.makedirs(folder, exist_ok=True)
+    # Written to a temporary file first so a reader never sees half a pdf
+    fd, tmp = tempfile.mkstemp(dir=folder, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(value)
+    os.replace(tmp, path)
+    for name in os.listdir(folder):
+        if name.endswith('.pdf') and os.path.join(folder, name) != path:
+            try:
+                os.remove(os.path.join(folder, name))
+            except OSError:
+                pass
+
+def evict_invoice_pdf_cache(max_age_days=None):
+    ''' Remove cached invoices not downloaded in max_age_days, returns the number removed.
+    '''
+    if max_age_days is None:
+        max_age_days = getattr(settings, 'INVOICE_PDF_CACHE_MAX_AGE_DAYS', 30)
+    cutoff = time.time() - max_age_days * 86400
+    removed = 0
+    if not os.path.isdir(INVOICE_PDF_CACHE_DIR):
+        return removed
+    for folder, dirs, files in os.walk(INVOICE_PDF_CACHE_DIR, topdown=False):
+        for name in files:
+            path = os.path.join(folder, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                pass
+        if folder != INVOICE_PDF_CACHE_DIR and not os.listdir(folder):
+            os.rmdir(folder)
+    return removed
+
+def render_invoice_pdf(invoice):
     invoice_buffer = BytesIO()
+    _create_invoice(invoice_buffer, invoice)
+    # Get the value of the BytesIO buffer
+    value = invoice_buffer.getvalue()
+    invoice_buffer.close()
+    return value
 
+def create_invoice_pdf_bytes(filename, invoice):
     if invoice.oracle_invoice_number:
         if len(invoice.oracle_invoice_number) > 0 and invoice.oracle_invoice_file:         
             if invoice.oracle_invoice_file.upload:
@@ -421,10 +548,17 @@ def create_invoice_pdf_bytes(filename, invoice):
 
          #print (settings.LEDGER_PRIVATE_MEDIA_ROOT+':'+str(invoice.oracle_invoice_file.upload))
 
+    elif getattr(settings, 'INVOICE_PDF_CACHE', True):
+        path = invoice_pdf_cache_path(invoice.reference, invoice_pdf_cache_key(invoice))
+        try:
+            with open(path, 'rb') as f:
+                value = f.read()
+            # Eviction goes by the last download
+            os.utime(path, None)
+        except (IOError, OSError):
+            value = render_invoice_pdf(invoice)
+            _cache_invoice_pdf(path, value)
     else:
-        _create_invoice(invoice_buffer, invoice)
-        # Get the value of the BytesIO buffer
-        value = invoice_buffer.getvalue()
-        invoice_buffer.close()
+        value = render_invoice_pdf(invoice)
 
     return value
@@ -1,760 +1,287 @@
 from six.moves import StringIO
 import csv
 import pytz
+from collections import OrderedDict
+from itertools import islice
 from datetime import timedelta,datetime
 from decimal import Decimal as D
+from django.db.models import Q
 from ledger.payments.models import Invoice, CashTransaction, BpointTransaction, BpayTransaction
 from ledger.order.models import Line
 
 PERTH_TIMEZONE = pytz.timezone('Australia/Perth')
+REPORT_DATE_FORMAT = '%d/%m/%y'
+# Number of invoices aggregated per round trip when building item reports
+REPORT_CHUNK_SIZE = 500
 
 def daterange(start,end):
     for n in range(int ((end-start).days) + 1):
         yield start + timedelta(n)
 
-def generate_items_csv(system,start,end,banked_start,banked_end,region=None,district=None):
-    strIO = None
-    invoices = []
-    invoice_list = []
-    dates, banked_dates = [], []
-    date_amounts, banked_date_amounts = [], []
-    items = []
-    oracle_codes = {}
-    banked_oracle_codes = {}
-    date_format = '%d/%m/%y'
-
-    eftpos = []
-    banked_cash = []
-    bpoint = []
-    bpay = []
-
-    # Get all transactions
-    if not district:
-        eftpos.extend([x for x in CashTransaction.objects.filter(created__gte=start, created__lte=end, source='eftpos').exclude(district__isnull=False)])
-        banked_cash.extend([x for x in CashTransaction.objects.filter(created__gte=banked_start, created__lte=banked_end).exclude(source='eftpos').exclude(district__isnull=False)])
-        bpoint.extend([x for x in BpointTransaction.objects.filter(settlement_date__gte=start, settlement_date__lte=end).exclude(crn1__endswith='_test')])
-        bpay.extend([x for x in BpayTransaction.objects.filter(p_date__gte=start, p_date__lte=end)])
-    else:
-        eftpos.extend([x for x in CashTransaction.objects.filter(created__gte=start, created__lte=end, source='eftpos',district=district)])
-        banked_cash.extend([x for x in CashTransaction.objects.filter(created__gte=banked_start, created__lte=banked_end,district=district).exclude(source='eftpos')])
-
-    # Get the required invoices
-    for e in eftpos:
-        if e.invoice.reference not in invoice_list:
-            if e.invoice.system == system:
-                invoices.append(e.invoice)
-                invoice_list.append(str(e.invoice.reference))
-    for b in banked_cash:
-        if b.invoice.reference not in invoice_list:
-            if b.invoice.system == system:
-                invoices.append(b.invoice)
-                invoice_list.append(str(b.invoice.reference))
-    for b in bpoint:
-        if b.crn1 not in invoice_list:
-            invoice = Invoice.objects.get(reference=b.crn1)
-            if invoice.system == system:
-                invoices.append(invoice)
-                invoice_list.append(str(b.crn1))
-    for b in bpay:
-        if b.crn not in invoice_list:
-            invoice = Invoice.objects.get(reference=b.crn)
-            if invoice.system == system:
-                invoices.append(invoice)
-                invoice_list.append(str(b.crn))
-
-    invoice_list = list(set(invoice_list))
-
-    if invoices:
-        strIO = StringIO()
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+class Echo(object):
+    ''' Pseudo buffer handing back what the csv writer writes
+        so rows can be streamed straight to the response.
+    '''
+    def write(self, value):
+        return value
+
+def stream_csv(rows):
+    writer = csv.writer(Echo())
+    for row in rows:
+        yield writer.writerow(row)
+
+class ItemsReport(object):
+    ''' Itemised payments report, aggregated per oracle code, date and
+        payment method in a single pass over the invoice order lines.
+
+        Invoices are processed in chunks of REPORT_CHUNK_SIZE and only the
+        transactions referenced by the lines of a chunk are loaded, so
+        memory is bounded by the number of oracle codes and days reported.
+    '''
+    methods = ('card','bpay','eftpos')
+    method_labels = ['Credit Card','Bpay','EFTPOS']
+    banked_methods = ('cash','cheque','money_order')
+    banked_labels = ['Cash','Cheque','Money Order']
+    banked_sources = set(['cash','cheque','money_order'])
+    skip_empty_codes = True
+
+    def __init__(self,system,start,end,banked_start,banked_end,region=None,district=None):
+        self.system = system
+        self.start = start
+        self.end = end
+        self.banked_start = banked_start
+        self.banked_end = banked_end
+        self.region = region
+        self.district = district
+
+        self.dates = [d.strftime(REPORT_DATE_FORMAT) for d in daterange(start,end)]
+        self.banked_dates = [d.strftime(REPORT_DATE_FORMAT) for d in daterange(banked_start,banked_end)]
+        self.date_index = dict((d,i) for i,d in enumerate(self.dates))
+        self.banked_date_index = dict((d,i) for i,d in enumerate(self.banked_dates))
+
+        self.date_amounts = self._empty_amounts(self.dates, self.methods)
+        self.banked_date_amounts = self._empty_amounts(self.banked_dates, self.banked_methods)
+        self.oracle_codes = OrderedDict()
+        self.banked_oracle_codes = OrderedDict()
+
+    def _empty_amounts(self, dates, methods):
+        return [dict((m, D('0.0')) for m in methods) for d in dates]
+
+    def transaction_references(self):
+        ''' Querysets of invoice references with transactions in the report ranges.
+        '''
+        start, end = self.start, self.end
+        banked_start, banked_end = self.banked_start, self.banked_end
+        if not self.district:
+            return [
+                CashTransaction.objects.filter(created__gte=start, created__lte=end, source='eftpos').exclude(district__isnull=False).values_list('invoice__reference', flat=True),
+                CashTransaction.objects.filter(created__gte=banked_start, created__lte=banked_end).exclude(source='eftpos').exclude(district__isnull=False).values_list('invoice__reference', flat=True),
+                BpointTransaction.objects.filter(settlement_date__gte=start, settlement_date__lte=end).exclude(crn1__endswith='_test').values_list('crn1', flat=True),
+                BpayTransaction.objects.filter(p_date__gte=start, p_date__lte=end).values_list('crn', flat=True),
+            ]
+        return [
+            CashTransaction.objects.filter(created__gte=start, created__lte=end, source='eftpos',district=self.district).values_list('invoice__reference', flat=True),
+            CashTransaction.objects.filter(created__gte=banked_start, created__lte=banked_end,district=self.district).exclude(source='eftpos').values_list('invoice__reference', flat=True),
+        ]
+
+    def invoice_queryset(self):
+        ''' The system invoices with transactions in the report ranges.
+        '''
+        in_ranges = Q()
+        for qs in self.transaction_references():
+            in_ranges |= Q(reference__in=qs)
+        return Invoice.objects.filter(in_ranges, system=self.system)
+
+    def invoices(self):
+        ''' (reference, order_number) of the invoices in the report, streamed from the database.
+        '''
+        return self.invoice_queryset().order_by('id').values_list('reference','order_number').iterator()
+
+    def has_invoices(self):
+        return self.invoice_queryset().exists()
+
+    def aggregate(self):
+        for chunk in chunked(self.invoices(), REPORT_CHUNK_SIZE):
+            self._aggregate_chunk(chunk)
+
+    def _aggregate_chunk(self, invoices):
+        lines = OrderedDict()
+        order_numbers = set(n for r,n in invoices if n)
+        for line in Line.objects.filter(order__number__in=order_numbers).order_by('pk').values(
+                'order__number','order__date_placed','oracle_code','payment_details','refund_details','deduction_details'):
+            lines.setdefault(line['order__number'], []).append(line)
+
+        invoice_lines = []
+        cash_ids, card_ids, bpay_ids = set(), set(), set()
+        for reference, order_number in invoices:
+            for line in lines.get(order_number, []):
+                invoice_lines.append(line)
+                self._add_code(line['oracle_code'])
+                for field in ('payment_details','refund_details','deduction_details'):
+                    details = line[field] or {}
+                    cash_ids.update(int(k) for k in details.get('cash',{}))
+                    card_ids.update(int(k) for k in details.get('card',{}))
+                    bpay_ids.update(int(k) for k in details.get('bpay',{}))
+
+        self.cash = dict(
+            (i, (source, created.strftime(REPORT_DATE_FORMAT)))
+            for i, source, created in CashTransaction.objects.filter(id__in=cash_ids).values_list('id','source','created')
+        )
+        # Only approved card and bpay transactions are reported, keep their dates
+        self.card = dict(
+            (i, settlement_date.strftime(REPORT_DATE_FORMAT) if response_code == '0' else None)
+            for i, settlement_date, response_code in BpointTransaction.objects.filter(id__in=card_ids).values_list('id','settlement_date','response_code')
+        )
+        self.bpay = dict(
+            (i, p_date.strftime(REPORT_DATE_FORMAT) if service_code == '0' else None)
+            for i, p_date, service_code in BpayTransaction.objects.filter(id__in=bpay_ids).values_list('id','p_date','service_code')
+        )
+
+        for line in invoice_lines:
+            self.add_line(line)
+
+    def _add_code(self, code):
+        # create empty subtotal list for each oracle code
+        if code not in self.oracle_codes:
+            self.oracle_codes[code] = self._empty_amounts(self.dates, self.methods)
+        if code not in self.banked_oracle_codes:
+            self.banked_oracle_codes[code] = self._empty_amounts(self.banked_dates, self.banked_methods)
+
+    def _add(self, code, date, method, amount):
+        index = self.date_index.get(date)
+        if index is not None:
+            self.oracle_codes[code][index][method] += amount
+            self.date_amounts[index][method] += amount
+
+    def _add_banked(self, code, date, method, amount):
+        index = self.banked_date_index.get(date)
+        if index is not None:
+            self.banked_oracle_codes[code][index][method] += amount
+            self.banked_date_amounts[index][method] += amount
+
+    def _signed_details(self, line, method, deductions=False):
+        fields = [('payment_details', 1), ('refund_details', -1)]
+        if deductions:
+            fields.append(('deduction_details', -1))
+        for field, sign in fields:
+            details = line[field] or {}
+            for k,v in details.get(method,{}).items():
+                yield int(k), sign * D(v)
+
+    def add_line(self, line):
+        code = line['oracle_code']
+        # Banked Cash
+        for k, amount in self._signed_details(line, 'cash', deductions=True):
+            source, date = self.cash[k]
+            if source in self.banked_sources:
+                self._add_banked(code, date, source, amount)
+        self.add_electronic(line)
+
+    def add_electronic(self, line):
+        code = line['oracle_code']
+        # EFT
+        for k, amount in self._signed_details(line, 'cash'):
+            source, date = self.cash[k]
+            if source == 'eftpos':
+                self._add(code, date, 'eftpos', amount)
+        # Card
+        for k, amount in self._signed_details(line, 'card'):
+            date = self.card[k]
+            if date:
+                self._add(code, date, 'card', amount)
+        # BPAY
+        for k, amount in self._signed_details(line, 'bpay'):
+            date = self.bpay[k]
+            if date:
+                self._add(code, date, 'bpay', amount)
+
+    def _dates_row(self, dates, width):
+        row = ['']
+        for date in dates:
+            row += [date] + [''] * (width - 1)
+        return row + ['']
+
+    def _amounts_row(self, label, amounts, methods, skip_empty=False):
+        totals = dict((m, D('0.0')) for m in methods)
+        row = ['{}'.format(label)]
+        for d in amounts:
+            for m in methods:
+                row.append('{}'.format(d[m]))
+                totals[m] += d[m]
+        if skip_empty and all(totals[m] == D('0.0') for m in methods):
+            return None
+        return row + [''] + ['{}'.format(totals[m]) for m in methods] + ['']
+
+    def rows(self):
+        ''' Yield the report rows, aggregating once the headers are out.
+        '''
         fieldnames = ['Account Code', 'Day']
-        writer = csv.writer(strIO)
-        writer.writerow(fieldnames)
-
-        for d in daterange(start,end):
-            dates.append(d.strftime(date_format))
-            date_amounts.append({
-                'date':d.strftime(date_format),
-                'amounts':{
-                    'card': D('0.0'),
-                    'bpay': D('0.0'),
-                    'eftpos': D('0.0'),
-                    'cash': D('0.0'),
-                    'cheque': D('0.0'),
-                    'money_order': D('0.0')
-                }
-            })
-        for d in daterange(banked_start,banked_end):
-            banked_dates.append(d.strftime(date_format))
-            banked_date_amounts.append({
-                'date':d.strftime(date_format),
-                'amounts':{
-                    'cash': D('0.0'),
-                    'cheque': D('0.0'),
-                    'money_order': D('0.0')
-                }
-            })
+        yield fieldnames
+        yield self._dates_row(self.dates, len(self.method_labels))
+        yield [''] + self.method_labels * len(self.dates) + [''] + self.method_labels
 
-        dates_row = ''
-        for date in dates:
-            dates_row += '{},,,'.format(date)
-
-        # Dates row
-        writer.writerow(['']+ dates_row.split(','))
-        writer.writerow([''] + ['Credit Card','Bpay','EFTPOS'] * len(dates) + ['','Credit Card','Bpay','EFTPOS'])
-
-        # Loop through the payments and not the invoices
-        for i in invoices:
-            # Add items of invoice if not in list
-
-            if i.order:# and not i.voided:
-                lines = i.order.lines.all()
-                for x in lines:
-                    #print((i, i.__dict__, x, x.oracle_code))
-                    item_date_amounts, banked_item_dates_amounts = [], []
-                    for d in dates:
-                        item_date_amounts.append({
-                            'date':d,
-                            'amounts':{
-                                'card': D('0.0'),
-                                'bpay': D('0.0'),
-                                'eftpos': D('0.0'),
-                                'cash': D('0.0'),
-                                'cheque': D('0.0'),
-                                'money_order': D('0.0')
-                            }
-                        })
-                    for d in banked_dates:
-                        banked_item_dates_amounts.append({
-                            'date':d,
-                            'amounts':{
-                                'cash': D('0.0'),
-                                'cheque': D('0.0'),
-                                'money_order': D('0.0')
-                            }
-                        })
-
-                    items.append({
-                        'dates':item_date_amounts,
-                        'banked_dates': banked_item_dates_amounts,
-                        'item': x,
-                        'card': D('0.0'),
-                        'bpay': D('0.0'),
-                        'eftpos': D('0.0'),
-                        'cash': D('0.0'),
-                        'cheque': D('0.0'),
-                        'money_order': D('0.0')
-                    })
-
-                    # create empty subtotal list for each oracle code
-                    if x.oracle_code not in oracle_codes:
-                        oracle_codes[x.oracle_code] = []
-                        for d in daterange(start,end):
-                            oracle_codes[x.oracle_code].append({
-                                'date':d.strftime(date_format),
-                                'amounts':{
-                                    'card': D('0.0'),
-                                    'bpay': D('0.0'),
-                                    'eftpos': D('0.0'),
-                                    'cash': D('0.0'),
-                                    'cheque': D('0.0'),
-                                    'money_order': D('0.0')
-                                }
-                            })
-
-                    if x.oracle_code not in banked_oracle_codes:
-                        banked_oracle_codes[x.oracle_code] = []
-                        for d in daterange(banked_start,banked_end):
-                            banked_oracle_codes[x.oracle_code].append({
-                                'date':d.strftime(date_format),
-                                'amounts':{
-                                    'cash': D('0.0'),
-                                    'cheque': D('0.0'),
-                                    'money_order': D('0.0')
-                                }
-                            })
-
-        for item in items:
-            price = D(item.get('item').line_price_before_discounts_incl_tax)
-            code = item.get('item').oracle_code
-            order = item.get('item').order
-
-            payment_details = item.get('item').payment_details
-            refund_details = item.get('item').refund_details
-            deduction_details = item.get('item').deduction_details
-
-            # Banked Cash
-            for d in item['banked_dates']:
-                index = 0
-                for l in banked_date_amounts:
-                    if l.get('date') == d.get('date'):
-                        date_amount_index = index
-                        break
-                    index += 1
-
-                for k,v in payment_details["cash"].items():
-                    c = CashTransaction.objects.get(id=int(k))
-                    source = c.source
-                    if source in set(['cash','cheque','money_order']):
-                        if c.created.strftime(date_format) == d.get('date'):
-                            banked_oracle_codes[code][date_amount_index]['amounts'][source] += D(v)
-                            item[source] += D(v)
-                            banked_date_amounts[date_amount_index]['amounts'][source] += D(v)
-
-                for k,v in refund_details["cash"].items():
-                    c = CashTransaction.objects.get(id=int(k))
-                    source = c.source
-                    if source in set(['cash','cheque','money_order']):
-                        if c.created.strftime(date_format) == d.get('date'):
-                            banked_oracle_codes[code][date_amount_index]['amounts'][source] -= D(v)
-                            item[source] -= D(v)
-                            banked_date_amounts[date_amount_index]['amounts'][source] -= D(v)
-
-                for k,v in deduction_details["cash"].items():
-                    c = CashTransaction.objects.get(id=int(k))
-                    source = c.source
-                    if source in set(['cash','cheque','money_order']):
-                        if c.created.strftime(date_format) == d.get('date'):
-                            banked_oracle_codes[code][date_amount_index]['amounts'][source] -= D(v)
-                            item[source] -= D(v)
-                            banked_date_amounts[date_amount_index]['amounts'][source] -= D(v)
-
-
-            # Other transactions
-            for d in oracle_codes[code]:
-                index = 0
-                for l in date_amounts:
-                    if l.get('date') == d.get('date'):
-                        date_amount_index = index
-                        break
-                    index += 1
-                # EFT
-                for k,v in payment_details["cash"].items():
-                    c = CashTransaction.objects.get(id=int(k))
-                    source = c.source
-                    if source == 'eftpos':
-                        if c.created.strftime(date_format) == d.get('date'):
-                            oracle_codes[code][date_amount_index]['amounts']['eftpos'] += D(v)
-                            item['eftpos'] += D(v)
-                            date_amounts[date_amount_index]['amounts']['eftpos'] += D(v)
-
-                for k,v in refund_details["cash"].items():
-                    c = CashTransaction.objects.get(id=int(k))
-                    source = c.source
-                    if source == 'eftpos':
-                        if c.created.strftime(date_format) == d.get('date'):
-                            oracle_codes[code][date_amount_index]['amounts']['eftpos'] -= D(v)
-                            item['eftpos'] -= D(v)
-                            date_amounts[date_amount_index]['amounts']['eftpos'] -= D(v)
-
-                # Card
-                for k,v in payment_details['card'].items():
-                    c = BpointTransaction.objects.get(id=int(k))
-                    if c.settlement_date.strftime(date_format) == d.get('date') and c.approved:
-                        oracle_codes[code][date_amount_index]['amounts']['card'] += D(v)
-                        item['card'] += D(v)
-                        date_amounts[date_amount_index]['amounts']['card'] += D(v)
-
-                for k,v in refund_details['card'].items():
-                    c = BpointTransaction.objects.get(id=int(k))
-                    if c.settlement_date.strftime(date_format) == d.get('date') and c.approved:
-                        oracle_codes[code][date_amount_index]['amounts']['card'] -= D(v)
-                        item['card'] -= D(v)
-                        date_amounts[date_amount_index]['amounts']['card'] -= D(v)
-
-                # BPAY
-                for k,v in payment_details['bpay'].items():
-                    b = BpayTransaction.objects.get(id=int(k))
-                    if b.approved and b.p_date.strftime(date_format) == d.get('date'):
-                        oracle_codes[code][date_amount_index]['amounts']['bpay'] += D(v)
-                        item['bpay'] += D(v)
-                        date_amounts[date_amount_index]['amounts']['bpay'] += D(v)
-
-                for k,v in refund_details['bpay'].items():
-                    b = BpayTransaction.objects.get(id=int(k))
-                    if b.approved and b.p_date.strftime(date_format) == d.get('date'):
-                        oracle_codes[code][date_amount_index]['amounts']['bpay'] -= D(v)
-                        item['bpay'] -= D(v)
-                        date_amounts[date_amount_index]['amounts']['bpay'] -= D(v)
-
-        for code in oracle_codes:
-            item_str = ''
-            item_str += '{},'.format(code)
-            card_total = D('0.0')
-            bpay_total = D('0.0')
-            eftpos_total = D('0.0')
-            for d in oracle_codes[code]:
-                item_str += '{},{},{},'.format(d['amounts']['card'],d['amounts']['bpay'],d['amounts']['eftpos'])
-                card_total += d['amounts']['card']
-                bpay_total += d['amounts']['bpay']
-                eftpos_total += d['amounts']['eftpos']
-            item_str += ',{},{},{},'.format(card_total, bpay_total, eftpos_total)
-            if not ((card_total == D('0.0')) and (bpay_total == D('0.0')) and (eftpos_total == D('0.0'))):
-                writer.writerow(item_str.split(','))
-
-        total_str = 'Totals,'
-        total_amounts = {
-            'card': D('0.0'),
-            'bpay': D('0.0'),
-            'eftpos': D('0.0')
-        }
-        for d in date_amounts:
-            total_amounts['card'] += d['amounts']['card']
-            total_amounts['bpay'] += d['amounts']['bpay']
-            total_amounts['eftpos'] += d['amounts']['eftpos']
-            total_str += '{},{},{},'.format(d['amounts']['card'],d['amounts']['bpay'],d['amounts']['eftpos'])
-        total_str += ',{},{},{},'.format(total_amounts['card'],total_amounts['bpay'],total_amounts['eftpos'])
-        writer.writerow('')
-        writer.writerow(total_str.split(','))
+        self.aggregate()
 
-        # Banked Items
-        writer.writerow('')
-        writer.writerow(fieldnames)
-        banked_dates_row = ''
-        for date in banked_dates:
-            banked_dates_row += '{},,,'.format(date)
-        writer.writerow(['']+ banked_dates_row.split(','))
-        writer.writerow([''] + ['Cash','Cheque','Money Order'] * len(banked_dates) + ['','Cash','Cheque','Money Order','Banked(Cash,Money Order,Cheque)'])
-
-        for code in banked_oracle_codes:
-            banked_item_str = ''
-            banked_item_str += '{},'.format(code)
-            cash_total = D('0.0')
-            cheque_total = D('0.0')
-            moneyorder_total = D('0.0')
-            for d in banked_oracle_codes[code]:
-                banked_item_str += '{},{},{},'.format(d['amounts']['cash'],d['amounts']['cheque'],d['amounts']['money_order'])
-                cash_total += d['amounts']['cash']
-                cheque_total += d['amounts']['cheque']
-                moneyorder_total += d['amounts']['money_order']
-            banked_item_str += ',{},{},{},'.format(cash_total, cheque_total, moneyorder_total)
-            if not ((cash_total == D('0.0')) and (cheque_total == D('0.0')) and (moneyorder_total == D('0.0'))):
-                writer.writerow(banked_item_str.split(','))
-
-        banked_total_str = 'Totals,'
-        banked_total_amounts = {
-            'cash': D('0.0'),
-            'cheque': D('0.0'),
-            'money_order': D('0.0')
-        }
-        for d in banked_date_amounts:
-            banked_total_amounts['cash'] += d['amounts']['cash']
-            banked_total_amounts['cheque'] += d['amounts']['cheque']
-            banked_total_amounts['money_order'] += d['amounts']['money_order']
-            banked_total_str += '{},{},{},'.format(d['amounts']['cash'],d['amounts']['cheque'],d['amounts']['money_order'])
-        banked_total_str += ',{},{},{},'.format(banked_total_amounts['cash'],banked_total_amounts['cheque'],banked_total_amounts['money_order'])
-        writer.writerow('')
-        writer.writerow(banked_total_str.split(','))
-
-        strIO.flush()
-        strIO.seek(0)
-    return strIO
+        for code, amounts in self.oracle_codes.items():
+            row = self._amounts_row(code, amounts, self.methods, self.skip_empty_codes)
+            if row:
+                yield row
+        yield []
+        yield self._amounts_row('Totals', self.date_amounts, self.methods)
 
-def generate_items_csv_allocated(system,start,end,banked_start,banked_end,region=None,district=None):
-    strIO = None
-    invoices = []
-    invoice_list = []
-    dates, banked_dates = [], []
-    date_amounts, banked_date_amounts = [], []
-    items = []
-    oracle_codes = {}
-    banked_oracle_codes = {}
-    date_format = '%d/%m/%y'
-
-    eftpos = []
-    banked_cash = []
-    bpoint = []
-    bpay = []
-
-#    # Get all transactions
-#    if not district:
-#        eftpos.extend([x for x in CashTransaction.objects.filter(created__gte=start, created__lte=end, source='eftpos').exclude(district__isnull=False)])
-#        banked_cash.extend([x for x in CashTransaction.objects.filter(created__gte=banked_start, created__lte=banked_end).exclude(source='eftpos').exclude(district__isnull=False)])
-#        bpoint.extend([x for x in BpointTransaction.objects.filter(settlement_date__gte=start, settlement_date__lte=end).exclude(crn1__endswith='_test')])
-#        bpay.extend([x for x in BpayTransaction.objects.filter(p_date__gte=start, p_date__lte=end)])
-#    else:
-#        eftpos.extend([x for x in CashTransaction.objects.filter(created__gte=start, created__lte=end, source='eftpos',district=district)])
-#        banked_cash.extend([x for x in CashTransaction.objects.filter(created__gte=banked_start, created__lte=banked_end,district=district).exclude(source='eftpos')])
-#
-#    # Get the required invoices
-#    for e in eftpos:
-#        if e.invoice.reference not in invoice_list:
-#            if e.invoice.system == system:
-#                invoices.append(e.invoice)
-#                invoice_list.append(str(e.invoice.reference))
-#    for b in banked_cash:
-#        if b.invoice.reference not in invoice_list:
-#            if b.invoice.system == system:
-#                invoices.append(b.invoice)
-#                invoice_list.append(str(b.invoice.reference))
-#    for b in bpoint:
-#        if b.crn1 not in invoice_list:
-#            invoice = Invoice.objects.get(reference=b.crn1)
-#            if invoice.system == system:
-#                invoices.append(invoice)
-#                invoice_list.append(str(b.crn1))
-#    for b in bpay:
-#        if b.crn not in invoice_list:
-#            invoice = Invoice.objects.get(reference=b.crn)
-#            if invoice.system == system:
-#                invoices.append(invoice)
-#                invoice_list.append(str(b.crn))
-#
-    print (str(banked_start)+ ":"+str(banked_end)+":"+str(system))
-    invoices = Invoice.objects.filter(created__gte=banked_start, created__lte=banked_end, system=system)
-
-    print ("INVOICES")
-    print (invoices)
-    invoice_list = invoices
-    invoice_list = list(set(invoice_list))
-    if invoices:
-        strIO = StringIO()
-        fieldnames = ['Account Code', 'Day']
-        writer = csv.writer(strIO)
-        writer.writerow(fieldnames)
-
-        ########################################################
-        ## Header Dates START ##
-        ########################################################
-        for d in daterange(start,end):
-            dates.append(d.strftime(date_format))
-            date_amounts.append({
-                'date':d.strftime(date_format),
-                'amounts':{
-                    'card': D('0.0'),
-                    'bpay': D('0.0'),
-                    'eftpos': D('0.0'),
-                    'cash': D('0.0'),
-                    'cheque': D('0.0'),
-                    'money_order': D('0.0'),
-                    'order': D('0.0'), 
-                }
-            })
-
-        for d in daterange(banked_start,banked_end):
-            banked_dates.append(d.strftime(date_format))
-            banked_date_amounts.append({
-                'date':d.strftime(date_format),
-                'amounts':{
-                    'cash': D('0.0'),
-                    'cheque': D('0.0'),
-                    'money_order': D('0.0'),
-                    'order': D('0.0'),
-                }
-            })
-
-        dates_row = ''
-        for date in dates:
-            dates_row += '{},,,,'.format(date)
-
-        # Dates row
-        writer.writerow(['']+ dates_row.split(','))
-        writer.writerow([''] + ['Credit Card','Bpay','EFTPOS','Order'] * len(dates) + ['','Credit Card','Bpay','EFTPOS','Order'])
-        ########################################################
-        #### Header Dates END ####
-        ########################################################       
-
-        ####################################################################################################
-        ### Oracle Code Grouping Per Day Per Amount START (Electronic Payments, Credit Card,EFTpos Bpay,) ##
-        ####################################################################################################
-
-        # Loop through the payments and not the invoices
-        for i in invoices:
-            # Add items of invoice if not in list
-            if i.order:# and not i.voided:
-                lines = i.order.lines.all()
-                for x in lines:
-                    #print((i, i.__dict__, x, x.oracle_code))
-                    item_date_amounts, banked_item_dates_amounts = [], []
-                    for d in dates:
-                        item_date_amounts.append({
-                            'date':d,
-                            'amounts':{
-                                'card': D('0.0'),
-                                'bpay': D('0.0'),
-                                'eftpos': D('0.0'),
-                                'cash': D('0.0'),
-                                'cheque': D('0.0'),
-                                'money_order': D('0.0'),
-                                'order' : D('0.0'),
-                            }
-                        })
-
-                    for d in banked_dates:
-                        banked_item_dates_amounts.append({
-                            'date':d,
-                            'amounts':{
-                                'cash': D('0.0'),
-                                'cheque': D('0.0'),
-                                'money_order': D('0.0')
-                            }
-                        })
-
-                    items.append({
-                        'dates':item_date_amounts,
-                        'banked_dates': banked_item_dates_amounts,
-                        'item': x,
-                        'card': D('0.0'),
-                        'bpay': D('0.0'),
-                        'eftpos': D('0.0'),
-                        'cash': D('0.0'),
-                        'cheque': D('0.0'),
-                        'money_order': D('0.0'),
-                        'order' : D('0.0'),
-                    })
-
-                    
-                    # create empty subtotal list for each oracle code
-                    if x.oracle_code not in oracle_codes:
-                        oracle_codes[x.oracle_code] = []
-                        for d in daterange(start,end):
-                            oracle_codes[x.oracle_code].append({
-                                'date':d.strftime(date_format),
-                                'amounts':{
-                                    'card': D('0.0'),
-                                    'bpay': D('0.0'),
-                                    'eftpos': D('0.0'),
-                                    'cash': D('0.0'),
-                                    'cheque': D('0.0'),
-                                    'money_order': D('0.0'),
-                                    'order': D('0.0')
-                                }
-                            })
-                    
-                    if x.oracle_code not in banked_oracle_codes:
-                        banked_oracle_codes[x.oracle_code] = []
-                        for d in daterange(banked_start,banked_end):
-                            banked_oracle_codes[x.oracle_code].append({
-                                'date':d.strftime(date_format),
-                                'amounts':{
-                                    'cash': D('0.0'),
-                                    'cheque': D('0.0'),
-                                    'money_order': D('0.0'),
-                                    'order' : D('0.0')
-                                }
-                            })
-
-
-        for item in items:
-            price = D(item.get('item').line_price_before_discounts_incl_tax)
-            code = item.get('item').oracle_code
-            #order = item.get('item').order
-            date_placed = item.get('item').order.date_placed
-            payment_details = item.get('item').payment_details
-            refund_details = item.get('item').refund_details
-            deduction_details = item.get('item').deduction_details
-
-            # Banked Cash
-            for d in item['banked_dates']:
-                index = 0
-                for l in banked_date_amounts:
-                    if l.get('date') == d.get('date'):
-                        date_amount_index = index
-                        break
-                    index += 1
-                for k,v in payment_details["cash"].items():
-                    c = CashTransaction.objects.get(id=int(k))
-                    source = c.source
-                    if source in set(['cash','cheque','money_order','order']):
-                        if c.created.strftime(date_format) == d.get('date'):
-                            banked_oracle_codes[code][date_amount_index]['amounts'][source] += D(v)
-                            item[source] += D(v)
-                            banked_date_amounts[date_amount_index]['amounts'][source] += D(v)
-
-                for k,v in refund_details["cash"].items():
-                    c = CashTransaction.objects.get(id=int(k))
-                    source = c.source
-                    if source in set(['cash','cheque','money_order','order']):
-                        if c.created.strftime(date_format) == d.get('date'):
-                            banked_oracle_codes[code][date_amount_index]['amounts'][source] -= D(v)
-                            item[source] -= D(v)
-                            banked_date_amounts[date_amount_index]['amounts'][source] -= D(v)
-
-                for k,v in deduction_details["cash"].items():
-                    c = CashTransaction.objects.get(id=int(k))
-                    source = c.source
-                    if source in set(['cash','cheque','money_order','order']):
-                        if c.created.strftime(date_format) == d.get('date'):
-                            banked_oracle_codes[code][date_amount_index]['amounts'][source] -= D(v)
-                            item[source] -= D(v)
-                            banked_date_amounts[date_amount_index]['amounts'][source] -= D(v)
-
-            # Other transactions
-            for d in oracle_codes[code]:
-                index = 0
-                for l in date_amounts:
-                    if l.get('date') == d.get('date'):
-                        date_amount_index = index
-                        break
-                    index += 1
-                for k,v in payment_details["cash"].items():
-                    c = CashTransaction.objects.get(id=int(k))
-                    source = c.source
-                    if source == 'eftpos':
-                        if c.created.strftime(date_format) == d.get('date'):
-                            oracle_codes[code][date_amount_index]['amounts']['eftpos'] += D(v)
-                            item['eftpos'] += D(v)
-                            date_amounts[date_amount_index]['amounts']['eftpos'] += D(v)
-
-                for k,v in refund_details["cash"].items():
-                    c = CashTransaction.objects.get(id=int(k))
-                    source = c.source
-                    if source == 'eftpos':
-                        if c.created.strftime(date_format) == d.get('date'):
-                            oracle_codes[code][date_amount_index]['amounts']['eftpos'] -= D(v)
-                            item['eftpos'] -= D(v)
-                            date_amounts[date_amount_index]['amounts']['eftpos'] -= D(v)
-
-#                # Card
-#                for k,v in payment_details['card'].items():
-#                    c = BpointTransaction.objects.get(id=int(k))
-#                    if c.settlement_date.strftime(date_format) == d.get('date') and c.approved:
-#                        oracle_codes[code][date_amount_index]['amounts']['card'] += D(v)
-#                        item['card'] += D(v)
-#                        date_amounts[date_amount_index]['amounts']['card'] += D(v)
-#
-#                for k,v in refund_details['card'].items():
-#                    c = BpointTransaction.objects.get(id=int(k))
-#                    if c.settlement_date.strftime(date_format) == d.get('date') and c.approved:
-#                        oracle_codes[code][date_amount_index]['amounts']['card'] -= D(v)
-#                        item['card'] -= D(v)
-#                        date_amounts[date_amount_index]['amounts']['card'] -= D(v)
-#
-#                # BPAY
-#                for k,v in payment_details['bpay'].items():
-#                    b = BpayTransaction.objects.get(id=int(k))
-#                    if b.approved and b.p_date.strftime(date_format) == d.get('date'):
-#                        oracle_codes[code][date_amount_index]['amounts']['bpay'] += D(v)
-#                        item['bpay'] += D(v)
-#                        date_amounts[date_amount_index]['amounts']['bpay'] += D(v)
-#
-#                for k,v in refund_details['bpay'].items():
-#                    b = BpayTransaction.objects.get(id=int(k))
-#                    if b.approved and b.p_date.strftime(date_format) == d.get('date'):
-#                        oracle_codes[code][date_amount_index]['amounts']['bpay'] -= D(v)
-#                        item['bpay'] -= D(v)
-#                        date_amounts[date_amount_index]['amounts']['bpay'] -= D(v)
-#
-
-                # Order
-                if d.get('date') == date_placed.strftime(date_format):
-                    if 'order' in payment_details:
-                        print ("ORDER")
-                        print (payment_details['order'])
-                        for k,v in payment_details['order'].items():
-                            #c = BpointTransaction.objects.get(id=int(k))
-                            #if c.settlement_date.strftime(date_format) == d.get('date') and c.approved:
-                            
-                            oracle_codes[code][date_amount_index]['amounts']['order'] += D(v)
-                            item['order'] += D(v)
-                            date_amounts[date_amount_index]['amounts']['order'] += D(v)
-    
-                    if 'order' in refund_details: 
-                        for k,v in refund_details['order'].items():
-                            #c = BpointTransaction.objects.get(id=int(k))
-                            #if c.settlement_date.strftime(date_format) == d.get('date') and c.approved:
-                            oracle_codes[code][date_amount_index]['amounts']['order'] -= D(v)
-                            item['order'] -= D(v)
-                            date_amounts[date_amount_index]['amounts']['order'] -= D(v)
-    
-        for code in oracle_codes:
-            item_str = ''
-            item_str += '{},'.format(code)
-            card_total = D('0.0')
-            bpay_total = D('0.0')
-            eftpos_total = D('0.0')
-            order_total = D('0.0')
-            for d in oracle_codes[code]:
-                item_str += '{},{},{},{},'.format(d['amounts']['card'],d['amounts']['bpay'],d['amounts']['eftpos'],d['amounts']['order'])
-                card_total += d['amounts']['card']
-                bpay_total += d['amounts']['bpay']
-                eftpos_total += d['amounts']['eftpos']
-                order_total += d['amounts']['order']
-
-            item_str += ',{},{},{},{},'.format(card_total, bpay_total, eftpos_total, order_total)
-            #if not ((card_total == D('0.0')) and (bpay_total == D('0.0')) and (eftpos_total == D('0.0')) and (order_total == D('0.0'))):
-            writer.writerow(item_str.split(','))
-
-
-        ##################################################################################################
-        ### Oracle Code Grouping Per Day Per Amount END (Electronic Payments, Credit Card,EFTpos Bpay,) ## 
-        ##################################################################################################
-
-
-        ##############################################################################################
-        ### Oracle Code Grouping Per Day Per Amount END (Manual Payments,  Cash Cheque, Money Order ##
-        ##############################################################################################
-
-
-
-
-        total_str = 'Totals,'
-        total_amounts = {
-            'card': D('0.0'),
-            'bpay': D('0.0'),
-            'eftpos': D('0.0'),
-            'order': D('0.0'),
-        }
-        for d in date_amounts:
-            total_amounts['card'] += d['amounts']['card']
-            total_amounts['bpay'] += d['amounts']['bpay']
-            total_amounts['eftpos'] += d['amounts']['eftpos']
-            total_amounts['order'] += d['amounts']['order']
-
-            total_str += '{},{},{},{},'.format(d['amounts']['card'],d['amounts']['bpay'],d['amounts']['eftpos'],d['amounts']['order'])
-        total_str += ',{},{},{},{},'.format(total_amounts['card'],total_amounts['bpay'],total_amounts['eftpos'], total_amounts['order'])
-        writer.writerow('')
-        writer.writerow(total_str.split(','))
         # Banked Items
-        writer.writerow('')
-        writer.writerow(fieldnames)
-        banked_dates_row = ''
-        for date in banked_dates:
-            banked_dates_row += '{},,,'.format(date)
-        writer.writerow(['']+ banked_dates_row.split(','))
-        writer.writerow([''] + ['Cash','Cheque','Money Order'] * len(banked_dates) + ['','Cash','Cheque','Money Order','Banked(Cash,Money Order,Cheque)'])
-
-        for code in banked_oracle_codes:
-            banked_item_str = ''
-            banked_item_str += '{},'.format(code)
-            cash_total = D('0.0')
-            cheque_total = D('0.0')
-            moneyorder_total = D('0.0')
-            order_total = D('0.0')
- 
-            for d in banked_oracle_codes[code]:
-                banked_item_str += '{},{},{},{},'.format(d['amounts']['cash'],d['amounts']['cheque'],d['amounts']['money_order'], d['amounts']['order'])
-                cash_total += d['amounts']['cash']
-                cheque_total += d['amounts']['cheque']
-                moneyorder_total += d['amounts']['money_order']
-                order_total +=  d['amounts']['order']
-            banked_item_str += ',{},{},{},{},'.format(cash_total, cheque_total, moneyorder_total, order_total)
-            if not ((cash_total == D('0.0')) and (cheque_total == D('0.0')) and (moneyorder_total == D('0.0')) and (order_total == D('0.0'))):
-                writer.writerow(banked_item_str.split(','))
-
-        banked_total_str = 'Totals,'
-        banked_total_amounts = {
-            'cash': D('0.0'),
-            'cheque': D('0.0'),
-            'money_order': D('0.0'),
-            'order' : D('0.0'),
-        }
-        for d in banked_date_amounts:
-            banked_total_amounts['cash'] += d['amounts']['cash']
-            banked_total_amounts['cheque'] += d['amounts']['cheque']
-            banked_total_amounts['money_order'] += d['amounts']['money_order']
-            if 'order' in d['amounts']:
-                banked_total_amounts['order'] += d['amounts']['order']
-            else:
-                banked_total_amounts['order'] = D('0.0')
-                d['amounts']['order'] = D('0.0')
-            banked_total_str += '{},{},{},{},'.format(d['amounts']['cash'],d['amounts']['cheque'],d['amounts']['money_order'],d['amounts']['order'])
-        banked_total_str += ',{},{},{},{},'.format(banked_total_amounts['cash'],banked_total_amounts['cheque'],banked_total_amounts['money_order'],banked_total_amounts['order'])
-        writer.writerow('')
-        writer.writerow(banked_total_str.split(','))
-
-        strIO.flush()
-        strIO.seek(0)
-    return strIO
+        yield []
+        yield fieldnames
+        yield self._dates_row(self.banked_dates, len(self.banked_labels))
+        yield [''] + self.banked_labels * len(self.banked_dates) + [''] + self.banked_labels + ['Banked(Cash,Money Order,Cheque)']
+
+        for code, amounts in self.banked_oracle_codes.items():
+            row = self._amounts_row(code, amounts, self.banked_methods, True)
+            if row:
+                yield row
+        yield []
+        yield self._amounts_row('Totals', self.banked_date_amounts, self.banked_methods)
+
+class AllocatedItemsReport(ItemsReport):
+    ''' Itemised report over the invoices created in the banked range,
+        with order allocations reported on the day the order was placed.
+    '''
+    methods = ('card','bpay','eftpos','order')
+    method_labels = ['Credit Card','Bpay','EFTPOS','Order']
+    banked_methods = ('cash','cheque','money_order','order')
+    banked_sources = set(['cash','cheque','money_order','order'])
+    skip_empty_codes = False
+
+    def invoice_queryset(self):
+        return Invoice.objects.filter(created__gte=self.banked_start, created__lte=self.banked_end, system=self.system)
+
+    def add_electronic(self, line):
+        code = line['oracle_code']
+        for k, amount in self._signed_details(line, 'cash'):
+            source, date = self.cash[k]
+            if source == 'eftpos':
+                self._add(code, date, 'eftpos', amount)
+        # Order
+        date_placed = line['order__date_placed'].strftime(REPORT_DATE_FORMAT)
+        for k, amount in self._signed_details(line, 'order'):
+            self._add(code, date_placed, 'order', amount)
+
+def generate_items_csv_stream(system,start,end,banked_start,banked_end,region=None,district=None,allocated=False):
+    ''' Encoded csv lines of the itemised report, None if there are no invoices.
+    '''
+    report_class = AllocatedItemsReport if allocated else ItemsReport
+    report = report_class(system,start,end,banked_start,banked_end,region=region,district=district)
+    if not report.has_invoices():
+        return None
+    return stream_csv(report.rows())
 
 def generate_trans_csv(system,start,end,region=None,district=None):
     # Get invoices matching the system and date range
@@ -1,3 +1,888 @@
-from django.test import TestCase
+import csv
+import json
+import os
+import tempfile
+import threading
+import zipfile
+from collections import namedtuple
+from datetime import date
+from decimal import Decimal as D
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import mock
 
-# Create your tests here.
+from django.db import connection
+from django.core.exceptions import ValidationError
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from ledger.accounts.models import EmailUser
+from ledger.order.models import Order, Line as OrderLine, LineAllocation
+from ledger.payments.bpay import facade as bpay_facade
+from ledger.payments.bpay.models import BpayFile, BpayTransaction
+from ledger.payments import api as payments_api, bulk_pdf, parallel, pdf, trans_hash
+from ledger.payments.bpoint.models import BpointTransaction
+from ledger.payments.bpoint import reconcile
+from ledger.payments.bpoint.BPOINT import Utils as bpoint_utils
+from ledger.payments.bpoint.BPOINT.Requests import Credentials, Request, SystemStatusRequest
+from ledger.payments.cash.models import CashTransaction
+from ledger.payments.invoice.models import Invoice, InvoicePaymentSummary, UnpaidInvoice, calculate_payment_status
+from ledger.payments.models import LinkedInvoice, LinkedInvoiceGroupIncrementer, OracleInterface, OracleInterfaceDeduction, OracleInterfaceSystem, OracleOpenPeriod
+from ledger.payments.utils import OracleParserData, addToInterface, ledger_payment_invoice_calulations, update_payments
+from ledger.payments.reports import ItemsReport
+
+
+class PaymentStatusTestCase(TestCase):
+
+    def test_payment_status(self):
+        """Testing the balance and status worked out from the amount paid"""
+        self.assertEqual(calculate_payment_status(D('10.00'), False, D('0.00')), (D('10.00'), 'unpaid'))
+        self.assertEqual(calculate_payment_status(D('10.00'), False, D('4.00')), (D('6.00'), 'partially_paid'))
+        self.assertEqual(calculate_payment_status(D('10.00'), False, D('10.00')), (D('0.00'), 'paid'))
+        self.assertEqual(calculate_payment_status(D('10.00'), False, D('12.00')), (D('0'), 'over_paid'))
+        self.assertEqual(calculate_payment_status(D('10.00'), True, D('4.00')), (D('0'), 'cancelled'))
+
+
+class InvoicePaymentSummaryTestCase(TestCase):
+
+    def card(self, invoice, action, amount, n):
+        return BpointTransaction.objects.create(
+            action=action, amount=D(amount), amount_original=D(amount), crn1=invoice.reference,
+            response_code='0', response_txt='Approved', receipt_number='S{}'.format(n), processed=timezone.now(),
+            settlement_date=timezone.now().date(), type='internet', txn_number='SUM{}'.format(n)
+        )
+
+    def summary(self, invoice):
+        summary = InvoicePaymentSummary.objects.get(invoice=invoice)
+        return (summary.paid, summary.refunded, summary.balance, summary.payment_status)
+
+    def test_follows_transaction_saves(self):
+        """Testing that saving, changing and deleting transactions keeps the summary up to date"""
+        invoice = Invoice.objects.create(reference='09970000001', order_number='SUM1', amount=D('30.00'), system='0997')
+        cash = CashTransaction.objects.create(invoice=invoice, amount=D('10.00'), type='payment', source='cash')
+        self.assertEqual(self.summary(invoice), (D('10.00'), D('0.00'), D('20.00'), 'partially_paid'))
+        card = self.card(invoice, 'payment', '20.00', 1)
+        self.assertEqual(self.summary(invoice), (D('30.00'), D('0.00'), D('0.00'), 'paid'))
+
+        card.amount = D('15.00')
+        card.save()
+        self.assertEqual(self.summary(invoice), (D('25.00'), D('0.00'), D('5.00'), 'partially_paid'))
+        self.card(invoice, 'refund', '5.00', 2)
+        self.assertEqual(self.summary(invoice), (D('25.00'), D('5.00'), D('10.00'), 'partially_paid'))
+        cash.delete()
+        self.assertEqual(self.summary(invoice), (D('15.00'), D('5.00'), D('20.00'), 'partially_paid'))
+
+        # The incremental totals match a rebuild from the transactions
+        rebuilt = InvoicePaymentSummary(invoice=invoice)
+        rebuilt.calculate()
+        self.assertEqual((rebuilt.paid, rebuilt.refunded, rebuilt.balance, rebuilt.payment_status), self.summary(invoice))
+
+    def test_read_does_not_write(self):
+        invoice = Invoice.objects.create(reference='09970000002', order_number='SUM2', amount=D('30.00'), system='0997')
+        CashTransaction.objects.create(invoice=invoice, amount=D('10.00'), type='payment', source='cash')
+        InvoicePaymentSummary.objects.filter(invoice=invoice).delete()
+        self.assertEqual((invoice.payment_status, invoice.balance), ('partially_paid', D('20.00')))
+        self.assertFalse(InvoicePaymentSummary.objects.filter(invoice=invoice).exists())
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class TransactionHashTestCase(TestCase):
+
+    def test_invalidate_single_invoice(self):
+        """Testing that invalidating one invoice leaves the others cached"""
+        first = trans_hash.bpoint_transaction_hash('00010000001')
+        second = trans_hash.bpoint_transaction_hash('00010000002')
+        trans_hash.invalidate_invoice_transactions('BpointTransaction', '00010000001')
+        self.assertNotEqual(first, trans_hash.bpoint_transaction_hash('00010000001'))
+        self.assertEqual(second, trans_hash.bpoint_transaction_hash('00010000002'))
+
+    def test_invalidate_all(self):
+        """Testing the bulk invalidation of every invoice"""
+        first = trans_hash.cash_transaction_hash('00010000001')
+        bpay = trans_hash.bpay_transaction_hash('00010000001')
+        trans_hash.invalidate_all_transactions('CashTransaction')
+        self.assertNotEqual(first, trans_hash.cash_transaction_hash('00010000001'))
+        self.assertEqual(bpay, trans_hash.bpay_transaction_hash('00010000001'))
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class OracleParserQueryCountTestCase(TestCase):
+    """Query count benchmark of the oracle parser against a generated settlement day"""
+
+    SETTLEMENT_DATE = '2026-01-15'
+
+    def generate_settlement_day(self, number_of_invoices, lines_per_invoice=3):
+        invoices = []
+        start = Invoice.objects.count()
+        for n in range(start, start + number_of_invoices):
+            reference = '0999{:07d}'.format(n)
+            order = Order.objects.create(number='TEST{}'.format(n), total_incl_tax=D('30.00'), total_excl_tax=D('30.00'), date_placed=timezone.now())
+            invoice = Invoice.objects.create(reference=reference, order_number=order.number, amount=D('30.00'), system='0999')
+            txn = BpointTransaction.objects.create(
+                action='payment', amount=D('30.00'), amount_original=D('30.00'), crn1=reference,
+                response_code='0', response_txt='Approved', receipt_number=reference, processed=timezone.now(),
+                settlement_date=self.SETTLEMENT_DATE, type='internet', txn_number='TXN{}'.format(reference)
+            )
+            for l in range(lines_per_invoice):
+                OrderLine.objects.create(
+                    order=order, title='Line {}'.format(l), oracle_code='NNP{} GST'.format(l),
+                    line_price_incl_tax=D('10.00'), line_price_excl_tax=D('10.00'),
+                    line_price_before_discounts_incl_tax=D('10.00'), line_price_before_discounts_excl_tax=D('10.00'),
+                    payment_details={'bpay': {}, 'cash': {}, 'card': {str(txn.id): '10.00'}}
+                )
+            invoices.append(invoice)
+        return invoices
+
+    def count_queries(self, invoices):
+        with CaptureQueriesContext(connection) as queries:
+            data = OracleParserData(self.SETTLEMENT_DATE, invoices)
+        # Walking the lines of every invoice must not hit the database
+        with self.assertNumQueries(0):
+            total = D('0.0')
+            for invoice in invoices:
+                for line in data.order_lines(invoice):
+                    total += data.allocated_on_date(line.payment_details['card'], 'card')
+                    data.previous_amounts(invoice.reference, line.id)
+        self.assertEqual(total, D('30.00') * len(invoices))
+        return len(queries)
+
+    def test_fixed_query_count(self):
+        """Testing that the parser loads a settlement day with the same number of queries regardless of size"""
+        small = self.count_queries(self.generate_settlement_day(2))
+        large = self.count_queries(self.generate_settlement_day(25))
+        self.assertEqual(small, large)
+
+
+class ItemsReportTestCase(TestCase):
+    """Itemised report aggregation per oracle code, date and payment method"""
+
+    def setUp(self):
+        self.day = date(2026, 1, 15)
+        self.add_invoices(3)
+
+    def add_invoices(self, number_of_invoices):
+        start = Invoice.objects.count()
+        for n in range(start, start + number_of_invoices):
+            reference = '0990{:07d}'.format(n)
+            order = Order.objects.create(number='ITEMS{}'.format(n), total_incl_tax=D('30.00'), total_excl_tax=D('30.00'), date_placed=timezone.now())
+            Invoice.objects.create(reference=reference, order_number=order.number, amount=D('30.00'), system='0990')
+            txn = BpointTransaction.objects.create(
+                action='payment', amount=D('30.00'), amount_original=D('30.00'), crn1=reference,
+                response_code='0', response_txt='Approved', receipt_number=reference, processed=timezone.now(),
+                settlement_date=self.day, type='internet', txn_number='ITEMS{}'.format(reference)
+            )
+            for l in range(3):
+                OrderLine.objects.create(
+                    order=order, title='Line {}'.format(l), oracle_code='NNP{} GST'.format(l),
+                    line_price_incl_tax=D('10.00'), line_price_excl_tax=D('10.00'),
+                    line_price_before_discounts_incl_tax=D('10.00'), line_price_before_discounts_excl_tax=D('10.00'),
+                    payment_details={'bpay': {}, 'cash': {}, 'card': {str(txn.id): '10.00'}}
+                )
+
+    def report_rows(self):
+        report = ItemsReport('0990', self.day, self.day, self.day, self.day)
+        self.assertTrue(report.has_invoices())
+        return list(report.rows())
+
+    def test_card_totals(self):
+        rows = self.report_rows()
+        self.assertIn(['NNP0 GST', '30.00', '0.0', '0.0', '', '30.00', '0.0', '0.0', ''], rows)
+        self.assertIn(['Totals', '90.00', '0.0', '0.0', '', '90.00', '0.0', '0.0', ''], rows)
+
+    def test_fixed_query_count(self):
+        """Testing that the report runs the same number of queries regardless of size"""
+        with CaptureQueriesContext(connection) as small:
+            self.report_rows()
+        self.add_invoices(25)
+        with CaptureQueriesContext(connection) as large:
+            self.report_rows()
+        self.assertEqual(len(small), len(large))
+
+
+class AddToInterfaceTestCase(TestCase):
+
+    def setUp(self):
+        self.system = OracleInterfaceSystem.objects.create(system_id='0996', system_name='Interface', source='test', method='test', deduct_percentage=True)
+        # The account codes and open periods live in the oracle finance database
+        patcher = mock.patch('ledger.payments.utils.OracleAccountCode')
+        self.account_codes = patcher.start()
+        self.account_codes.objects.filter.return_value.values_list.return_value = ['NNP GST', 'NNP FEE']
+        self.addCleanup(patcher.stop)
+
+    def test_deductions(self):
+        """Testing that deductions move a percentage of a line to another account code"""
+        OracleInterfaceDeduction.objects.create(oisystem=self.system, percentage=10, percentage_account_code='NNP GST', destination_account_code='NNP FEE')
+        amounts = addToInterface('2026-01-15', {'NNP GST': D('100.00')}, self.system, True)
+        self.assertEqual(amounts, {'NNP GST': D('90.00'), 'NNP FEE': D('10.00')})
+        receipts = list(OracleInterface.objects.order_by('receipt_number').values_list('activity_name', 'amount'))
+        self.assertEqual(receipts, [('NNP GST', D('90.00')), ('NNP FEE', D('10.00'))])
+
+    def test_invalid_account_code(self):
+        with self.assertRaisesMessage(ValidationError, 'NNP UNKNOWN is not a valid account code'):
+            addToInterface('2026-01-15', {'NNP GST': D('10.00'), 'NNP UNKNOWN': D('5.00')}, self.system, True)
+        self.assertFalse(OracleInterface.objects.exists())
+
+    def test_incomplete_deduction(self):
+        OracleInterfaceDeduction.objects.create(oisystem=self.system, percentage=None, percentage_account_code='NNP GST', destination_account_code='NNP FEE')
+        with self.assertRaisesMessage(Exception, 'Deduction Percentage and an oracle account are required'):
+            addToInterface('2026-01-15', {'NNP GST': D('10.00')}, self.system, True)
+        self.assertFalse(OracleInterface.objects.exists())
+
+    def test_closed_period(self):
+        with mock.patch.object(OracleOpenPeriod.objects, 'get', side_effect=OracleOpenPeriod.DoesNotExist):
+            with self.assertRaisesMessage(ValidationError, 'There is currently no open period'):
+                addToInterface('2026-01-15', {'NNP GST': D('10.00')}, self.system, False)
+        self.assertFalse(OracleInterface.objects.exists())
+
+
+class PaymentAllocationRegressionTestCase(TestCase):
+    """The allocation engine must keep allocating what the line by line implementation did"""
+
+    def create_invoice(self, prices, amount=None):
+        n = Invoice.objects.count()
+        reference = '0999{:07d}'.format(n + 5000)
+        total = sum(prices, D('0.00'))
+        order = Order.objects.create(number='ALLOC{}'.format(n), total_incl_tax=total, total_excl_tax=total, date_placed=timezone.now())
+        invoice = Invoice.objects.create(reference=reference, order_number=order.number, amount=amount or total, system='0999')
+        for index, price in enumerate(prices):
+            OrderLine.objects.create(
+                order=order, title='Line {}'.format(index), oracle_code='NNP{} GST'.format(index % 2),
+                line_price_incl_tax=price, line_price_excl_tax=price,
+                line_price_before_discounts_incl_tax=price, line_price_before_discounts_excl_tax=price,
+                payment_details={'bpay': {}, 'cash': {}, 'card': {}},
+                refund_details={'bpay': {}, 'cash': {}, 'card': {}},
+                deduction_details={'bpay': {}, 'cash': {}, 'card': {}},
+            )
+        return invoice
+
+    def bpoint(self, invoice, amount, action='payment', response_code='0'):
+        n = BpointTransaction.objects.count()
+        return BpointTransaction.objects.create(
+            action=action, amount=D(amount), amount_original=D(amount), crn1=invoice.reference,
+            response_code=response_code, response_txt='Approved', receipt_number='R{}'.format(n), processed=timezone.now(),
+            settlement_date=timezone.now().date(), type='internet', txn_number='ALLOC{}'.format(n)
+        )
+
+    def cash(self, invoice, amount, type='payment'):
+        return CashTransaction.objects.create(invoice=invoice, amount=D(amount), type=type, source='cash')
+
+    def details(self, **methods):
+        details = {'bpay': {}, 'cash': {}, 'card': {}}
+        for method, amounts in methods.items():
+            details[method] = dict((str(txn.id), D(amount)) for txn, amount in amounts.items())
+        return details
+
+    def line_details(self, invoice):
+        return [
+            tuple(dict((method, dict((txn_id, D(a)) for txn_id, a in amounts.items())) for method, amounts in details.items())
+                  for details in (line.payment_details, line.refund_details, line.deduction_details))
+            for line in OrderLine.objects.filter(order__number=invoice.order_number).order_by('pk')
+        ]
+
+    def assertAllocations(self, invoice, payments, refunds=None, runs=1):
+        """payments and refunds hold the details expected on each line, in line order"""
+        for run in range(runs):
+            update_payments(invoice.reference)
+        refunds = refunds or [self.details() for line in payments]
+        expected = [(payment, refund, self.details()) for payment, refund in zip(payments, refunds)]
+        self.assertEqual(self.line_details(invoice), expected)
+
+    # Approved bpoint transactions are allocated newest first, each line
+    # takes what it still needs from each transaction in turn.
+    def test_single_payment(self):
+        invoice = self.create_invoice([D('10.00'), D('10.00'), D('10.00')])
+        txn = self.bpoint(invoice, '30.00')
+        self.assertAllocations(invoice, [
+            self.details(card={txn: '10.00'}),
+            self.details(card={txn: '10.00'}),
+            self.details(card={txn: '10.00'}),
+        ])
+
+    def test_split_payments(self):
+        invoice = self.create_invoice([D('10.00'), D('20.00'), D('5.00')])
+        first = self.bpoint(invoice, '15.00')
+        self.bpoint(invoice, '50.00', response_code='1')
+        last = self.bpoint(invoice, '20.00')
+        self.assertAllocations(invoice, [
+            self.details(card={last: '10.00'}),
+            self.details(card={last: '10.00', first: '10.00'}),
+            self.details(card={last: '0.00', first: '5.00'}),
+        ])
+
+    def test_remainder_to_first_line(self):
+        invoice = self.create_invoice([D('10.00'), D('10.00')], amount=D('25.00'))
+        txn = self.bpoint(invoice, '25.00')
+        self.assertAllocations(invoice, [
+            self.details(card={txn: '15.00'}),
+            self.details(card={txn: '10.00'}),
+        ])
+
+    def test_refund(self):
+        invoice = self.create_invoice([D('10.00'), D('10.00'), D('10.00')])
+        payment = self.bpoint(invoice, '30.00')
+        refund = self.bpoint(invoice, '10.00', action='refund')
+        self.assertAllocations(invoice, [
+            self.details(card={payment: '10.00'}),
+            self.details(card={payment: '10.00'}),
+            self.details(card={payment: '10.00'}),
+        ], [
+            self.details(card={refund: '10.00'}),
+            self.details(),
+            self.details(),
+        ])
+
+    def test_cash_and_card(self):
+        invoice = self.create_invoice([D('10.00'), D('10.00'), D('10.00')])
+        cash = self.cash(invoice, '12.00')
+        card = self.bpoint(invoice, '18.00')
+        self.assertAllocations(invoice, [
+            self.details(card={card: '10.00'}),
+            self.details(card={card: '8.00'}, cash={cash: '2.00'}),
+            self.details(card={card: '0.00'}, cash={cash: '10.00'}),
+        ])
+
+    def test_existing_allocations(self):
+        invoice = self.create_invoice([D('10.00'), D('15.00')])
+        txn = self.bpoint(invoice, '25.00')
+        first_line = OrderLine.objects.filter(order__number=invoice.order_number).order_by('pk').first()
+        first_line.payment_details['card'][str(txn.id)] = '5.00'
+        first_line.save()
+        self.assertAllocations(invoice, [
+            self.details(card={txn: '10.00'}),
+            self.details(card={txn: '15.00'}),
+        ])
+
+    def test_repeat_is_stable(self):
+        invoice = self.create_invoice([D('7.50'), D('12.25'), D('0.25')])
+        first = self.bpoint(invoice, '10.00')
+        last = self.bpoint(invoice, '10.00')
+        self.assertAllocations(invoice, [
+            self.details(card={last: '7.50'}),
+            self.details(card={last: '2.50', first: '9.75'}),
+            self.details(card={last: '0.00', first: '0.25'}),
+        ], runs=2)
+
+    def test_allocation_table_matches_lines(self):
+        invoice = self.create_invoice([D('10.00'), D('15.00')])
+        card = self.bpoint(invoice, '20.00')
+        cash = self.cash(invoice, '5.00')
+        self.bpoint(invoice, '4.00', action='refund')
+        update_payments(invoice.reference)
+        lines = OrderLine.objects.filter(order__number=invoice.order_number)
+        expected = [(a.line_id, a.kind, a.method, a.transaction_id, a.amount) for l in lines for a in LineAllocation.from_line(l)]
+        rows = list(LineAllocation.objects.filter(line__in=lines).values_list('line_id', 'kind', 'method', 'transaction_id', 'amount'))
+        self.assertEqual(sorted(rows), sorted(expected))
+        self.assertEqual(card.payment_allocated, D('20.00'))
+        self.assertEqual(cash.payment_allocated, D('5.00'))
+        self.assertEqual(LineAllocation.objects.filter(line__in=lines).totals_by_transaction('card', [card.id]), {card.id: D('20.00')})
+        self.assertEqual(sum(LineAllocation.objects.filter(line__in=lines).totals_by_oracle_code().values()), D('25.00'))
+
+
+GatewayTxn = namedtuple('GatewayTxn', 'crn1 action txn_number amount bank_response_code response_code')
+LedgerTxn = namedtuple('LedgerTxn', 'crn1 action txn_number amount')
+
+
+class ReconciliationTestCase(TestCase):
+
+    def test_reconcile(self):
+        gateway = [
+            GatewayTxn('09990000001', 'payment', 'T1', 1000, '00', '0'),
+            GatewayTxn('09990000002', 'payment', 'T2', 500, '00', '0'),
+            GatewayTxn('09990000002', 'payment', 'T3', 500, '00', '0'),
+            GatewayTxn('09990000003', 'reversal', 'T4', 700, '00', '0'),
+            GatewayTxn('09990000004', 'payment', 'T5', 200, '05', '1'),
+        ]
+        ledger = [
+            LedgerTxn('09990000001', 'payment', 'T1', D('10.00')),
+            LedgerTxn('09990000002', 'payment', 'T2', D('5.00')),
+            LedgerTxn('09990000009', 'refund', 'T9', D('3.00')),
+        ]
+        recon = reconcile.Reconciliation(gateway, ledger)
+        self.assertEqual([c.txn_number for c, rows in recon.matched()], ['T1', 'T2'])
+        self.assertEqual([c.txn_number for c in recon.missing_in_ledger()], ['T3', 'T4'])
+        self.assertEqual([t.txn_number for t in recon.missing_in_gateway()], ['T9'])
+        self.assertEqual([t.txn_number for t in recon.missing_in_gateway('crn1')], ['T9'])
+        self.assertEqual([c.txn_number for c in recon.duplicates('crn1')], ['T3'])
+        self.assertEqual(reconcile.gateway_amount(1050), '10.50')
+        self.assertEqual(reconcile.bpoint_total(ledger), D('12.00'))
+
+
+class StubGatewayHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def respond(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        self.server.calls.append((self.command, self.path, self.client_address[1], self.headers.get('Authorization')))
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+        body = json.dumps({'APIResponse': {'ResponseCode': 0 if status == 200 else 1, 'ResponseText': str(status)}}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = respond
+
+    def log_message(self, *args):
+        pass
+
+
+class BpointRequestSenderTestCase(TestCase):
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), StubGatewayHandler)
+        self.server.calls = []
+        self.server.statuses = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = 'http://127.0.0.1:{}/webapi/v2'.format(self.server.server_port)
+        self.credentials = Credentials('user', 'secret', '5353109000000000', 'AUD', '1234', True, None)
+        patcher = mock.patch.object(bpoint_utils, 'BPOINT_RETRY_BACKOFF', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        bpoint_utils.close_sessions()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def status(self):
+        request = SystemStatusRequest(self.credentials)
+        request.base_url = self.base_url
+        return request.submit()
+
+    def test_connection_reused(self):
+        self.status()
+        self.status()
+        self.assertEqual(len(self.server.calls), 2)
+        self.assertEqual(self.server.calls[0][2], self.server.calls[1][2])
+        self.assertEqual(self.server.calls[0][3], bpoint_utils.auth_header(self.credentials))
+
+    def test_get_retried(self):
+        self.server.statuses = [503, 200]
+        response = self.status()
+        self.assertEqual(response.api_response.response_code, 0)
+        self.assertEqual(len(self.server.calls), 2)
+
+    def test_payment_not_retried(self):
+        self.server.statuses = [503, 200]
+        request = Request(self.credentials)
+        request.base_url = self.base_url
+        request.url = '/txns/'
+        request.method = 'POST'
+        result = request.submit()
+        self.assertEqual(result['APIResponse']['ResponseText'], '503')
+        self.assertEqual(len(self.server.calls), 1)
+
+
+def flaky_system(system_id, fail_on):
+    if system_id == fail_on:
+        raise ValueError('system {} failed'.format(system_id))
+    return system_id.lower()
+
+
+def add_receipts(system_id, batches):
+    # Runs in a pool process, the account codes are patched there
+    system = OracleInterfaceSystem.objects.get(system_id=system_id)
+    with mock.patch('ledger.payments.utils.OracleAccountCode') as account_codes:
+        account_codes.objects.filter.return_value.values_list.return_value = ['NNP{} GST'.format(n) for n in range(10)]
+        for batch in range(batches):
+            addToInterface('2026-01-15', dict(('NNP{} GST'.format(n), D('1.00')) for n in range(10)), system, True)
+
+
+class RunForSystemsTestCase(TestCase):
+
+    def test_failures_isolated(self):
+        results = parallel.run_for_systems(flaky_system, ['S1', 'S2', 'S3'], args=('S2',), processes=1)
+        self.assertEqual([r['system_id'] for r in results], ['S1', 'S2', 'S3'])
+        self.assertEqual([r['result'] for r in results], ['s1', None, 's3'])
+        self.assertIsNone(results[0]['error'])
+        self.assertIn('system S2 failed', results[1]['error'])
+        self.assertTrue(all(r['runtime'] is not None for r in results))
+
+
+class ParallelReceiptNumberTestCase(TransactionTestCase):
+    """Systems interfaced by separate processes must not share receipt numbers"""
+
+    def test_receipt_numbers_unique(self):
+        system_ids = ['0981', '0982', '0983']
+        for system_id in system_ids:
+            OracleInterfaceSystem.objects.create(system_id=system_id, system_name=system_id, source='test', method='test')
+        results = parallel.run_for_systems(add_receipts, system_ids, args=(5,), processes=3)
+        self.assertEqual([r['error'] for r in results], [None, None, None])
+        numbers = list(OracleInterface.objects.values_list('receipt_number', flat=True))
+        self.assertEqual(len(numbers), 150)
+        self.assertEqual(sorted(numbers), list(range(min(numbers), min(numbers) + 150)))
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'invoice-group'}})
+class LedgerPaymentInvoiceCalculationsTestCase(TestCase):
+    """The ledger payments page loads a linked invoice group with a fixed number of queries"""
+
+    def setUp(self):
+        self.system = OracleInterfaceSystem.objects.create(system_id='0999', system_name='Test', source='test', method='test')
+
+    def create_group(self, size):
+        group = LinkedInvoiceGroupIncrementer.objects.create(system_identifier=self.system)
+        start = Invoice.objects.count()
+        for n in range(start, start + size):
+            reference = '0999{:07d}'.format(n + 8000)
+            order = Order.objects.create(number='GROUP{}'.format(n), total_incl_tax=D('20.00'), total_excl_tax=D('20.00'), date_placed=timezone.now())
+            Invoice.objects.create(reference=reference, order_number=order.number, amount=D('20.00'), system='0999', settlement_date=date(2026, 1, 15))
+            for l in range(2):
+                OrderLine.objects.create(
+                    order=order, title='Line {}'.format(l), oracle_code='NNP{} GST'.format(l),
+                    line_price_incl_tax=D('10.00'), line_price_excl_tax=D('10.00'),
+                    line_price_before_discounts_incl_tax=D('10.00'), line_price_before_discounts_excl_tax=D('10.00'),
+                )
+            BpointTransaction.objects.create(
+                action='payment', amount=D('20.00'), amount_original=D('20.00'), crn1=reference,
+                response_code='0', response_txt='Approved', receipt_number='G{}'.format(n), processed=timezone.now(),
+                settlement_date=date(2026, 1, 15), type='internet', txn_number='GTXN{}'.format(n)
+            )
+            CashTransaction.objects.create(invoice=Invoice.objects.get(reference=reference), amount=D('1.00'), type='payment', source='cash')
+            LinkedInvoice.objects.create(invoice_reference=reference, system_identifier=self.system, booking_reference='PB{}'.format(n), invoice_group_id=group)
+        return group
+
+    def count_queries(self, group):
+        with CaptureQueriesContext(connection) as queries:
+            data = ledger_payment_invoice_calulations(group.id, None, None, None, None)
+        self.assertEqual(data['status'], 200)
+        return len(queries), data
+
+    def test_fixed_query_count(self):
+        small, data = self.count_queries(self.create_group(2))
+        self.assertEqual(len(data['data']['order']), 4)
+        self.assertEqual(data['data']['total_gateway_amount'], '40.00')
+        large, data = self.count_queries(self.create_group(8))
+        self.assertEqual(len(data['data']['linked_payments']), 8)
+        self.assertEqual(data['data']['total_cash_amount'], '8.00')
+        self.assertEqual(small, large)
+
+    def test_cached_until_transaction_changes(self):
+        group = self.create_group(3)
+        first, data = self.count_queries(group)
+        cached, cached_data = self.count_queries(group)
+        # The group's links and the invoice ids for the row versions
+        self.assertEqual(cached, 2)
+        self.assertEqual(cached_data, data)
+        CashTransaction.objects.create(invoice=Invoice.objects.get(reference=data['data']['linked_payments'][0]['invoice_reference']), amount=D('2.00'), type='payment', source='cash')
+        refreshed, data = self.count_queries(group)
+        self.assertEqual(data['data']['total_cash_amount'], '5.00')
+
+    def test_cached_until_invoice_or_order_changes(self):
+        group = self.create_group(2)
+        first, data = self.count_queries(group)
+        invoice = Invoice.objects.get(reference=data['data']['linked_payments'][0]['invoice_reference'])
+        invoice.oracle_invoice_number = 'ORACLE1'
+        invoice.save()
+        refreshed, data = self.count_queries(group)
+        self.assertEqual(data['data']['linked_payments'][0]['oracle_invoice_number'], 'ORACLE1')
+        line = OrderLine.objects.filter(order__number=invoice.order_number).order_by('pk').first()
+        line.title = 'Renamed'
+        line.save()
+        refreshed, data = self.count_queries(group)
+        self.assertIn('Renamed', [row['title'] for row in data['data']['order']])
+
+    def test_voided_invoice_status(self):
+        group = self.create_group(2)
+        reference = LinkedInvoice.objects.filter(invoice_group_id=group).order_by('id').first().invoice_reference
+        # Voided without a save, the stored summary still says partially paid
+        Invoice.objects.filter(reference=reference).update(voided=True)
+        first, data = self.count_queries(group)
+        statuses = dict((i['invoice_reference'], (i['payment_status'], i['balance'])) for i in data['data']['invoices_data'])
+        self.assertEqual(statuses[reference], ('cancelled', '0'))
+
+
+class BpayFileMixin(object):
+
+    def bpay_file(self, file_id, crns):
+        rows = [
+            ['01', 'CBA', 'DPAW', '20240102', '0930', str(file_id), '', '', '/'],
+            ['02', '123456', '', '', '20240102', '0930', '', '2/'],
+            ['03', '123456', 'AUD', '', '2000', str(len(crns)), '', '', '0', '0', '', '', '0', '0', '/'],
+        ]
+        for n, crn in enumerate(crns):
+            rows.append(['30', '399', '1000', '0', crn, 'REF{:03d}{:06d}'.format(file_id, n), '0', '05', '001', '20240102', '093000', '004', '', '', '', 'Payer', '', '', '', '', '/'])
+        rows += [['49', '2000', '{}/'.format(len(crns) + 2)], ['98', '2000', '1', '{}/'.format(len(crns) + 4)], ['99', '2000', '1', '{}/'.format(len(crns) + 6)]]
+        f = tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False)
+        with f:
+            csv.writer(f).writerows(rows)
+        self.addCleanup(os.remove, f.name)
+        return f.name
+
+    def create_invoice(self, reference):
+        order = Order.objects.create(number='BPAY{}'.format(reference), total_incl_tax=D('20.00'), total_excl_tax=D('20.00'), date_placed=timezone.now())
+        OrderLine.objects.create(
+            order=order, title='Line', oracle_code='NNP GST',
+            line_price_incl_tax=D('20.00'), line_price_excl_tax=D('20.00'),
+            line_price_before_discounts_incl_tax=D('20.00'), line_price_before_discounts_excl_tax=D('20.00'),
+            payment_details={'bpay': {}, 'cash': {}, 'card': {}},
+            refund_details={'bpay': {}, 'cash': {}, 'card': {}},
+            deduction_details={'bpay': {}, 'cash': {}, 'card': {}},
+        )
+        return Invoice.objects.create(reference=reference, order_number=order.number, amount=D('20.00'), system='0999')
+
+    def bpay_allocated(self, invoice):
+        line = OrderLine.objects.get(order__number=invoice.order_number)
+        return dict((int(txn_id), D(amount)) for txn_id, amount in line.payment_details['bpay'].items())
+
+
+class BpayFileParserTestCase(BpayFileMixin, TestCase):
+
+    @mock.patch.object(bpay_facade, 'BPAY_CHUNK_SIZE', 2)
+    def test_parse_file(self):
+        """Testing that a file is stored in chunks once and unknown crns are left unmatched"""
+        path = self.bpay_file(1, ['00019990001', '00019990002', '00019990001'])
+        success, bpay_file, reason = bpay_facade.parseFile(path)
+        self.assertTrue(success, reason)
+        self.assertEqual(BpayTransaction.objects.filter(file=bpay_file).count(), 3)
+        self.assertEqual(BpayTransaction.objects.get(txn_ref='REF001000001').biller_code, '123456')
+
+        success, bpay_file, reason = bpay_facade.parseFile(path)
+        self.assertFalse(success)
+        self.assertIn('unique constraint', reason)
+        self.assertEqual(BpayFile.objects.count(), 1)
+
+    def test_allocates_to_invoice(self):
+        invoice = self.create_invoice('09990000017')
+        success, bpay_file, reason = bpay_facade.parseFile(self.bpay_file(2, [invoice.reference]))
+        self.assertTrue(success, reason)
+        txn = BpayTransaction.objects.get(file=bpay_file)
+        self.assertEqual(self.bpay_allocated(invoice), {txn.id: D('10.00')})
+        self.assertEqual(Invoice.objects.get(pk=invoice.pk).total_payment_amount, D('10.00'))
+        self.assertTrue(BpayFile.objects.get(pk=bpay_file.pk).payments_allocated)
+
+    def test_failed_allocation_retried(self):
+        invoice = self.create_invoice('09990000018')
+        path = self.bpay_file(3, [invoice.reference])
+        with mock.patch.object(bpay_facade, 'update_payments', side_effect=ValueError('allocation down')):
+            results, failed = bpay_facade.parseFiles([[path, 'BPAY3']])
+        self.assertTrue(results[0][0], results[0][2])
+        self.assertEqual(failed, [(invoice.reference, 'allocation down')])
+        self.assertFalse(BpayFile.objects.get(file_id=3).payments_allocated)
+        self.assertEqual(self.bpay_allocated(invoice), {})
+
+        # The next run allocates the file left over
+        results, failed = bpay_facade.parseFiles([])
+        self.assertEqual((results, failed), ([], []))
+        self.assertTrue(BpayFile.objects.get(file_id=3).payments_allocated)
+        self.assertEqual(sum(self.bpay_allocated(invoice).values()), D('10.00'))
+
+
+class BpayFileConcurrentParseTestCase(BpayFileMixin, TransactionTestCase):
+    """Runs of the parser at the same time must allocate every file once"""
+
+    def parse(self, path, name, results):
+        try:
+            results[name] = bpay_facade.parseFiles([[path, name]])
+        finally:
+            connection.close()
+
+    def test_concurrent_parse(self):
+        invoice = self.create_invoice('09990000019')
+        results = {}
+        threads = [
+            threading.Thread(target=self.parse, args=(self.bpay_file(file_id, [invoice.reference]), 'BPAY{}'.format(file_id), results))
+            for file_id in (4, 5)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for name in ('BPAY4', 'BPAY5'):
+            file_results, failed = results[name]
+            self.assertTrue(file_results[0][0], file_results[0][2])
+            self.assertEqual(failed, [])
+        self.assertFalse(BpayFile.objects.filter(payments_allocated=False).exists())
+        self.assertEqual(sorted(self.bpay_allocated(invoice).values()), [D('10.00'), D('10.00')])
+        self.assertEqual(Invoice.objects.get(pk=invoice.pk).total_payment_amount, D('20.00'))
+
+
+class UnpaidInvoiceTrackingTestCase(TestCase):
+
+    def test_tracked_from_payments(self):
+        """Testing that the unpaid invoice table follows the payments of the invoice"""
+        invoice = Invoice.objects.create(reference='09980000001', order_number='UNPAID1', amount=D('20.00'), system='0998', due_date=date(2026, 1, 15))
+        Invoice.objects.create(reference='09980000002', order_number='UNPAID2', amount=D('20.00'), system='0998')
+        self.assertEqual(list(UnpaidInvoice.objects.values_list('invoice_reference', 'amount', 'due_status')), [('09980000001', D('20.00'), 'Overdue')])
+
+        CashTransaction.objects.create(invoice=invoice, amount=D('5.00'), type='payment', source='cash')
+        self.assertEqual(UnpaidInvoice.objects.get(invoice=invoice).due_status, 'Overdue')
+        CashTransaction.objects.create(invoice=invoice, amount=D('15.00'), type='payment', source='cash')
+        self.assertFalse(UnpaidInvoice.objects.exists())
+
+    def test_due_status_moves_on(self):
+        invoice = Invoice.objects.create(reference='09980000003', order_number='UNPAID3', amount=D('20.00'), system='0998', due_date=date(2026, 1, 15))
+        UnpaidInvoice.objects.filter(invoice=invoice).update(due_status='Not Due')
+        self.assertEqual(UnpaidInvoice.refresh_due_status(today=date(2026, 1, 16)), 1)
+        self.assertEqual(UnpaidInvoice.objects.get(invoice=invoice).due_status, 'Overdue')
+
+    def test_owed_again_after_cancel(self):
+        invoice = Invoice.objects.create(reference='09980000004', order_number='UNPAID4', amount=D('20.00'), system='0998', due_date=date(2026, 1, 15))
+        UnpaidInvoice.track(invoice, 'cancelled')
+        self.assertTrue(UnpaidInvoice.objects.get(invoice=invoice).voided)
+        UnpaidInvoice.track(invoice, 'unpaid')
+        self.assertFalse(UnpaidInvoice.objects.get(invoice=invoice).voided)
+
+    def test_rebuild_removes_stale_rows(self):
+        paid = Invoice.objects.create(reference='09980000005', order_number='UNPAID5', amount=D('20.00'), system='0998', due_date=date(2026, 1, 15))
+        CashTransaction.objects.create(invoice=paid, amount=D('20.00'), type='payment', source='cash')
+        undated = Invoice.objects.create(reference='09980000006', order_number='UNPAID6', amount=D('20.00'), system='0998', due_date=date(2026, 1, 15))
+        Invoice.objects.filter(pk=undated.pk).update(due_date=None)
+        owed = Invoice.objects.create(reference='09980000007', order_number='UNPAID7', amount=D('20.00'), system='0998', due_date=date(2026, 1, 15))
+        # Rows left by the report before the table was tracked
+        UnpaidInvoice.objects.create(invoice=paid, invoice_reference=paid.reference, system='0998', amount=D('20.00'), due_status='Overdue')
+        UnpaidInvoice.objects.filter(invoice=owed).delete()
+        UnpaidInvoice.rebuild('0998')
+        self.assertEqual(list(UnpaidInvoice.objects.values_list('invoice_reference', flat=True)), ['09980000007'])
+
+    def test_rebuild_with_stale_summary(self):
+        """Testing that a rebuild doesn't put an invoice cancelled behind its summary's back on the report"""
+        invoice = Invoice.objects.create(reference='09980000009', order_number='UNPAID9', amount=D('20.00'), system='0998', due_date=date(2026, 1, 15))
+        Invoice.objects.filter(pk=invoice.pk).update(voided=True)
+        UnpaidInvoice.objects.filter(invoice=invoice).update(voided=True)
+        UnpaidInvoice.rebuild('0998')
+        self.assertTrue(UnpaidInvoice.objects.get(invoice=invoice).voided)
+        self.assertEqual(InvoicePaymentSummary.objects.get(invoice=invoice).payment_status, 'cancelled')
+
+    def test_cancel_invoice(self):
+        """Testing that cancelling a part paid invoice records it as cancelled and no longer owed"""
+        OracleInterfaceSystem.objects.create(system_id='0998', system_name='Test', source='test', method='test')
+        invoice = Invoice.objects.create(reference='09980000008', order_number='UNPAID8', amount=D('20.00'), system='0998', due_date=date(2026, 1, 15))
+        CashTransaction.objects.create(invoice=invoice, amount=D('5.00'), type='payment', source='cash')
+        request = RequestFactory().get('/', {'invoice_reference': invoice.reference})
+        request.user = mock.Mock(email='admin@test.net')
+        with mock.patch('ledger.payments.api.helpers.is_payment_admin', return_value=True), \
+                mock.patch('ledger.payments.api.payments_utils.get_oracle_interface_system_permissions', return_value={'manage_ledger_tool': True, 'all_access': False}):
+            response = payments_api.CancelInvoice(request)
+        self.assertEqual(response.status_code, 200)
+        summary = InvoicePaymentSummary.objects.get(invoice=invoice)
+        self.assertEqual((summary.payment_status, summary.balance), ('cancelled', D('0.00')))
+        self.assertTrue(UnpaidInvoice.objects.get(invoice=invoice).voided)
+
+
+class InvoicePDFCacheTestCase(TestCase):
+
+    def setUp(self):
+        cache_dir = tempfile.mkdtemp()
+        patcher = mock.patch.object(pdf, 'INVOICE_PDF_CACHE_DIR', cache_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache_dir = cache_dir
+        self.rendered = []
+
+    def fake_render(self, buffer, invoice):
+        self.rendered.append(invoice.reference)
+        buffer.write('pdf {}'.format(len(self.rendered)).encode('utf-8'))
+
+    @override_settings(INVOICE_PDF_CACHE=True)
+    def test_rendered_once_per_version(self):
+        """Testing that an invoice pdf is rendered again only after a payment"""
+        invoice = Invoice.objects.create(reference='09970000001', order_number='PDF1', amount=D('20.00'), system='0997')
+        with mock.patch.object(pdf, '_create_invoice', self.fake_render):
+            first = pdf.create_invoice_pdf_bytes('invoice.pdf', invoice)
+            self.assertEqual(pdf.create_invoice_pdf_bytes('invoice.pdf', invoice), first)
+            self.assertEqual(len(self.rendered), 1)
+
+            CashTransaction.objects.create(invoice=invoice, amount=D('20.00'), type='payment', source='cash')
+            invoice = Invoice.objects.get(pk=invoice.pk)
+            self.assertNotEqual(pdf.create_invoice_pdf_bytes('invoice.pdf', invoice), first)
+            self.assertEqual(len(self.rendered), 2)
+        # The stale render is removed
+        self.assertEqual(len(os.listdir(os.path.join(self.cache_dir, invoice.reference))), 1)
+        self.assertEqual(pdf.evict_invoice_pdf_cache(max_age_days=-1), 1)
+
+    @override_settings(INVOICE_PDF_CACHE=True)
+    def test_rendered_again_after_order_changes(self):
+        """Testing that an invoice pdf is rendered again when its owner or order lines change"""
+        owner = EmailUser.objects.create(email='pdf.owner@test.net', first_name='Jo', last_name='Bloggs')
+        order = Order.objects.create(number='PDF2', user=owner, total_incl_tax=D('20.00'), total_excl_tax=D('20.00'), date_placed=timezone.now())
+        line = OrderLine.objects.create(order=order, title='Park entry', oracle_code='PDF2', quantity=1,
+            line_price_incl_tax=D('20.00'), line_price_excl_tax=D('20.00'),
+            line_price_before_discounts_incl_tax=D('20.00'), line_price_before_discounts_excl_tax=D('20.00'))
+        invoice = Invoice.objects.create(reference='09970000002', order_number=order.number, amount=D('20.00'), system='0997')
+        with mock.patch.object(pdf, '_create_invoice', self.fake_render):
+            pdf.create_invoice_pdf_bytes('invoice.pdf', invoice)
+            pdf.create_invoice_pdf_bytes('invoice.pdf', invoice)
+            self.assertEqual(len(self.rendered), 1)
+
+            owner.first_name = 'Joanne'
+            owner.save()
+            pdf.create_invoice_pdf_bytes('invoice.pdf', invoice)
+            self.assertEqual(len(self.rendered), 2)
+
+            line.title = 'Camping'
+            line.save()
+            pdf.create_invoice_pdf_bytes('invoice.pdf', invoice)
+            self.assertEqual(len(self.rendered), 3)
+
+
+class BulkInvoicePDFTestCase(TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        patcher = mock.patch.object(pdf, 'INVOICE_PDF_CACHE_DIR', self.cache_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.rendered = []
+
+    def fake_render(self, buffer, invoice):
+        self.rendered.append(invoice.reference)
+        buffer.write(b'%PDF /Type /Pages /Type /Page /Type /Page')
+
+    @override_settings(INVOICE_PDF_CACHE=True)
+    def test_render_invoices(self):
+        """Testing that bulk rendering zips every invoice and warms the pdf cache"""
+        for n in range(3):
+            Invoice.objects.create(reference='0996000000{}'.format(n), order_number='BULK{}'.format(n), amount=D('20.00'), system='0996')
+        output = os.path.join(self.cache_dir, 'invoices.zip')
+        with mock.patch.object(pdf, '_create_invoice', self.fake_render):
+            stats = bulk_pdf.render_invoices(Invoice.objects.filter(system='0996'), output, processes=1, chunksize=2)
+            self.assertEqual((stats['documents'], stats['pages'], stats['failed']), (3, 6, {}))
+            with zipfile.ZipFile(output) as z:
+                self.assertEqual(z.namelist(), ['invoice-09960000000.pdf', 'invoice-09960000001.pdf', 'invoice-09960000002.pdf'])
+
+            # Served from the cache now
+            stats = bulk_pdf.render_invoices(['09960000000', '09969999999'], processes=1)
+        self.assertEqual(len(self.rendered), 3)
+        self.assertEqual(list(stats['failed']), ['09969999999'])
+
+    def test_merged_pdf_small_batches_only(self):
+        """Testing that a merged pdf of too many invoices is refused before rendering"""
+        output = os.path.join(self.cache_dir, 'invoices.pdf')
+        with override_settings(INVOICE_PDF_MAX_MERGED=1), mock.patch.object(pdf, '_create_invoice', self.fake_render):
+            with self.assertRaises(ValueError):
+                bulk_pdf.render_invoices(['09960000000', '09960000001'], output, processes=1)
+        self.assertEqual(self.rendered, [])
+        self.assertFalse(os.path.exists(output))
+        self.assertFalse(os.path.exists(output + '.part'))
+
+    def test_pool_terminated_on_error(self):
+        """Testing that the render processes are killed when a chunk fails"""
+        pool = mock.Mock()
+        pool.imap.side_effect = RuntimeError('render failed')
+        context = mock.Mock()
+        context.Pool.return_value = pool
+        with mock.patch.object(bulk_pdf.multiprocessing, 'get_context', return_value=context):
+            with self.assertRaises(RuntimeError):
+                list(bulk_pdf.render_chunks(['09960000000', '09960000001'], 2, 1))
+        pool.terminate.assert_called_once_with()
+        pool.close.assert_not_called()
+        pool.join.assert_called_once_with()
+
+
+class BulkInvoicePDFProcessesTestCase(TransactionTestCase):
+    """Invoices rendered by spawned processes are read from the parent's database"""
+
+    def test_render_chunks_in_processes(self):
+        references = ['0995000000{}'.format(n) for n in range(3)]
+        for reference in references:
+            Invoice.objects.create(reference=reference, order_number='SPAWN{}'.format(reference), amount=D('20.00'), system='0995')
+        # Settings overrides don't reach spawned processes, the environment does
+        with mock.patch.dict(os.environ, {'INVOICE_PDF_CACHE': 'False'}):
+            results = [r for chunk in bulk_pdf.render_chunks(references + ['09959999999'], 2, 2) for r in chunk]
+        self.assertEqual([r[0] for r in results], references + ['09959999999'])
+        self.assertEqual([r[2] for r in results if r[2] == 'Invoice not found'], ['Invoice not found'])
+        self.assertEqual(results[-1][2], 'Invoice not found')
@@ -1,26 +1,70 @@
 from django.core.cache import cache
-from confy import env
-import datetime
-import hashlib
-
-
-def bpoint_transaction_hash():
-    change_hash = cache.get('BpointTransaction')
-    if change_hash is None:
-       change_hash = hashlib.md5(datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S").encode('utf-8')).hexdigest()
-       cache.set('BpointTransaction', change_hash,  86400)
-    return change_hash
-
-def bpay_transaction_hash():
-    change_hash = cache.get('BpayTransaction')
-    if change_hash is None:
-         change_hash = hashlib.md5(datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S").encode('utf-8')).hexdigest()
-         cache.set('BpayTransaction', change_hash,  86400)
-    return change_hash
-
-def cash_transaction_hash():
-    change_cash_hash = cache.get('CashTransaction')
-    if change_cash_hash is None:
-       change_cash_hash = hashlib.md5(datetime.datetime.now().strftime("%m/%d/%Y, %H:%M:%S").encode('utf-8')).hexdigest()
-       cache.set('CashTransaction', change_cash_hash,  86400)
-    return change_cash_hash
+from ledger.api.versions import now_and_on_commit
+import uuid
+
+# Versions of the transactions of each invoice reference, used in the keys of
+# data cached from them (invoice pdfs, linked invoice totals, gateway ETags).
+# A save on a transaction only replaces the version of the invoice(s) it
+# belongs to, so the cached data of every other invoice stays valid. Like the
+# row versions, they are replaced on save and again on commit.
+TRANSACTION_MODELS = ('BpointTransaction', 'BpayTransaction', 'CashTransaction')
+CACHE_TIMEOUT = 86400
+
+
+def _new_version():
+    return uuid.uuid4().hex
+
+def _generation(model_name):
+    ''' Generation shared by all the invoices of a transaction model,
+        replaced to invalidate every invoice at once.
+    '''
+    key = '{}:generation'.format(model_name)
+    generation = cache.get(key)
+    if generation is None:
+        generation = _new_version()
+        cache.set(key, generation, CACHE_TIMEOUT)
+    return generation
+
+def _version_key(model_name, reference):
+    return '{}:{}:version:{}'.format(model_name, _generation(model_name), reference)
+
+def transaction_version(model_name, reference):
+    ''' Get the current version of the cached transactions of model_name
+        for the invoice with the given reference.
+    '''
+    key = _version_key(model_name, reference)
+    version = cache.get(key)
+    if version is None:
+        version = _new_version()
+        cache.set(key, version, CACHE_TIMEOUT)
+    return version
+
+def invalidate_invoice_transactions(model_name, *references):
+    ''' Evict the cached transactions of model_name for the given invoice references.
+    '''
+    references = set(r for r in references if r)
+    if references:
+        now_and_on_commit(_delete_versions, model_name, references)
+
+def _delete_versions(model_name, references):
+    cache.delete_many([_version_key(model_name, r) for r in references])
+
+def invalidate_all_transactions(model_name=None):
+    ''' Evict the cached transactions of every invoice, eg after a data migration.
+        If model_name is not given all the transaction models are invalidated.
+    '''
+    models = [model_name] if model_name else TRANSACTION_MODELS
+    now_and_on_commit(_replace_generations, models)
+
+def _replace_generations(models):
+    for m in models:
+        cache.set('{}:generation'.format(m), _new_version(), CACHE_TIMEOUT)
+
+def bpoint_transaction_hash(reference):
+    return transaction_version('BpointTransaction', reference)
+
+def bpay_transaction_hash(reference):
+    return transaction_version('BpayTransaction', reference)
+
+def cash_transaction_hash(reference):
+    return transaction_version('CashTransaction', reference)
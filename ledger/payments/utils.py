@@ -8,24 +8,31 @@ from wsgiref.util import FileWrapper
 from decimal import Decimal as D
 from django.core.mail import EmailMessage
 from django.conf import settings
+from django.core.cache import cache
 from django.db import transaction
 from django.core.exceptions import ValidationError
 from django.core.urlresolvers import resolve
 from six.moves.urllib.parse import urlparse
 #
-from ledger.payments.models import OracleParser, OracleParserInvoice, Invoice, OracleInterface, OracleInterfaceSystem, OracleInterfacePermission, BpointTransaction, BpayTransaction, OracleAccountCode, OracleAccountCodeTax,OracleOpenPeriod, OracleInterfaceDeduction, OracleInterfaceSystem, LinkedInvoiceGroupIncrementer, LinkedInvoice
+from ledger.payments.models import increment_receipt_number, lock_receipt_numbers, OracleParser, OracleParserInvoice, Invoice, OracleInterface, OracleInterfaceSystem, OracleInterfacePermission, BpayTransaction, OracleAccountCode, OracleAccountCodeTax,OracleOpenPeriod, OracleInterfaceDeduction, LinkedInvoiceGroupIncrementer, LinkedInvoice
 #from ledger.payments.invoice import utils
 #from oscar.apps.order.models import Order
 from ledger.order.models import Order
 from ledger.basket.models import Basket
 from ledger.order import models as order_model
 from ledger.payments.cash.models import CashTransaction
+from ledger.payments.invoice.models import calculate_payment_status
 from ledger.payments.bpoint.models import BpointTransaction
+from ledger.payments import trans_hash
+from ledger.api import versions
 from oscar.core.loading import get_class
 from confy import env
 from decimal import Decimal
 from django.db.models import Q
-from django.db.models import Count
+from django.db.models import Count, Case, When, Value
+from django.db.models.functions import Cast
+from django.contrib.postgres.fields import JSONField
+import hashlib
 import logging
 logger = logging.getLogger(__name__)
 
@@ -121,63 +128,38 @@ def addToInterface(date,oracle_codes,system,override):
             except OracleOpenPeriod.DoesNotExist:
                 raise ValidationError('There is currently no open period for transactions done on {}'.format(trans_date))
 
-        # create dictionary of OracleInterface records for line items in transaction
-        records = {}
+        # Load the deductions and the valid account codes once for the system
+        deductions = {}
+        if system.deduct_percentage:
+            for deduction in OracleInterfaceDeduction.objects.filter(oisystem=system, percentage_account_code__in=list(oracle_codes.keys())).order_by('id'):
+                deductions.setdefault(deduction.percentage_account_code, []).append(deduction)
+        valid_codes = set(OracleAccountCode.objects.filter(active_receivables_activities__in=[k for k, v in oracle_codes.items() if v != 0]).values_list('active_receivables_activities', flat=True))
+
+        # work out the amount of each account code in memory
+        amounts = {}
         for k, v in oracle_codes.items():
-            if k not in records:
-                records[k] = OracleInterface.objects.create(
-                    receipt_date = trans_date,
-                    activity_name = k,
-                    amount = D(v),
-                    customer_name = system.system_name,
-                    description = k,
-                    source = system.source,
-                    method = system.method,
-                    comments = '{} GST/{}'.format(k,date),
-                    status = 'NEW',
-                    status_date = today
-                )
+            if k not in amounts:
+                amounts[k] = D(v)
 
         deductions_only = set()
 
         # add empty stubs for deductions
         for k, v in oracle_codes.items():
-            deduction_qs = OracleInterfaceDeduction.objects.filter(oisystem=system, percentage_account_code=k)
-            if deduction_qs and system.deduct_percentage:
-                for deduction in deduction_qs:
-                    if (not deduction.percentage or not deduction.destination_account_code):
-                        raise Exception('Deduction Percentage and an oracle account are required if deduction is enabled.')
-
-                    try:
-                        OracleAccountCode.objects.filter(active_receivables_activities=deduction.destination_account_code)
-                    except OracleAccountCode.DoesNotExist:
-                        raise ValidationError('The account code setup for oracle deduction does not exist.')
-
-                    if deduction.destination_account_code not in records:
-                        records[deduction.destination_account_code] = OracleInterface.objects.create(
-                            receipt_date = trans_date,
-                            activity_name = deduction.destination_account_code,
-                            amount = D(0),
-                            customer_name = system.system_name,
-                            description = deduction.destination_account_code,
-                            source = system.source,
-                            method = system.method,
-                            comments = '{} GST/{}'.format(deduction.destination_account_code,date),
-                            status = 'NEW',
-                            status_date = today
-                        )
-                        deductions_only.add(deduction.destination_account_code)
+            for deduction in deductions.get(k, []):
+                if (not deduction.percentage or not deduction.destination_account_code):
+                    raise Exception('Deduction Percentage and an oracle account are required if deduction is enabled.')
+
+                if deduction.destination_account_code not in amounts:
+                    amounts[deduction.destination_account_code] = D(0)
+                    deductions_only.add(deduction.destination_account_code)
 
         for k,v in oracle_codes.items():
             if v != 0:
-                found = OracleAccountCode.objects.filter(active_receivables_activities=k)
-                if not found:
+                if k not in valid_codes:
                     raise ValidationError('{} is not a valid account code'.format(k))
 
                 # Check if there is a deduction for that system/account code, and sends to another oracle account code
-                deduction_qs = OracleInterfaceDeduction.objects.filter(oisystem=system, percentage_account_code=k)
-
-                if deduction_qs and system.deduct_percentage:
+                if k in deductions:
 
                     # sanity check: deductions should not transfer money to an account code that shows up as a line item
                     if k in deductions_only:
@@ -186,23 +168,114 @@ def addToInterface(date,oracle_codes,system,override):
                     initial_amount = D(v)
                     remainder_amount = initial_amount
 
-                    for deduction in deduction_qs:
+                    for deduction in deductions[k]:
 
                         # Add the deducted amount to the oracle code specified in the system table
                         deduction_amount = deduction.percentage * initial_amount / D(100)
-                        records[deduction.destination_account_code].amount += deduction_amount
+                        amounts[deduction.destination_account_code] += deduction_amount
                         remainder_amount -= deduction_amount
 
-                    records[k].amount = remainder_amount
+                    amounts[k] = remainder_amount
 
-        # save records
-        for record in records.values():
-            record.save()
+        # save records in one statement, numbering the receipts in creation order.
+        # Other systems may be interfaced by other processes at the same time,
+        # the numbers are taken under a lock held until the records are committed.
+        with transaction.atomic():
+            lock_receipt_numbers()
+            receipt_number = increment_receipt_number()
+            records = []
+            for k, amount in amounts.items():
+                records.append(OracleInterface(
+                    receipt_number = receipt_number,
+                    receipt_date = trans_date,
+                    activity_name = k,
+                    amount = amount,
+                    customer_name = system.system_name,
+                    description = k,
+                    source = system.source,
+                    method = system.method,
+                    comments = '{} GST/{}'.format(k,date),
+                    status = 'NEW',
+                    status_date = today
+                ))
+                receipt_number += 1
+            OracleInterface.objects.bulk_create(records)
 
-        return {k: v.amount for k, v in records.items()}
+        return amounts
     except:
         raise
 
+class OracleParserData(object):
+    ''' Invoices, order lines, previous parser results and the transactions
+        referenced by the lines of an oracle parse, loaded with a fixed number
+        of queries regardless of the number of invoices.
+    '''
+
+    def __init__(self, date, invoices):
+        self.date = date
+        references = [i.reference for i in invoices]
+        orders = Order.objects.filter(number__in=[i.order_number for i in invoices])
+        self.orders = dict((o.number, o) for o in orders)
+
+        self.lines = {}
+        for line in order_model.Line.objects.filter(order_id__in=[o.id for o in self.orders.values()]):
+            self.lines.setdefault(line.order_id, []).append(line)
+
+        self.previous = {}
+        for p in OracleParserInvoice.objects.filter(reference__in=references, parser__date_parsed=date):
+            self.previous.setdefault(p.reference, []).append(dict(json.loads(p.details)))
+
+        # Collect the transactions allocated to the lines
+        txn_ids = {'bpay': set(), 'card': set(), 'cash': set()}
+        for lines in self.lines.values():
+            for line in lines:
+                for details in (line.payment_details, line.refund_details, line.deduction_details):
+                    for kind, ids in txn_ids.items():
+                        ids.update(str(k) for k in details.get(kind, {}).keys())
+
+        # Store the date each transaction counts towards as a string to compare with the parse date
+        self.txn_dates = {'bpay': {}, 'card': {}, 'cash': {}}
+        for b in BpayTransaction.objects.filter(id__in=txn_ids['bpay']).only('id','p_date'):
+            self.txn_dates['bpay'][str(b.id)] = b.p_date.strftime('%Y-%m-%d')
+        for b in BpointTransaction.objects.filter(id__in=txn_ids['card']).only('id','settlement_date'):
+            self.txn_dates['card'][str(b.id)] = str(b.settlement_date)
+        for c in CashTransaction.objects.filter(id__in=txn_ids['cash']).only('id','created'):
+            self.txn_dates['cash'][str(c.id)] = c.created.strftime('%Y-%m-%d')
+
+    def order_lines(self, invoice):
+        ''' Get the lines of the invoice order or None if the invoice has no order.
+        '''
+        order = self.orders.get(invoice.order_number)
+        if order is None:
+            return None
+        return self.lines.get(order.id, [])
+
+    def previous_amounts(self, reference, item_id):
+        ''' Get the amounts already parsed for an order line on this date.
+        '''
+        paid = D('0.0')
+        refunded = D('0.0')
+        deducted = D('0.0')
+        for details in self.previous.get(reference, []):
+            for k,v in details.items():
+                if int(k) == item_id:
+                    paid += D(v['payment'])
+                    refunded += D(v['refund'])
+                    deducted += D(v['deductions'])
+        return paid, refunded, deducted
+
+    def allocated_on_date(self, allocations, kind):
+        ''' Total of the allocations made by transactions settled on the parse date.
+        '''
+        models = {'bpay': BpayTransaction, 'card': BpointTransaction, 'cash': CashTransaction}
+        amount = D('0.0')
+        for k,v in allocations.items():
+            txn_date = self.txn_dates[kind].get(str(k))
+            if txn_date is None:
+                raise models[kind].DoesNotExist('{} matching query does not exist.'.format(models[kind].__name__))
+            amount += D(v) if txn_date == self.date else D(0.0)
+        return amount
+
 
 def oracle_parser(date,system,system_name,override=False):
     invoices = []
@@ -218,31 +291,28 @@ def oracle_parser(date,system,system_name,override=False):
             raise Exception('The oracle job is not enabled for {}'.format(ois.system_name))
         with transaction.atomic():
             op,created = OracleParser.objects.get_or_create(date_parsed=date)
-            bpoint_txns = []
-            bpay_txns = []
-            bpoint_txns.extend([x for x in BpointTransaction.objects.filter(settlement_date=date,response_code=0).exclude(crn1__endswith='_test')])
-            bpay_txns.extend([x for x in BpayTransaction.objects.filter(p_date__contains=date, service_code=0)])
             # Get the required invoices
-            for b in bpoint_txns:
-                if b.crn1 not in invoice_list:
-                    if Invoice.objects.filter(reference=b.crn1).count() > 0:
-                        invoice = Invoice.objects.get(reference=b.crn1)
-                        if invoice.system == system:
-                            invoices.append(invoice)
-                            invoice_list.append(b.crn1)
-            for b in bpay_txns:
-                if b.crn not in invoice_list:
-                    if Invoice.objects.filter(reference=b.crn1).count() > 0:
-                        invoice = Invoice.objects.get(reference=b.crn)
-                        if invoice.system == system:
-                            invoices.append(invoice)
-                            invoice_list.append(b.crn)
+            references = set()
+            for crn1 in BpointTransaction.objects.filter(settlement_date=date,response_code=0).exclude(crn1__endswith='_test').values_list('crn1', flat=True):
+                if crn1 not in references:
+                    invoice_list.append(crn1)
+                    references.add(crn1)
+            for crn in BpayTransaction.objects.filter(p_date__contains=date, service_code=0).values_list('crn', flat=True):
+                if crn not in references:
+                    invoice_list.append(crn)
+                    references.add(crn)
+            invoice_map = Invoice.objects.in_bulk(invoice_list, field_name='reference')
+            for reference in invoice_list:
+                invoice = invoice_map.get(reference)
+                if invoice and invoice.system == system:
+                    invoices.append(invoice)
+            data = OracleParserData(date, invoices)
             for invoice in invoices:
-                if invoice.order:
+                items = data.order_lines(invoice)
+                if items is not None:
                     if invoice.reference not in parser_codes.keys():
                         parser_codes[invoice.reference] = {}
                     # Go through the items
-                    items = invoice.order.lines.all()
                     items_codes = [{'id':i.id,'code':i.oracle_code} for i in items]
                     for i in items_codes:
                         v = i['code']
@@ -257,76 +327,43 @@ def oracle_parser(date,system,system_name,override=False):
                         code = i.oracle_code
                         item_id = i.id
                         # Check previous parser results for this invoice
-                        previous_invoices = OracleParserInvoice.objects.filter(reference=invoice.reference,parser__date_parsed=date)
-                        code_paid_amount = D('0.0')
-                        code_refunded_amount = D('0.0')
-                        code_deducted_amount = D('0.0')
-                        for p in previous_invoices:
-                            details = dict(json.loads(p.details))
-                            for k,v in details.items():
-                                p_item = details[k]
-                                if int(k) == item_id:
-                                    code_paid_amount +=  D(p_item['payment'])
-                                    code_refunded_amount += D(p_item['refund'])
-                                    code_deducted_amount += D(p_item['deductions'])
+                        code_paid_amount, code_refunded_amount, code_deducted_amount = data.previous_amounts(invoice.reference, item_id)
                         # Deal with the current item
                         # Payments
-                        paid_amount = D('0.0')
-                        for k,v in i.payment_details['bpay'].items():
-                            b_txn = BpayTransaction.objects.get(id=k)
-                            paid_amount += D(v) if b_txn.p_date.strftime('%Y-%m-%d') == date else D(0.0)
-                        for k,v in i.payment_details['card'].items():
-                            b_txn = BpointTransaction.objects.get(id=k)
-                            paid_amount += D(v) if str(b_txn.settlement_date) == date else D(0.0)
+                        paid_amount = data.allocated_on_date(i.payment_details['bpay'], 'bpay') + data.allocated_on_date(i.payment_details['card'], 'card')
                         code_payable_amount = paid_amount - code_paid_amount
                         if code_payable_amount >= 0:
                             oracle_codes[code] += code_payable_amount
-                            for k,v in parser_codes[invoice.reference][item_id].items():
-                                item = parser_codes[invoice.reference][item_id]
-                                if k == 'payment':
-                                    item[k] += code_payable_amount
+                            parser_codes[invoice.reference][item_id]['payment'] += code_payable_amount
 
                         # Deductions
-                        deducted_amount = D('0.0')
-                        for k,v in i.deduction_details['cash'].items():
-                            c_txn = CashTransaction.objects.get(id=k)
-                            deducted_amount += D(v) if c_txn.created.strftime('%Y-%m-%d') == date else D(0.0)
+                        deducted_amount = data.allocated_on_date(i.deduction_details['cash'], 'cash')
                         code_deductable_amount = deducted_amount - code_deducted_amount
                         if code_deductable_amount >= 0:
                             oracle_codes[code] -= code_deductable_amount
-                            for k,v in parser_codes[invoice.reference][item_id].items():
-                                item = parser_codes[invoice.reference][item_id]
-                                if k == 'deductions':
-                                    item[k] += code_deductable_amount
+                            parser_codes[invoice.reference][item_id]['deductions'] += code_deductable_amount
 
                         # Refunds
-                        refunded_amount = D('0.0')
-                        for k,v in i.refund_details['bpay'].items():
-                            b_txn = BpayTransaction.objects.get(id=k)
-                            refunded_amount += D(v) if b_txn.p_date.strftime('%Y-%m-%d') == date else D(0.0)
-                        for k,v in i.refund_details['card'].items():
-                            b_txn = BpointTransaction.objects.get(id=k)
-                            refunded_amount += D(v) if str(b_txn.settlement_date) == date else D(0.0)
+                        refunded_amount = data.allocated_on_date(i.refund_details['bpay'], 'bpay') + data.allocated_on_date(i.refund_details['card'], 'card')
                         code_refundable_amount = refunded_amount - code_refunded_amount
                         if code_refundable_amount >= 0:
                             oracle_codes[code] -= code_refundable_amount
-                            for k,v in parser_codes[invoice.reference][item_id].items():
-                                item = parser_codes[invoice.reference][item_id]
-                                if k == 'refund':
-                                    item[k] += code_refundable_amount
+                            parser_codes[invoice.reference][item_id]['refund'] += code_refundable_amount
 
             # Convert Deimals to strings as they cannot be serialized
             for k,v in parser_codes.items():
                 for a,b in v.items():
                     for r,f in b.items():
                         parser_codes[k][a][r] = str(parser_codes[k][a][r])
+            new_parser_invoices = []
             for k,v in parser_codes.items():
                 can_add = False
                 for g,h in v.items():
                     if h['payment'] != 0 or h['refund'] != 0 or h['deductions'] != 0:
                         can_add = True
                 if can_add:
-                    OracleParserInvoice.objects.create(reference=k,details=json.dumps(v),parser=op)
+                    new_parser_invoices.append(OracleParserInvoice(reference=k,details=json.dumps(v),parser=op))
+            OracleParserInvoice.objects.bulk_create(new_parser_invoices)
             # Add items to oracle interface table
             new_codes = addToInterface(date,oracle_codes,ois,override)
             # Send an email with all the activity codes entered into the interface table
@@ -354,24 +391,20 @@ def oracle_parser_on_invoice(date,system,system_name,override=False):
             raise Exception('The oracle job is not enabled for {}'.format(ois.system_name))
         with transaction.atomic():
             op,created = OracleParser.objects.get_or_create(date_parsed=date)
-            op_invoices = OracleParserInvoice.objects.filter(parser=op)
 
             #Build a list of invoices already in the oracle parse for parse date query
-            for opi in op_invoices:
-               oracle_parser_invoices.append(opi.reference)
-            invoices = Invoice.objects.filter(settlement_date=date, system=system)
+            oracle_parser_invoices = set(OracleParserInvoice.objects.filter(parser=op).values_list('reference', flat=True))
+            # If invoice already exists in the parse date than skip it.
+            invoices = [i for i in Invoice.objects.filter(settlement_date=date, system=system) if i.reference not in oracle_parser_invoices]
+            data = OracleParserData(date, invoices)
 
             #Loop through invoices
             for invoice in invoices:
-                # If invoice already exists in the parse date than skip and move to next invoice.
-                if invoice.reference in oracle_parser_invoices:
-                     continue
-
-                if invoice.order:
+                items = data.order_lines(invoice)
+                if items is not None:
                     if invoice.reference not in parser_codes.keys():
                         parser_codes[invoice.reference] = {}
                     # Go through the items
-                    items = invoice.order.lines.all()
                     items_codes = [{'id':i.id,'code':i.oracle_code} for i in items]
                     for i in items_codes:
                         v = i['code']
@@ -386,87 +419,49 @@ def oracle_parser_on_invoice(date,system,system_name,override=False):
                         code = i.oracle_code
                         item_id = i.id
                         # Check previous parser results for this invoice
-                        previous_invoices = OracleParserInvoice.objects.filter(reference=invoice.reference,parser__date_parsed=date)
-                        code_paid_amount = D('0.0')
-                        code_refunded_amount = D('0.0')
-                        code_deducted_amount = D('0.0')
-                        for p in previous_invoices:
-                            details = dict(json.loads(p.details))
-                            for k,v in details.items():
-                                p_item = details[k]
-                                if int(k) == item_id:
-                                    code_paid_amount +=  D(p_item['payment'])
-                                    code_refunded_amount += D(p_item['refund'])
-                                    code_deducted_amount += D(p_item['deductions'])
+                        code_paid_amount, code_refunded_amount, code_deducted_amount = data.previous_amounts(invoice.reference, item_id)
                         # Deal with the current item
                         # Payments
-                        paid_amount = D('0.0')
-                        for k,v in i.payment_details['bpay'].items():
-                            b_txn = BpayTransaction.objects.get(id=k)
-                            paid_amount += D(v) if b_txn.p_date.strftime('%Y-%m-%d') == date else D(0.0)
-                        for k,v in i.payment_details['card'].items():
-                            b_txn = BpointTransaction.objects.get(id=k)
-                            paid_amount += D(v) if str(b_txn.settlement_date) == date else D(0.0)
+                        paid_amount = data.allocated_on_date(i.payment_details['bpay'], 'bpay') + data.allocated_on_date(i.payment_details['card'], 'card')
                         code_payable_amount = paid_amount - code_paid_amount
                         if code_payable_amount >= 0:
                             oracle_codes[code] += code_payable_amount
-                            for k,v in parser_codes[invoice.reference][item_id].items():
-                                item = parser_codes[invoice.reference][item_id]
-                                if k == 'payment':
-                                    item[k] += code_payable_amount
+                            parser_codes[invoice.reference][item_id]['payment'] += code_payable_amount
                         # Deductions
-                        deducted_amount = D('0.0')
-                        for k,v in i.deduction_details['cash'].items():
-                            c_txn = CashTransaction.objects.get(id=k)
-                            deducted_amount += D(v) if c_txn.created.strftime('%Y-%m-%d') == date else D(0.0)
+                        deducted_amount = data.allocated_on_date(i.deduction_details['cash'], 'cash')
                         code_deductable_amount = deducted_amount - code_deducted_amount
                         #if code_deductable_amount >= 0:
                         oracle_codes[code] -= code_deductable_amount
-                        for k,v in parser_codes[invoice.reference][item_id].items():
-                            item = parser_codes[invoice.reference][item_id]
-                            if k == 'deductions':
-                                item[k] += code_deductable_amount
+                        parser_codes[invoice.reference][item_id]['deductions'] += code_deductable_amount
 
                         # Refunds
-                        refunded_amount = D('0.0')
-                        for k,v in i.refund_details['bpay'].items():
-                            b_txn = BpayTransaction.objects.get(id=k)
-                            refunded_amount += D(v) if b_txn.p_date.strftime('%Y-%m-%d') == date else D(0.0)
-                        for k,v in i.refund_details['card'].items():
-                            b_txn = BpointTransaction.objects.get(id=k)
-                            refunded_amount += D(v) if str(b_txn.settlement_date) == date else D(0.0)
+                        refunded_amount = data.allocated_on_date(i.refund_details['bpay'], 'bpay') + data.allocated_on_date(i.refund_details['card'], 'card')
                         code_refundable_amount = refunded_amount - code_refunded_amount
                         if code_refundable_amount >= 0:
                             oracle_codes[code] -= code_refundable_amount
-                            for k,v in parser_codes[invoice.reference][item_id].items():
-                                item = parser_codes[invoice.reference][item_id]
-                                if k == 'refund':
-                                    item[k] += code_refundable_amount
+                            parser_codes[invoice.reference][item_id]['refund'] += code_refundable_amount
 
                         # Order Calculations
                         if 'order' in i.payment_details:
-                             order_amount = D('0.0')
                              for k,v in i.payment_details['order'].items():
-                                 #c_txn = CashTransaction.objects.get(id=k)
-                                 deducted_amount += D(v) #if c_txn.created.strftime('%Y-%m-%d') == date else D(0.0)
+                                 deducted_amount += D(v)
                              code_deductable_amount = deducted_amount - code_deducted_amount
                              #if code_deductable_amount >= 0:
                              oracle_codes[code] += code_deductable_amount
-                             for k,v in parser_codes[invoice.reference][item_id].items():
-                                 item = parser_codes[invoice.reference][item_id]
-                                 if k == 'order':
-                                     item[k] += code_deductable_amount
+                             parser_codes[invoice.reference][item_id]['order'] += code_deductable_amount
             # Convert Deimals to strings as they cannot be serialized
             for k,v in parser_codes.items():
                 for a,b in v.items():
                     for r,f in b.items():
                         parser_codes[k][a][r] = str(parser_codes[k][a][r])
+            new_parser_invoices = []
             for k,v in parser_codes.items():
                 can_add = False
                 if k not in oracle_parser_invoices:
                     can_add = True
                 if can_add:
-                    OracleParserInvoice.objects.create(reference=k,details=json.dumps(v),parser=op)
+                    new_parser_invoices.append(OracleParserInvoice(reference=k,details=json.dumps(v),parser=op))
+            OracleParserInvoice.objects.bulk_create(new_parser_invoices)
             # Add items to oracle interface table
             new_codes = addToInterface(date,oracle_codes,ois,override)
             # Send an email with all the activity codes entered into the interface table
@@ -478,6 +473,229 @@ def oracle_parser_on_invoice(date,system,system_name,override=False):
         raise e
 
 
+LINE_DETAIL_FIELDS = ('payment_details', 'refund_details', 'deduction_details')
+
+def bulk_update_line_details(lines):
+    ''' Write the payment, refund and deduction details of lines with one UPDATE
+        and refresh their LineAllocation rows.
+    '''
+    if not lines:
+        return
+    updates = {}
+    for field in LINE_DETAIL_FIELDS:
+        updates[field] = Case(
+            *[When(pk=line.pk, then=Cast(Value(getattr(line, field), output_field=JSONField()), JSONField())) for line in lines],
+            output_field=JSONField()
+        )
+    order_model.Line.objects.filter(pk__in=[line.pk for line in lines]).update(**updates)
+    order_model.LineAllocation.sync(lines)
+
+class PaymentAllocation(object):
+    ''' Allocates the payments, refunds and deductions of an invoice to its
+        order lines in memory.
+
+        Lines and transactions are loaded once, the amount already allocated
+        per transaction is kept in an index instead of being re-read from every
+        line, and changed lines are written back with bulk_update_line_details.
+    '''
+
+    def __init__(self, invoice):
+        self.invoice = invoice
+        self.order = invoice.order
+        self.lines = list(self.order.lines.all()) if self.order else []
+        self.original = {}
+        for line in self.lines:
+            for field in LINE_DETAIL_FIELDS:
+                # Keys come back from the database as strings, keep them that way
+                details = dict((k, dict((str(i), a) for i,a in v.items())) for k,v in getattr(line, field).items())
+                setattr(line, field, details)
+            self.original[line.pk] = json.dumps([getattr(line, f) for f in LINE_DETAIL_FIELDS], sort_keys=True)
+        self.index = None
+
+    def _build_index(self):
+        self.bpoint = list(self.invoice.bpoint_transactions)
+        self.bpay = list(self.invoice.bpay_transactions)
+        self.cash = list(self.invoice.cash_transactions.all())
+        # (field, method, transaction id) -> {line id: amount}
+        self.index = {}
+        for line in self.lines:
+            for field in LINE_DETAIL_FIELDS:
+                for method, amounts in getattr(line, field).items():
+                    for txn_id, a in amounts.items():
+                        self.index.setdefault((field, method, txn_id), {})[line.pk] = a
+        # Bpay transactions matched through another invoice are allocated against that invoice's order
+        self.fixed = {}
+        for bpay in self.bpay:
+            if bpay.crn != self.invoice.reference:
+                order = bpay.order
+                if order is None or self.order is None or order.pk != self.order.pk:
+                    self.fixed[('payment_details', 'bpay', str(bpay.id))] = bpay.payment_allocated
+                    self.fixed[('refund_details', 'bpay', str(bpay.id))] = bpay.refund_allocated
+
+    def allocated(self, field, method, txn):
+        ''' Same as the transaction payment_allocated/refund_allocated/deduction_allocated properties.
+        '''
+        key = (field, method, str(txn.id))
+        if key in self.fixed:
+            return self.fixed[key]
+        allocated = D('0.0')
+        for a in self.index.get(key, {}).values():
+            allocated += D(a)
+        return allocated
+
+    def _set(self, line, field, method, txn_id, value):
+        getattr(line, field)[method][txn_id] = value
+        self.index.setdefault((field, method, txn_id), {})[line.pk] = value
+
+    def _allocate(self, line, field, method, txn, amount, line_total, total, invoice_total, check_remaining=True):
+        details = getattr(line, field)[method]
+        txn_id = str(txn.id)
+        remaining_amount = amount - line_total
+        remaining_invoice_amount = invoice_total - total
+        unallocated = txn.amount - self.allocated(field, method, txn)
+        if txn_id in details.keys() and (remaining_invoice_amount > 0 or not check_remaining):
+            if remaining_amount <= unallocated:
+                new_amount = D(details[txn_id]) + remaining_amount
+            else:
+                new_amount = D(details[txn_id]) + unallocated
+            if unallocated > 0:
+                self._set(line, field, method, txn_id, str(new_amount))
+                line_total += new_amount
+                total += new_amount
+        else:
+            if remaining_amount <= unallocated:
+                new_amount = D(0.0) + remaining_amount
+            else:
+                new_amount = D(0.0) + unallocated
+            self._set(line, field, method, txn_id, str(new_amount))
+            line_total += new_amount
+            total += new_amount
+        return line_total, total
+
+    def _allocate_remainder(self, line, field, method, txn):
+        allocated = self.allocated(field, method, txn)
+        txn_id = str(txn.id)
+        if getattr(line, field)[method].get(txn_id):
+            self._set(line, field, method, txn_id, str(D(getattr(line, field)[method][txn_id]) + (txn.amount - allocated)))
+        else:
+            self._set(line, field, method, txn_id, str(txn.amount - allocated))
+
+    def allocate_payments(self):
+        ''' Allocate transactions to lines in order until each line is covered,
+            anything left over goes to the first line.
+        '''
+        self._build_index()
+        i = self.invoice
+        total_paid = i.total_payment_amount
+        total_refund = i.refund_amount
+        total_deductions = i.deduction_amount
+        refunded = D(0.0)
+        paid = D(0.0)
+        deductions = D(0.0)
+        for line in self.lines:
+            paid_amount = line.paid
+            refunded_amount = line.refunded
+            deducted_amount = line.deducted
+            amount = line.line_price_incl_tax
+            paid += paid_amount
+            refunded += refunded_amount
+            deductions += deducted_amount
+            # Bpoint Amounts
+            for bpoint in self.bpoint:
+                if bpoint.approved:
+                    if paid_amount < amount and paid < total_paid:
+                        if bpoint.action == 'payment':
+                            paid_amount, paid = self._allocate(line, 'payment_details', 'card', bpoint, amount, paid_amount, paid, total_paid)
+                    if refunded_amount < amount and refunded < total_refund:
+                        if bpoint.action == 'refund':
+                            refunded_amount, refunded = self._allocate(line, 'refund_details', 'card', bpoint, amount, refunded_amount, refunded, total_refund)
+            # Bpay Transactions
+            for bpay in self.bpay:
+                if bpay.approved:
+                    if paid_amount < amount and paid < total_paid:
+                        if bpay.p_instruction_code == '05' and bpay.type == '399':
+                            paid_amount, paid = self._allocate(line, 'payment_details', 'bpay', bpay, amount, paid_amount, paid, total_paid)
+                    if refunded_amount < amount and refunded < total_refund:
+                        if bpay.p_instruction_code == '25' and bpay.type == '699':
+                            refunded_amount, refunded = self._allocate(line, 'refund_details', 'bpay', bpay, amount, refunded_amount, refunded, total_refund)
+            # Cash Transactions
+            for c in self.cash:
+                if paid_amount < amount and paid < total_paid:
+                    if c.type in ['payment','move_in']:
+                        paid_amount, paid = self._allocate(line, 'payment_details', 'cash', c, amount, paid_amount, paid, total_paid)
+                if deducted_amount < amount and deductions < total_deductions:
+                    if c.type == 'move_out':
+                        deducted_amount, deductions = self._allocate(line, 'deduction_details', 'cash', c, amount, deducted_amount, deductions, total_deductions, check_remaining=False)
+                if refunded_amount < amount and refunded < total_refund:
+                    if c.type == 'refund':
+                        refunded_amount, refunded = self._allocate(line, 'refund_details', 'cash', c, amount, refunded_amount, refunded, total_refund)
+
+        # Check if the whole amount paid on the invoice has been allocated otherwise add to the first line item
+        if total_paid > paid:
+            first_item = self.lines[0] if self.lines else None
+            for b in self.bpoint:
+                if self.allocated('payment_details', 'card', b) < b.amount and b.action == 'payment':
+                    self._allocate_remainder(first_item, 'payment_details', 'card', b)
+            for b in self.bpay:
+                if self.allocated('payment_details', 'bpay', b) < b.amount and b.p_instruction_code == '05' and b.type == '399':
+                    self._allocate_remainder(first_item, 'payment_details', 'bpay', b)
+            for b in self.cash:
+                if self.allocated('payment_details', 'cash', b) < b.amount and b.type in ['payment','move_in']:
+                    self._allocate_remainder(first_item, 'payment_details', 'cash', b)
+        if total_refund > refunded:
+            first_item = self.lines[0] if self.lines else None
+            for b in self.bpoint:
+                if self.allocated('refund_details', 'card', b) < b.amount and b.action == 'refund':
+                    self._allocate_remainder(first_item, 'refund_details', 'card', b)
+            for b in self.bpay:
+                if self.allocated('refund_details', 'bpay', b) < b.amount and b.p_instruction_code == '25' and b.type == '699':
+                    self._allocate_remainder(first_item, 'refund_details', 'bpay', b)
+            for b in self.cash:
+                if self.allocated('refund_details', 'cash', b) < b.amount and b.type == 'refund':
+                    self._allocate_remainder(first_item, 'refund_details', 'cash', b)
+
+    def allocate_order(self, no_oracle):
+        ''' Allocate the order amounts per oracle code, new lines are paid
+            from the code total and removed lines take what is left of it.
+        '''
+        oracle_code_totals = {}
+        # total amount based on oracle code to get a negiative / positive value.
+        for line in self.lines:
+            if line.oracle_code not in oracle_code_totals:
+                oracle_code_totals[line.oracle_code] = Decimal('0.00')
+            oracle_code_totals[line.oracle_code] = oracle_code_totals[line.oracle_code] + line.line_price_incl_tax
+
+        # assign payment or refund based on oracle code
+        for line in self.lines:
+            line.deduction_details['cash'] = {}
+            line.refund_details['cash'] = {}
+            line.payment_details['cash'] = {}
+
+            line.refund_details['order'] = {}
+            line.payment_details['order']  = {}
+            line.deduction_details['order']  = {}
+            if no_oracle is True:
+                continue
+            # look for lines under invoice --> order that are new line
+            if line.line_price_incl_tax > 0 and line.line_status == 1:
+                if oracle_code_totals[line.oracle_code] >= line.line_price_incl_tax:
+                    line.payment_details['order'][str(line.id)] = str(line.line_price_incl_tax)
+                    oracle_code_totals[line.oracle_code] = oracle_code_totals[line.oracle_code] - line.line_price_incl_tax
+            # look for lines under invoice --> order that are have been removed
+            if line.line_price_incl_tax < 0 and line.line_status == 3:
+                line.payment_details['order'][str(line.id)] = str(oracle_code_totals[line.oracle_code])
+                oracle_code_totals[line.oracle_code] =  oracle_code_totals[line.oracle_code] - oracle_code_totals[line.oracle_code]
+
+    def changed_lines(self):
+        return [line for line in self.lines if json.dumps([getattr(line, f) for f in LINE_DETAIL_FIELDS], sort_keys=True) != self.original[line.pk]]
+
+    def save(self):
+        lines = self.changed_lines()
+        bulk_update_line_details(lines)
+        for line in lines:
+            self.original[line.pk] = json.dumps([getattr(line, f) for f in LINE_DETAIL_FIELDS], sort_keys=True)
+        return lines
+
 def update_payments(invoice_reference):
     UPDATE_PAYMENT_ALLOCATION = env('UPDATE_PAYMENT_ALLOCATION', False)
 
@@ -500,234 +718,9 @@ def update_payments(invoice_reference):
                     i = Invoice.objects.get(reference=str(invoice_reference))
                 except Invoice.DoesNotExist:
                     raise ValidationError('The invoice with refererence {} does not exist'.format(invoice_reference))
-                refunded = D(0.0)
-                paid = D(0.0)
-                deductions = D(0.0)
-                # Bpoint Transactions
-                if i.order:
-                    for line in i.order.lines.all():
-                        paid_amount = line.paid
-                        refunded_amount = line.refunded
-                        deducted_amount = line.deducted
-                        amount = line.line_price_incl_tax
-                        total_paid = i.total_payment_amount
-                        total_refund = i.refund_amount
-                        total_deductions = i.deduction_amount
-                        paid += paid_amount
-                        refunded += refunded_amount
-                        deductions += deducted_amount
-                        # Bpoint Amounts
-                        for bpoint in i.bpoint_transactions:
-                            if bpoint.approved:
-                                if paid_amount < amount and paid < total_paid:
-                                    if bpoint.action == 'payment':
-                                        remaining_amount = amount - paid_amount
-                                        remaining_payable_amount = total_paid - paid
-                                        unallocated = bpoint.amount - bpoint.payment_allocated
-                                        if str(bpoint.id) in line.payment_details['card'].keys() and remaining_payable_amount > 0:
-                                            if remaining_amount <= unallocated:
-                                                new_amount = D(line.payment_details['card'][str(bpoint.id)]) + remaining_amount
-                                            else:
-                                                new_amount = D(line.payment_details['card'][str(bpoint.id)]) + unallocated
-                                            if unallocated > 0:
-                                                line.payment_details['card'][str(bpoint.id)] = str(new_amount)
-                                                paid_amount += new_amount
-                                                paid += new_amount
-                                        else:
-                                            if remaining_amount <= unallocated:
-                                                new_amount = D(0.0) + remaining_amount
-                                            else:
-                                                new_amount = D(0.0) + unallocated
-                                            line.payment_details['card'][bpoint.id] = str(new_amount)
-                                            paid_amount += new_amount
-                                            paid += new_amount
-                                if refunded_amount < amount and refunded < total_refund:
-                                    if bpoint.action == 'refund':
-                                        remaining_amount = amount - refunded_amount
-                                        remaining_refundable_amount = total_refund - refunded
-                                        unallocated = bpoint.amount - bpoint.refund_allocated
-                                        if str(bpoint.id) in line.refund_details['card'].keys() and remaining_refundable_amount > 0:
-                                            if remaining_amount <= unallocated:
-                                                new_amount = D(line.refund_details['card'][str(bpoint.id)]) + remaining_amount
-                                            else:
-                                                new_amount = D(line.refund_details['card'][str(bpoint.id)]) + unallocated
-                                            if unallocated > 0:
-                                                line.refund_details['card'][str(bpoint.id)] = str(new_amount)
-                                                refunded_amount += new_amount
-                                                refunded += new_amount
-                                        else:
-                                            if remaining_amount <= unallocated:
-                                                new_amount = D(0.0) + remaining_amount
-                                            else:
-                                                new_amount = D(0.0) + unallocated
-                                            line.refund_details['card'][bpoint.id] = str(new_amount)
-                                            refunded_amount += new_amount
-                                            refunded += new_amount
-                        # Bpay Transactions
-                        for bpay in i.bpay_transactions:
-                            if bpay.approved:
-                                if paid_amount < amount and paid < total_paid:
-                                    if bpay.p_instruction_code == '05' and bpay.type == '399':
-                                        remaining_amount = amount - paid_amount
-                                        remaining_payable_amount = total_paid - paid
-                                        unallocated = bpay.amount - bpay.payment_allocated
-                                        if str(bpay.id) in line.payment_details['bpay'].keys() and remaining_payable_amount > 0:
-                                            if remaining_amount <= unallocated:
-                                                new_amount = D(line.payment_details['bpay'][str(bpay.id)]) + remaining_amount
-                                            else:
-                                                new_amount = D(line.payment_details['bpay'][str(bpay.id)]) + unallocated
-                                            if unallocated > 0:
-                                                line.payment_details['bpay'][str(bpay.id)] = str(new_amount)
-                                                paid_amount += new_amount
-                                                paid += new_amount
-                                        else:
-                                            if remaining_amount <= unallocated:
-                                                new_amount = D(0.0) + remaining_amount
-                                            else:
-                                                new_amount = D(0.0) + unallocated
-                                            line.payment_details['bpay'][bpay.id] = str(new_amount)
-                                            paid_amount += new_amount
-                                            paid += new_amount
-                                if refunded_amount < amount and refunded < total_refund:
-                                    if bpay.p_instruction_code == '25' and bpay.type == '699':
-                                        remaining_amount = amount - refunded_amount
-                                        remaining_refundable_amount = total_refund - refunded
-                                        unallocated = bpay.amount - bpay.refund_allocated
-                                        if str(bpay.id) in line.refund_details['bpay'].keys() and remaining_refundable_amount > 0:
-                                            if remaining_amount <= unallocated:
-                                                new_amount = D(line.refund_details['bpay'][str(bpay.id)]) + remaining_amount
-                                            else:
-                                                new_amount = D(line.refund_details['bpay'][str(bpay.id)]) + unallocated
-                                            if unallocated > 0:
-                                                line.refund_details['bpay'][str(bpay.id)] = str(new_amount)
-                                                refunded_amount += new_amount
-                                                refunded += new_amount
-                                        else:
-                                            if remaining_amount <= unallocated:
-                                                new_amount = D(0.0) + remaining_amount
-                                            else:
-                                                new_amount = D(0.0) + unallocated
-                                            line.refund_details['bpay'][bpay.id] = str(new_amount)
-                                            refunded_amount += new_amount
-                                            refunded += new_amount
-                        # Cash Transactions
-                        for c in i.cash_transactions.all():
-                            if paid_amount < amount and paid < total_paid:
-                                if c.type in ['payment','move_in']:
-                                    remaining_amount = amount - paid_amount
-                                    remaining_payable_amount = total_paid - paid
-                                    unallocated = c.amount - c.payment_allocated
-                                    if str(c.id) in line.payment_details['cash'].keys() and remaining_payable_amount > 0:
-                                        if remaining_amount <= unallocated:
-                                            new_amount = D(line.payment_details['cash'][str(c.id)]) + remaining_amount
-                                        else:
-                                            new_amount = D(line.payment_details['cash'][str(c.id)]) + unallocated
-                                        if unallocated > 0:
-                                            line.payment_details['cash'][str(c.id)] = str(new_amount)
-                                            paid_amount += new_amount
-                                            paid += new_amount
-                                    else:
-                                        if remaining_amount <= unallocated:
-                                            new_amount = D(0.0) + remaining_amount
-                                        else:
-                                            new_amount = D(0.0) + unallocated
-                                        line.payment_details['cash'][c.id] = str(new_amount)
-                                        paid_amount += new_amount
-                                        paid += new_amount
-                            if deducted_amount < amount and deductions < total_deductions:
-                                if c.type == 'move_out':
-                                    remaining_amount = amount - deducted_amount
-                                    remaining_deductable_amount = total_deductions - deductions
-                                    unallocated = c.amount - c.deduction_allocated
-                                    if str(c.id) in line.deduction_details['cash'].keys():
-                                        if remaining_amount <= unallocated:
-                                            new_amount = D(line.deduction_details['cash'][str(c.id)]) + remaining_amount
-                                        else:
-                                            new_amount = D(line.deduction_details['cash'][str(c.id)]) + unallocated
-                                        if unallocated > 0:
-                                            line.deduction_details['cash'][str(c.id)] = str(new_amount)
-                                            deducted_amount += new_amount
-                                            deductions += new_amount
-                                    else:
-                                        if remaining_amount <= unallocated:
-                                            new_amount = D(0.0) + remaining_amount
-                                        else:
-                                            new_amount = D(0.0) + unallocated
-                                        line.deduction_details['cash'][c.id] = str(new_amount)
-                                        deducted_amount += new_amount
-                                        deductions += new_amount
-                            if refunded_amount < amount and refunded < total_refund:
-                                if c.type == 'refund':
-                                    remaining_amount = amount - refunded_amount
-                                    remaining_refundable_amount = total_refund - refunded
-                                    unallocated = c.amount - c.refund_allocated
-                                    if str(c.id) in line.refund_details['cash'].keys() and remaining_refundable_amount > 0:
-                                        if remaining_amount <= unallocated:
-                                            new_amount = D(line.refund_details['cash'][str(c.id)]) + remaining_amount
-                                        else:
-                                            new_amount = D(line.refund_details['cash'][str(c.id)]) + unallocated
-                                        if unallocated > 0:
-                                            line.refund_details['cash'][str(c.id)] = str(new_amount)
-                                            refunded_amount += new_amount
-                                            refunded += new_amount
-                                    else:
-                                        if remaining_amount <= unallocated:
-                                            new_amount = D(0.0) + remaining_amount
-                                        else:
-                                            new_amount = D(0.0) + unallocated
-                                        line.refund_details['cash'][c.id] = str(new_amount)
-                                        refunded_amount += new_amount
-                                        refunded += new_amount
-                        line.save()
-                # Check if the whole amount paid on the invoice has been allocated otherwise add to the first line item
-                if i.total_payment_amount > paid:
-                    first_item = i.order.lines.first()
-                    # Bpoint
-                    for b in i.bpoint_transactions:
-                        if b.payment_allocated < b.amount and b.action == 'payment':
-                            if first_item.payment_details['card'].get(str(b.id)):
-                                first_item.payment_details['card'][str(b.id)] = str(D(first_item.payment_details['card'][str(b.id)]) + (b.amount - b.payment_allocated))
-                            else:
-                                first_item.payment_details['card'][str(b.id)] = str(b.amount - b.payment_allocated)
-                    # Bpay
-                    for b in i.bpay_transactions:
-                        if b.payment_allocated < b.amount and b.p_instruction_code == '05' and b.type == '399':
-                            if first_item.payment_details['bpay'].get(str(b.id)):
-                                first_item.payment_details['bpay'][str(b.id)] = str(D(first_item.payment_details['bpay'][str(b.id)]) + (b.amount - b.payment_allocated))
-                            else:
-                                first_item.payment_details['bpay'][str(b.id)] = str(b.amount - b.payment_allocated)
-                    # Cash
-                    for b in i.cash_transactions.all():
-                        if b.payment_allocated < b.amount and b.type in ['payment','move_in']:
-                            if first_item.payment_details['cash'].get(str(b.id)):
-                                first_item.payment_details['cash'][str(b.id)] = str(D(first_item.payment_details['cash'][str(b.id)]) + (b.amount - b.payment_allocated))
-                            else:
-                                first_item.payment_details['cash'][str(b.id)] = str(b.amount - b.payment_allocated)
-                    first_item.save()
-                if i.refund_amount > refunded:
-                    first_item = i.order.lines.first()
-                    # Bpoint
-                    for b in i.bpoint_transactions:
-                        if b.refund_allocated < b.amount and b.action == 'refund':
-                            if first_item.refund_details['card'].get(str(b.id)):
-                                first_item.refund_details['card'][str(b.id)] = str(D(first_item.refund_details['card'][str(b.id)]) + (b.amount - b.refund_allocated))
-                            else:
-                                first_item.refund_details['card'][str(b.id)] = str(b.amount - b.refund_allocated)
-                    # Bpay
-                    for b in i.bpay_transactions:
-                        if b.refund_allocated < b.amount and b.p_instruction_code == '25' and b.type == '699':
-                            if first_item.refund_details['bpay'].get(str(b.id)):
-                                first_item.refund_details['bpay'][str(b.id)] = str(D(first_item.refund_details['bpay'][str(b.id)]) + (b.amount - b.refund_allocated))
-                            else:
-                                first_item.refund_details['bpay'][str(b.id)] = str(b.amount - b.refund_allocated)
-                    # Cash
-                    for b in i.cash_transactions.all():
-                        if b.refund_allocated < b.amount and b.type == 'refund':
-                            if first_item.refund_details['cash'].get(str(b.id)):
-                                first_item.refund_details['cash'][str(b.id)] = str(D(first_item.refund_details['cash'][str(b.id)]) + (b.amount - b.refund_allocated))
-                            else:
-                                first_item.refund_details['cash'][str(b.id)] = str(b.amount - b.refund_allocated)
-                    first_item.save()
+                allocation = PaymentAllocation(i)
+                allocation.allocate_payments()
+                allocation.save()
             except:
                 print(traceback.print_exc())
                 raise
@@ -742,11 +735,6 @@ def update_payments_allocation(invoice_reference):
             except Invoice.DoesNotExist:
                 raise ValidationError('The invoice with refererence {} does not exist'.format(invoice_reference))
 
-            refunded = D(0.0)
-            paid = D(0.0)
-            deductions = D(0.0)
-            oracle_code_totals = {}
-
             invoice_settlement_date = None
             if BpointTransaction.objects.filter(crn1=i.reference).count() > 0:
                 bp = BpointTransaction.objects.filter(crn1=i.reference)[0]
@@ -756,51 +744,9 @@ def update_payments_allocation(invoice_reference):
 
             # Get Order Information
             if i.order:
-                no_oracle = i.order.basket.no_oracle
-                # total amount based on oracle code to get a negiative / positive value.
-                for line in i.order.lines.all():
-                    if line.oracle_code not in oracle_code_totals:
-                            oracle_code_totals[line.oracle_code] = Decimal('0.00')
-                    oracle_code_totals[line.oracle_code] = oracle_code_totals[line.oracle_code] + line.line_price_incl_tax
-
-                # assign payment or refund based on oracle code
-                for line in i.order.lines.all():
-                    paid_amount = line.paid
-                    refunded_amount = line.refunded
-                    deducted_amount = line.deducted
-                    amount = line.line_price_incl_tax
-                    total_paid = i.total_payment_amount
-                    total_refund = i.refund_amount
-                    total_deductions = i.deduction_amount
-                    line_status = line.line_status
-                    paid += paid_amount
-                    refunded += refunded_amount
-                    deductions += deducted_amount
-                    if line:
-                        if line.id:
-                              line.deduction_details['cash'] = {}
-                              line.refund_details['cash'] = {}
-                              line.payment_details['cash'] = {}
-
-                              line.refund_details['order'] = {}
-                              line.payment_details['order']  = {}
-                              line.deduction_details['order']  = {}
-                              if no_oracle is True:
-                                  pass
-                              else:
-                                  if line is not None:
-                                     # look for lines under invoice --> order that are new line
-                                     if line.line_price_incl_tax > 0 and line.line_status == 1:
-                                             if oracle_code_totals[line.oracle_code] >= line.line_price_incl_tax:
-                                                 line.payment_details['order'][str(line.id)] = str(line.line_price_incl_tax)
-                                                 oracle_code_totals[line.oracle_code] = oracle_code_totals[line.oracle_code] - line.line_price_incl_tax
-                                     # look for lines under invoice --> order that are have been removed
-                                     if line.line_price_incl_tax < 0 and line.line_status == 3:
-                                             line.payment_details['order'][str(line.id)] = str(oracle_code_totals[line.oracle_code])
-                                             oracle_code_totals[line.oracle_code] =  oracle_code_totals[line.oracle_code] - oracle_code_totals[line.oracle_code]
-
-
-                    line.save()
+                allocation = PaymentAllocation(i)
+                allocation.allocate_order(i.order.basket.no_oracle)
+                allocation.save()
                 if i.settlement_date is None:
                    i.settlement_date = invoice_settlement_date
                    i.save()
@@ -905,6 +851,239 @@ def LinkedInvoiceCreate(invoice, basket_id):
 #        return order
 #
 
+INVOICE_GROUP_CACHE_TIMEOUT = 300
+
+def invoice_group_cache_key(invoice_group_id, linkinv):
+    ''' Changes with the invoices in the group, the transaction version of
+        each of them and the row versions of the invoices and their orders.
+    '''
+    parts = [str(invoice_group_id)]
+    for li in linkinv:
+        parts.append('{}:{}:{}:{}:{}'.format(
+            li.id, li.invoice_reference,
+            trans_hash.bpoint_transaction_hash(li.invoice_reference),
+            trans_hash.bpay_transaction_hash(li.invoice_reference),
+            trans_hash.cash_transaction_hash(li.invoice_reference),
+        ))
+    rows = []
+    for invoice_id, order_number in Invoice.objects.filter(reference__in=[li.invoice_reference for li in linkinv]).order_by('id').values_list('id', 'order_number'):
+        rows.append(('Invoice', invoice_id))
+        rows.append(('Order', order_number))
+    parts.extend('{}:{}:{}'.format(m, k, v) for (m, k), v in zip(rows, versions.row_versions(rows)))
+    return 'LedgerPaymentInvoiceCalculations:{}:{}'.format(invoice_group_id, hashlib.md5('|'.join(parts).encode()).hexdigest())
+
+def invoice_group_calculations(invoice_group_id, linkinv):
+    ''' Invoices, order lines and transactions of a linked invoice group for the
+        ledger payments page. Every model is loaded with a single query whatever
+        the size of the group and the result is cached until a transaction of
+        one of the invoices changes.
+    '''
+    cache_key = invoice_group_cache_key(invoice_group_id, linkinv)
+    result = cache.get(cache_key)
+    if result is None:
+        result = _invoice_group_calculations(invoice_group_id, linkinv)
+        cache.set(cache_key, result, INVOICE_GROUP_CACHE_TIMEOUT)
+    return result
+
+def _invoice_group_calculations(invoice_group_id, linkinv):
+    result = {}
+    system_id = linkinv[0].system_identifier.system_id
+    latest_li = max(linkinv, key=lambda li: li.created)
+    linked_payments = []
+    linked_payments_booking_references = []
+    invoices = [li.invoice_reference for li in linkinv]
+    invoices_data = []
+    orders = []
+    invoice_group_checks_total = 0
+
+    invs = list(Invoice.objects.filter(reference__in=invoices).select_related('payment_summary'))
+    invoices_by_reference = {}
+    for i in invs:
+        invoices_by_reference.setdefault(i.reference, i)
+
+    for li in linkinv:
+        inv = invoices_by_reference.get(li.invoice_reference)
+        settlement_date = ''
+        oracle_invoice_number = ''
+        if inv is not None:
+            settlement_date = inv.settlement_date.strftime("%d/%m/%Y")
+            oracle_invoice_number = inv.oracle_invoice_number
+        linked_payments.append({'id': li.id, 'invoice_reference': li.invoice_reference, 'system_identifier_id': li.system_identifier.id, 'system_identifier_system': li.system_identifier.system_id, 'booking_reference': li.booking_reference, 'booking_reference_linked': li.booking_reference_linked, 'invoice_group_id': li.invoice_group_id_id,'settlement_date': settlement_date, 'oracle_invoice_number': oracle_invoice_number})
+        if li.booking_reference not in linked_payments_booking_references:
+           linked_payments_booking_references.append(li.booking_reference)
+        if li.booking_reference_linked not in linked_payments_booking_references:
+           linked_payments_booking_references.append(li.booking_reference_linked)
+
+    invoice_group_checks = LinkedInvoice.objects.filter(Q(booking_reference__in=linked_payments_booking_references) | Q(booking_reference_linked__in=linked_payments_booking_references)).values('invoice_group_id_id').annotate(total=Count('invoice_group_id_id')).order_by('total')
+    invoice_group_checks_total = invoice_group_checks.count()
+
+    for i in invs:
+        orders.append(i.order_number)
+        settlement_date = None
+        if i.settlement_date:
+             settlement_date = i.settlement_date.strftime("%d/%m/%Y")
+
+        summary = getattr(i, 'payment_summary', None)
+        if summary is None:
+             summary = i._payment_summary()
+        # Status from the live voided flag, like InvoiceProjection and the invoice pdf
+        balance, payment_status = calculate_payment_status(i.amount, i.voided, summary.paid - summary.refunded)
+        invoices_data.append({'invoice_reference': i.reference, 'payment_status': str(payment_status), 'balance': str(balance), 'settlement_date': settlement_date, 'amount': str(i.amount)})
+    order_array = []
+    order_obj = order_model.Line.objects.filter(order__number__in=orders).select_related('order__basket__owner').order_by('order__date_placed')
+    rolling_total = Decimal('0.00')
+    total_unallocated = Decimal('0.00')
+
+    oracle_code_totals = {}
+    result['oracle_code_totals'] = {}
+    for o in order_obj:
+        owner_id = None
+        if o.order:
+           if o.order.basket:
+               if o.order.basket.owner:
+                   owner_id = o.order.basket.owner.id
+
+        if o.oracle_code == 'NNP449 GST':
+            total_unallocated = total_unallocated + o.line_price_incl_tax
+        rolling_total = rolling_total + o.line_price_incl_tax
+        tax_amount = o.line_price_incl_tax - o.line_price_excl_tax
+        row = {'id': o.id, 'order_number': o.order.number, 'title': o.title, 'line_price_incl_tax': str(o.line_price_incl_tax), 'line_price_excl_tax': str(o.line_price_excl_tax), 'owner_id': str(owner_id),'oracle_code': o.oracle_code, 'rolling_total': str(rolling_total), 'tax_amount': str(tax_amount), 'order_date': o.order.date_placed.strftime("%d/%m/%Y %H:%M:%S")}
+        order_array.append(row)
+
+        if o.oracle_code not in oracle_code_totals:
+            oracle_code_totals[o.oracle_code] = Decimal('0.00')
+        oracle_code_totals[o.oracle_code] = oracle_code_totals[o.oracle_code] + o.line_price_incl_tax 
+
+    for cct in oracle_code_totals.keys():
+        result['oracle_code_totals'][cct] = str(oracle_code_totals[cct])
+
+    bp_array = []
+    bp_txn_refund_hash = {}
+    bp_txn_total ={}
+    bp_trans = list(BpointTransaction.objects.filter(crn1__in=invoices))
+    for bp in bp_trans:
+        if bp.original_txn not in bp_txn_refund_hash:
+              bp_txn_refund_hash[bp.original_txn] = Decimal('0.00')
+              
+        if bp.original_txn not in bp_txn_total:
+              bp_txn_total[bp.original_txn] = float('0.00')
+              
+        if bp.txn_number not in bp_txn_total:
+              bp_txn_total[bp.txn_number] = float('0.00')                                   
+
+        if bp.action == 'payment':
+            bp_txn_total[bp.txn_number] = bp_txn_total[bp.txn_number] + float(bp.amount)
+                                                                                  
+        if bp.action == 'refund':
+            bp_txn_total[bp.original_txn] = bp_txn_total[bp.original_txn] - float(bp.amount)
+            
+            bp_txn_refund_hash[bp.original_txn] = bp_txn_refund_hash[bp.original_txn] + bp.amount
+
+    total_gateway_amount = Decimal('0.00')
+    for bp in bp_trans:
+        if bp.action == 'refund':
+            total_gateway_amount = total_gateway_amount - bp.amount
+        else:
+            total_gateway_amount = total_gateway_amount + bp.amount
+
+        row = {}
+        row['id'] = bp.id
+        row['crn1'] = bp.crn1
+        row['txnnumber'] = bp.txn_number
+        row['original_txn'] = bp.original_txn
+        row['receipt_number'] = bp.receipt_number
+        row['settlement_date'] = bp.settlement_date.strftime("%d/%m/%Y")
+        row['last_digits'] = bp.last_digits
+        row['amount'] = str(bp.amount)
+        row['response_code'] = bp.response_code
+        row['action'] = bp.action
+        row['processed'] = bp.processed.strftime("%d/%m/%Y %H:%M:%S")
+        row['response_txt'] = bp.response_txt
+        if bp.action == 'payment':
+           row['amount_refunded'] = '0.00'
+           if bp.txn_number in bp_txn_refund_hash:
+               row['amount_refunded'] = str(bp_txn_refund_hash[bp.txn_number])
+        bp_array.append(row)
+
+
+    cash_array = []
+    cash_array_invoices = {}
+    cash_txn_refund_hash = {}
+    cash_trans = list(CashTransaction.objects.filter(invoice__in=[i.id for i in invs]).select_related('invoice'))
+    for c in cash_trans:
+        if c.id not in cash_txn_refund_hash:
+            cash_txn_refund_hash[c.id] = Decimal('0.00')
+        if c.type == 'refund':
+            cash_txn_refund_hash[c.id] = cash_txn_refund_hash[c.id] + c.amount
+   
+    total_cash_amount = Decimal('0.00')
+    for ch in cash_trans:
+        if ch.type  == 'refund':
+              total_cash_amount = total_cash_amount - ch.amount
+        elif ch.type == 'payment':
+              total_cash_amount = total_cash_amount + ch.amount
+
+        row = {}
+        row['id'] = ch.id
+        row['invoice_reference'] = ch.invoice.reference
+        row['amount'] = str(ch.amount)
+        row['action'] = ch.type
+        row['source'] = ch.source
+        row['receipt'] = ch.receipt
+        row['details'] = ch.details
+        row['created'] = ch.created.strftime("%d/%m/%Y %H:%M:%S")
+        
+        if ch.type == 'payment':
+             row['amount_refunded'] = '0.00'
+             if ch.id in cash_txn_refund_hash:
+                 row['amount_refunded'] = str(cash_txn_refund_hash[ch.id])
+        cash_array.append(row)
+
+    # cash group by invoice
+    for ch in cash_trans:
+        if ch.invoice.reference not in cash_array_invoices:
+              cash_array_invoices[ch.invoice.reference] = Decimal('0.00')
+
+        if ch.type  == 'refund':
+             cash_array_invoices[ch.invoice.reference] = cash_array_invoices[ch.invoice.reference] - ch.amount
+        if ch.type  == 'payment':
+             cash_array_invoices[ch.invoice.reference] = cash_array_invoices[ch.invoice.reference] + ch.amount
+
+    cai = []
+    # convert decimal money to string for json dump    
+    for ca in cash_array_invoices.keys():
+          row = {}
+          row['invoice_reference'] = ca
+          row['amount'] = str(cash_array_invoices[ca])
+          cai.append(row)
+
+    oact_obj = {}
+    oact = OracleAccountCodeTax.objects.all()
+    for ca in oact: 
+       if len(ca.oracle_code) > 2:
+           oact_obj[ca.oracle_code] = ca.tax_type                             
+                                
+    result['oracle_code_tax_status'] = oact_obj
+    result['linked_payments'] = linked_payments
+    result['total_gateway_amount'] = str(total_gateway_amount)
+    result['total_oracle_amount'] = str(rolling_total)
+    result['total_cash_amount'] = str(total_cash_amount)
+    result['total_unallocated'] = str(total_unallocated)
+    #result['oracle_code_totals']  
+    result['order'] = order_array
+    result['bpoint'] = bp_array
+    result['cash'] = cash_array
+    result['cash_on_invoices'] = cai
+    result['invoices_data'] = invoices_data
+    result['booking_reference'] = latest_li.booking_reference
+    result['booking_reference_linked'] = latest_li.booking_reference_linked
+    result['invoice_group_checks_total'] = invoice_group_checks_total
+    #result['bp_txn_refund'] = bp_txn_refund_hash
+    result['bp_txn_total'] = bp_txn_total
+    result['invoice_group_id'] = invoice_group_id
+    result['system_id'] = system_id
+    return result
+
 def ledger_payment_invoice_calulations(invoice_group_id, invoice_no, booking_reference, receipt_no, txn_number):
         if invoice_no is None:
             invoice_no = ''
@@ -918,222 +1097,23 @@ def ledger_payment_invoice_calulations(invoice_group_id, invoice_no, booking_ref
         data = {"status": 403, "data": {}} 
         exists=False
         if len(invoice_no) > 0:
-            link_res = LinkedInvoice.objects.filter(invoice_reference=invoice_no)
-            if link_res.count() > 0:
-                invoice_group_id = link_res[0].invoice_group_id.id
+            invoice_group_id = LinkedInvoice.objects.filter(invoice_reference=invoice_no).values_list('invoice_group_id', flat=True).first() or invoice_group_id
         elif len(receipt_no) > 0:
-            bt = BpointTransaction.objects.filter(receipt_number=receipt_no)
-            crn1=None
-            if bt.count() > 0:
-                 crn1 = bt[0].crn1
-                 link_res = LinkedInvoice.objects.filter(invoice_reference=crn1)
-                 if link_res.count() > 0:
-                     invoice_group_id = link_res[0].invoice_group_id.id
+            crn1 = BpointTransaction.objects.filter(receipt_number=receipt_no).values_list('crn1', flat=True).first()
+            if crn1 is not None:
+                 invoice_group_id = LinkedInvoice.objects.filter(invoice_reference=crn1).values_list('invoice_group_id', flat=True).first() or invoice_group_id
         elif len(txn_number) > 0:
-            bt = BpointTransaction.objects.filter(txn_number=txn_number)
-            crn1=None
-            if bt.count() > 0:
-                 crn1 = bt[0].crn1
-                 link_res = LinkedInvoice.objects.filter(invoice_reference=crn1)
-                 if link_res.count() > 0:
-                     invoice_group_id = link_res[0].invoice_group_id.id
+            crn1 = BpointTransaction.objects.filter(txn_number=txn_number).values_list('crn1', flat=True).first()
+            if crn1 is not None:
+                 invoice_group_id = LinkedInvoice.objects.filter(invoice_reference=crn1).values_list('invoice_group_id', flat=True).first() or invoice_group_id
         elif len(booking_reference) > 0:
-            link_res = LinkedInvoice.objects.filter(booking_reference=booking_reference)
-            if link_res.count() > 0:
-                invoice_group_id = link_res[0].invoice_group_id.id
+            invoice_group_id = LinkedInvoice.objects.filter(booking_reference=booking_reference).values_list('invoice_group_id', flat=True).first() or invoice_group_id
 
         if invoice_group_id:
                 if int(invoice_group_id) > 0:
-                     linkinv = LinkedInvoice.objects.filter(invoice_group_id=invoice_group_id)                     
-                     system_id = None
-                     if linkinv.count() > 0:
-                         system_id = linkinv[0].system_identifier.system_id
-                         latest_li = LinkedInvoice.objects.filter(invoice_group_id=invoice_group_id).order_by('-created')[0]
-                         linked_payments = []
-                         linked_payments_booking_references = []
-                         invoices = []
-                         invoices_data = []
-                         orders = []
-                         invoice_group_checks_total = 0
-                         for li in linkinv:                             
-                             invoices.append(li.invoice_reference)
-                             inv = Invoice.objects.filter(reference=li.invoice_reference)
-                             settlement_date = ''
-                             oracle_invoice_number = ''
-                             if inv.count() > 0:
-                                 settlement_date = inv[0].settlement_date.strftime("%d/%m/%Y")
-                                 oracle_invoice_number = inv[0].oracle_invoice_number
-                             linked_payments.append({'id': li.id, 'invoice_reference': li.invoice_reference, 'system_identifier_id': li.system_identifier.id, 'system_identifier_system': li.system_identifier.system_id, 'booking_reference': li.booking_reference, 'booking_reference_linked': li.booking_reference_linked, 'invoice_group_id': li.invoice_group_id.id,'settlement_date': settlement_date, 'oracle_invoice_number': oracle_invoice_number})
-                             if li.booking_reference not in linked_payments_booking_references:
-                                linked_payments_booking_references.append(li.booking_reference)
-                             if li.booking_reference_linked not in linked_payments_booking_references:
-                                linked_payments_booking_references.append(li.booking_reference_linked)
-                         
-                         invoice_group_checks = LinkedInvoice.objects.filter(Q(booking_reference__in=linked_payments_booking_references) | Q(booking_reference_linked__in=linked_payments_booking_references)).values('invoice_group_id_id').annotate(total=Count('invoice_group_id_id')).order_by('total')
-                         invoice_group_checks_total = invoice_group_checks.count()
-
-                         invs = Invoice.objects.filter(reference__in=invoices)
-                         for i in invs:
-                             orders.append(i.order_number)
-                             settlement_date = None
-                             if i.settlement_date:
-                                  settlement_date = i.settlement_date.strftime("%d/%m/%Y")
-                                 
-                             invoices_data.append({'invoice_reference': i.reference, 'payment_status': str(i.payment_status), 'balance': str(i.balance), 'settlement_date': settlement_date, 'amount': str(i.amount)})
-                         invoice_orders = Order.objects.filter(number__in=orders)
-                         order_array = []
-                         order_obj = order_model.Line.objects.filter(order__number__in=orders).order_by('order__date_placed')
-                         rolling_total = Decimal('0.00')
-                         total_unallocated = Decimal('0.00')
-
-                         oracle_code_totals = {}
-                         data['data']['oracle_code_totals'] = {}
-                         for o in order_obj:
-                             owner_id = None
-                             if o.order:
-                                if o.order.basket:
-                                    if o.order.basket.owner:
-                                        owner_id = o.order.basket.owner.id
-
-                             if o.oracle_code == 'NNP449 GST':
-                                 total_unallocated = total_unallocated + o.line_price_incl_tax
-                             rolling_total = rolling_total + o.line_price_incl_tax
-                             tax_amount = o.line_price_incl_tax - o.line_price_excl_tax
-                             row = {'id': o.id, 'order_number': o.order.number, 'title': o.title, 'line_price_incl_tax': str(o.line_price_incl_tax), 'line_price_excl_tax': str(o.line_price_excl_tax), 'owner_id': str(owner_id),'oracle_code': o.oracle_code, 'rolling_total': str(rolling_total), 'tax_amount': str(tax_amount), 'order_date': o.order.date_placed.strftime("%d/%m/%Y %H:%M:%S")}
-                             order_array.append(row)
-
-                             if o.oracle_code not in oracle_code_totals:
-                                 oracle_code_totals[o.oracle_code] = Decimal('0.00')
-                             oracle_code_totals[o.oracle_code] = oracle_code_totals[o.oracle_code] + o.line_price_incl_tax 
-
-                         for cct in oracle_code_totals.keys():
-                             data['data']['oracle_code_totals'][cct] = str(oracle_code_totals[cct])
-
-                         bp_array = []
-                         bp_txn_refund_hash = {}
-                         bp_txn_total ={}
-                         bp_trans = BpointTransaction.objects.filter(crn1__in=invoices)
-                         for bp in bp_trans:
-                             if bp.original_txn not in bp_txn_refund_hash:
-                                   bp_txn_refund_hash[bp.original_txn] = Decimal('0.00')
-                                   
-                             if bp.original_txn not in bp_txn_total:
-                                   bp_txn_total[bp.original_txn] = float('0.00')
-                                   
-                             if bp.txn_number not in bp_txn_total:
-                                   bp_txn_total[bp.txn_number] = float('0.00')                                   
-
-                             if bp.action == 'payment':
-                                 bp_txn_total[bp.txn_number] = bp_txn_total[bp.txn_number] + float(bp.amount)
-                                                                                                       
-                             if bp.action == 'refund':
-                                 bp_txn_total[bp.original_txn] = bp_txn_total[bp.original_txn] - float(bp.amount)
-                                 
-                                 bp_txn_refund_hash[bp.original_txn] = bp_txn_refund_hash[bp.original_txn] + bp.amount
-
-                         total_gateway_amount = Decimal('0.00')
-                         for bp in bp_trans:
-                             if bp.action == 'refund':
-                                 total_gateway_amount = total_gateway_amount - bp.amount
-                             else:
-                                 total_gateway_amount = total_gateway_amount + bp.amount
-
-                             row = {}
-                             row['id'] = bp.id
-                             row['crn1'] = bp.crn1
-                             row['txnnumber'] = bp.txn_number
-                             row['original_txn'] = bp.original_txn
-                             row['receipt_number'] = bp.receipt_number
-                             row['settlement_date'] = bp.settlement_date.strftime("%d/%m/%Y")
-                             row['last_digits'] = bp.last_digits
-                             row['amount'] = str(bp.amount)
-                             row['response_code'] = bp.response_code
-                             row['action'] = bp.action
-                             row['processed'] = bp.processed.strftime("%d/%m/%Y %H:%M:%S")
-                             row['response_txt'] = bp.response_txt
-                             if bp.action == 'payment':
-                                row['amount_refunded'] = '0.00'
-                                if bp.txn_number in bp_txn_refund_hash:
-                                    row['amount_refunded'] = str(bp_txn_refund_hash[bp.txn_number])
-                             bp_array.append(row)
-
-
-                         cash_array = []
-                         cash_array_invoices = {}
-                         cash_txn_refund_hash = {}
-                         cash_trans = CashTransaction.objects.filter(invoice__in=invs)
-                         for c in cash_trans:
-                             if c.id not in cash_txn_refund_hash:
-                                 cash_txn_refund_hash[c.id] = Decimal('0.00')
-                             if c.type == 'refund':
-                                 cash_txn_refund_hash[c.id] = cash_txn_refund_hash[c.id] + c.amount
-                        
-                         total_cash_amount = Decimal('0.00')
-                         for ch in cash_trans:
-                             if ch.type  == 'refund':
-                                   total_cash_amount = total_cash_amount - ch.amount
-                             elif ch.type == 'payment':
-                                   total_cash_amount = total_cash_amount + ch.amount
-
-                             row = {}
-                             row['id'] = ch.id
-                             row['invoice_reference'] = ch.invoice.reference
-                             row['amount'] = str(ch.amount)
-                             row['action'] = ch.type
-                             row['source'] = ch.source
-                             row['receipt'] = ch.receipt
-                             row['details'] = ch.details
-                             row['created'] = ch.created.strftime("%d/%m/%Y %H:%M:%S")
-                             
-                             if ch.type == 'payment':
-                                  row['amount_refunded'] = '0.00'
-                                  if ch.id in cash_txn_refund_hash:
-                                      row['amount_refunded'] = str(cash_txn_refund_hash[ch.id])
-                             cash_array.append(row)
-
-                         # cash group by invoice
-                         for ch in cash_trans:
-                             if ch.invoice.reference not in cash_array_invoices:
-                                   cash_array_invoices[ch.invoice.reference] = Decimal('0.00')
-
-                             if ch.type  == 'refund':
-                                  cash_array_invoices[ch.invoice.reference] = cash_array_invoices[ch.invoice.reference] - ch.amount
-                             if ch.type  == 'payment':
-                                  cash_array_invoices[ch.invoice.reference] = cash_array_invoices[ch.invoice.reference] + ch.amount
-
-                         cai = []
-                         # convert decimal money to string for json dump    
-                         for ca in cash_array_invoices.keys():
-                               row = {}
-                               row['invoice_reference'] = ca
-                               row['amount'] = str(cash_array_invoices[ca])
-                               cai.append(row)
-
-                         oact_obj = {}
-                         oact = OracleAccountCodeTax.objects.all()
-                         for ca in oact: 
-                            if len(ca.oracle_code) > 2:
-                                oact_obj[ca.oracle_code] = ca.tax_type                             
-                                                     
-                         data['data']['oracle_code_tax_status'] = oact_obj
-                         data['data']['linked_payments'] = linked_payments
-                         data['data']['total_gateway_amount'] = str(total_gateway_amount)
-                         data['data']['total_oracle_amount'] = str(rolling_total)
-                         data['data']['total_cash_amount'] = str(total_cash_amount)
-                         data['data']['total_unallocated'] = str(total_unallocated)
-                         #data['data']['oracle_code_totals']  
-                         data['data']['order'] = order_array
-                         data['data']['bpoint'] = bp_array
-                         data['data']['cash'] = cash_array
-                         data['data']['cash_on_invoices'] = cai
-                         data['data']['invoices_data'] = invoices_data
-                         data['data']['booking_reference'] = latest_li.booking_reference
-                         data['data']['booking_reference_linked'] = latest_li.booking_reference_linked
-                         data['data']['invoice_group_checks_total'] = invoice_group_checks_total
-                         #data['data']['bp_txn_refund'] = bp_txn_refund_hash
-                         data['data']['bp_txn_total'] = bp_txn_total
-                         data['data']['invoice_group_id'] = invoice_group_id
-                         data['data']['system_id'] = system_id
+                     linkinv = list(LinkedInvoice.objects.filter(invoice_group_id=invoice_group_id).select_related('system_identifier'))
+                     if len(linkinv) > 0:
+                         data['data'] = invoice_group_calculations(invoice_group_id, linkinv)
                          data['status'] = 200
                          exists = True
                      else:
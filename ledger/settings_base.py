@@ -52,6 +52,7 @@ INSTALLED_APPS = [
     ]) + [
     'ledger.accounts',   #  Defines custom user model, passwordless auth pipeline.
     'ledger.api',
+    'ledger.emails',
     'ledger.licence',
     'ledger.payments',
     'ledger.payments.bpay',
@@ -322,6 +323,13 @@ LEDGER_PASS=env('LEDGER_PASS')
 NOTIFICATION_EMAIL=env('NOTIFICATION_EMAIL')
 BPAY_GATEWAY = env('BPAY_GATEWAY', None)
 INVOICE_UNPAID_WARNING = env('INVOICE_UNPAID_WARNING', '')
+# Rendered invoice pdfs kept in private media, keyed on their content
+INVOICE_PDF_CACHE = env('INVOICE_PDF_CACHE', True)
+INVOICE_PDF_CACHE_MAX_AGE_DAYS = int(env('INVOICE_PDF_CACHE_MAX_AGE_DAYS', 30))
+# Processes rendering invoices for bulk_invoice_pdf
+INVOICE_PDF_PROCESSES = int(env('INVOICE_PDF_PROCESSES', 4))
+# Most invoices bulk_invoice_pdf merges into one pdf, a merged pdf is built in memory
+INVOICE_PDF_MAX_MERGED = int(env('INVOICE_PDF_MAX_MERGED', 500))
 # GST Settings
 LEDGER_GST = env('LEDGER_GST',10)
 # BPAY settings
@@ -336,6 +344,10 @@ BPOINT_MERCHANT_NUM=env('BPOINT_MERCHANT_NUM')
 BPOINT_TEST=env('BPOINT_TEST',True)
 # Custom Email Settings
 EMAIL_BACKEND = 'ledger.ledger_email.LedgerEmailBackend'
+# Queue outgoing email for the outbox worker (manage.py email_outbox_worker) instead of sending it inline
+EMAIL_OUTBOX = env('EMAIL_OUTBOX', False)
+EMAIL_OUTBOX_BATCH_SIZE = int(env('EMAIL_OUTBOX_BATCH_SIZE', 100))
+EMAIL_OUTBOX_RETRY_BACKOFF_SECONDS = int(env('EMAIL_OUTBOX_RETRY_BACKOFF_SECONDS', 60))
 PRODUCTION_EMAIL = env('PRODUCTION_EMAIL', False)
 # Intercept and forward email recipient for non-production instances
 # Send to list of NON_PROD_EMAIL users instead
@@ -46,9 +46,9 @@ class APIAdmin(ModelAdmin):
 
 @admin.register(models.JobQueue)
 class JobQueueAdmin(ModelAdmin):
-     list_display = ('id','job_cmd','parameters_json','system_id','status','processed_dt','user','created')
+     list_display = ('id','job_cmd','parameters_json','system_id','status','attempts','worker','runtime','peak_memory','processed_dt','user','created')
      search_fields = ('job_cmd','parameters_json',)
-     list_filter = ('system_id','created')  
+     list_filter = ('status','system_id','created')  
      ordering = ('id',)
      raw_id_fields = ['user']
 
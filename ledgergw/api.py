@@ -4,9 +4,7 @@ from ledger.accounts import models
 from django.contrib.auth.models import Group
 from ledgergw import models as ledgergw_models
 from ledgergw import reports
-from ledger.api import models as ledgerapi_models
 from ledger.api import utils as ledgerapi_utils
-#from ledgergw import common
 from django.db.models import Q
 from ledger.checkout import utils
 from ledger.payments import utils as payments_utils
@@ -28,6 +26,7 @@ from rest_framework.renderers import JSONRenderer
 from decimal import Decimal
 from ledgergw.serialisers import ReportSerializer, SettlementReportSerializer, OracleSerializer,ItemisedSettlementReportSerializer
 from ledgergw import utils as ledgergw_utils
+from ledgergw import batch, projections, response_cache
 from django.http import HttpResponse
 from wsgiref.util import FileWrapper
 from django.core.exceptions import ValidationError
@@ -37,12 +36,11 @@ from ledger.payment import forms as payment_forms
 from ledger.payments.bpoint.gateway import Gateway
 from ledger.basket.middleware import BasketMiddleware
 from ledger.address.models import Country
-from django.db.models import Q, Max
 from ledger.accounts.models import PrivateDocument
+from ledger.accounts.search import search_emailusers
 import base64
 import traceback
 import json
-import ipaddress
 import re
 import mimetypes
 
@@ -60,89 +58,33 @@ from ledger.payments import helpers
 @csrf_exempt
 def user_info_search(request, apikey):
     jsondata = {'status': 404, 'message': 'API Key Not Found'}
-    ledger_user_json  = {}
-    if ledgerapi_models.API.objects.filter(api_key=apikey,active=1).count():
-        if ledgerapi_utils.api_allow(ledgerapi_utils.get_client_ip(request),apikey) is True:
+    api_key_obj = ledgerapi_utils.get_api(apikey)
+    if api_key_obj:
+        if ledgerapi_utils.authorize(request, api_key_obj) is True:
 
             keyword = request.POST.get('keyword', '')
             jsondata = {'status': 200, 'message': 'No Results'}
-            jsondata['users'] = [] 
-            ledger_user_json = {}
-            search_filter = Q()
-            query_str_split = keyword.split(" ")
-            search_filter |= Q(email__icontains=keyword.lower())
-        
-            #search_filter |= Q(first_name__icontains=query_str_split[0].lower())
-            if len(query_str_split) == 1:
-                  search_filter |= Q(first_name__icontains=query_str_split[0].lower())
-            if len(query_str_split) > 1:
-                  search_filter |= Q(Q(first_name__icontains=query_str_split[0].lower()) & Q(last_name__icontains=query_str_split[1].lower()))
-            #for se_wo in query_str_split:
-            #     
-            #     search_filter |= Q(first_name__icontains=se_wo.lower()) | Q(last_name__icontains=se_wo.lower())
-
-            ledger_users = models.EmailUser.objects.filter(search_filter)[:20]
-            #,last_name__icontains=keyword)
-            for ledger_obj in ledger_users:
-
-                    ledger_user_json = {}
-                    #if keyword.lower() in ledger_obj.first_name.lower()+' '+ledger_obj.last_name.lower() or keyword.lower() in ledger_obj.email.lower():
-                    ledger_user_json['ledgerid'] = ledger_obj.id
-                    ledger_user_json['email'] = ledger_obj.email
-                    ledger_user_json['first_name'] = ledger_obj.first_name
-                    ledger_user_json['last_name'] = ledger_obj.last_name
-                    ledger_user_json['is_staff'] = ledger_obj.is_staff
-                    ledger_user_json['is_superuser'] = ledger_obj.is_superuser
-                    ledger_user_json['is_active'] = ledger_obj.is_active
-                    ledger_user_json['date_joined'] = ledger_obj.date_joined.strftime('%d/%m/%Y %H:%M')
-                    ledger_user_json['title'] = ledger_obj.title
-                    if ledger_obj.dob:
-                        ledger_user_json['dob'] = ledger_obj.dob.strftime('%d/%m/%Y %H:%M')
-                    else:
-                        ledger_user_json['dob'] = None
-                    ledger_user_json['phone_number'] = ledger_obj.phone_number
-                    ledger_user_json['position_title'] = ledger_obj.position_title
-                    ledger_user_json['mobile_number'] = ledger_obj.mobile_number
-                    ledger_user_json['fax_number'] = ledger_obj.fax_number
-                    ledger_user_json['organisation'] = ledger_obj.organisation
-                    #ledger_user_json['identification'] = ledger_obj.identification
-                    #ledger_user_json['senior_card'] = ledger_obj.senior_card
-                    ledger_user_json['character_flagged'] = ledger_obj.character_flagged
-                    ledger_user_json['character_comments'] = ledger_obj.character_comments
-                    ledger_user_json['extra_data'] = ledger_obj.extra_data
-                    ledger_user_json['fullname'] = ledger_obj.get_full_name()
-                    if ledger_obj.dob:
-                        ledger_user_json['fullnamedob'] = ledger_obj.get_full_name_dob()
-                    else:
-                        ledger_user_json['fullnamedob'] = None
-                    # Groups
-                    #ledger_user_group = []
-                    #for g in ledger_obj.groups.all():
-                    #    ledger_user_group.append({'group_id': g.id, 'group_name': g.name})
-                    #ledger_user_json['groups'] = ledger_user_group
-
-                    jsondata['users'].append(ledger_user_json)
-                    jsondata['status'] = 200
-                    jsondata['message'] = 'Results'
+            jsondata['users'] = projections.UserSummaryProjection().rows(search_emailusers(keyword), 20)
+            if jsondata['users']:
+                jsondata['message'] = 'Results'
 
         else:
             jsondata['status'] = 403
             jsondata['message'] = 'Access Forbidden'
     else:
         pass
-    return HttpResponse(json.dumps(jsondata), content_type='application/json')
+    return projections.json_response(jsondata)
 
 @csrf_exempt
 def update_user_info_id(request, userid,apikey):
     jsondata = {'status': 404, 'message': 'API Key Not Found'}
-    ledger_user_json  = {}
     
     post_list = list(request.POST)
     
-    if ledgerapi_models.API.objects.filter(api_key=apikey,active=1).count():
-        api_key_obj = ledgerapi_models.API.objects.filter(api_key=apikey,active=1)
-        api_key_obj_update_key = "{} ({}) ".format(api_key_obj[0].system_id,api_key_obj[0].id)
-        if ledgerapi_utils.api_allow(ledgerapi_utils.get_client_ip(request),apikey) is True:
+    api_key_obj = ledgerapi_utils.get_api(apikey)
+    if api_key_obj:
+        api_key_obj_update_key = "{} ({}) ".format(api_key_obj.system_id,api_key_obj.id)
+        if ledgerapi_utils.authorize(request, api_key_obj) is True:
             ledger_user = models.EmailUser.objects.filter(id=int(userid))
 
             if ledger_user.count() > 0:
@@ -339,124 +281,46 @@ def update_user_info_id(request, userid,apikey):
         pass
     return HttpResponse(json.dumps(jsondata), content_type='application/json')
 
+def user_info_id_data(userid):
+    jsondata = {}
+    ledger_user_json = projections.UserDetailProjection().first(models.EmailUser.objects.filter(id=int(userid)))
+    if ledger_user_json:
+            jsondata['information_status'] = {"personal_details_completed" : False,
+                                                      "address_details_completed": False,
+                                                      "contact_details_completed": False,    
+                                                      "identification_details_completed" : False                                                       
+                                                     }
+            jsondata['user'] = ledger_user_json
+            jsondata['status'] = 200
+            jsondata['message'] = 'User Found'
+    else:
+        jsondata['status'] = '404'
+        jsondata['message'] = 'User not found'
+    return jsondata
+
 @csrf_exempt
 def user_info_id(request, userid,apikey):
     jsondata = {'status': 404, 'message': 'API Key Not Found'}
-    ledger_user_json  = {}
-    if ledgerapi_models.API.objects.filter(api_key=apikey,active=1).count():
-        if ledgerapi_utils.api_allow(ledgerapi_utils.get_client_ip(request),apikey) is True:
-
-            ledger_user = models.EmailUser.objects.filter(id=int(userid))
-            if ledger_user.count() > 0:
-                    ledger_obj = ledger_user[0]
-                    ledger_user_json['ledgerid'] = ledger_obj.id
-                    ledger_user_json['email'] = ledger_obj.email
-                    ledger_user_json['first_name'] = ledger_obj.first_name
-                    ledger_user_json['last_name'] = ledger_obj.last_name
-                    ledger_user_json['is_staff'] = ledger_obj.is_staff
-                    ledger_user_json['is_superuser'] = ledger_obj.is_superuser
-                    ledger_user_json['is_active'] = ledger_obj.is_active
-                    ledger_user_json['date_joined'] = ledger_obj.date_joined.strftime('%d/%m/%Y %H:%M')
-                    ledger_user_json['title'] = ledger_obj.title
-                    if ledger_obj.dob:
-                        ledger_user_json['dob'] = ledger_obj.dob.strftime('%d/%m/%Y')
-                    else:
-                        ledger_user_json['dob'] = None
-                    ledger_user_json['phone_number'] = ledger_obj.phone_number
-                    ledger_user_json['position_title'] = ledger_obj.position_title
-                    ledger_user_json['mobile_number'] = ledger_obj.mobile_number
-                    ledger_user_json['fax_number'] = ledger_obj.fax_number
-                    ledger_user_json['organisation'] = ledger_obj.organisation
-                    identification2 = ''
-                    if ledger_obj.identification2:
-                        identification2 = ledger_obj.identification2.name
-
-                    ledger_user_json['identification']  = identification2
-                    #ledger_user_json['identification'] = ledger_obj.identification
-                    #ledger_user_json['senior_card'] = ledger_obj.senior_card
-                    ledger_user_json['character_flagged'] = ledger_obj.character_flagged
-                    ledger_user_json['character_comments'] = ledger_obj.character_comments
-                    ledger_user_json['extra_data'] = ledger_obj.extra_data
-                    ledger_user_json['fullname'] = ledger_obj.get_full_name()
-                    if ledger_obj.dob:
-                        ledger_user_json['fullnamedob'] = ledger_obj.get_full_name_dob()
-                    else:
-                        ledger_user_json['fullnamedob'] = None
-                        
-                    
-                    ledger_user_json['residential_address'] =  {}
-                    ledger_user_json['residential_address']['line1'] = ""
-                    ledger_user_json['residential_address']['line2'] = ""
-                    ledger_user_json['residential_address']['line3'] = ""
-                    ledger_user_json['residential_address']['locality'] = ""
-                    ledger_user_json['residential_address']['state'] = ""
-                    ledger_user_json['residential_address']['country'] = ""
-                    ledger_user_json['residential_address']['postcode'] = ""
-                    if ledger_obj.residential_address:
-                         ledger_user_json['residential_address']['line1'] = ledger_obj.residential_address.line1
-                         ledger_user_json['residential_address']['line2'] = ledger_obj.residential_address.line2
-                         ledger_user_json['residential_address']['line3'] = ledger_obj.residential_address.line3
-                         ledger_user_json['residential_address']['locality'] = ledger_obj.residential_address.locality
-                         ledger_user_json['residential_address']['state'] = ledger_obj.residential_address.state
-                         if ledger_obj.residential_address.country:
-                             ledger_user_json['residential_address']['country'] = ledger_obj.residential_address.country.code
-                         ledger_user_json['residential_address']['postcode'] = ledger_obj.residential_address.postcode
-
-                    ledger_user_json['postal_address'] = {}
-                    ledger_user_json['postal_address']['line1'] = ""
-                    ledger_user_json['postal_address']['line2'] = ""
-                    ledger_user_json['postal_address']['line3'] = ""
-                    ledger_user_json['postal_address']['locality'] = ""
-                    ledger_user_json['postal_address']['state'] = ""
-                    ledger_user_json['postal_address']['country'] = ""
-                    ledger_user_json['postal_address']['postcode'] = ""
-
-                    if ledger_obj.postal_address:
-                         ledger_user_json['postal_address']['line1'] = ledger_obj.postal_address.line1
-                         ledger_user_json['postal_address']['line2'] = ledger_obj.postal_address.line2
-                         ledger_user_json['postal_address']['line3'] = ledger_obj.postal_address.line3
-                         ledger_user_json['postal_address']['locality'] = ledger_obj.postal_address.locality
-                         ledger_user_json['postal_address']['state'] = ledger_obj.postal_address.state
-                         ledger_user_json['postal_address']['country'] = ""
-                         if ledger_obj.postal_address.country:
-                             ledger_user_json['postal_address']['country'] = ledger_obj.postal_address.country.code
-                         ledger_user_json['postal_address']['postcode'] = ledger_obj.postal_address.postcode
-                    ledger_user_json['postal_same_as_residential'] = ledger_obj.postal_same_as_residential
-
-                    # Groups
-                    ledger_user_group = []
-                    for g in ledger_obj.groups.all():
-                        ledger_user_group.append({'group_id': g.id, 'group_name': g.name})
-                    ledger_user_json['groups'] = ledger_user_group                    
-                    jsondata['information_status'] = {"personal_details_completed" : False,
-                                                              "address_details_completed": False,
-                                                              "contact_details_completed": False,    
-                                                              "identification_details_completed" : False                                                       
-                                                             }
-                    
-                    # if len(ledger_user_json['dob']) == 10:
-                    #     jsondata['information_status']["personal_details_completed"] = True
-                        
-                    jsondata['user'] = ledger_user_json
-                    jsondata['status'] = 200
-                    jsondata['message'] = 'User Found'
-            else:
-                jsondata['status'] = '404'
-                jsondata['message'] = 'User not found'
+    api_key_obj = ledgerapi_utils.get_api(apikey)
+    if api_key_obj:
+        if ledgerapi_utils.authorize(request, api_key_obj) is True:
+            etag = response_cache.user_etag('user_info_id', userid)
+            return response_cache.cached_json_response(request, 'user_info_id', etag, lambda: user_info_id_data(userid))
         else:
             jsondata['status'] = 403
             jsondata['message'] = 'Access Forbidden'
     else:
         pass
-    return HttpResponse(json.dumps(jsondata), content_type='application/json')
+    return projections.json_response(jsondata)
 
 
 @csrf_exempt
 def user_info(request, ledgeremail,apikey):
     jsondata = {'status': 404, 'message': 'API Key Not Found'}
     ledger_user_json  = {}
-    if ledgerapi_models.API.objects.filter(api_key=apikey,active=1).count():
-        if ledgerapi_utils.api_allow(ledgerapi_utils.get_client_ip(request),apikey) is True:
+    api_key_obj = ledgerapi_utils.get_api(apikey)
+    if api_key_obj:
+        if ledgerapi_utils.authorize(request, api_key_obj) is True:
             ledgeremail=ledgeremail.lower()
             ledgeremail=ledgeremail.replace(" ","")
             ledger_user = models.EmailUser.objects.filter(email=ledgeremail)
@@ -477,48 +341,8 @@ def user_info(request, ledgeremail,apikey):
                  ledger_user_obj.save()
                  ledger_user = models.EmailUser.objects.filter(email=ledgeremail)
 
-            if ledger_user.count() > 0:
-                    ledger_obj = ledger_user[0]
-                    ledger_user_json['ledgerid'] = ledger_obj.id
-                    ledger_user_json['email'] = ledger_obj.email
-                    ledger_user_json['first_name'] = ledger_obj.first_name
-                    ledger_user_json['last_name'] = ledger_obj.last_name
-                    ledger_user_json['is_staff'] = ledger_obj.is_staff
-                    ledger_user_json['is_superuser'] = ledger_obj.is_superuser
-                    ledger_user_json['is_active'] = ledger_obj.is_active
-                    ledger_user_json['date_joined'] = ledger_obj.date_joined.strftime('%d/%m/%Y %H:%M')
-                    ledger_user_json['title'] = ledger_obj.title
-                    if ledger_obj.dob:
-                        ledger_user_json['dob'] = ledger_obj.dob.strftime('%d/%m/%Y %H:%M')
-                    else:
-                        ledger_user_json['dob'] = None
-                    ledger_user_json['phone_number'] = ledger_obj.phone_number
-                    ledger_user_json['position_title'] = ledger_obj.position_title
-                    ledger_user_json['mobile_number'] = ledger_obj.mobile_number
-                    ledger_user_json['fax_number'] = ledger_obj.fax_number
-                    ledger_user_json['organisation'] = ledger_obj.organisation
-                    #ledger_user_json['residential_address'] =  {}
-                    #if ledger_obj.residential_address:
-                    #     ledger_user_json['residential_address']['line1'] = ledger_obj.residential_address.line1 
-
-                    #ledger_user_json['residential_address'] = ledger_obj.residential_address
-                    #ledger_user_json['postal_address'] = ledger_obj.postal_address
-                    #ledger_user_json['billing_address'] = ledger_obj.billing_address
-                    #ledger_user_json['identification'] = ledger_obj.identification
-                    #ledger_user_json['senior_card'] = ledger_obj.senior_card
-                    ledger_user_json['character_flagged'] = ledger_obj.character_flagged
-                    ledger_user_json['character_comments'] = ledger_obj.character_comments
-                    ledger_user_json['extra_data'] = ledger_obj.extra_data
-                    ledger_user_json['fullname'] = ledger_obj.get_full_name()
-                    if ledger_obj.dob:
-                        ledger_user_json['fullnamedob'] = ledger_obj.get_full_name_dob()
-                    else:
-                        ledger_user_json['fullnamedob'] = None
-                    # Groups
-                    ledger_user_group = []
-                    for g in ledger_obj.groups.all():
-                        ledger_user_group.append({'group_id': g.id, 'group_name': g.name})
-                    ledger_user_json['groups'] = ledger_user_group
+            ledger_user_json = projections.UserProjection().first(ledger_user)
+            if ledger_user_json:
                     jsondata['user'] = ledger_user_json
                     jsondata['status'] = 200
                     jsondata['message'] = 'User Found'
@@ -530,7 +354,7 @@ def user_info(request, ledgeremail,apikey):
             jsondata['message'] = 'Access Forbidden'
     else:
         pass
-    return HttpResponse(json.dumps(jsondata), content_type='application/json')
+    return projections.json_response(jsondata)
 
 
 
@@ -540,8 +364,9 @@ def user_group_info(request, ledger_id,apikey):
     query_exists = False
     ledger_user_json  = {}
     filter_post = json.loads(request.POST['filter'])
-    if ledgerapi_models.API.objects.filter(api_key=apikey,active=1).count():
-        if ledgerapi_utils.api_allow(ledgerapi_utils.get_client_ip(request),apikey) is True:
+    api_key_obj = ledgerapi_utils.get_api(apikey)
+    if api_key_obj:
+        if ledgerapi_utils.authorize(request, api_key_obj) is True:
             ledger_user = models.EmailUser.objects.filter(id=ledger_id)
             if ledger_user.count() > 0:
                     ledger_obj = ledger_user[0]
@@ -583,8 +408,9 @@ def user_group_info(request, ledger_id,apikey):
 def group_info(request, apikey):
     ledger_json  = {}
     jsondata = {'status': 404, 'message': 'API Key Not Found'}
-    if ledgerapi_models.API.objects.filter(api_key=apikey,active=1).count():
-        if ledgerapi_utils.api_allow(ledgerapi_utils.get_client_ip(request),apikey) is True:
+    api_key_obj = ledgerapi_utils.get_api(apikey)
+    if api_key_obj:
+        if ledgerapi_utils.authorize(request, api_key_obj) is True:
             groups = Group.objects.all()
             ledger_json['groups_list'] = []
             ledger_json['groups_id_map'] = {}
@@ -611,9 +437,9 @@ def group_info(request, apikey):
 @csrf_exempt
 def add_update_file_emailuser(request, apikey):
     jsondata = {'status': 404, 'message': 'API Key Not Found'}
-    ledger_user_json  = {}
-    if ledgerapi_models.API.objects.filter(api_key=apikey,active=1).count():
-        if ledgerapi_utils.api_allow(ledgerapi_utils.get_client_ip(request),apikey) is True:
+    api_key_obj = ledgerapi_utils.get_api(apikey)
+    if api_key_obj:
+        if ledgerapi_utils.authorize(request, api_key_obj) is True:
             emailuser_id = request.POST.get('emailuser_id', '')
             file_group_id = request.POST.get('file_group_id', None)
             filebase64 = request.POST['filebase64']
@@ -641,9 +467,9 @@ def add_update_file_emailuser(request, apikey):
 @csrf_exempt
 def get_private_document(request, apikey):
     jsondata = {'status': 404, 'message': 'API Key Not Found'}
-    ledger_user_json  = {}
-    if ledgerapi_models.API.objects.filter(api_key=apikey,active=1).count():
-        if ledgerapi_utils.api_allow(ledgerapi_utils.get_client_ip(request),apikey) is True:
+    api_key_obj = ledgerapi_utils.get_api(apikey)
+    if api_key_obj:
+        if ledgerapi_utils.authorize(request, api_key_obj) is True:
             private_document_id = request.POST.get('private_document_id', None)
             private_document = models.PrivateDocument.objects.get(id=private_document_id)
 
@@ -663,9 +489,9 @@ def get_private_document(request, apikey):
 @csrf_exempt
 def create_basket_session(request,apikey):
     jsondata = {'status': 404, 'message': 'API Key Not Found'}
-    ledger_user_json  = {}
-    if ledgerapi_models.API.objects.filter(api_key=apikey,active=1).count():
-        if ledgerapi_utils.api_allow(ledgerapi_utils.get_client_ip(request),apikey) is True:
+    api_key_obj = ledgerapi_utils.get_api(apikey)
+    if api_key_obj:
+        if ledgerapi_utils.authorize(request, api_key_obj) is True:
             print ("API create_basket_session")
             parameters = json.loads(request.POST.get('parameters', "{}"))
             emailuser_id = request.POST.get('emailuser_id', None)
@@ -698,9 +524,9 @@ def create_basket_session(request,apikey):
 @csrf_exempt
 def create_checkout_session(request,apikey):
     jsondata = {'status': 404, 'message': 'API Key Not Found'}
-    ledger_user_json  = {}
-    if ledgerapi_models.API.objects.filter(api_key=apikey,active=1).count():
-        if ledgerapi_utils.api_allow(ledgerapi_utils.get_client_ip(request),apikey) is True:
+    api_key_obj = ledgerapi_utils.get_api(apikey)
+    if api_key_obj:
+        if ledgerapi_utils.authorize(request, api_key_obj) is True:
             print ("API create_basket_session")
             checkout_parameters = json.loads(request.POST.get('checkout_parameters', "{}"))
             resp = utils.create_checkout_session(request,checkout_parameters)
@@ -730,9 +556,9 @@ def create_checkout_session(request,apikey):
 @csrf_exempt
 def get_order_info(request,apikey):
     jsondata = {'status': 404, 'message': 'API Key Not Found'}
-    ledger_user_json  = {}
-    if ledgerapi_models.API.objects.filter(api_key=apikey,active=1).count():
-        if ledgerapi_utils.api_allow(ledgerapi_utils.get_client_ip(request),apikey) is True:
+    api_key_obj = ledgerapi_utils.get_api(apikey)
+    if api_key_obj:
+        if ledgerapi_utils.authorize(request, api_key_obj) is True:
             print ("API get_order_info")
             data = json.loads(request.POST.get('data', "{}"))
             if 'basket_id' in data:
@@ -760,47 +586,39 @@ def get_order_info(request,apikey):
     response.set_cookie('CookieTest', 'Testing',5)
     return response
 
+def order_lines_data(data):
+    jsondata = {}
+    order = order_models.Line.objects.none()
+
+    if 'number' in data:
+        order = order_models.Line.objects.filter(order__number=data['number'])
+
+    if 'order_id' in data:
+        order = order_models.Line.objects.filter(order_id=data['order_id'])
+
+    jsondata['status'] = 200
+    jsondata['message'] = 'Success'
+    jsondata['data'] = {'orderlines': projections.OrderLineProjection().rows(order)}
+    return jsondata
+
 @csrf_exempt
 def get_order_lines(request,apikey):
     jsondata = {'status': 404, 'message': 'API Key Not Found'}
-    ledger_user_json  = {}
-    if ledgerapi_models.API.objects.filter(api_key=apikey,active=1).count():
-        if ledgerapi_utils.api_allow(ledgerapi_utils.get_client_ip(request),apikey) is True:
+    api_key_obj = ledgerapi_utils.get_api(apikey)
+    if api_key_obj:
+        if ledgerapi_utils.authorize(request, api_key_obj) is True:
             print ("API get_order_line")
             data = json.loads(request.POST.get('data', "{}"))
-            order = []
-            order_obj = []
-
-            if 'number' in data:
-                order_info = order_models.Order.objects.filter(number=data['number'])
-                if order_info.count() > 0:
-                     order = order_models.Line.objects.filter(order=order_info[0])#,oracle_code=data['oracle_code'])
-
-            if 'order_id' in data:
-                order = order_models.Line.objects.filter(order_id=data['order_id'])
-
-            for o in order:
-               row = {}
-               row['id'] = o.id
-               row['title'] = o.title
-               row['oracle_code'] = o.oracle_code
-               row['quantity'] = o.quantity
-               row['price_incl_tax'] = str(o.line_price_incl_tax)
-               row['price_excl_tax'] = str(o.line_price_excl_tax)
-               row['paid'] = str(o.paid)
-               row['unit_price_incl_tax'] = str(o.unit_price_incl_tax)
-               row['unit_price_excl_tax'] = str(o.unit_price_excl_tax)
-
-               order_obj.append(row)
-            jsondata['status'] = 200
-            jsondata['message'] = 'Success'
-            jsondata['data'] = {'orderlines': order_obj}
+            etag = response_cache.order_lines_etag('get_order_lines', data)
+            response = response_cache.cached_json_response(request, 'get_order_lines', etag, lambda: order_lines_data(data))
+            response.set_cookie('CookieTest', 'Testing',5)
+            return response
         else:
             jsondata['status'] = 403
             jsondata['message'] = 'Access Forbidden'
     else:
         pass
-    response = HttpResponse(json.dumps(jsondata), content_type='application/json')
+    response = projections.json_response(jsondata)
     response.set_cookie('CookieTest', 'Testing',5)
     return response
 
@@ -808,9 +626,9 @@ def get_order_lines(request,apikey):
 
 def get_failed_refund_totals(request,apikey,system_id):
     jsondata = {'status': 404, 'message': 'API Key Not Found'}
-    ledger_user_json  = {}
-    if ledgerapi_models.API.objects.filter(api_key=apikey,active=1).count():
-        if ledgerapi_utils.api_allow(ledgerapi_utils.get_client_ip(request),apikey) is True:
+    api_key_obj = ledgerapi_utils.get_api(apikey)
+    if api_key_obj:
+        if ledgerapi_utils.authorize(request, api_key_obj) is True:
             ois_obj = {}
             total_fr = payment_models.RefundFailed.objects.filter(system_identifier__system_id=system_id, status=0).count()
             jsondata['status'] = 200
@@ -825,24 +643,33 @@ def get_failed_refund_totals(request,apikey,system_id):
     response.set_cookie('CookieTest', 'Testing',5)
     return response
 
+def oracle_interface_system_data(system_id_zeroed):
+    jsondata = {}
+    ois_obj = {}
+    ois = payment_models.OracleInterfaceSystem.objects.filter(system_id=system_id_zeroed,enabled=True).first()
+    if ois:
+        ois_obj['system_id'] = ois.system_id
+        ois_obj['system_name'] = ois.system_name
+        ois_obj['enabled'] = ois.enabled
+        ois_obj['integration_type'] = ois.integration_type
+
+    jsondata['status'] = 200
+    jsondata['message'] = 'Success'
+    jsondata['data'] = {'ois': ois_obj}
+    return jsondata
+
 @csrf_exempt
 def oracle_interface_system(request,apikey):
     jsondata = {'status': 404, 'message': 'API Key Not Found'}
-    ledger_user_json  = {}
-    if ledgerapi_models.API.objects.filter(api_key=apikey,active=1).count():
-        if ledgerapi_utils.api_allow(ledgerapi_utils.get_client_ip(request),apikey) is True:
-            ois_obj = {}
+    api_key_obj = ledgerapi_utils.get_api(apikey)
+    if api_key_obj:
+        if ledgerapi_utils.authorize(request, api_key_obj) is True:
             data = json.loads(request.POST.get('data', "{}"))
-            ois = payment_models.OracleInterfaceSystem.objects.filter(system_id=system_id_zeroed,enabled=True)
-            if ois.count() > 0:
-                ois_obj['system_id'] = ois[0].system_id
-                ois_obj['system_name'] = ois[0].system_name
-                ois_obj['enabled'] = ois[0].enabled
-                ois_obj['integration_type'] = ois[0].integration_type
-
-            jsondata['status'] = 200
-            jsondata['message'] = 'Success'
-            jsondata['data'] = {'ois': ois_obj}
+            system_id_zeroed = str(data.get('system_id', '')).replace('S','0')
+            etag = response_cache.oracle_interface_system_etag('oracle_interface_system', system_id_zeroed)
+            response = response_cache.cached_json_response(request, 'oracle_interface_system', etag, lambda: oracle_interface_system_data(system_id_zeroed))
+            response.set_cookie('CookieTest', 'Testing',5)
+            return response
         else:
             jsondata['status'] = 403
             jsondata['message'] = 'Access Forbidden'
@@ -857,8 +684,9 @@ def get_basket_for_future_invoice(request,apikey, reference):
     jsondata = {'status': 404, 'message': 'API Key Not Found'}
     invoice_json = {}
     print ("get_basket_for_future_invoice")
-    if ledgerapi_models.API.objects.filter(api_key=apikey,active=1).count():
-        if ledgerapi_utils.api_allow(ledgerapi_utils.get_client_ip(request),apikey) is True:
+    api_key_obj = ledgerapi_utils.get_api(apikey)
+    if api_key_obj:
+        if ledgerapi_utils.authorize(request, api_key_obj) is True:
             data = json.loads(request.POST.get('data', "{}"))
             user_logged_in = request.POST.get('user_logged_in',None)
             fallback_url = request.POST.get('fallback_url', None)
@@ -926,110 +754,65 @@ def get_basket_for_future_invoice(request,apikey, reference):
 
 
 
+def invoice_properties_data(invoice_id):
+    jsondata = {}
+    invoice_obj = projections.InvoiceProjection().first(Invoice.objects.filter(id=invoice_id))
+    if invoice_obj:
+          jsondata['status'] = 200
+          jsondata['message'] = 'Success'
+          jsondata['data'] = {'invoice': invoice_obj}
+    else:
+          jsondata['status'] = 404
+          jsondata['message'] = 'not found'
+          jsondata['data'] = {'invoice': None}
+    return jsondata
+
 @csrf_exempt
 def get_invoice_properties(request,apikey):
     jsondata = {'status': 404, 'message': 'API Key Not Found'}
     invoice_json = {}
     print ("API get_invoice_properties 1") 
-    if ledgerapi_models.API.objects.filter(api_key=apikey,active=1).count():
-        if ledgerapi_utils.api_allow(ledgerapi_utils.get_client_ip(request),apikey) is True:
+    api_key_obj = ledgerapi_utils.get_api(apikey)
+    if api_key_obj:
+        if ledgerapi_utils.authorize(request, api_key_obj) is True:
             print ("API get_invoice_properties 2")
             data = json.loads(request.POST.get('data', "{}"))
             print (data)
-            if Invoice.objects.filter(id=data['invoice_id']).count() > 0:
-                 try:
-                       invoice = Invoice.objects.get(id=data['invoice_id'])
-                       invoice_obj = {}
-                       invoice_obj['id'] = invoice.id
-                       invoice_obj['text'] = invoice.text
-                       invoice_obj['amount'] = str(invoice.amount)
-                       invoice_obj['order_number'] = invoice.order_number
-                       invoice_obj['reference'] = invoice.reference
-                       invoice_obj['system'] = invoice.system
-                       invoice_obj['token'] = invoice.token
-                       invoice_obj['voided'] = invoice.voided
-                       invoice_obj['previous_invoice'] = invoice.previous_invoice
-                       invoice_obj['settlement_date'] = ''
-                       if invoice.settlement_date:
-                           invoice_obj['settlement_date'] = invoice.settlement_date.strftime('%d/%m/%Y')
-                       
-                       invoice_obj['payment_method'] = invoice.payment_method
-                       invoice_obj['biller_code'] = invoice.biller_code
-                       invoice_obj['number'] = invoice.number
-                       if invoice.owner:
-                           invoice_obj['owner'] = invoice.owner.id
-                       else:
-                           invoice_obj['owner'] = None
-                       invoice_obj['refundable_amount'] = str(invoice.refundable_amount)
-                       invoice_obj['refundable'] = invoice.refundable
-                       invoice_obj['num_items'] = invoice.num_items
-                       #invoice_obj['linked_bpay_transactions'] = invoice.linked_bpay_transactions
-
-                       invoice_obj['payment_amount'] = str(invoice.payment_amount)
-                       invoice_obj['total_payment_amount'] = str(invoice.total_payment_amount)
-                       invoice_obj['refund_amount'] = str(invoice.refund_amount)
-                       invoice_obj['deduction_amount'] = str(invoice.deduction_amount)
-                       invoice_obj['transferable_amount'] = str(invoice.transferable_amount)
-                       invoice_obj['balance'] = str(invoice.balance)
-                       invoice_obj['payment_status'] = invoice.payment_status
-                       invoice_obj['oracle_invoice_number'] = invoice.oracle_invoice_number
-                       
-                       jsondata['status'] = 200
-                       jsondata['message'] = 'Success'
-                       jsondata['data'] = {'invoice': invoice_obj}
-                      
-                 except Exception as e:
-                       jsondata['status'] = 500
-                       jsondata['message'] = 'Invoice Error: '+str(e)                       
-                       print ("ERROR")
-                       print (e)
-            else:
-                 jsondata['status'] = 404
-                 jsondata['message'] = 'not found'
-                 jsondata['data'] = {'invoice': None}
+            try:
+                 etag = response_cache.invoice_etag('get_invoice_properties', data['invoice_id'])
+                 return response_cache.cached_json_response(request, 'get_invoice_properties', etag, lambda: invoice_properties_data(data['invoice_id']))
+            except Exception as e:
+                 jsondata['status'] = 500
+                 jsondata['message'] = 'Invoice Error: '+str(e)
+                 print ("ERROR")
+                 print (e)
         else:
             jsondata['status'] = 403
             jsondata['message'] = 'Access Forbidden'
     else:
         pass
-    response = HttpResponse(json.dumps(jsondata), content_type='application/json')
+    response = projections.json_response(jsondata)
     return response
 
 def get_linked_invoice_data_by_booking_reference(booking_reference, system_id):
     linked_payment_data = {}
     ois = payment_models.OracleInterfaceSystem.objects.get(system_id=system_id)
-    li = payment_models.LinkedInvoice.objects.filter(booking_reference=booking_reference,system_identifier=ois)
+    # The group is taken from the first link of the booking
+    li = payment_models.LinkedInvoice.objects.filter(booking_reference=booking_reference,system_identifier=ois).order_by('id')
     if li.count() > 0:
         invoice_group_id = li[0].invoice_group_id
         linked_payment_data = get_linked_invoice_data(invoice_group_id,system_id)
     return linked_payment_data
 
 def get_linked_invoice_data(invoice_group_id, system_id):
-    linked_payment_data = {'total_available': '0.00', 'txn_pool': {}}
     invoice_array = []
-    total_available = Decimal('0.00')
     ois = payment_models.OracleInterfaceSystem.objects.get(system_id=system_id)
     li = payment_models.LinkedInvoice.objects.filter(invoice_group_id=invoice_group_id,system_identifier=ois)
     for lp in li:
         if lp.invoice_reference not in invoice_array:
             invoice_array.append(lp.invoice_reference)
-    bp_trans = payment_bpoint_models.BpointTransaction.objects.filter(crn1__in=invoice_array)
-    for bp in bp_trans:
-        if bp.action == 'payment':
-            if bp.txn_number not in linked_payment_data['txn_pool']:
-                linked_payment_data['txn_pool'][bp.txn_number] = Decimal('0.00')
-
-            total_available = total_available + bp.amount
-            linked_payment_data['txn_pool'][bp.txn_number] = linked_payment_data['txn_pool'][bp.txn_number] + bp.amount
-
-        if bp.action == 'refund':
-            if bp.original_txn not in linked_payment_data['txn_pool']:
-                linked_payment_data['txn_pool'][bp.original_txn] = Decimal('0.00')
-
-            total_available = total_available - bp.amount
-            linked_payment_data['txn_pool'][bp.original_txn] = linked_payment_data['txn_pool'][bp.original_txn] - bp.amount
-    linked_payment_data['total_available'] = str(total_available)
-    return linked_payment_data
+    bp_trans = payment_bpoint_models.BpointTransaction.objects.filter(crn1__in=invoice_array).order_by('id')
+    return batch.linked_payment_data(bp_trans)
 
 def basket_totals(basket_id):
     basket_obj = basket_models.Line.objects.filter(basket_id=basket_id)
@@ -1046,8 +829,9 @@ def basket_totals(basket_id):
 def get_basket_total(request,apikey):
     jsondata = {'status': 404, 'message': 'API Key Not Found'}
     invoice_json = {}
-    if ledgerapi_models.API.objects.filter(api_key=apikey,active=1).count():
-        if ledgerapi_utils.api_allow(ledgerapi_utils.get_client_ip(request),apikey) is True:
+    api_key_obj = ledgerapi_utils.get_api(apikey)
+    if api_key_obj:
+        if ledgerapi_utils.authorize(request, api_key_obj) is True:
                  data = json.loads(request.POST.get('data', "{}"))
                  try:
                        basket_total = basket_totals(data['basket_id'])
@@ -1073,8 +857,9 @@ def process_api_refund(request,apikey):
     invoice_json = {}
     basket =None
     failed_refund = False
-    if ledgerapi_models.API.objects.filter(api_key=apikey,active=1).count():
-         if ledgerapi_utils.api_allow(ledgerapi_utils.get_client_ip(request),apikey) is True:
+    api_key_obj = ledgerapi_utils.get_api(apikey)
+    if api_key_obj:
+         if ledgerapi_utils.authorize(request, api_key_obj) is True:
              data = json.loads(request.POST.get('data', "{}")) 
              basket_params = json.loads(request.POST.get("basket_parameters","{}"))
              customer_id = json.loads(request.POST.get("customer_id", None))
@@ -1253,8 +1038,9 @@ def process_zero(request,apikey):
     invoice_json = {}
     basket =None
     failed_refund = False
-    if ledgerapi_models.API.objects.filter(api_key=apikey,active=1).count():
-        if ledgerapi_utils.api_allow(ledgerapi_utils.get_client_ip(request),apikey) is True:
+    api_key_obj = ledgerapi_utils.get_api(apikey)
+    if api_key_obj:
+        if ledgerapi_utils.authorize(request, api_key_obj) is True:
             data = json.loads(request.POST.get('data', "{}"))
             basket_hash = request.COOKIES.get('ledgergw_basket','')
             basket_hash_split = basket_hash.split("|")
@@ -1288,8 +1074,9 @@ def process_no(request,apikey):
     invoice_json = {}
     basket =None
     failed_refund = False
-    if ledgerapi_models.API.objects.filter(api_key=apikey,active=1).count():
-        if ledgerapi_utils.api_allow(ledgerapi_utils.get_client_ip(request),apikey) is True:
+    api_key_obj = ledgerapi_utils.get_api(apikey)
+    if api_key_obj:
+        if ledgerapi_utils.authorize(request, api_key_obj) is True:
             data = json.loads(request.POST.get('data', "{}"))
             basket_hash = request.COOKIES.get('ledgergw_basket','')
             basket_hash_split = basket_hash.split("|")
@@ -1328,8 +1115,9 @@ def process_create_future_invoice(request,apikey):
     invoice_json = {}
     basket =None
     failed_refund = False
-    if ledgerapi_models.API.objects.filter(api_key=apikey,active=1).count():
-        if ledgerapi_utils.api_allow(ledgerapi_utils.get_client_ip(request),apikey) is True:
+    api_key_obj = ledgerapi_utils.get_api(apikey)
+    if api_key_obj:
+        if ledgerapi_utils.authorize(request, api_key_obj) is True:
             checkout_session = CheckoutSessionData(request)
             data = json.loads(request.POST.get('data', "{}"))
             basket_id = request.POST.get('basket_id','')
@@ -1399,8 +1187,9 @@ def delete_card_token(request,apikey):
     invoice_json = {}
     basket =None
     failed_refund = False
-    if ledgerapi_models.API.objects.filter(api_key=apikey,active=1).count():
-        if ledgerapi_utils.api_allow(ledgerapi_utils.get_client_ip(request),apikey) is True:
+    api_key_obj = ledgerapi_utils.get_api(apikey)
+    if api_key_obj:
+        if ledgerapi_utils.authorize(request, api_key_obj) is True:
             data = json.loads(request.POST.get('data', "{}"))
             card_token_id = request.POST.get('card_token_id', None)
             user_logged_in = request.POST.get('user_logged_in', None)
@@ -1424,8 +1213,9 @@ def delete_card_token(request,apikey):
 def get_primary_card_token_for_user(request,apikey):
     jsondata = {'status': 404, 'message': 'API Key Not Found'}    
    
-    if ledgerapi_models.API.objects.filter(api_key=apikey,active=1).count():
-        if ledgerapi_utils.api_allow(ledgerapi_utils.get_client_ip(request),apikey) is True:
+    api_key_obj = ledgerapi_utils.get_api(apikey)
+    if api_key_obj:
+        if ledgerapi_utils.authorize(request, api_key_obj) is True:
             data = json.loads(request.POST.get('data', "{}"))
             user_id = data['user_id']
             PAYMENT_INTERFACE_SYSTEM_PROJECT_CODE = request.POST.get('PAYMENT_INTERFACE_SYSTEM_PROJECT_CODE',None)
@@ -1455,8 +1245,9 @@ def get_card_tokens_for_user(request,apikey):
     failed_refund = False
     card_tokens = []
 
-    if ledgerapi_models.API.objects.filter(api_key=apikey,active=1).count():
-        if ledgerapi_utils.api_allow(ledgerapi_utils.get_client_ip(request),apikey) is True:
+    api_key_obj = ledgerapi_utils.get_api(apikey)
+    if api_key_obj:
+        if ledgerapi_utils.authorize(request, api_key_obj) is True:
             data = json.loads(request.POST.get('data', "{}"))
             user_logged_in = request.POST.get('user_logged_in', None)
             PAYMENT_INTERFACE_SYSTEM_PROJECT_CODE = request.POST.get('PAYMENT_INTERFACE_SYSTEM_PROJECT_CODE',None)
@@ -1490,8 +1281,9 @@ def create_store_card_token(request,apikey):
 
     card_tokens = []
     token = None
-    if ledgerapi_models.API.objects.filter(api_key=apikey,active=1).count():
-        if ledgerapi_utils.api_allow(ledgerapi_utils.get_client_ip(request),apikey) is True:
+    api_key_obj = ledgerapi_utils.get_api(apikey)
+    if api_key_obj:
+        if ledgerapi_utils.authorize(request, api_key_obj) is True:
             data = json.loads(request.POST.get('data', "{}"))
             payload = json.loads(request.POST.get('payload', "{}"))            
             try:                                
@@ -1564,8 +1356,9 @@ def set_primary_card(request,apikey):
 
     card_tokens = []
     token = None
-    if ledgerapi_models.API.objects.filter(api_key=apikey,active=1).count():
-        if ledgerapi_utils.api_allow(ledgerapi_utils.get_client_ip(request),apikey) is True:
+    api_key_obj = ledgerapi_utils.get_api(apikey)
+    if api_key_obj:
+        if ledgerapi_utils.authorize(request, api_key_obj) is True:
             data = json.loads(request.POST.get('data', "{}"))
             payload = json.loads(request.POST.get('payload', "{}"))
             user_logged_in  = request.POST.get("user_logged_in", None)
@@ -1606,8 +1399,9 @@ def get_primary_card(request,apikey):
 
     card_tokens = []
     token = None
-    if ledgerapi_models.API.objects.filter(api_key=apikey,active=1).count():
-        if ledgerapi_utils.api_allow(ledgerapi_utils.get_client_ip(request),apikey) is True:
+    api_key_obj = ledgerapi_utils.get_api(apikey)
+    if api_key_obj:
+        if ledgerapi_utils.authorize(request, api_key_obj) is True:
             data = json.loads(request.POST.get('data', "{}"))
             payload = json.loads(request.POST.get('payload', "{}"))
             user_id = json.loads(request.POST.get('user_id',"{}"))
@@ -1636,8 +1430,9 @@ def process_refund(request,apikey):
     invoice_json = {}
     basket =None
     failed_refund = False
-    if ledgerapi_models.API.objects.filter(api_key=apikey,active=1).count():
-        if ledgerapi_utils.api_allow(ledgerapi_utils.get_client_ip(request),apikey) is True:
+    api_key_obj = ledgerapi_utils.get_api(apikey)
+    if api_key_obj:
+        if ledgerapi_utils.authorize(request, api_key_obj) is True:
             data = json.loads(request.POST.get('data', "{}"))
             basket_hash = request.COOKIES.get('ledgergw_basket','')
             basket_hash_split = basket_hash.split("|")
@@ -1899,26 +1694,48 @@ class OracleJob(views.APIView):
             raise serializers.ValidationError(str(e[0]))
 
 
-def get_countries(request):
-     resp = {'status': 404, 'data': {}, 'message': ''}
+def countries_data():
+     resp = {'status': 200, 'data': {}, 'message': ''}
      countries_list = []
-     countries = models.Country.objects.all() 
-     for c in countries:
-         countries_list.append({'country_name' : c.printable_name, 'country_code' : c.iso_3166_1_a2 })
+     for name, code in models.Country.objects.values_list('printable_name', 'iso_3166_1_a2'):
+         countries_list.append({'country_name' : name, 'country_code' : code })
      resp['data'] = countries_list
-     return HttpResponse(json.dumps(resp), content_type='application/json')
+     return resp
+
+def get_countries(request):
+     return response_cache.cached_json_response(request, 'get_countries', response_cache.countries_etag('get_countries'), countries_data)
+
+@csrf_exempt
+def user_info_id_batch(request, apikey):
+     return batch.batch_response(request, apikey, batch.users)
+
+@csrf_exempt
+def get_invoice_properties_batch(request, apikey):
+     return batch.batch_response(request, apikey, batch.invoices)
+
+@csrf_exempt
+def get_order_info_batch(request, apikey):
+     return batch.batch_response(request, apikey, batch.orders)
+
+@csrf_exempt
+def get_linked_invoice_data_batch(request, apikey):
+     return batch.batch_response(request, apikey, batch.linked_invoice_data)
+
+def response_cache_stats(request):
+     if not (request.user.is_authenticated() and request.user.is_staff):
+         return HttpResponse(json.dumps({'status': 403, 'message': 'Access Forbidden'}), content_type='application/json', status=403)
+     return HttpResponse(json.dumps({'status': 200, 'data': response_cache.cache_stats()}), content_type='application/json')
 
 
 @csrf_exempt
 def cancel_invoice(request,apikey):
     # Due to auth2,  given_name and last_name are auto populated by auth2
     jsondata = {'status': 404, 'message': 'API Key Not Found'}
-    ledger_user_json  = {}
-    if ledgerapi_models.API.objects.filter(api_key=apikey,active=1).count():
+    api_key_obj = ledgerapi_utils.get_api(apikey)
+    if api_key_obj:
         invoice_reference = request.POST.get('invoice_reference','')
-        api_key_obj = ledgerapi_models.API.objects.filter(api_key=apikey,active=1)
-        api_key_obj_update_key = "{} ({}) ".format(api_key_obj[0].system_id,api_key_obj[0].id)       
-        if ledgerapi_utils.api_allow(ledgerapi_utils.get_client_ip(request),apikey) is True:
+        api_key_obj_update_key = "{} ({}) ".format(api_key_obj.system_id,api_key_obj.id)       
+        if ledgerapi_utils.authorize(request, api_key_obj) is True:
             ois_obj = {}
             try:
                     if Invoice.objects.filter(reference=invoice_reference, voided=False).count() > 0:                                    
@@ -1947,14 +1764,13 @@ def cancel_invoice(request,apikey):
 def change_user_invoice_ownership(request,apikey):
     # Due to auth2,  given_name and last_name are auto populated by auth2
     jsondata = {'status': 404, 'message': 'API Key Not Found'}
-    ledger_user_json  = {}
-    if ledgerapi_models.API.objects.filter(api_key=apikey,active=1).count():
+    api_key_obj = ledgerapi_utils.get_api(apikey)
+    if api_key_obj:
         current_email = request.POST.get('current_email','')
         new_email = request.POST.get('new_email','')
         print (new_email)
-        api_key_obj = ledgerapi_models.API.objects.filter(api_key=apikey,active=1)
-        api_key_obj_update_key = "{} ({}) ".format(api_key_obj[0].system_id,api_key_obj[0].id)        
-        if ledgerapi_utils.api_allow(ledgerapi_utils.get_client_ip(request),apikey) is True:
+        api_key_obj_update_key = "{} ({}) ".format(api_key_obj.system_id,api_key_obj.id)        
+        if ledgerapi_utils.authorize(request, api_key_obj) is True:
             ois_obj = {}
             try:    
                     eu = models.EmailUser.objects.filter(email__iexact=current_email)
@@ -1967,7 +1783,7 @@ def change_user_invoice_ownership(request,apikey):
                             invoices = Invoice.objects.filter(order_number=order.number)
                             for invoice in invoices:
                                 invoice_systemid = invoice.reference[0:4]
-                                if api_key_obj[0].system_id == invoice_systemid:  
+                                if api_key_obj.system_id == invoice_systemid:  
                                     print ("Found Invoice :{} to change user ownership".format(invoice.reference))                                                               
                                     order.user = ne[0]
                                     order.save()
@@ -1994,11 +1810,10 @@ def change_user_invoice_ownership(request,apikey):
 def create_get_emailuser(request,apikey):
     # Due to auth2,  given_name and last_name are auto populated by auth2
     jsondata = {'status': 404, 'message': 'API Key Not Found'}
-    ledger_user_json  = {}
-    if ledgerapi_models.API.objects.filter(api_key=apikey,active=1).count():
-        api_key_obj = ledgerapi_models.API.objects.filter(api_key=apikey,active=1)
-        api_key_obj_update_key = "{} ({}) ".format(api_key_obj[0].system_id,api_key_obj[0].id)        
-        if ledgerapi_utils.api_allow(ledgerapi_utils.get_client_ip(request),apikey) is True:
+    api_key_obj = ledgerapi_utils.get_api(apikey)
+    if api_key_obj:
+        api_key_obj_update_key = "{} ({}) ".format(api_key_obj.system_id,api_key_obj.id)        
+        if ledgerapi_utils.authorize(request, api_key_obj) is True:
             ois_obj = {}
             try:
                 data = json.loads(request.POST.get('data', "{}"))
@@ -2056,9 +1871,9 @@ def create_get_emailuser(request,apikey):
 @csrf_exempt
 def create_organisation(request,apikey):
     jsondata = {'status': 404, 'message': 'API Key Not Found'}
-    ledger_user_json  = {}
-    if ledgerapi_models.API.objects.filter(api_key=apikey,active=1).count():
-        if ledgerapi_utils.api_allow(ledgerapi_utils.get_client_ip(request),apikey) is True:
+    api_key_obj = ledgerapi_utils.get_api(apikey)
+    if api_key_obj:
+        if ledgerapi_utils.authorize(request, api_key_obj) is True:
             ois_obj = {}
             try:
                 data = json.loads(request.POST.get('data', "{}"))
@@ -2086,9 +1901,9 @@ def create_organisation(request,apikey):
 @csrf_exempt
 def update_organisation(request,apikey):
     jsondata = {'status': 404, 'message': 'API Key Not Found'}
-    ledger_user_json  = {}
-    if ledgerapi_models.API.objects.filter(api_key=apikey,active=1).count():
-        if ledgerapi_utils.api_allow(ledgerapi_utils.get_client_ip(request),apikey) is True:
+    api_key_obj = ledgerapi_utils.get_api(apikey)
+    if api_key_obj:
+        if ledgerapi_utils.authorize(request, api_key_obj) is True:
             ois_obj = {}
             data = json.loads(request.POST.get('data', "{}"))            
             organisation_id = None
@@ -2221,9 +2036,9 @@ def update_organisation(request,apikey):
 @csrf_exempt
 def get_organisation(request,apikey):
     jsondata = {'status': 404, 'message': 'API Key Not Found'}
-    ledger_user_json  = {}
-    if ledgerapi_models.API.objects.filter(api_key=apikey,active=1).count():
-        if ledgerapi_utils.api_allow(ledgerapi_utils.get_client_ip(request),apikey) is True:
+    api_key_obj = ledgerapi_utils.get_api(apikey)
+    if api_key_obj:
+        if ledgerapi_utils.authorize(request, api_key_obj) is True:
             ois_obj = {}
             data = json.loads(request.POST.get('data', "{}"))
             organisation_id = data['organisation_id']          
@@ -2286,39 +2101,50 @@ def get_organisation(request,apikey):
     response = HttpResponse(json.dumps(jsondata), content_type='application/json')
     return response   
 
+# next_cursor of a response that wasn't paged
+NOT_PAGED = object()
+
+def organisation_rows(queryset, data):
+    ''' A page of organisations when the client sent a cursor or limit,
+        otherwise every organisation as before paging was added.
+    '''
+    if 'cursor' in data or 'limit' in data:
+        return projections.OrganisationProjection().page(queryset, data.get('cursor'), data.get('limit'))
+    return projections.OrganisationProjection().rows(queryset), NOT_PAGED
+
 @csrf_exempt
 def get_all_organisation(request,apikey):
     jsondata = {'status': 404, 'message': 'API Key Not Found'}
-    ledger_user_json  = {}
-    if ledgerapi_models.API.objects.filter(api_key=apikey,active=1).count():
-        if ledgerapi_utils.api_allow(ledgerapi_utils.get_client_ip(request),apikey) is True:
-            ois_obj = {}
-            org_array = []
-            data = json.loads(request.POST.get('data', "{}"))           
-            org_obj = models.Organisation.objects.all()
-            for o in org_obj:
-                org_row = {'organisation_id': o.id, "organisation_name": o.name, "organisation_abn": o.abn, "organisation_email": o.email}
-                org_array.append(org_row)
-
-            jsondata['status'] = 200
-            jsondata['message'] = 'Success'
-            jsondata['data'] = org_array
+    api_key_obj = ledgerapi_utils.get_api(apikey)
+    if api_key_obj:
+        if ledgerapi_utils.authorize(request, api_key_obj) is True:
+            data = json.loads(request.POST.get('data', "{}"))
+            try:
+                org_array, next_cursor = organisation_rows(models.Organisation.objects.all(), data)
+                jsondata['status'] = 200
+                jsondata['message'] = 'Success'
+                jsondata['data'] = org_array
+                if next_cursor is not NOT_PAGED:
+                    jsondata['next_cursor'] = next_cursor
+            except ValueError:
+                jsondata['status'] = 400
+                jsondata['message'] = 'Invalid cursor or limit'
             
         else:
             jsondata['status'] = 403
             jsondata['message'] = 'Access Forbidden'
     else:
         pass
-    response = HttpResponse(json.dumps(jsondata), content_type='application/json')
+    response = projections.json_response(jsondata)
     return response       
 
 @csrf_exempt
 def get_search_organisation(request,apikey):
     jsondata = {'status': 404, 'message': 'API Key Not Found'}
-    ledger_user_json  = {}
       
-    if ledgerapi_models.API.objects.filter(api_key=apikey,active=1).count():
-        if ledgerapi_utils.api_allow(ledgerapi_utils.get_client_ip(request),apikey) is True:
+    api_key_obj = ledgerapi_utils.get_api(apikey)
+    if api_key_obj:
+        if ledgerapi_utils.authorize(request, api_key_obj) is True:
             ois_obj = {}
             org_array = []
             data = json.loads(request.POST.get('data', "{}"))
@@ -2329,18 +2155,21 @@ def get_search_organisation(request,apikey):
                 search_filter = Q(name__icontains=organisation_name)
             if organisation_abn:
                 search_filter = Q(abn__icontains=organisation_abn)                            
-            org_obj = models.Organisation.objects.filter(search_filter)
-            
-            if org_obj.count() > 0:
-                    for o in org_obj:
-                        org_row = {'organisation_id': o.id, "organisation_name": o.name, "organisation_abn": o.abn, "organisation_email": o.email}
-                        org_array.append(org_row)
+            try:
+                org_array, next_cursor = organisation_rows(models.Organisation.objects.filter(search_filter), data)
+            except ValueError:
+                org_array, next_cursor = None, None
+                jsondata['status'] = 400
+                jsondata['message'] = 'Invalid cursor or limit'
 
+            if org_array:
                     jsondata['status'] = 200
                     jsondata['message'] = 'Success'
                     jsondata['data'] = org_array
+                    if next_cursor is not NOT_PAGED:
+                        jsondata['next_cursor'] = next_cursor
 
-            else:
+            elif org_array is not None:
                     jsondata['status'] = 404
                     jsondata['message'] = 'Not found '
                     jsondata['data'] = {}
@@ -2351,7 +2180,7 @@ def get_search_organisation(request,apikey):
             jsondata['message'] = 'Access Forbidden'
     else:
         pass
-    response = HttpResponse(json.dumps(jsondata), content_type='application/json')
+    response = projections.json_response(jsondata)
     return response   
 
 def QueuePayemntAuditReportJob(request, *args, **kwargs):
@@ -2401,11 +2230,11 @@ def QueuePayemntAuditReportJob(request, *args, **kwargs):
 @csrf_exempt
 def update_ledger_oracle_invoice(request,apikey):
     jsondata = {'status': 404, 'message': 'API Key Not Found'}
-    ledger_user_json  = {}
     print ('update_ledger_oracle_invoice')
-    if ledgerapi_models.API.objects.filter(api_key=apikey,active=1).count():
+    api_key_obj = ledgerapi_utils.get_api(apikey)
+    if api_key_obj:
         
-        if ledgerapi_utils.api_allow(ledgerapi_utils.get_client_ip(request),apikey) is True:
+        if ledgerapi_utils.authorize(request, api_key_obj) is True:
         
             ois_obj = {}
             org_array = []
@@ -2453,11 +2282,11 @@ def update_ledger_oracle_invoice(request,apikey):
 @csrf_exempt
 def check_oracle_code(request,apikey):
     jsondata = {'status': 404, 'message': 'API Key Not Found'}
-    ledger_user_json  = {}
     print ('update_ledger_oracle_invoice')
-    if ledgerapi_models.API.objects.filter(api_key=apikey,active=1).count():
+    api_key_obj = ledgerapi_utils.get_api(apikey)
+    if api_key_obj:
         
-        if ledgerapi_utils.api_allow(ledgerapi_utils.get_client_ip(request),apikey) is True:
+        if ledgerapi_utils.authorize(request, api_key_obj) is True:
             try:
                 oracle_code = request.POST.get('oracle_code','')
                 print (oracle_code)
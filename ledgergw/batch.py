@@ -0,0 +1,179 @@
+'''
+    Batch versions of the per item gateway lookups.
+
+    A client system passes a list of ids in data and gets one result per id
+    back, in the order given:
+
+        {'status': 200, 'message': 'Success', 'data': {'results': [
+            {'key': 12, 'status': 200, 'data': {...}},
+            {'key': 13, 'status': 404, 'message': 'Not found'},
+        ]}}
+
+    The api key is checked and data decoded once per request and each kind
+    of id is resolved with a fixed number of set based queries.
+    LEDGERGW_API_MAX_BATCH_SIZE limits the ids per request.
+'''
+
+import json
+from decimal import Decimal
+
+from django.conf import settings
+from django.db.models import Min, Q
+
+from ledger.accounts.models import EmailUser
+from ledger.api import utils as ledgerapi_utils
+from ledger.order.models import Order
+from ledger.payments import models as payment_models
+from ledger.payments.bpoint.models import BpointTransaction
+from ledger.payments.invoice.models import Invoice
+from ledgergw import projections
+
+
+class BatchError(Exception):
+    pass
+
+
+def max_batch_size():
+    return getattr(settings, 'LEDGERGW_API_MAX_BATCH_SIZE', 200)
+
+def batch_ids(data, name, cast=int):
+    ''' The list of ids in data[name], (valid ids, results for the invalid ones).
+    '''
+    values = data.get(name) or []
+    if not isinstance(values, list):
+        raise BatchError('{} must be a list'.format(name))
+    ids = []
+    invalid = {}
+    for value in values:
+        if isinstance(value, (list, dict)):
+            raise BatchError('{} must be a list of ids'.format(name))
+        try:
+            ids.append(cast(value))
+        except (TypeError, ValueError):
+            invalid[value] = {'key': value, 'status': 400, 'message': 'Invalid id'}
+    return values, ids, invalid
+
+def item_results(values, cast, found, invalid):
+    ''' One result per value in request order from {id: data}.
+    '''
+    results = []
+    for value in values:
+        if value in invalid:
+            results.append(invalid[value])
+            continue
+        key = cast(value)
+        if key in found:
+            results.append({'key': value, 'status': 200, 'data': found[key]})
+        else:
+            results.append({'key': value, 'status': 404, 'message': 'Not found'})
+    return results
+
+def batch_response(request, apikey, build):
+    ''' Check the api key, decode data and check its size, then return build(data) as json.
+    '''
+    jsondata = {'status': 404, 'message': 'API Key Not Found'}
+    api_key_obj = ledgerapi_utils.get_api(apikey)
+    if api_key_obj:
+        if ledgerapi_utils.authorize(request, api_key_obj) is True:
+            try:
+                data = json.loads(request.POST.get('data', "{}"))
+                if not isinstance(data, dict):
+                    raise BatchError('data must be an object')
+                size = sum(len(v) for v in data.values() if isinstance(v, list))
+                if size > max_batch_size():
+                    raise BatchError('At most {} ids per request, got {}'.format(max_batch_size(), size))
+                jsondata = {'status': 200, 'message': 'Success', 'data': {'results': build(data)}}
+            except (ValueError, BatchError) as e:
+                jsondata = {'status': 400, 'message': str(e)}
+        else:
+            jsondata['status'] = 403
+            jsondata['message'] = 'Access Forbidden'
+    return projections.json_response(jsondata)
+
+
+# Lookups
+# =============================================
+def users(data):
+    ''' user_info_id for data.user_ids '''
+    values, ids, invalid = batch_ids(data, 'user_ids')
+    found = {}
+    for row in projections.UserDetailProjection().rows(EmailUser.objects.filter(id__in=ids)):
+        found[row['ledgerid']] = {'user': row}
+    return item_results(values, int, found, invalid)
+
+def invoices(data):
+    ''' get_invoice_properties for data.invoice_ids '''
+    values, ids, invalid = batch_ids(data, 'invoice_ids')
+    found = {}
+    for row in projections.InvoiceProjection().rows(Invoice.objects.filter(id__in=ids)):
+        found[row['id']] = {'invoice': row}
+    return item_results(values, int, found, invalid)
+
+def orders(data):
+    ''' get_order_info for data.numbers and data.basket_ids '''
+    numbers, number_ids, number_invalid = batch_ids(data, 'numbers', str)
+    baskets, basket_ids, basket_invalid = batch_ids(data, 'basket_ids')
+    by_number = {}
+    by_basket = {}
+    for order_id, number, user_id, basket_id in Order.objects.filter(
+        Q(number__in=number_ids) | Q(basket_id__in=basket_ids)
+    ).values_list('id', 'number', 'user_id', 'basket_id'):
+        order = {'order': {'id': order_id, 'number': number, 'user_id': user_id}}
+        by_number[number] = order
+        if basket_id is not None:
+            by_basket[basket_id] = order
+    return item_results(numbers, str, by_number, number_invalid) + item_results(baskets, int, by_basket, basket_invalid)
+
+def linked_invoice_data(data):
+    ''' get_linked_invoice_data_by_booking_reference for data.booking_references of data.system_id '''
+    if not data.get('system_id'):
+        raise BatchError('system_id is required')
+    values, references, invalid = batch_ids(data, 'booking_references', str)
+    ois = payment_models.OracleInterfaceSystem.objects.filter(system_id=data['system_id']).first()
+    if ois is None:
+        raise BatchError('Unknown system_id')
+    linked = payment_models.LinkedInvoice.objects.filter(system_identifier=ois)
+
+    # The group of each booking is taken from its first link by id, like
+    # get_linked_invoice_data_by_booking_reference
+    groups = dict(
+        linked.filter(booking_reference__in=references).values('booking_reference')
+        .annotate(first=Min('id')).values_list('booking_reference', 'first')
+    )
+    first_links = dict(linked.filter(id__in=groups.values()).values_list('id', 'invoice_group_id'))
+    booking_groups = dict((booking, first_links[link]) for booking, link in groups.items())
+
+    group_invoices = {}
+    for group_id, invoice_reference in linked.filter(invoice_group_id__in=set(booking_groups.values())).values_list('invoice_group_id', 'invoice_reference'):
+        group_invoices.setdefault(group_id, set()).add(invoice_reference)
+    transactions = {}
+    all_references = set(r for refs in group_invoices.values() for r in refs)
+    for bp in BpointTransaction.objects.filter(crn1__in=all_references).order_by('id'):
+        transactions.setdefault(bp.crn1, []).append(bp)
+
+    found = {}
+    for booking, group_id in booking_groups.items():
+        txns = [bp for r in group_invoices.get(group_id, ()) for bp in transactions.get(r, [])]
+        txns.sort(key=lambda bp: bp.id)
+        found[booking] = linked_payment_data(txns)
+    return item_results(values, str, found, invalid)
+
+def linked_payment_data(bp_trans):
+    ''' The totals get_linked_invoice_data works out from the bpoint transactions of a group.
+    '''
+    linked_payment_data = {'total_available': '0.00', 'txn_pool': {}}
+    total_available = Decimal('0.00')
+    for bp in bp_trans:
+        if bp.action == 'payment':
+            if bp.txn_number not in linked_payment_data['txn_pool']:
+                linked_payment_data['txn_pool'][bp.txn_number] = Decimal('0.00')
+            total_available = total_available + bp.amount
+            linked_payment_data['txn_pool'][bp.txn_number] = linked_payment_data['txn_pool'][bp.txn_number] + bp.amount
+
+        if bp.action == 'refund':
+            if bp.original_txn not in linked_payment_data['txn_pool']:
+                linked_payment_data['txn_pool'][bp.original_txn] = Decimal('0.00')
+            total_available = total_available - bp.amount
+            linked_payment_data['txn_pool'][bp.original_txn] = linked_payment_data['txn_pool'][bp.original_txn] - bp.amount
+    linked_payment_data['total_available'] = str(total_available)
+    return linked_payment_data
@@ -0,0 +1,310 @@
+'''
+    Two level cache backend.
+
+    L1 is a bounded LRU held in each process, L2 is another configured cache
+    (file, database or memcached) shared by every node. Reads are served
+    from L1 when possible, writes go to L2 and are recorded in a short
+    invalidation log kept in L2. Every COHERENCY_INTERVAL seconds each
+    process reads the log and drops the L1 entries written elsewhere, so a
+    value is never stale on another node for longer than that. Values are
+    stored in L2 with their expiry, so a copy taken into L1 from L2 never
+    outlives the L2 entry.
+
+    CACHES = {
+        'default': {
+            'BACKEND': 'ledgergw.cache.TieredCache',
+            'OPTIONS': {'SHARED': 'shared', 'MAX_ENTRIES': 1000, 'L1_TIMEOUT': 300, 'COHERENCY_INTERVAL': 1},
+        },
+        'shared': {...},
+    }
+'''
+import pickle
+import re
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from django.core.cache import caches
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
+
+SEQ_KEY = 'tieredcache:seq'
+LOG_KEY = 'tieredcache:log:{}'
+# Log entries older than this are gone, a process that has not synced for
+# longer clears its whole L1
+LOG_TIMEOUT = 600
+# Marker in the log for cache.clear()
+CLEAR_ALL = '*'
+
+_MISSING = object()
+
+# What is stored in L2, expiry is a time.time() or None for no expiry
+_Stored = namedtuple('_Stored', ['value', 'expiry'])
+
+
+def key_prefix(key):
+    ''' Statistics are kept per prefix, the part of the key before the first : or .
+    '''
+    return re.match(r'[^:.]*', str(key)).group(0) or str(key)
+
+
+class TieredCache(BaseCache):
+
+    def __init__(self, location, params):
+        super(TieredCache, self).__init__(params)
+        options = params.get('OPTIONS', {})
+        self._shared_alias = options.get('SHARED', 'shared')
+        self._max_l1_entries = int(options.get('MAX_ENTRIES', 1000))
+        self._l1_timeout = float(options.get('L1_TIMEOUT', 300))
+        self._interval = float(options.get('COHERENCY_INTERVAL', 1))
+        self._lock = threading.RLock()
+        # l1 key -> (pickled value, expiry)
+        self._l1 = OrderedDict()
+        self._seq = None
+        self._synced = 0
+        self._published = set()
+        self._stats = {}
+
+    @property
+    def shared(self):
+        return caches[self._shared_alias]
+
+    # Statistics
+    # =============================================
+    def _record(self, key, counter, elapsed=None):
+        with self._lock:
+            row = self._stats.setdefault(key_prefix(key), {'l1_hits': 0, 'l2_hits': 0, 'misses': 0, 'writes': 0, 'l2_calls': 0, 'l2_time': 0.0})
+            row[counter] += 1
+            if elapsed is not None:
+                row['l2_calls'] += 1
+                row['l2_time'] += elapsed
+
+    def stats(self):
+        ''' Hit rates and average shared cache latency (ms) of this process per key prefix.
+        '''
+        with self._lock:
+            stats = {}
+            for prefix, row in self._stats.items():
+                row = dict(row)
+                lookups = row['l1_hits'] + row['l2_hits'] + row['misses']
+                row['hit_rate'] = float(row['l1_hits'] + row['l2_hits']) / lookups if lookups else 0.0
+                row['l1_hit_rate'] = float(row['l1_hits']) / lookups if lookups else 0.0
+                row['l2_latency_ms'] = row['l2_time'] * 1000 / row['l2_calls'] if row['l2_calls'] else 0.0
+                stats[prefix] = row
+            stats['l1_entries'] = len(self._l1)
+            return stats
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats.clear()
+
+    # L1
+    # =============================================
+    def _l1_get(self, l1key):
+        with self._lock:
+            entry = self._l1.get(l1key)
+            if entry is None:
+                return _MISSING
+            if entry[1] is not None and entry[1] <= time.time():
+                del self._l1[l1key]
+                return _MISSING
+            self._l1.move_to_end(l1key)
+        return pickle.loads(entry[0])
+
+    def _l1_set(self, l1key, value, backend_expiry):
+        expiry = time.time() + self._l1_timeout
+        if backend_expiry is not None:
+            expiry = min(expiry, backend_expiry)
+        pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._l1[l1key] = (pickled, expiry)
+            self._l1.move_to_end(l1key)
+            while len(self._l1) > self._max_l1_entries:
+                self._l1.popitem(last=False)
+
+    def _l1_delete(self, l1keys):
+        with self._lock:
+            if CLEAR_ALL in l1keys:
+                self._l1.clear()
+                return
+            for l1key in l1keys:
+                self._l1.pop(l1key, None)
+
+    # L2
+    # =============================================
+    def _stored(self, value, timeout):
+        return _Stored(value, self.get_backend_timeout(timeout))
+
+    def _unstored(self, stored):
+        ''' (value, expiry) of an L2 entry, entries not written through this
+            backend are kept in L1 for at most L1_TIMEOUT.
+        '''
+        if isinstance(stored, _Stored):
+            return stored.value, stored.expiry
+        return stored, None
+
+    # Coherency
+    # =============================================
+    def _sync(self):
+        ''' Drop the L1 entries written by other processes since the last sync.
+        '''
+        now = time.time()
+        if now - self._synced < self._interval:
+            return
+        self._synced = now
+        seq = self.shared.get(SEQ_KEY) or 0
+        with self._lock:
+            last = self._seq
+            self._seq = seq
+        if last is None or seq == last:
+            return
+        if seq < last:
+            # Two writers raced on the sequence, start again
+            self._l1_delete([CLEAR_ALL])
+            return
+        wanted = [n for n in range(last + 1, seq + 1) if n not in self._published]
+        logged = self.shared.get_many([LOG_KEY.format(n) for n in wanted])
+        if len(logged) < len(wanted):
+            # Entries expired before we got to them
+            self._l1_delete([CLEAR_ALL])
+            return
+        for l1keys in logged.values():
+            self._l1_delete(l1keys)
+
+    def _publish(self, l1keys):
+        ''' Tell the other processes these keys changed.
+        '''
+        seq = (self.shared.get(SEQ_KEY) or 0) + 1
+        while not self.shared.add(LOG_KEY.format(seq), list(l1keys), LOG_TIMEOUT):
+            seq += 1
+        self.shared.set(SEQ_KEY, seq, None)
+        with self._lock:
+            self._published.add(seq)
+            if len(self._published) > 10000:
+                self._published = set(n for n in self._published if n > seq - 1000)
+
+    # Cache API
+    # =============================================
+    def get(self, key, default=None, version=None):
+        l1key = self.make_key(key, version=version)
+        self.validate_key(l1key)
+        self._sync()
+        value = self._l1_get(l1key)
+        if value is not _MISSING:
+            self._record(key, 'l1_hits')
+            return value
+        started = time.time()
+        stored = self.shared.get(key, _MISSING, version=version)
+        if stored is _MISSING:
+            self._record(key, 'misses', time.time() - started)
+            return default
+        self._record(key, 'l2_hits', time.time() - started)
+        value, expiry = self._unstored(stored)
+        self._l1_set(l1key, value, expiry)
+        return value
+
+    def get_many(self, keys, version=None):
+        self._sync()
+        found = {}
+        remaining = []
+        for key in keys:
+            value = self._l1_get(self.make_key(key, version=version))
+            if value is _MISSING:
+                remaining.append(key)
+            else:
+                self._record(key, 'l1_hits')
+                found[key] = value
+        if remaining:
+            started = time.time()
+            shared = self.shared.get_many(remaining, version=version)
+            elapsed = (time.time() - started) / len(remaining)
+            for key in remaining:
+                if key in shared:
+                    self._record(key, 'l2_hits', elapsed)
+                    value, expiry = self._unstored(shared[key])
+                    self._l1_set(self.make_key(key, version=version), value, expiry)
+                    found[key] = value
+                else:
+                    self._record(key, 'misses', elapsed)
+        return found
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        l1key = self.make_key(key, version=version)
+        self.validate_key(l1key)
+        stored = self._stored(value, timeout)
+        started = time.time()
+        self.shared.set(key, stored, timeout, version=version)
+        self._record(key, 'writes', time.time() - started)
+        self._publish([l1key])
+        self._l1_set(l1key, value, stored.expiry)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        l1key = self.make_key(key, version=version)
+        self.validate_key(l1key)
+        stored = self._stored(value, timeout)
+        started = time.time()
+        added = self.shared.add(key, stored, timeout, version=version)
+        self._record(key, 'writes', time.time() - started)
+        if added:
+            self._publish([l1key])
+            self._l1_set(l1key, value, stored.expiry)
+        return added
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        expiry = self.get_backend_timeout(timeout)
+        started = time.time()
+        failed = self.shared.set_many(dict((key, _Stored(value, expiry)) for key, value in data.items()), timeout, version=version) or []
+        elapsed = (time.time() - started) / max(len(data), 1)
+        l1keys = []
+        for key, value in data.items():
+            self._record(key, 'writes', elapsed)
+            l1key = self.make_key(key, version=version)
+            l1keys.append(l1key)
+            if key not in failed:
+                self._l1_set(l1key, value, expiry)
+        if l1keys:
+            self._publish(l1keys)
+        return failed
+
+    def delete(self, key, version=None):
+        l1key = self.make_key(key, version=version)
+        self.validate_key(l1key)
+        started = time.time()
+        self.shared.delete(key, version=version)
+        self._record(key, 'writes', time.time() - started)
+        self._l1_delete([l1key])
+        self._publish([l1key])
+
+    def delete_many(self, keys, version=None):
+        keys = list(keys)
+        if not keys:
+            return
+        self.shared.delete_many(keys, version=version)
+        l1keys = [self.make_key(key, version=version) for key in keys]
+        self._l1_delete(l1keys)
+        self._publish(l1keys)
+
+    def incr(self, key, delta=1, version=None):
+        # Read and write back like BaseCache.incr, the shared backend can't
+        # increment the stored value in place
+        stored = self.shared.get(key, _MISSING, version=version)
+        if stored is _MISSING:
+            raise ValueError("Key '%s' not found" % key)
+        value, expiry = self._unstored(stored)
+        value += delta
+        timeout = None if expiry is None else max(expiry - time.time(), 0.001)
+        self.shared.set(key, _Stored(value, expiry), timeout, version=version)
+        l1key = self.make_key(key, version=version)
+        self._l1_delete([l1key])
+        self._publish([l1key])
+        return value
+
+    def has_key(self, key, version=None):
+        return self.get(key, _MISSING, version=version) is not _MISSING
+
+    def clear(self):
+        self.shared.clear()
+        self._l1_delete([CLEAR_ALL])
+        # The log went with it, sequence numbers start again
+        with self._lock:
+            self._published = set()
+        self._publish([CLEAR_ALL])
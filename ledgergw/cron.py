@@ -2,10 +2,8 @@ from datetime import date, timedelta, datetime
 from django_cron import CronJobBase, Schedule
 from ledgergw import utils as ledgergw_utils
 from ledger.payments import models as ledger_payment_models 
-from django.core import management
-from ledgergw import models as ledgergw_models
+from ledgergw import jobs as ledgergw_jobs
 from datetime import datetime
-import json
 import traceback
 
 class OracleReceipts(CronJobBase):
@@ -36,37 +34,36 @@ class JobQueue(CronJobBase):
     code = "ledgergw.ledger_job"
 
     def do(self) -> None:
-        """Perform the Scanner Cron Job."""
+        """Perform the Scanner Cron Job.
+
+        Fallback for hosts without a job_queue_worker, jobs are claimed
+        with the same row locks and leases so they never run twice.
+        """
         # Run Management Command
         cron_response = ""
-        job_queue = ledgergw_models.JobQueue.objects.filter(status=0)[:3]
-        for jq in job_queue:
-            print (jq.job_cmd)
-            jq.status = 1
-            jq.save()
-            params_array = []
-            try:
-                params_array = json.loads(jq.parameters_json)
-            except Exception as e:
-                print (e)
-            print (params_array)   
-            try:     
-
-                if len(params_array) == 1:
-                    management.call_command(jq.job_cmd, params_array[0])
-                else:
-                    management.call_command(jq.job_cmd, params_array[0], params_array[1])
-                print ("Job Completed {}".format(str(jq.id)))                
-                jq.processed_dt = datetime.now()
-                jq.status = 2
-                jq.save()
-            except Exception as e:                
-                print (e)
-                jq.status = 3
-                jq.save()
-                tb = traceback.format_exc()
-                cron_response = cron_response + str(tb)
+        worker = ledgergw_jobs.worker_name()
+        for job_id in ledgergw_jobs.claim_jobs(worker, 3):
+            error = ledgergw_jobs.run_job(job_id, worker)
+            if error:
+                cron_response = cron_response + str(error)
         
         return cron_response
 
 
+class InvoicePDFCacheEviction(CronJobBase):
+    RUN_AT_TIMES = ['03:00']
+
+    schedule = Schedule(run_at_times=RUN_AT_TIMES)
+    code = 'ledgergw.invoice_pdf_cache_eviction'
+
+    def do(self):
+        from ledger.payments import pdf as ledger_payment_pdf
+        cron_response = "Success"
+        try:
+            removed = ledger_payment_pdf.evict_invoice_pdf_cache()
+            cron_response = "Removed {} cached invoices".format(removed)
+        except Exception as e:
+            print (e)
+            cron_response = str(traceback.format_exc())
+
+        return cron_response
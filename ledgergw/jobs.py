@@ -0,0 +1,161 @@
+import json
+import logging
+import os
+import resource
+import socket
+import threading
+import time
+import traceback
+import multiprocessing
+from datetime import timedelta
+
+from django.conf import settings
+from django.core import management
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+# Models are imported inside the functions, this module is loaded by spawned
+# pool processes before django.setup() has run.
+
+logger = logging.getLogger(__name__)
+
+def lease_seconds():
+    return getattr(settings, 'JOB_QUEUE_LEASE_SECONDS', 300)
+
+def heartbeat_seconds():
+    return getattr(settings, 'JOB_QUEUE_HEARTBEAT_SECONDS', 30)
+
+def worker_name():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+def retry_delay(attempts):
+    ''' Exponential backoff before a failed job is picked up again.
+    '''
+    backoff = getattr(settings, 'JOB_QUEUE_RETRY_BACKOFF_SECONDS', 60)
+    return timedelta(seconds=backoff * (2 ** max(attempts - 1, 0)))
+
+def job_parameters(job):
+    params_array = []
+    try:
+        params_array = json.loads(job.parameters_json)
+    except Exception:
+        logger.exception('Job {} has invalid parameters'.format(job.id))
+    return params_array
+
+def claim_jobs(worker, limit):
+    ''' Lock and lease up to limit runnable jobs for this worker, returns their ids.
+
+        Pending jobs past their retry time and running jobs whose lease has
+        expired (the worker died) are runnable. Running jobs without a lease
+        were left by the cron before leases and are not picked up again, see
+        migration 0010. Rows locked by another worker are skipped so several
+        workers can claim at once.
+    '''
+    from ledgergw import models as ledgergw_models
+    now = timezone.now()
+    claimed = []
+    with transaction.atomic():
+        job_queue = ledgergw_models.JobQueue.objects.select_for_update(skip_locked=True).filter(
+            Q(status=0, run_after_dt__isnull=True) | Q(status=0, run_after_dt__lte=now) |
+            Q(status=1, lease_expiry_dt__lt=now)
+        ).order_by('id')[:limit]
+        for jq in job_queue:
+            if jq.status == 1 and jq.attempts >= jq.max_attempts:
+                jq.status = 3
+                jq.processed_dt = now
+                jq.lease_expiry_dt = None
+                jq.error = 'Lease expired on {}'.format(jq.worker)
+                jq.save()
+                continue
+            jq.status = 1
+            jq.attempts += 1
+            jq.worker = worker
+            jq.started_dt = now
+            jq.heartbeat_dt = now
+            jq.lease_expiry_dt = now + timedelta(seconds=lease_seconds())
+            jq.save()
+            claimed.append(jq.id)
+    return claimed
+
+def lease_lost(job_id, worker):
+    ''' True once the job is no longer running under this worker's lease.
+    '''
+    from ledgergw import models as ledgergw_models
+    return not ledgergw_models.JobQueue.objects.filter(id=job_id, worker=worker, status=1, lease_expiry_dt__gte=timezone.now()).exists()
+
+class Heartbeat(threading.Thread):
+    ''' Extends the lease of a running job until stopped.
+    '''
+    def __init__(self, job_id, worker):
+        super(Heartbeat, self).__init__()
+        self.daemon = True
+        self.job_id = job_id
+        self.worker = worker
+        self.stopped = threading.Event()
+
+    def run(self):
+        from ledgergw import models as ledgergw_models
+        try:
+            while not self.stopped.wait(heartbeat_seconds()):
+                now = timezone.now()
+                ledgergw_models.JobQueue.objects.filter(id=self.job_id, worker=self.worker, status=1).update(
+                    heartbeat_dt=now, lease_expiry_dt=now + timedelta(seconds=lease_seconds())
+                )
+        finally:
+            connection.close()
+
+def run_job(job_id, worker, record_peak_memory=False):
+    ''' Run a claimed job and record its outcome and runtime. Returns the
+        traceback when the job failed.
+
+        The peak memory is only meaningful in a process that runs this one
+        job (see worker_pool), elsewhere it is left empty.
+    '''
+    from ledgergw import models as ledgergw_models
+    jq = ledgergw_models.JobQueue.objects.get(id=job_id)
+    logger.info('Running Job {} {} {}'.format(jq.id, jq.job_cmd, jq.parameters_json))
+
+    heartbeat = Heartbeat(jq.id, worker)
+    heartbeat.start()
+    started = time.time()
+    error = None
+    try:
+        management.call_command(jq.job_cmd, *job_parameters(jq))
+    except Exception:
+        error = traceback.format_exc()
+        logger.error('Job {} failed on attempt {}\n{}'.format(jq.id, jq.attempts, error))
+    finally:
+        heartbeat.stopped.set()
+        heartbeat.join()
+
+    now = timezone.now()
+    outcome = {
+        'runtime': time.time() - started,
+        # ru_maxrss is kilobytes on linux, for the whole process
+        'peak_memory': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if record_peak_memory else None,
+        'heartbeat_dt': now,
+        'lease_expiry_dt': None,
+        'error': error,
+    }
+    if error is None:
+        logger.info('Job Completed {}'.format(jq.id))
+        outcome.update(status=2, processed_dt=now)
+    elif jq.attempts < jq.max_attempts:
+        outcome.update(status=0, run_after_dt=now + retry_delay(jq.attempts))
+    else:
+        outcome.update(status=3, processed_dt=now)
+    # Only record the outcome if the lease was not taken over in the meantime
+    ledgergw_models.JobQueue.objects.filter(id=jq.id, worker=worker, status=1).update(**outcome)
+    return error
+
+def _setup_worker():
+    import django
+    django.setup()
+
+def worker_pool(processes):
+    ''' Pool of freshly spawned processes, one job per process so the peak
+        memory recorded belongs to that job alone.
+    '''
+    context = multiprocessing.get_context('spawn')
+    return context.Pool(processes, initializer=_setup_worker, maxtasksperchild=1)
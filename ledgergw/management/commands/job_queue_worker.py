@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand
+from django.conf import settings
+from ledgergw import jobs as ledgergw_jobs
+import time
+
+class Command(BaseCommand):
+    help = 'Run queued jobs in a pool of worker processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=getattr(settings, 'JOB_QUEUE_PROCESSES', 2), help='Number of jobs run at once')
+        parser.add_argument('--poll', type=float, default=5, help='Seconds between checks for new jobs')
+        parser.add_argument('--once', action='store_true', help='Exit once no jobs are pending or running')
+
+    def handle(self, *args, **options):
+        processes = options['processes']
+        worker = ledgergw_jobs.worker_name()
+        pool = ledgergw_jobs.worker_pool(processes)
+        running = {}
+        self.stdout.write('Job queue worker {} started with {} processes'.format(worker, processes))
+        try:
+            while True:
+                for job_id, result in list(running.items()):
+                    if result.ready():
+                        del running[job_id]
+                        try:
+                            error = result.get()
+                        except Exception as e:
+                            error = str(e)
+                        if error:
+                            self.stdout.write(self.style.ERROR('Job {} failed'.format(job_id)))
+                        else:
+                            self.stdout.write(self.style.SUCCESS('Job {} completed'.format(job_id)))
+                    elif ledgergw_jobs.lease_lost(job_id, worker):
+                        # the pool process died without reporting back
+                        del running[job_id]
+                        self.stdout.write(self.style.ERROR('Job {} lost its lease'.format(job_id)))
+
+                free = processes - len(running)
+                if free > 0:
+                    for job_id in ledgergw_jobs.claim_jobs(worker, free):
+                        running[job_id] = pool.apply_async(ledgergw_jobs.run_job, (job_id, worker, True))
+
+                if options['once'] and not running:
+                    break
+                time.sleep(options['poll'])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            pool.close()
+            pool.join()
@@ -60,7 +60,10 @@ class BookingTimerMiddleware(object):
 
 class CacheControlMiddleware(object):
     def process_response(self, request, response):
-        if request.path[:5] == '/api/' or request.path == '/':
+        if response.has_header('ETag'):
+            # Versioned lookups, clients may keep them but must revalidate with If-None-Match
+            response['Cache-Control'] = 'private, no-cache'
+        elif request.path[:5] == '/api/' or request.path == '/':
             response['Cache-Control'] = 'private, no-store'
         elif request.path[:8] == '/static/':
             response['Cache-Control'] = 'public, max-age=86400'
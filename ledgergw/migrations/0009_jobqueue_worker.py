@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 09:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ledgergw', '0008_jobqueue_user'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='jobqueue',
+            name='attempts',
+            field=models.SmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='jobqueue',
+            name='max_attempts',
+            field=models.SmallIntegerField(default=3),
+        ),
+        migrations.AddField(
+            model_name='jobqueue',
+            name='run_after_dt',
+            field=models.DateTimeField(blank=True, default=None, help_text='Retry is held back until this time', null=True),
+        ),
+        migrations.AddField(
+            model_name='jobqueue',
+            name='worker',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='jobqueue',
+            name='started_dt',
+            field=models.DateTimeField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='jobqueue',
+            name='heartbeat_dt',
+            field=models.DateTimeField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='jobqueue',
+            name='lease_expiry_dt',
+            field=models.DateTimeField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='jobqueue',
+            name='runtime',
+            field=models.FloatField(blank=True, default=None, help_text='Seconds', null=True),
+        ),
+        migrations.AddField(
+            model_name='jobqueue',
+            name='peak_memory',
+            field=models.BigIntegerField(blank=True, default=None, help_text='Kilobytes', null=True),
+        ),
+        migrations.AddField(
+            model_name='jobqueue',
+            name='error',
+            field=models.TextField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.utils import timezone
+
+
+def close_interrupted_jobs(apps, schema_editor):
+    ''' Jobs the old cron left running were interrupted part way, they are
+        failed rather than picked up and run again by the leased worker.
+    '''
+    JobQueue = apps.get_model('ledgergw', 'JobQueue')
+    JobQueue.objects.filter(status=1, lease_expiry_dt__isnull=True).update(
+        status=3, processed_dt=timezone.now(), error='Interrupted before the job queue worker was deployed'
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ledgergw', '0009_jobqueue_worker'),
+    ]
+
+    operations = [
+        migrations.RunPython(close_interrupted_jobs, migrations.RunPython.noop),
+    ]
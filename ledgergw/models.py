@@ -65,6 +65,16 @@ class JobQueue(models.Model):
     parameters_json = models.TextField(null=True, blank=True)
     processed_dt = models.DateTimeField(default=None,null=True, blank=True )
     user = models.ForeignKey(settings.AUTH_USER_MODEL,default=None,null=True, blank=True )
+    attempts = models.SmallIntegerField(default=0)
+    max_attempts = models.SmallIntegerField(default=3)
+    run_after_dt = models.DateTimeField(default=None,null=True, blank=True, help_text="Retry is held back until this time")
+    worker = models.CharField(max_length=255, null=True, blank=True)
+    started_dt = models.DateTimeField(default=None,null=True, blank=True )
+    heartbeat_dt = models.DateTimeField(default=None,null=True, blank=True )
+    lease_expiry_dt = models.DateTimeField(default=None,null=True, blank=True )
+    runtime = models.FloatField(default=None,null=True, blank=True, help_text="Seconds")
+    peak_memory = models.BigIntegerField(default=None,null=True, blank=True, help_text="Kilobytes")
+    error = models.TextField(null=True, blank=True)
     created = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
@@ -0,0 +1,178 @@
+'''
+    Resends the payment notifications (basket.notification_url) that the
+    booking systems did not acknowledge at checkout.
+
+    Pending baskets are claimed in batches, notification_next is pushed out
+    while they are being sent so an overlapping run skips them. Each host
+    gets its own connection pool and at most PAYMENT_NOTIFICATION_PER_HOST
+    requests in flight, a host that times out has the rest of its baskets
+    put off until the next attempt instead of holding up the other systems.
+    Results are written back with a few bulk updates per batch.
+'''
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import requests
+from requests.adapters import HTTPAdapter
+from six.moves.urllib.parse import urlparse
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+SENT = 'sent'
+FAILED = 'failed'
+DEFERRED = 'deferred'
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def setting(name, default):
+    return getattr(settings, name, default)
+
+def max_attempts():
+    return setting('PAYMENT_NOTIFICATION_MAX_ATTEMPTS', 5)
+
+def retry_delay(attempts):
+    ''' Exponential backoff before a failed notification is sent again.
+    '''
+    backoff = setting('PAYMENT_NOTIFICATION_BACKOFF_SECONDS', 60)
+    return timedelta(seconds=backoff * (2 ** max(attempts - 1, 0)))
+
+def notification_host(url):
+    try:
+        return urlparse(url).netloc.lower()
+    except ValueError:
+        return ''
+
+def host_session(host):
+    ''' One session, and so one connection pool, per host.
+    '''
+    with _sessions_lock:
+        session = _sessions.get(host)
+        if session is None:
+            per_host = setting('PAYMENT_NOTIFICATION_PER_HOST', 4)
+            session = requests.Session()
+            session.verify = False
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=per_host)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[host] = session
+        return session
+
+def close_sessions():
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+def claim_baskets(limit):
+    ''' Lock and lease up to limit baskets due a notification, returns (id, url) pairs.
+        Rows locked by another run are skipped.
+    '''
+    from ledger.basket.models import Basket
+    now = timezone.now()
+    with transaction.atomic():
+        baskets = list(Basket.objects.select_for_update(skip_locked=True).filter(
+            Q(notification_next__isnull=True) | Q(notification_next__lte=now),
+            notification_completed=False, notification_count__lte=max_attempts(), status='Submitted',
+        ).order_by('notification_next', 'id').values_list('id', 'notification_url')[:limit])
+        lease = now + timedelta(seconds=setting('PAYMENT_NOTIFICATION_LEASE_SECONDS', 300))
+        Basket.objects.filter(id__in=[b[0] for b in baskets]).update(notification_next=lease)
+    return baskets
+
+def send_notification(url):
+    ''' True when the booking system answered 200.
+    '''
+    timeout = (setting('PAYMENT_NOTIFICATION_CONNECT_TIMEOUT', 5), setting('PAYMENT_NOTIFICATION_READ_TIMEOUT', 20))
+    resp = host_session(notification_host(url)).get(url, timeout=timeout)
+    return resp.status_code == 200
+
+def send_lane(lane):
+    ''' Send the notifications of one host in turn, returns {basket id: status}.
+        Once the host times out or refuses the connection the rest are deferred.
+    '''
+    results = {}
+    host_down = False
+    for basket_id, url in lane:
+        if host_down:
+            results[basket_id] = DEFERRED
+            continue
+        try:
+            results[basket_id] = SENT if send_notification(url) else FAILED
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            results[basket_id] = FAILED
+            host_down = True
+        except Exception:
+            results[basket_id] = FAILED
+    return results
+
+def lanes(baskets, per_host):
+    ''' Split the baskets into per_host lanes for each host. Baskets without
+        a usable url are returned separately.
+    '''
+    by_host = {}
+    invalid = []
+    for basket_id, url in baskets:
+        host = notification_host(url) if url and len(url) > 6 else ''
+        if not host:
+            invalid.append(basket_id)
+            continue
+        by_host.setdefault(host, []).append((basket_id, url))
+    result = []
+    for host_baskets in by_host.values():
+        for n in range(min(per_host, len(host_baskets))):
+            result.append(host_baskets[n::per_host])
+    return result, invalid
+
+def save_results(results):
+    ''' Bulk update the baskets: sent ones are completed, failed ones count an
+        attempt and back off, deferred ones wait one backoff step without counting.
+    '''
+    from ledger.basket.models import Basket
+    now = timezone.now()
+    sent = [b for b, s in results.items() if s == SENT]
+    failed = [b for b, s in results.items() if s == FAILED]
+    deferred = [b for b, s in results.items() if s == DEFERRED]
+    with transaction.atomic():
+        if sent:
+            Basket.objects.filter(id__in=sent).update(notification_completed=True)
+        if deferred:
+            Basket.objects.filter(id__in=deferred).update(notification_next=now + retry_delay(1))
+        if failed:
+            # One update per attempt count, the backoff depends on it
+            counts = {}
+            for basket_id, count in Basket.objects.filter(id__in=failed).values_list('id', 'notification_count'):
+                counts.setdefault((count or 0) + 1, []).append(basket_id)
+            for count, ids in counts.items():
+                Basket.objects.filter(id__in=ids).update(notification_count=count, notification_next=now + retry_delay(count))
+
+def dispatch_notifications(workers=None, batch_size=None, max_seconds=None):
+    ''' Send pending notifications until none are due or max_seconds has passed.
+        Returns the number of baskets sent, failed and deferred.
+    '''
+    if workers is None:
+        workers = setting('PAYMENT_NOTIFICATION_WORKERS', 20)
+    if batch_size is None:
+        batch_size = setting('PAYMENT_NOTIFICATION_BATCH_SIZE', 500)
+    per_host = setting('PAYMENT_NOTIFICATION_PER_HOST', 4)
+    started = time.time()
+    totals = {SENT: 0, FAILED: 0, DEFERRED: 0}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while max_seconds is None or time.time() - started < max_seconds:
+            baskets = claim_baskets(batch_size)
+            if not baskets:
+                break
+            batch_lanes, invalid = lanes(baskets, per_host)
+            results = dict((b, FAILED) for b in invalid)
+            for lane_results in executor.map(send_lane, batch_lanes):
+                results.update(lane_results)
+            save_results(results)
+            for status in results.values():
+                totals[status] += 1
+    return totals
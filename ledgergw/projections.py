@@ -0,0 +1,287 @@
+'''
+    Declared payloads for the ledgergw JSON endpoints.
+
+    A Projection lists the keys of a payload and where each value comes
+    from, along with the relations to load for it. Related rows come from
+    select_related, prefetch_related or one query per batch in load(), so a
+    response costs the same number of queries whatever the number of rows.
+
+    Long lists are paged on id, the cursor is the id of the last row of the
+    previous page:
+
+        rows, next_cursor = OrganisationProjection().page(queryset, cursor, limit)
+'''
+
+from decimal import Decimal
+
+import orjson
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import Case, DecimalField, F, Sum, When
+from django.http import HttpResponse
+
+from ledger.accounts.models import EmailUser, Organisation
+from ledger.order.models import Line as OrderLine, Order
+from ledger.payments.invoice.models import Invoice, calculate_payment_status
+
+
+def _default(value):
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError('{} is not JSON serializable'.format(type(value).__name__))
+
+def dumps(data):
+    return orjson.dumps(data, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+def json_response(data, status=200):
+    return HttpResponse(dumps(data), content_type='application/json', status=status)
+
+def page_size(limit=None):
+    ''' The requested page size, within LEDGERGW_API_MAX_PAGE_SIZE.
+    '''
+    if not limit:
+        limit = getattr(settings, 'LEDGERGW_API_PAGE_SIZE', 500)
+    return max(1, min(int(limit), getattr(settings, 'LEDGERGW_API_MAX_PAGE_SIZE', 1000)))
+
+def attr(path):
+    ''' Getter for a dotted attribute path, None once a link in the path is None.
+    '''
+    names = path.split('.')
+    def get(obj):
+        for name in names:
+            if obj is None:
+                return None
+            obj = getattr(obj, name)
+        return obj
+    return get
+
+def date_format(path, fmt, empty=None):
+    get = attr(path)
+    def formatted(obj):
+        value = get(obj)
+        return value.strftime(fmt) if value else empty
+    return formatted
+
+def text(path):
+    get = attr(path)
+    return lambda obj: str(get(obj))
+
+
+class Projection(object):
+    model = None
+    # (key, source) pairs in payload order, a source is a dotted attribute
+    # path or a function of the object
+    fields = ()
+    select_related = ()
+    prefetch_related = ()
+    annotations = {}
+
+    def __init__(self):
+        self.getters = [(key, attr(source) if isinstance(source, str) else source) for key, source in self.fields]
+
+    def queryset(self, queryset=None):
+        if queryset is None:
+            queryset = self.model.objects.all()
+        if self.select_related:
+            queryset = queryset.select_related(*self.select_related)
+        if self.prefetch_related:
+            queryset = queryset.prefetch_related(*self.prefetch_related)
+        if self.annotations:
+            queryset = queryset.annotate(**self.annotations)
+        return queryset
+
+    def load(self, objs):
+        ''' Attach the related data that isn't a foreign key, for the whole batch at once.
+        '''
+        pass
+
+    def row(self, obj):
+        return dict((key, get(obj)) for key, get in self.getters)
+
+    def rows(self, queryset=None, limit=None):
+        queryset = self.queryset(queryset)
+        if limit is not None:
+            queryset = queryset[:limit]
+        objs = list(queryset)
+        self.load(objs)
+        return [self.row(obj) for obj in objs]
+
+    def first(self, queryset=None):
+        rows = self.rows(queryset, 1)
+        return rows[0] if rows else None
+
+    def page(self, queryset=None, cursor=None, limit=None):
+        ''' A page of rows after cursor and the cursor of the next page,
+            None on the last page. Raises ValueError for a bad cursor.
+        '''
+        limit = page_size(limit)
+        queryset = self.queryset(queryset).order_by('id')
+        if cursor:
+            queryset = queryset.filter(id__gt=int(cursor))
+        objs = list(queryset[:limit + 1])
+        next_cursor = str(objs[limit - 1].id) if len(objs) > limit else None
+        objs = objs[:limit]
+        self.load(objs)
+        return [self.row(obj) for obj in objs], next_cursor
+
+
+# Users
+# =============================================
+def address(path):
+    get = attr(path)
+    def address_fields(obj):
+        a = get(obj)
+        if a is None:
+            return {'line1': '', 'line2': '', 'line3': '', 'locality': '', 'state': '', 'country': '', 'postcode': ''}
+        return {
+            'line1': a.line1, 'line2': a.line2, 'line3': a.line3, 'locality': a.locality, 'state': a.state,
+            'country': a.country.code if a.country else '', 'postcode': a.postcode,
+        }
+    return address_fields
+
+def groups(user):
+    return [{'group_id': g.id, 'group_name': g.name} for g in user.groups.all()]
+
+def user_fields(dob_format):
+    return (
+        ('ledgerid', 'id'),
+        ('email', 'email'),
+        ('first_name', 'first_name'),
+        ('last_name', 'last_name'),
+        ('is_staff', 'is_staff'),
+        ('is_superuser', 'is_superuser'),
+        ('is_active', 'is_active'),
+        ('date_joined', date_format('date_joined', '%d/%m/%Y %H:%M')),
+        ('title', 'title'),
+        ('dob', date_format('dob', dob_format)),
+        ('phone_number', 'phone_number'),
+        ('position_title', 'position_title'),
+        ('mobile_number', 'mobile_number'),
+        ('fax_number', 'fax_number'),
+        ('organisation', 'organisation'),
+    )
+
+USER_NAME_FIELDS = (
+    ('character_flagged', 'character_flagged'),
+    ('character_comments', 'character_comments'),
+    ('extra_data', 'extra_data'),
+    ('fullname', lambda u: u.get_full_name()),
+    ('fullnamedob', lambda u: u.get_full_name_dob() if u.dob else None),
+)
+
+class UserSummaryProjection(Projection):
+    ''' user_info_search '''
+    model = EmailUser
+    fields = user_fields('%d/%m/%Y %H:%M') + USER_NAME_FIELDS
+
+class UserProjection(Projection):
+    ''' user_info '''
+    model = EmailUser
+    fields = user_fields('%d/%m/%Y %H:%M') + USER_NAME_FIELDS + (('groups', groups),)
+    prefetch_related = ('groups',)
+
+class UserDetailProjection(Projection):
+    ''' user_info_id '''
+    model = EmailUser
+    fields = user_fields('%d/%m/%Y') + (('identification', lambda u: u.identification2.name if u.identification2 else ''),) + USER_NAME_FIELDS + (
+        ('residential_address', address('residential_address')),
+        ('postal_address', address('postal_address')),
+        ('postal_same_as_residential', 'postal_same_as_residential'),
+        ('groups', groups),
+    )
+    select_related = ('residential_address', 'postal_address', 'identification2')
+    prefetch_related = ('groups',)
+
+
+# Orders and invoices
+# =============================================
+class OrderLineProjection(Projection):
+    ''' get_order_lines, paid is summed from the line allocations '''
+    model = OrderLine
+    fields = (
+        ('id', 'id'),
+        ('title', 'title'),
+        ('oracle_code', 'oracle_code'),
+        ('quantity', 'quantity'),
+        ('price_incl_tax', text('line_price_incl_tax')),
+        ('price_excl_tax', text('line_price_excl_tax')),
+        ('paid', lambda l: str(Decimal(0.0) + (l.paid_total or 0))),
+        ('unit_price_incl_tax', text('unit_price_incl_tax')),
+        ('unit_price_excl_tax', text('unit_price_excl_tax')),
+    )
+    annotations = {
+        'paid_total': Sum(Case(
+            When(allocations__kind='payment', then=F('allocations__amount')),
+            output_field=DecimalField(max_digits=12, decimal_places=2)
+        )),
+    }
+
+    def queryset(self, queryset=None):
+        return super(OrderLineProjection, self).queryset(queryset).order_by('id')
+
+def invoice_summary(invoice):
+    try:
+        return invoice.payment_summary
+    except ObjectDoesNotExist:
+        return invoice._payment_summary()
+
+def invoice_payment(invoice):
+    return invoice.summary.paid - invoice.summary.refunded
+
+class InvoiceProjection(Projection):
+    ''' get_invoice_properties, the totals come from the payment summary '''
+    model = Invoice
+    fields = (
+        ('id', 'id'),
+        ('text', 'text'),
+        ('amount', text('amount')),
+        ('order_number', 'order_number'),
+        ('reference', 'reference'),
+        ('system', 'system'),
+        ('token', 'token'),
+        ('voided', 'voided'),
+        ('previous_invoice', 'previous_invoice_id'),
+        ('settlement_date', date_format('settlement_date', '%d/%m/%Y', '')),
+        ('payment_method', 'payment_method'),
+        ('biller_code', 'biller_code'),
+        ('number', 'number'),
+        ('owner', lambda i: i.order_user_id),
+        ('refundable_amount', lambda i: str(invoice_payment(i))),
+        ('refundable', lambda i: invoice_payment(i) > 0),
+        ('num_items', lambda i: i.order_num_items),
+        ('payment_amount', lambda i: str(invoice_payment(i))),
+        ('total_payment_amount', lambda i: str(i.summary.paid)),
+        ('refund_amount', lambda i: str(i.summary.refunded)),
+        ('deduction_amount', lambda i: str(i.summary.deducted)),
+        ('transferable_amount', lambda i: str(i.summary.cash_paid)),
+        ('balance', lambda i: str(calculate_payment_status(i.amount, i.voided, invoice_payment(i))[0])),
+        ('payment_status', lambda i: calculate_payment_status(i.amount, i.voided, invoice_payment(i))[1]),
+        ('oracle_invoice_number', 'oracle_invoice_number'),
+    )
+    select_related = ('payment_summary',)
+
+    def load(self, invoices):
+        # Orders are matched on number, not a foreign key
+        orders = dict(
+            (number, (user_id, num_items)) for number, user_id, num_items in
+            Order.objects.filter(number__in=[i.order_number for i in invoices])
+            .annotate(num_items=Sum('lines__quantity')).values_list('number', 'user_id', 'num_items')
+        )
+        for invoice in invoices:
+            invoice.summary = invoice_summary(invoice)
+            user_id, num_items = orders.get(invoice.order_number, (None, None))
+            invoice.order_user_id = user_id
+            invoice.order_num_items = (num_items or 0) if invoice.order_number in orders else None
+
+
+# Organisations
+# =============================================
+class OrganisationProjection(Projection):
+    ''' get_all_organisation and get_search_organisation '''
+    model = Organisation
+    fields = (
+        ('organisation_id', 'id'),
+        ('organisation_name', 'name'),
+        ('organisation_abn', 'abn'),
+        ('organisation_email', 'email'),
+    )
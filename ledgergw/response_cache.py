@@ -0,0 +1,133 @@
+'''
+    Cached responses for the read-only gateway lookups.
+
+    Every lookup names the rows its response is built from. The ETag is a
+    hash of the endpoint, the rows and their versions (ledger.api.versions,
+    plus the transaction versions of an invoice), which only takes a couple
+    of cache reads. A request whose If-None-Match matches gets a 304 without
+    the response being built, otherwise the response is served from the
+    cache under its ETag or built and stored. Saving any of the rows
+    replaces its version, so a changed row gets a new ETag.
+'''
+
+import hashlib
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse, HttpResponseNotModified
+
+from ledger.api import versions
+from ledger.payments import trans_hash
+from ledgergw import projections
+
+_stats_lock = threading.Lock()
+_stats = {}
+
+
+def cache_timeout():
+    return getattr(settings, 'LEDGERGW_RESPONSE_CACHE_TIMEOUT', 3600)
+
+def make_etag(endpoint, rows, extra=()):
+    ''' Strong ETag of the response of endpoint built from rows, [(model_name, key), ...].
+    '''
+    parts = [endpoint] + ['{}:{}:{}'.format(m, k, v) for (m, k), v in zip(rows, versions.row_versions(rows))] + list(extra)
+    return '"{}"'.format(hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest())
+
+def etag_matches(request, etag):
+    header = request.META.get('HTTP_IF_NONE_MATCH')
+    if not header:
+        return False
+    if header.strip() == '*':
+        return True
+    return etag in [t.strip() for t in header.split(',')]
+
+def cached_json_response(request, endpoint, etag, build):
+    ''' Response for a lookup with the given ETag. build() returns the json
+        data, only status 200 responses are kept.
+    '''
+    if etag is None:
+        return projections.json_response(build())
+    if etag_matches(request, etag):
+        _record(endpoint, 'not_modified')
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
+    key = 'ledgergw_response:{}:{}'.format(endpoint, etag)
+    body = cache.get(key)
+    if body is None:
+        _record(endpoint, 'misses')
+        data = build()
+        body = projections.dumps(data)
+        if data.get('status') != 200:
+            return HttpResponse(body, content_type='application/json')
+        cache.set(key, body, cache_timeout())
+    else:
+        _record(endpoint, 'hits')
+    response = HttpResponse(body, content_type='application/json')
+    response['ETag'] = etag
+    return response
+
+
+# Rows behind each lookup
+# =============================================
+def user_etag(endpoint, userid):
+    return make_etag(endpoint, [('EmailUser', int(userid))])
+
+def invoice_keys(invoice_id):
+    ''' (reference, order_number) of an invoice, neither changes once created.
+    '''
+    from ledger.payments.invoice.models import Invoice
+    key = 'ledgergw_invoice_keys:{}'.format(invoice_id)
+    keys = cache.get(key)
+    if keys is None:
+        keys = Invoice.objects.filter(id=invoice_id).values_list('reference', 'order_number').first()
+        if keys is None:
+            return None
+        cache.set(key, keys, versions.CACHE_TIMEOUT)
+    return keys
+
+def invoice_etag(endpoint, invoice_id):
+    keys = invoice_keys(int(invoice_id))
+    if keys is None:
+        return None
+    reference, order_number = keys
+    transactions = [trans_hash.transaction_version(m, reference) for m in trans_hash.TRANSACTION_MODELS]
+    return make_etag(endpoint, [('Invoice', int(invoice_id)), ('Order', order_number)], transactions)
+
+def order_lines_etag(endpoint, data):
+    if 'order_id' in data:
+        return make_etag(endpoint, [('OrderId', int(data['order_id']))])
+    if 'number' in data:
+        return make_etag(endpoint, [('Order', data['number'])])
+    return None
+
+def oracle_interface_system_etag(endpoint, system_id):
+    return make_etag(endpoint, [('OracleInterfaceSystem', system_id)])
+
+def countries_etag(endpoint):
+    return make_etag(endpoint, [('Country', 'all')])
+
+
+# Statistics
+# =============================================
+def _record(endpoint, counter):
+    with _stats_lock:
+        row = _stats.setdefault(endpoint, {'not_modified': 0, 'hits': 0, 'misses': 0})
+        row[counter] += 1
+
+def cache_stats():
+    ''' Not modified, hit and miss counters of this process per endpoint.
+    '''
+    with _stats_lock:
+        stats = {}
+        for endpoint, row in _stats.items():
+            row = dict(row)
+            lookups = row['not_modified'] + row['hits'] + row['misses']
+            row['hit_rate'] = float(row['not_modified'] + row['hits']) / lookups if lookups else 0.0
+            stats[endpoint] = row
+        return stats
+
+def reset_cache_stats():
+    with _stats_lock:
+        _stats.clear()
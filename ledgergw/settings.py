@@ -64,10 +64,22 @@ TEMPLATES[0]['OPTIONS']['context_processors'].append('ledgergw.context_processor
     'set_placeholder': False,
 }'''
 CACHES = {
+    # Per process LRU in front of the shared cache, see ledgergw/cache.py
     'default': {
-        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
-        'LOCATION': os.path.join(BASE_DIR, 'ledgergw', 'cache'),
-    }
+        'BACKEND': 'ledgergw.cache.TieredCache',
+        'OPTIONS': {
+            'SHARED': 'shared',
+            'MAX_ENTRIES': int(env('CACHE_L1_MAX_ENTRIES', 2000)),
+            'L1_TIMEOUT': int(env('CACHE_L1_TIMEOUT', 300)),
+            'COHERENCY_INTERVAL': float(env('CACHE_COHERENCY_INTERVAL', 1)),
+        },
+    },
+    # Shared by all the nodes, eg django.core.cache.backends.memcached.PyLibMCCache
+    # or django.core.cache.backends.db.DatabaseCache
+    'shared': {
+        'BACKEND': env('CACHE_SHARED_BACKEND', 'django.core.cache.backends.filebased.FileBasedCache'),
+        'LOCATION': env('CACHE_SHARED_LOCATION', os.path.join(BASE_DIR, 'ledgergw', 'cache')),
+    },
 }
 STATICFILES_DIRS.append(os.path.join(os.path.join(BASE_DIR, 'ledgergw', 'static')))
 
@@ -77,9 +89,33 @@ OSCAR_BASKET_COOKIE_OPEN = 'ledgergw_basket'
 
 CRON_CLASSES = [
         'ledgergw.cron.OracleReceipts',
-        'ledgergw.cron.JobQueue'
+        'ledgergw.cron.JobQueue',
+        'ledgergw.cron.InvoicePDFCacheEviction'
 ]
 
+# Job queue worker (manage.py job_queue_worker)
+JOB_QUEUE_PROCESSES = int(env('JOB_QUEUE_PROCESSES', 2))
+JOB_QUEUE_LEASE_SECONDS = int(env('JOB_QUEUE_LEASE_SECONDS', 300))
+JOB_QUEUE_HEARTBEAT_SECONDS = int(env('JOB_QUEUE_HEARTBEAT_SECONDS', 30))
+JOB_QUEUE_RETRY_BACKOFF_SECONDS = int(env('JOB_QUEUE_RETRY_BACKOFF_SECONDS', 60))
+# Oracle systems processed at once by the oracle receipts and bpoint audits
+ORACLE_SYSTEM_PROCESSES = int(env('ORACLE_SYSTEM_PROCESSES', 4))
+# BPAY files ingested at once by collectbpay
+BPAY_PARSER_WORKERS = int(env('BPAY_PARSER_WORKERS', 4))
+# Payment notification resends (manage.py check_unsent_payment_notification)
+PAYMENT_NOTIFICATION_WORKERS = int(env('PAYMENT_NOTIFICATION_WORKERS', 20))
+PAYMENT_NOTIFICATION_PER_HOST = int(env('PAYMENT_NOTIFICATION_PER_HOST', 4))
+PAYMENT_NOTIFICATION_CONNECT_TIMEOUT = int(env('PAYMENT_NOTIFICATION_CONNECT_TIMEOUT', 5))
+PAYMENT_NOTIFICATION_READ_TIMEOUT = int(env('PAYMENT_NOTIFICATION_READ_TIMEOUT', 20))
+PAYMENT_NOTIFICATION_BACKOFF_SECONDS = int(env('PAYMENT_NOTIFICATION_BACKOFF_SECONDS', 60))
+# Rows per page of the paged remote api lists (get_all_organisation)
+LEDGERGW_API_PAGE_SIZE = int(env('LEDGERGW_API_PAGE_SIZE', 500))
+LEDGERGW_API_MAX_PAGE_SIZE = int(env('LEDGERGW_API_MAX_PAGE_SIZE', 1000))
+# Seconds a gateway lookup response is kept under its ETag
+LEDGERGW_RESPONSE_CACHE_TIMEOUT = int(env('LEDGERGW_RESPONSE_CACHE_TIMEOUT', 3600))
+# Ids per request of the remote/batch lookups
+LEDGERGW_API_MAX_BATCH_SIZE = int(env('LEDGERGW_API_MAX_BATCH_SIZE', 200))
+
 # Additional logging
 LOGGING['handlers']['booking_checkout'] = {
             'level': 'INFO',
@@ -0,0 +1,384 @@
+import time
+from datetime import timedelta
+from decimal import Decimal as D
+from unittest import mock
+
+import requests
+from django.contrib.auth.models import Group
+from django.db import transaction
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from ledger.accounts.models import EmailUser, Organisation
+from ledger.address.models import Country
+from ledger.api import utils as ledgerapi_utils
+from ledger.api.models import API
+from ledger.basket.models import Basket
+from ledger.order.models import Order, Line as OrderLine
+from ledger.payments import trans_hash
+from ledger.payments.bpoint.models import BpointTransaction
+from ledger.payments.cash.models import CashTransaction
+from ledger.payments.invoice.models import Invoice
+from ledger.payments.models import LinkedInvoice, LinkedInvoiceGroupIncrementer, OracleInterfaceSystem
+from ledgergw import api, batch, jobs, notifications, projections, response_cache
+from ledgergw.models import JobQueue
+from ledgergw import cache as cache_module
+from ledgergw.cache import TieredCache
+
+
+class JobQueueTestCase(TestCase):
+
+    def test_claim_and_lease(self):
+        """Testing which jobs a worker claims and the lease it takes on them"""
+        now = timezone.now()
+        pending = JobQueue.objects.create(job_cmd='pending', status=0)
+        held_back = JobQueue.objects.create(job_cmd='held back', status=0, run_after_dt=now + timedelta(minutes=5))
+        expired = JobQueue.objects.create(job_cmd='expired', status=1, attempts=1, worker='gone:1', lease_expiry_dt=now - timedelta(minutes=1))
+        leased = JobQueue.objects.create(job_cmd='leased', status=1, attempts=1, worker='other:1', lease_expiry_dt=now + timedelta(minutes=5))
+        legacy = JobQueue.objects.create(job_cmd='legacy', status=1)
+        exhausted = JobQueue.objects.create(job_cmd='exhausted', status=1, attempts=3, worker='gone:1', lease_expiry_dt=now - timedelta(minutes=1))
+
+        self.assertEqual(jobs.claim_jobs('test:1', 10), [pending.id, expired.id])
+        pending.refresh_from_db()
+        self.assertEqual((pending.status, pending.attempts, pending.worker), (1, 1, 'test:1'))
+        self.assertGreater(pending.lease_expiry_dt, now)
+        self.assertFalse(jobs.lease_lost(pending.id, 'test:1'))
+        self.assertTrue(jobs.lease_lost(pending.id, 'other:1'))
+        self.assertEqual(JobQueue.objects.get(id=expired.id).attempts, 2)
+        self.assertEqual(JobQueue.objects.get(id=exhausted.id).status, 3)
+        for job in (held_back, leased, legacy):
+            self.assertEqual(JobQueue.objects.get(id=job.id).status, job.status)
+
+    @override_settings(JOB_QUEUE_RETRY_BACKOFF_SECONDS=60)
+    def test_retry_and_failure(self):
+        job = JobQueue.objects.create(job_cmd='broken', status=0, max_attempts=2, parameters_json='[]')
+        with mock.patch('ledgergw.jobs.management.call_command', side_effect=Exception('boom')):
+            self.assertEqual(jobs.claim_jobs('test:1', 1), [job.id])
+            self.assertIn('boom', jobs.run_job(job.id, 'test:1'))
+            job.refresh_from_db()
+            self.assertEqual((job.status, job.attempts), (0, 1))
+            self.assertGreater(job.run_after_dt, timezone.now() + timedelta(seconds=50))
+            self.assertEqual(jobs.claim_jobs('test:1', 1), [])
+
+            JobQueue.objects.filter(id=job.id).update(run_after_dt=timezone.now())
+            self.assertEqual(jobs.claim_jobs('test:1', 1), [job.id])
+            jobs.run_job(job.id, 'test:1')
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (3, 2))
+        self.assertIn('boom', job.error)
+
+    def test_completed(self):
+        job = JobQueue.objects.create(job_cmd='works', status=0, parameters_json='["0999"]')
+        jobs.claim_jobs('test:1', 1)
+        with mock.patch('ledgergw.jobs.management.call_command') as call_command:
+            self.assertIsNone(jobs.run_job(job.id, 'test:1'))
+        call_command.assert_called_once_with('works', '0999')
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.lease_expiry_dt), (2, None))
+        self.assertIsNotNone(job.runtime)
+        # Run by the cron fallback, the process peak isn't the job's
+        self.assertIsNone(job.peak_memory)
+
+
+class APIKeyRegistryTestCase(TestCase):
+
+    def setUp(self):
+        self.api = API.objects.create(system_name='Test', system_id='0999', api_key='testkey', allowed_ips='10.1.1.0/24\n', active=1)
+        self.request = RequestFactory().get('/', REMOTE_ADDR='10.1.1.5')
+
+    def test_authorize(self):
+        api_key_obj = ledgerapi_utils.get_api('testkey')
+        self.assertEqual((api_key_obj.id, api_key_obj.system_id), (self.api.id, '0999'))
+        self.assertIsNone(ledgerapi_utils.get_api('otherkey'))
+        with self.assertNumQueries(0):
+            self.assertTrue(ledgerapi_utils.authorize(self.request, api_key_obj))
+            self.assertTrue(ledgerapi_utils.authorize(self.request, 'testkey'))
+        self.assertFalse(ledgerapi_utils.authorize(RequestFactory().get('/', REMOTE_ADDR='10.1.2.5'), api_key_obj))
+        self.assertFalse(ledgerapi_utils.authorize(self.request, 'otherkey'))
+
+    def test_save_reloads_keys(self):
+        self.assertIsNotNone(ledgerapi_utils.get_api('testkey'))
+        self.api.active = 0
+        self.api.save()
+        self.assertIsNone(ledgerapi_utils.get_api('testkey'))
+        self.api.active = 1
+        self.api.allowed_ips = '10.1.2.0/24'
+        self.api.save()
+        self.assertFalse(ledgerapi_utils.authorize(self.request, 'testkey'))
+
+    def test_get_while_invalidated(self):
+        registry = ledgerapi_utils.api_registry
+        self.assertIsNotNone(registry.get('testkey'))
+        # Another thread dropping the map after the staleness check must not
+        # break a lookup that already passed it
+        now = time.time
+        def drop_keys():
+            registry.keys = None
+            return now()
+        with mock.patch.object(ledgerapi_utils.time, 'time', side_effect=drop_keys):
+            self.assertIsNotNone(registry.get('testkey'))
+
+
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'default'},
+    'shared': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'tiered-shared'},
+})
+class TieredCacheTestCase(TestCase):
+
+    def node(self):
+        # Each instance stands in for the cache of one app node
+        return TieredCache('', {'OPTIONS': {'SHARED': 'shared', 'MAX_ENTRIES': 3, 'COHERENCY_INTERVAL': 0}})
+
+    def test_l1_hits(self):
+        cache = self.node()
+        cache.set('Invoice:1', 'a')
+        self.assertEqual(cache.get('Invoice:1'), 'a')
+        self.assertEqual(cache.get('Invoice:2', 'missing'), 'missing')
+        stats = cache.stats()['Invoice']
+        self.assertEqual((stats['l1_hits'], stats['l2_hits'], stats['misses']), (1, 0, 1))
+
+    def test_writes_invalidate_other_nodes(self):
+        a, b = self.node(), self.node()
+        a.set('Invoice:1', 'one')
+        self.assertEqual(b.get('Invoice:1'), 'one')
+        a.set('Invoice:1', 'two')
+        self.assertEqual(b.get('Invoice:1'), 'two')
+        a.delete('Invoice:1')
+        self.assertIsNone(b.get('Invoice:1'))
+        a.set_many({'Invoice:2': 2, 'Invoice:3': 3})
+        self.assertEqual(b.get_many(['Invoice:2', 'Invoice:3']), {'Invoice:2': 2, 'Invoice:3': 3})
+        a.delete_many(['Invoice:2'])
+        self.assertEqual(b.get_many(['Invoice:2', 'Invoice:3']), {'Invoice:3': 3})
+
+    def test_l1_copy_expires_with_l2(self):
+        a, b = self.node(), self.node()
+        a.set('Invoice:1', 'one', timeout=60)
+        a.set_many({'Invoice:2': 'two'}, timeout=60)
+        self.assertEqual(b.get('Invoice:1'), 'one')
+        self.assertEqual(b.get_many(['Invoice:2']), {'Invoice:2': 'two'})
+        # L1_TIMEOUT is 300, the copies must still go when the shared entries do
+        later = time.time() + 61
+        with mock.patch.object(cache_module.time, 'time', return_value=later):
+            self.assertIsNone(b.get('Invoice:1'))
+            self.assertEqual(b.get_many(['Invoice:2']), {})
+
+    def test_incr(self):
+        a, b = self.node(), self.node()
+        a.set('Invoice:count', 1)
+        self.assertEqual(b.get('Invoice:count'), 1)
+        self.assertEqual(a.incr('Invoice:count', 2), 3)
+        self.assertEqual(b.get('Invoice:count'), 3)
+
+    def test_lru_bounded(self):
+        cache = self.node()
+        for n in range(5):
+            cache.set('Invoice:{}'.format(n), n)
+        self.assertEqual(cache.stats()['l1_entries'], 3)
+        self.assertEqual(cache.get('Invoice:0'), 0)
+
+
+class PaymentNotificationTestCase(TestCase):
+
+    def send(self, url):
+        if 'down.test' in url:
+            raise requests.exceptions.ConnectTimeout(url)
+        return 'ok.test' in url
+
+    @override_settings(PAYMENT_NOTIFICATION_PER_HOST=1)
+    def test_dispatch(self):
+        """Testing that a host timing out only holds back its own baskets"""
+        urls = ['https://ok.test/preload?invoice=1', 'https://ok.test/preload?invoice=2', 'https://bad.test/preload',
+                'https://down.test/preload?invoice=1', 'https://down.test/preload?invoice=2', '']
+        baskets = [Basket.objects.create(system='0001', status='Submitted', notification_url=url) for url in urls]
+        with mock.patch.object(notifications, 'send_notification', side_effect=self.send):
+            totals = notifications.dispatch_notifications(workers=4)
+        self.assertEqual(totals, {'sent': 2, 'failed': 3, 'deferred': 1})
+
+        baskets = [Basket.objects.get(id=b.id) for b in baskets]
+        self.assertEqual([b.notification_completed for b in baskets], [True, True, False, False, False, False])
+        self.assertEqual([b.notification_count for b in baskets], [0, 0, 1, 1, 0, 1])
+        # Nothing is due again until the backoff has passed
+        self.assertTrue(all(b.notification_next > timezone.now() for b in baskets[2:]))
+        self.assertEqual(notifications.claim_baskets(10), [])
+
+
+class ProjectionQueryCountTestCase(TestCase):
+
+    def test_users(self):
+        """Testing that the user payloads take the same queries for one user or many"""
+        group = Group.objects.create(name='Projection')
+        for n in range(3):
+            EmailUser.objects.create(email='projection{}@test.net'.format(n), first_name='Pro', last_name=str(n)).groups.add(group)
+        users = EmailUser.objects.filter(email__startswith='projection')
+        with self.assertNumQueries(1):
+            self.assertEqual(len(projections.UserSummaryProjection().rows(users)), 3)
+        with self.assertNumQueries(2):
+            rows = projections.UserProjection().rows(users)
+        self.assertEqual(rows[0]['groups'], [{'group_id': group.id, 'group_name': 'Projection'}])
+        with self.assertNumQueries(2):
+            rows = projections.UserDetailProjection().rows(users)
+        self.assertEqual(rows[0]['residential_address']['line1'], '')
+
+    def test_invoices_and_order_lines(self):
+        for n in range(3):
+            order = Order.objects.create(number='PROJ{}'.format(n), total_incl_tax=D('20.00'), total_excl_tax=D('20.00'), date_placed=timezone.now())
+            invoice = Invoice.objects.create(reference='0995000000{}'.format(n), order_number=order.number, amount=D('20.00'), system='0995')
+            OrderLine.objects.create(
+                order=order, title='Line', oracle_code='NNP GST', quantity=2,
+                line_price_incl_tax=D('20.00'), line_price_excl_tax=D('20.00'),
+                line_price_before_discounts_incl_tax=D('20.00'), line_price_before_discounts_excl_tax=D('20.00'),
+                payment_details={'cash': {'1': '20.00'}}, refund_details={}, deduction_details={},
+            )
+            CashTransaction.objects.create(invoice=invoice, amount=D('5.00'), type='payment', source='cash')
+        with self.assertNumQueries(2):
+            rows = projections.InvoiceProjection().rows(Invoice.objects.filter(system='0995'))
+        self.assertEqual([(r['payment_status'], r['balance'], r['num_items']) for r in rows], [('partially_paid', '15.00', 2)] * 3)
+        with self.assertNumQueries(1):
+            rows = projections.OrderLineProjection().rows(OrderLine.objects.filter(order__number__startswith='PROJ'))
+        self.assertEqual([r['paid'] for r in rows], ['20.00'] * 3)
+
+    @override_settings(LEDGERGW_API_PAGE_SIZE=2)
+    def test_organisation_pages(self):
+        for n in range(3):
+            Organisation.objects.create(name='Org {}'.format(n), abn='1000000000{}'.format(n))
+        with self.assertNumQueries(1):
+            rows, cursor = projections.OrganisationProjection().page()
+        self.assertEqual([r['organisation_name'] for r in rows], ['Org 0', 'Org 1'])
+        rows, cursor = projections.OrganisationProjection().page(cursor=cursor)
+        self.assertEqual(([r['organisation_name'] for r in rows], cursor), (['Org 2'], None))
+
+    @override_settings(LEDGERGW_API_PAGE_SIZE=2)
+    def test_organisations_paged_on_request(self):
+        for n in range(3):
+            Organisation.objects.create(name='Org {}'.format(n), abn='1000000000{}'.format(n))
+        # Clients that don't page get every organisation
+        rows, cursor = api.organisation_rows(Organisation.objects.all(), {})
+        self.assertEqual((len(rows), cursor), (3, api.NOT_PAGED))
+        rows, cursor = api.organisation_rows(Organisation.objects.all(), {'limit': 2})
+        self.assertEqual(([r['organisation_name'] for r in rows], cursor), (['Org 0', 'Org 1'], str(rows[1]['organisation_id'])))
+        rows, cursor = api.organisation_rows(Organisation.objects.all(), {'cursor': cursor})
+        self.assertEqual(([r['organisation_name'] for r in rows], cursor), (['Org 2'], None))
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'response-cache'}})
+class ResponseCacheTestCase(TestCase):
+
+    def get_countries(self, etag=None):
+        request = RequestFactory().get('/ledgergw/public/api/get-countries', HTTP_IF_NONE_MATCH=etag)
+        return api.get_countries(request)
+
+    def test_conditional_get(self):
+        """Testing that a matching If-None-Match gets a 304 until the rows change"""
+        response_cache.reset_cache_stats()
+        country = Country.objects.create(iso_3166_1_a2='ZZ', iso_3166_1_a3='ZZZ', iso_3166_1_numeric='999', name='Zedland', printable_name='Zedland')
+        first = self.get_countries()
+        etag = first['ETag']
+        self.assertEqual(first.status_code, 200)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.get_countries(etag).status_code, 304)
+            self.assertEqual(self.get_countries().content, first.content)
+
+        country.printable_name = 'Zedland Islands'
+        country.save()
+        changed = self.get_countries(etag)
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed['ETag'], etag)
+        stats = response_cache.cache_stats()['get_countries']
+        self.assertEqual((stats['not_modified'], stats['hits'], stats['misses']), (1, 1, 2))
+
+    def test_invoice_etag_follows_payments(self):
+        invoice = Invoice.objects.create(reference='09940000001', order_number='ETAG1', amount=D('20.00'), system='0994')
+        etag = response_cache.invoice_etag('get_invoice_properties', invoice.id)
+        self.assertEqual(response_cache.invoice_etag('get_invoice_properties', invoice.id), etag)
+        CashTransaction.objects.create(invoice=invoice, amount=D('5.00'), type='payment', source='cash')
+        self.assertNotEqual(response_cache.invoice_etag('get_invoice_properties', invoice.id), etag)
+        self.assertIsNone(response_cache.invoice_etag('get_invoice_properties', 0))
+
+
+class VersionsOnCommitTestCase(TransactionTestCase):
+    """A response built from the rows before the commit must not be cached under the version that follows it"""
+
+    def test_row_version_replaced_on_commit(self):
+        country = Country.objects.create(iso_3166_1_a2='ZY', iso_3166_1_a3='ZZY', iso_3166_1_numeric='998', name='Zyland', printable_name='Zyland')
+        before = response_cache.countries_etag('get_countries')
+        with transaction.atomic():
+            country.printable_name = 'Zyland Islands'
+            country.save()
+            # Another request still reads the old rows here
+            saved = response_cache.countries_etag('get_countries')
+        self.assertNotEqual(saved, before)
+        self.assertNotEqual(response_cache.countries_etag('get_countries'), saved)
+
+    def test_transaction_version_replaced_on_commit(self):
+        invoice = Invoice.objects.create(reference='09930000001', order_number='COMMIT1', amount=D('20.00'), system='0993')
+        before = trans_hash.cash_transaction_hash(invoice.reference)
+        with transaction.atomic():
+            CashTransaction.objects.create(invoice=invoice, amount=D('5.00'), type='payment', source='cash')
+            saved = trans_hash.cash_transaction_hash(invoice.reference)
+        self.assertNotEqual(saved, before)
+        self.assertNotEqual(trans_hash.cash_transaction_hash(invoice.reference), saved)
+
+
+class BatchLookupTestCase(TestCase):
+
+    def test_users_and_orders(self):
+        """Testing that a batch lookup gives a result per id with a fixed number of queries"""
+        users = [EmailUser.objects.create(email='batch{}@test.net'.format(n)) for n in range(3)]
+        Order.objects.create(number='BATCH1', user=users[0], total_incl_tax=D('1.00'), total_excl_tax=D('1.00'), date_placed=timezone.now())
+        with self.assertNumQueries(2):
+            results = batch.users({'user_ids': [u.id for u in users] + [0, 'x']})
+        self.assertEqual([r['status'] for r in results], [200, 200, 200, 404, 400])
+        self.assertEqual(results[1]['data']['user']['email'], 'batch1@test.net')
+        with self.assertNumQueries(1):
+            results = batch.orders({'numbers': ['BATCH1', 'BATCH2']})
+        self.assertEqual([(r['status'], r.get('data')) for r in results], [(200, {'order': {'id': results[0]['data']['order']['id'], 'number': 'BATCH1', 'user_id': users[0].id}}), (404, None)])
+
+    @override_settings(LEDGERGW_API_MAX_BATCH_SIZE=2)
+    def test_max_batch_size(self):
+        request = RequestFactory().post('/ledgergw/remote/batch/userid/key/', {'data': '{"user_ids": [1, 2, 3]}'})
+        with mock.patch('ledgergw.batch.ledgerapi_utils.get_api', return_value=True), mock.patch('ledgergw.batch.ledgerapi_utils.authorize', return_value=True):
+            response = api.user_info_id_batch(request, 'key')
+        self.assertIn(b'"status":400', response.content)
+
+    def test_invoices_match_single_lookup(self):
+        """Testing that each batch invoice result is what get_invoice_properties gives for it"""
+        invoices = []
+        for n in range(3):
+            order = Order.objects.create(number='BINV{}'.format(n), total_incl_tax=D('20.00'), total_excl_tax=D('20.00'), date_placed=timezone.now())
+            invoice = Invoice.objects.create(reference='0993000000{}'.format(n), order_number=order.number, amount=D('20.00'), system='0993')
+            CashTransaction.objects.create(invoice=invoice, amount=D('5.00') * (n + 1), type='payment', source='cash')
+            invoices.append(invoice)
+        ids = [i.id for i in invoices] + [0]
+        results = batch.invoices({'invoice_ids': ids})
+        for invoice_id, result in zip(ids, results):
+            single = api.invoice_properties_data(invoice_id)
+            self.assertEqual(result['status'], single['status'])
+            self.assertEqual(result.get('data', {'invoice': None}), single['data'])
+
+    def test_linked_invoice_data_match_single_lookup(self):
+        """Testing that each batch linked invoice result is what the single booking lookup gives for it"""
+        system = OracleInterfaceSystem.objects.create(system_id='0994', system_name='Test', source='test', method='test')
+        groups = [LinkedInvoiceGroupIncrementer.objects.create(system_identifier=system) for n in range(2)]
+        for n, group in enumerate(groups):
+            reference = '0994000000{}'.format(n)
+            BpointTransaction.objects.create(
+                action='payment', amount=D('30.00'), amount_original=D('30.00'), crn1=reference,
+                response_code='0', response_txt='Approved', receipt_number='L{}'.format(n), processed=timezone.now(),
+                type='internet', txn_number='LTXN{}'.format(n)
+            )
+            BpointTransaction.objects.create(
+                action='refund', amount=D('10.00'), amount_original=D('10.00'), crn1=reference, original_txn='LTXN{}'.format(n),
+                response_code='0', response_txt='Approved', receipt_number='LR{}'.format(n), processed=timezone.now(),
+                type='internet', txn_number='LREF{}'.format(n)
+            )
+            LinkedInvoice.objects.create(invoice_reference=reference, system_identifier=system, booking_reference='LB{}'.format(n), invoice_group_id=group)
+        # Linked into the second group later, the first link decides the group
+        LinkedInvoice.objects.create(invoice_reference='09940000001', system_identifier=system, booking_reference='LB0', invoice_group_id=groups[1])
+
+        bookings = ['LB0', 'LB1', 'LB9']
+        results = batch.linked_invoice_data({'system_id': '0994', 'booking_references': bookings})
+        for booking, result in zip(bookings, results):
+            single = api.get_linked_invoice_data_by_booking_reference(booking, '0994')
+            self.assertEqual(result.get('data', {}), single)
+        self.assertEqual([r['status'] for r in results], [200, 200, 404])
+        self.assertEqual(results[0]['data']['txn_pool'], {'LTXN0': D('20.00')})
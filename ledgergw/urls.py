@@ -27,6 +27,10 @@ urlpatterns = [
     url(r'^ledgergw/remote/get-basket-total/(?P<apikey>.+)/', api.get_basket_total),
     url(r'^ledgergw/remote/get_order_info/(?P<apikey>.+)/', api.get_order_info),
     url(r'^ledgergw/remote/get_order_lines/(?P<apikey>.+)/', api.get_order_lines),
+    url(r'^ledgergw/remote/batch/userid/(?P<apikey>.+)/', api.user_info_id_batch),
+    url(r'^ledgergw/remote/batch/get-invoice/(?P<apikey>.+)/', api.get_invoice_properties_batch),
+    url(r'^ledgergw/remote/batch/get_order_info/(?P<apikey>.+)/', api.get_order_info_batch),
+    url(r'^ledgergw/remote/batch/linked-invoice-data/(?P<apikey>.+)/', api.get_linked_invoice_data_batch),
     url(r'^ledgergw/remote/delete-card-token/(?P<apikey>.+)/', api.delete_card_token),
     url(r'^ledgergw/remote/get-card-tokens/(?P<apikey>.+)/', api.get_card_tokens_for_user),
     url(r'^ledgergw/remote/check-user-primary-card/(?P<apikey>.+)/', api.get_primary_card_token_for_user),
@@ -57,6 +61,7 @@ urlpatterns = [
     url(r'^api/oracle_job$', api.OracleJob.as_view(), name='get-oracle'),
     url(r'^api/queue-report-job$', api.QueuePayemntAuditReportJob, name='queue-report-job'),
     url(r'^ledgergw/ip-check/', api.ip_check),
+    url(r'^ledgergw/response-cache-stats/', api.response_cache_stats),
     url(r'^reports/$', views.ReportsView.as_view(), name='reports'),   
     url(r'^logout/$', logout, name='logout'),
 ] + ledger_patterns 
@@ -1,20 +1,27 @@
 from ledger.payments.utils import oracle_parser_on_invoice,update_payments
 from ledger.payments import models as ledger_payment_models #OracleInterfaceSystem
+from ledger.payments import parallel
 import re
 #from ledgergw import utils as ledgergw_utils
 
 def oracle_integration(date,override, system, system_name):
     oracle_codes = oracle_parser_on_invoice(date,system,system_name,override=override)
 
-def generate_oracle_receipts(date, override, system):
+def oracle_integration_for_system(system_id, date, override):
+    ois = ledger_payment_models.OracleInterfaceSystem.objects.get(system_id=system_id)
+    print (system_id)
+    oracle_integration(date, override, system_id, ois.system_name)
 
-    #today = datetime.today()
-    #yesterday = today - timedelta(days=1)
-    #print (yesterday.date().strftime('%Y-%m-%d'))
-    ois = ledger_payment_models.OracleInterfaceSystem.objects.filter(integration_type='bpoint_api', enabled=True)
-    for s in ois:
-        print (s.system_id)
-        oracle_integration(date, False, s.system_id,s.system_name)
+def generate_oracle_receipts(date, override, system):
+    ''' Run the oracle parser for every bpoint system, ORACLE_SYSTEM_PROCESSES at a time.
+    '''
+    system_ids = parallel.bpoint_system_ids()
+    # Every system adds to the same parser for the date, create it before they race for it
+    ledger_payment_models.OracleParser.objects.get_or_create(date_parsed=date)
+    results = parallel.run_for_systems(oracle_integration_for_system, system_ids, args=(date, False))
+    failed = parallel.report_system_results('Oracle receipts for {}'.format(date), results)
+    if failed:
+        raise Exception('Oracle receipts failed for {}'.format(', '.join(r['system_id'] for r in failed)))
     
 def remove_html_tags(text):
     HTML_TAGS_WRAPPED = re.compile(r'<[^>]+>.+</[^>]+>')
@@ -8,7 +8,6 @@ from ledger.payments.pdf import create_invoice_pdf_bytes
 from ledger.payments.mixins import InvoiceOwnerMixin
 from django.shortcuts import get_object_or_404
 from ledger.payments.invoice import models as invoice_models
-from ledger.api import models as ledgerapi_models
 from ledger.api import utils as ledgerapi_utils
 
 
@@ -27,8 +26,9 @@ class InvoicePDFView(View):
 
     def get(self, request, *args, **kwargs):
         apikey = self.kwargs['api_key']
-        if ledgerapi_models.API.objects.filter(api_key=apikey,active=1).count():
-                if ledgerapi_utils.api_allow(ledgerapi_utils.get_client_ip(request),apikey) is True:
+        api_key_obj = ledgerapi_utils.get_api(apikey)
+        if api_key_obj:
+                if ledgerapi_utils.authorize(request, api_key_obj) is True:
                       invoice = get_object_or_404(invoice_models.Invoice, reference=self.kwargs['reference'])
                       response = HttpResponse(content_type='application/pdf')
                       response.write(create_invoice_pdf_bytes('invoice.pdf',invoice))